@@ -1,8 +1,13 @@
+import os
+import json
 import random
+import shutil
 import logging
 import numpy as np
 import math
-from baseline.utils import exporter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from baseline.utils import exporter, Offsets, pads
 
 __all__ = []
 export = exporter(__all__)
@@ -27,10 +32,15 @@ class DataFeed:
     def __getitem__(self, i):
         return self._batch(i)
 
+    def _epoch_steps(self):
+        """Get the order to visit the steps in for one epoch
+
+        :return: An array of step indices
+        """
+        return np.random.permutation(np.arange(self.steps)) if self.shuffle else np.arange(self.steps)
+
     def __iter__(self):
-        shuffle = np.random.permutation(np.arange(self.steps)) if self.shuffle else np.arange(self.steps)
-        for i in range(self.steps):
-            si = shuffle[i]
+        for si in self._epoch_steps():
             yield self._batch(si)
 
     def __len__(self):
@@ -64,6 +74,11 @@ class ExampleDataFeed(DataFeed):
             * *truncate* -- bool, If true the datastream will be cut short when
                 a full batch cannot be made, otherwise the final batch is smaller
                 than normal batches.
+            * *max_tokens* -- If given, group the examples into length buckets and make batches that hold
+                at most this many (padded) tokens instead of `batchsz` examples.  Each batch is trimmed to the
+                max length of its bucket, and the batches are reshuffled every epoch if `shuffle` is set
+            * *num_buckets* -- The number of length buckets to use with `max_tokens`, defaults to 8
+            * *bucket_key* -- The length key to bucket on, defaults to the sort key of the examples
         """
         super().__init__()
 
@@ -71,11 +86,28 @@ class ExampleDataFeed(DataFeed):
         self.batchsz = batchsz
         self.shuffle = bool(kwargs.get('shuffle', False))
         self.truncate = bool(kwargs.get('truncate', False))
-        if self.truncate:
+        self.trim = bool(kwargs.get('trim', False))
+        self.max_tokens = kwargs.get('max_tokens')
+        if self.max_tokens:
+            self.num_buckets = int(kwargs.get('num_buckets', 8))
+            self.lengths = self.examples.lengths(kwargs.get('bucket_key'))
+            self.bucketed = self._bucket_batches()
+            self.steps = len(self.bucketed)
+        elif self.truncate:
             self.steps = int(math.floor(len(self.examples) / float(batchsz)))
         else:
             self.steps = (len(self.examples) + batchsz - 1) // batchsz
-        self.trim = bool(kwargs.get('trim', False))
+
+    def _bucket_batches(self):
+        return bucket_batches(self.lengths, self.max_tokens, self.num_buckets, shuffle=self.shuffle, truncate=self.truncate)
+
+    def _epoch_steps(self):
+        if not self.max_tokens:
+            return super()._epoch_steps()
+        # The batches are already in a random order, but new ones are drawn from the buckets each epoch
+        if self.shuffle:
+            self.bucketed = self._bucket_batches()
+        return np.arange(self.steps)
 
     def _batch(self, i):
         """
@@ -83,10 +115,268 @@ class ExampleDataFeed(DataFeed):
         :param i: (``int``) step index
         :return: A batch tensor x, batch tensor y
         """
+        if self.max_tokens:
+            indices, max_len = self.bucketed[i]
+            return self.examples.bucket_batch(indices, max_len)
         batch = self.examples.batch(i, self.batchsz, trim=self.trim)
         return batch
 
 
+@export
+class PrefetchDataFeed(DataFeed):
+    """Wrap a `DataFeed` so that the upcoming batches are built on background threads
+
+    While the trainer works on one batch, the next `prefetch` batches are being built by a pool of `num_workers`
+    threads.  The batches come out in the same order that the wrapped feed would give them for an epoch.  A
+    `transform` can be given to do more work on the worker threads, like converting the batch to tensors
+    """
+    def __init__(self, feed, prefetch=2, num_workers=1, transform=None):
+        """Constructor
+
+        :param feed: The `DataFeed` to wrap
+        :param prefetch: The number of batches to build ahead of the current one
+        :param num_workers: The number of threads building batches
+        :param transform: An optional function to apply to each batch on the worker thread
+        """
+        super().__init__()
+        self.feed = feed
+        self.steps = len(feed)
+        self.shuffle = feed.shuffle
+        self.prefetch = max(int(prefetch), 1)
+        self.num_workers = max(int(num_workers), 1)
+        self.transform = transform
+
+    def _batch(self, i):
+        batch = self.feed._batch(i)
+        return self.transform(batch) if self.transform is not None else batch
+
+    def __iter__(self):
+        steps = self.feed._epoch_steps()
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            try:
+                for si in steps:
+                    pending.append(executor.submit(self._batch, si))
+                    if len(pending) > self.prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # If the consumer stops early, dont build batches nobody will use
+                for future in pending:
+                    future.cancel()
+
+
+@export
+def bucket_batches(lengths, max_tokens, num_buckets=8, shuffle=True, truncate=False):
+    """Group examples into buckets of similar length and cut each bucket into batches that fit a token budget
+
+    The bucket boundaries are taken from the quantiles of `lengths` so that the buckets are roughly the same size.
+    A batch from a bucket whose longest example has length `L` holds `max_tokens // L` examples
+
+    :param lengths: The length of each example
+    :param max_tokens: The most (padded) tokens to put in a batch
+    :param num_buckets: The number of length buckets
+    :param shuffle: Shuffle the examples in each bucket, and the order of the batches
+    :param truncate: Drop the last batch of a bucket if it is not full
+    :return: A list of `(indices, max_len)` for each batch, where `max_len` is the longest length in its bucket
+    """
+    lengths = np.asarray(lengths)
+    if len(lengths) == 0:
+        return []
+    sorted_lengths = np.sort(lengths)
+    quantiles = [sorted_lengths[(len(lengths) * i) // num_buckets] for i in range(1, num_buckets)]
+    boundaries = np.unique(quantiles)
+    bucket_ids = np.searchsorted(boundaries, lengths, side='left')
+    batches = []
+    for bucket_id in range(len(boundaries) + 1):
+        members = np.flatnonzero(bucket_ids == bucket_id)
+        if len(members) == 0:
+            continue
+        if shuffle:
+            members = np.random.permutation(members)
+        max_len = max(int(lengths[members].max()), 1)
+        batchsz = max(max_tokens // max_len, 1)
+        for start in range(0, len(members), batchsz):
+            indices = members[start:start + batchsz]
+            if truncate and len(indices) < batchsz:
+                continue
+            batches.append((indices, max_len))
+    if shuffle:
+        random.shuffle(batches)
+    return batches
+
+
+def _compact_dtype(data):
+    """Get the smallest signed integer dtype that holds all the values in `data`, non-integer data is left alone"""
+    if not np.issubdtype(data.dtype, np.integer) or data.size == 0:
+        return data.dtype
+    lo, hi = data.min(), data.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return data.dtype
+
+
+def _valid_rows(vec):
+    """Get the number of rows of `vec` that remain after stripping the trailing rows that are all padding"""
+    if vec.shape[0] == 0:
+        return 0
+    non_pad = np.flatnonzero((vec != Offsets.PAD).reshape(vec.shape[0], -1).any(axis=1))
+    return non_pad[-1] + 1 if len(non_pad) else 0
+
+
+@export
+class PackedExampleList:
+    """A read-only list of example dictionaries that are stored in packed, memory-mapped arrays
+
+    Each array valued field is stored as a flat buffer of the rows of every example with the trailing padding
+    stripped, along with an offsets array giving where each example starts.  Scalar fields (labels, lengths, ids)
+    are stored as a single array.  Batches are rebuilt by padding the rows back out to the original shape.
+
+    The files are opened with `mmap_mode`, so only the pages that are used get read, and processes that load the
+    same cache share them through the page cache.  Shuffling and sorting never move the data, they only permute
+    an index array
+    """
+    META = 'meta.json'
+
+    def __init__(self, path, indices=None):
+        """Open a cache that was written with `PackedExampleList.write`
+
+        :param path: The directory holding the packed arrays
+        :param indices: An optional permutation of the examples
+        """
+        self.path = path
+        with open(os.path.join(path, PackedExampleList.META)) as rf:
+            self.meta = json.load(rf)
+        self.fields = {}
+        for i, (key, field) in enumerate(self.meta['fields'].items()):
+            values = np.load(os.path.join(path, f'{i}.npy'), mmap_mode='r')
+            offsets = np.load(os.path.join(path, f'{i}.offsets.npy'), mmap_mode='r') if field['shape'] is not None else None
+            self.fields[key] = (values, offsets, field['shape'], np.dtype(field['dtype']))
+        self.indices = np.arange(self.meta['num_examples']) if indices is None else indices
+
+    @property
+    def extra(self):
+        """Any extra information that was stored along with the examples"""
+        return self.meta.get('extra', {})
+
+    @staticmethod
+    def write(examples, path, extra=None):
+        """Pack a list of example dictionaries and write them to the `path` directory
+
+        The arrays are written to a temporary directory first and moved into place, so a reader never sees a
+        partially written cache
+
+        :param examples: A non-empty list of example dictionaries, all with the same keys
+        :param path: The directory to write to
+        :param extra: An optional JSON-serializable dictionary to store along with the examples
+        """
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        fields = {}
+        for i, key in enumerate(examples[0].keys()):
+            first = np.asarray(examples[0][key])
+            if first.ndim == 0:
+                values = np.array([ex[key] for ex in examples])
+                fields[key] = {'shape': None, 'dtype': values.dtype.str}
+                np.save(os.path.join(tmp_path, f'{i}.npy'), values.astype(_compact_dtype(values)))
+                continue
+            rows = []
+            offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+            for j, ex in enumerate(examples):
+                vec = np.asarray(ex[key])
+                valid = _valid_rows(vec)
+                rows.append(vec[:valid])
+                offsets[j + 1] = offsets[j] + valid
+            values = np.concatenate(rows)
+            fields[key] = {'shape': list(first.shape), 'dtype': first.dtype.str}
+            np.save(os.path.join(tmp_path, f'{i}.npy'), values.astype(_compact_dtype(values)))
+            np.save(os.path.join(tmp_path, f'{i}.offsets.npy'), offsets)
+        meta = {'num_examples': len(examples), 'fields': fields, 'extra': extra if extra is not None else {}}
+        with open(os.path.join(tmp_path, PackedExampleList.META), 'w') as wf:
+            json.dump(meta, wf)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Someone else wrote the same cache first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        """Get a single example, padded back out to its original shape
+
+        :param i: (``int``) simple index
+        :return: an example dictionary
+        """
+        return {k: v[0] for k, v in self.batch(i, i + 1).items()}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def shuffled(self):
+        """Get a view of the examples in a random order"""
+        return PackedExampleList(self.path, np.random.permutation(self.indices))
+
+    def sorted_by(self, key):
+        """Get a view of the examples sorted (stably) by a scalar field
+
+        :param key: The name of a scalar field such as `x_lengths`
+        """
+        values = self.fields[key][0]
+        order = np.argsort(values[self.indices], kind='stable')
+        return PackedExampleList(self.path, self.indices[order])
+
+    def lengths(self, key):
+        """Get the value of a scalar field for every example, in order
+
+        :param key: The name of a scalar field such as `x_lengths`
+        """
+        return self.fields[key][0][self.indices]
+
+    def batch(self, start, end):
+        """Build a batch from the examples in positions `[start, end)`
+
+        :param start: The position of the first example
+        :param end: The position past the last example
+        :return: A batch dictionary, with the original dtypes and (padded) shapes
+        """
+        return self.take(slice(start, end))
+
+    def take(self, positions):
+        """Build a batch from the examples at the given positions
+
+        :param positions: A slice, or an array of positions
+        :return: A batch dictionary, with the original dtypes and (padded) shapes
+        """
+        indices = self.indices[positions]
+        batch = {}
+        for key, (values, offsets, shape, dtype) in self.fields.items():
+            if shape is None:
+                batch[key] = values[indices].astype(dtype)
+                continue
+            vecs = pads([len(indices)] + shape, dtype=dtype)
+            for j, idx in enumerate(indices):
+                begin, finish = offsets[idx], offsets[idx + 1]
+                vecs[j, :finish - begin] = values[begin:finish]
+            batch[key] = vecs
+        return batch
+
+
+def _length_key(example_list, key=None):
+    """Get the key to read example lengths from, if none is given use the first key that ends in `_lengths`"""
+    if key is not None:
+        return key
+    for k in example_list[0].keys():
+        if k.endswith('_lengths'):
+            return k
+    raise Exception('No length key was found to bucket the examples on')
+
+
 @export
 class DictExamples:
     """This object holds a list of dictionaries, and knows how to shuffle, sort and batch them
@@ -100,11 +390,17 @@ class DictExamples:
         """
         self.example_list = example_list
 
-        if do_shuffle:
-            random.shuffle(self.example_list)
+        if isinstance(self.example_list, PackedExampleList):
+            if do_shuffle:
+                self.example_list = self.example_list.shuffled()
+            if sort_key is not None:
+                self.example_list = self.example_list.sorted_by(sort_key)
+        else:
+            if do_shuffle:
+                random.shuffle(self.example_list)
 
-        if sort_key is not None:
-            self.example_list = sorted(self.example_list, key=lambda x: x[sort_key])
+            if sort_key is not None:
+                self.example_list = sorted(self.example_list, key=lambda x: x[sort_key])
 
         self.sort_key = sort_key
 
@@ -142,6 +438,13 @@ class DictExamples:
         :param trim: (``bool``) Trim to maximum length in a batch
         :return batched dictionary
         """
+        if isinstance(self.example_list, PackedExampleList):
+            batch = self.example_list.batch(start * batchsz, (start + 1) * batchsz)
+            if not trim:
+                return batch
+            max_src_len = batch[self.sort_key].max() if self.sort_key is not None else 0
+            return self._trim_batch(batch, batch.keys(), max_src_len)
+
         ex = self.example_list[start]
         keys = ex.keys()
         batch = {}
@@ -169,6 +472,31 @@ class DictExamples:
             batch[k] = np.stack(batch[k])
         return self._trim_batch(batch, keys, max_src_len) if trim else batch
 
+    def lengths(self, key=None):
+        """Get the length of each example
+
+        :param key: The length key, defaults to the `sort_key`, or else the first key that ends in `_lengths`
+        :return: An array of lengths
+        """
+        key = _length_key(self.example_list, key or self.sort_key)
+        if isinstance(self.example_list, PackedExampleList):
+            return self.example_list.lengths(key)
+        return np.array([ex[key] for ex in self.example_list])
+
+    def bucket_batch(self, indices, max_len):
+        """Get a batch of the examples at `indices`, trimmed to `max_len`
+
+        :param indices: The positions of the examples in the batch
+        :param max_len: The length to trim to
+        :return: batched dictionary
+        """
+        if isinstance(self.example_list, PackedExampleList):
+            batch = self.example_list.take(indices)
+        else:
+            examples = [self.example_list[i] for i in indices]
+            batch = {k: np.stack([ex[k] for ex in examples]) for k in examples[0].keys()}
+        return self._trim_batch(batch, batch.keys(), max_len)
+
 
 @export
 class Seq2SeqExamples:
@@ -183,10 +511,16 @@ class Seq2SeqExamples:
         :param do_sort: Sort the data (defaults to `True`)
         """
         self.example_list = example_list
-        if do_shuffle:
-            random.shuffle(self.example_list)
-        if src_sort_key is not None:
-            self.example_list = sorted(self.example_list, key=lambda x: x[src_sort_key])
+        if isinstance(self.example_list, PackedExampleList):
+            if do_shuffle:
+                self.example_list = self.example_list.shuffled()
+            if src_sort_key is not None:
+                self.example_list = self.example_list.sorted_by(src_sort_key)
+        else:
+            if do_shuffle:
+                random.shuffle(self.example_list)
+            if src_sort_key is not None:
+                self.example_list = sorted(self.example_list, key=lambda x: x[src_sort_key])
         self.src_sort_key = src_sort_key
 
     def __getitem__(self, i):
@@ -226,6 +560,13 @@ class Seq2SeqExamples:
         :param vec_shape: A vector shape function
         :return: batched `x` word vector, `x` character vector, batched `y` vector, `length` vector, `ids`
         """
+        if isinstance(self.example_list, PackedExampleList):
+            batch = self.example_list.batch(start * batchsz, (start + 1) * batchsz)
+            if not trim:
+                return batch
+            max_src_len = batch[self.src_sort_key].max() if self.src_sort_key is not None else 0
+            return self._trim_batch(batch, max_src_len, batch['tgt_lengths'].max())
+
         ex = self.example_list[start]
         keys = ex.keys()
         batch = {}
@@ -257,6 +598,33 @@ class Seq2SeqExamples:
             batch[k] = np.stack(batch[k])
         return self._trim_batch(batch, max_src_len, max_tgt_len) if trim else batch
 
+    def lengths(self, key=None):
+        """Get the source length of each example
+
+        :param key: The length key, defaults to the `src_sort_key`, or else the first key that ends in `_lengths`
+        :return: An array of lengths
+        """
+        key = _length_key(self.example_list, key or self.src_sort_key)
+        if isinstance(self.example_list, PackedExampleList):
+            return self.example_list.lengths(key)
+        return np.array([ex[key] for ex in self.example_list])
+
+    def bucket_batch(self, indices, max_len):
+        """Get a batch of the examples at `indices`, with the source trimmed to `max_len`
+
+        The target is trimmed to the longest target in the batch
+
+        :param indices: The positions of the examples in the batch
+        :param max_len: The source length to trim to
+        :return: batched dictionary
+        """
+        if isinstance(self.example_list, PackedExampleList):
+            batch = self.example_list.take(indices)
+        else:
+            examples = [self.example_list[i] for i in indices]
+            batch = {k: np.stack([ex[k] for ex in examples]) for k in examples[0].keys()}
+        return self._trim_batch(batch, max_len, batch['tgt_lengths'].max())
+
 
 # This one is a little different at the moment
 @export
@@ -12,24 +12,33 @@ from eight_mile.progress import create_progress_bar
 from baseline.utils import verbose_output, get_model_file, get_metric_cmp
 from baseline.train import EpochReportingTrainer, create_trainer, register_trainer, register_training_func
 from baseline.model import create_model_for
-from torch.utils.data import DataLoader
+from baseline.pytorch.torchy import (
+    create_data_loader,
+    ConfusionCounts,
+    distributed_data_parallel,
+    distributed_rank,
+    unwrap_model,
+)
 
 logger = logging.getLogger('baseline')
 
 
 
-def _add_to_cm(cm, y, pred):
-    if cm is None:
+def _add_to_cm(counts, y, pred):
+    """Accumulate the confusion counts for a batch on the device, without syncing with the host
+
+    :param counts: A `ConfusionCounts` (or `None` if we arent tracking a confusion matrix)
+    :param y: The truth
+    :param pred: The model output
+    """
+    if counts is None:
         return
-    _, best = pred.max(1)
+    best = pred.argmax(1)
 
     # If the truth is actually a prob dist, do an argmax RQ
     if y.dtype == pred.dtype and len(y.shape) == len(pred.shape):
-        yt = torch.argmax(y, -1).cpu().int()
-    else:
-        yt = y.cpu().int()
-    yp = best.cpu().int()
-    cm.add_batch(yt.data.numpy(), yp.data.numpy())
+        y = torch.argmax(y, -1)
+    counts.add_batch(y, best)
 
 
 @register_trainer(task='classify', name='default')
@@ -62,13 +71,17 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
                 self.model.cuda()
         else:
             logger.warning("Requested training on CPU.  This will be slow.")
+        if bool(kwargs.get('distributed', False)):
+            self.model = distributed_data_parallel(self.model, **kwargs)
         self.nsteps = kwargs.get('nsteps', six.MAXSIZE)
 
     def _get_pytorch_model(self):
-        return self.model.module if self.gpus > 1 else self.model
+        return unwrap_model(self.model)
 
     def save(self, model_file):
-        self._get_pytorch_model().save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self._get_pytorch_model().save(model_file)
 
     def _make_input(self, batch_dict, **kwargs):
         return self._get_pytorch_model().make_input(batch_dict, **kwargs)
@@ -85,6 +98,7 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
         pg = create_progress_bar(steps)
         no_cm = bool(kwargs.get('no_cm', False))
         cm = None if no_cm else ConfusionMatrix(self.labels)
+        counts = None if no_cm else ConfusionCounts(len(self.labels))
         verbose = kwargs.get("verbose", None)
         output = kwargs.get('output')
         txts = kwargs.get('txts')
@@ -106,12 +120,13 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
                         handle.write('{}\t{}\t{}\n'.format(" ".join(txts[line_number]), self.model.labels[p], self.model.labels[y]))
                         line_number += 1
                 batchsz = self._get_batchsz(batch_dict)
-                total_loss += loss.item() * batchsz
+                # Keep the sums on the device, they are only synced once the epoch is done
+                total_loss += loss.detach().double() * batchsz
                 total_norm += batchsz
-                _add_to_cm(cm, ys, pred)
+                _add_to_cm(counts, ys, pred)
 
-        metrics = cm.get_all_metrics() if cm is not None else {}
-        metrics['avg_loss'] = total_loss / float(total_norm)
+        metrics = counts.update(cm).get_all_metrics() if cm is not None else {}
+        metrics['avg_loss'] = float(total_loss) / float(total_norm)
         verbose_output(verbose, cm)
         if handle is not None:
             handle.close()
@@ -125,27 +140,33 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
         pg = create_progress_bar(steps)
         no_cm = bool(kwargs.get('no_cm', False))
         cm = None if no_cm else ConfusionMatrix(self.labels)
+        counts = None if no_cm else ConfusionCounts(len(self.labels))
         epoch_loss = 0
         epoch_div = 0
-        for batch_dict in pg(loader):
-            self.optimizer.zero_grad()
+        self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
+        for i, batch_dict in enumerate(pg(loader)):
             example = self._make_input(batch_dict)
             y = example.pop('y')
-            pred = self.model(example)
-            loss = self.crit(pred, y)
+            with self.optimizer.autocast(self.model):
+                pred = self.model(example)
+                loss = self.crit(pred, y)
             batchsz = self._get_batchsz(batch_dict)
-            report_loss = loss.item() * batchsz
+            # The loss sums stay on the device so we dont sync every step, only when we report
+            report_loss = loss.detach().double() * batchsz
             epoch_loss += report_loss
             epoch_div += batchsz
             self.nstep_agg += report_loss
             self.nstep_div += batchsz
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-            _add_to_cm(cm, y, pred)
+            _add_to_cm(counts, y, pred)
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
             self.optimizer.step()
+            self.optimizer.zero_grad()
 
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
-                metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
+                metrics = self.calc_metrics(float(self.nstep_agg), self.nstep_div)
                 metrics['lr'] = self.optimizer.current_lr
                 self.report(
                     self.optimizer.global_step + 1, metrics, self.nstep_start,
@@ -153,10 +174,10 @@ class ClassifyTrainerPyTorch(EpochReportingTrainer):
                 )
                 self.reset_nstep()
 
-        metrics = cm.get_all_metrics() if cm is not None else {}
+        metrics = counts.update(cm).get_all_metrics() if cm is not None else {}
         metrics['lr'] = self.optimizer.current_lr
 
-        metrics['avg_loss'] = epoch_loss / float(epoch_div)
+        metrics['avg_loss'] = float(epoch_loss) / float(epoch_div)
         return metrics
 
 
@@ -195,13 +216,14 @@ def fit(model_params, ts, vs, es, **kwargs):
 
     num_loader_workers = int(kwargs.get('num_loader_workers', 0))
     pin_memory = bool(kwargs.get('pin_memory', True))
+    prefetch = int(kwargs.get('prefetch', 0))
+    prefetch_workers = int(kwargs.get('prefetch_workers', 1))
 
-    if not isinstance(ts, DataLoader):
-        ts = DataLoader(ts, num_workers=num_loader_workers, batch_size=None, pin_memory=pin_memory)
-    if not isinstance(vs, DataLoader):
-        vs = DataLoader(vs, batch_size=None, pin_memory=pin_memory)
-    if es and not isinstance(es, DataLoader):
-        es = DataLoader(es, batch_size=None, pin_memory=pin_memory)
+    distributed = bool(kwargs.get('distributed', False))
+    ts = create_data_loader(ts, num_loader_workers, pin_memory, prefetch, prefetch_workers, distributed=distributed)
+    vs = create_data_loader(vs, 0, pin_memory, prefetch, prefetch_workers)
+    if es:
+        es = create_data_loader(es, 0, pin_memory, prefetch, prefetch_workers)
 
     best_metric = 0
     if do_early_stopping:
@@ -237,9 +259,10 @@ def fit(model_params, ts, vs, es, **kwargs):
     if do_early_stopping is True:
         logger.info('Best performance on %s: %.3f at epoch %d', early_stopping_metric, best_metric, last_improved)
 
-    if es is not None:
+    # When we are distributed, only the first worker has the saved model, so it runs the test on its own
+    if es is not None and distributed_rank() == 0:
         logger.info('Reloading best checkpoint')
         model = torch.load(model_file)
-        trainer = create_trainer(model, **kwargs)
+        trainer = create_trainer(model, **{**kwargs, 'distributed': False})
         test_metrics = trainer.test(es, reporting_fns, phase='Test', verbose=verbose, output=output, txts=txts)
     return test_metrics
@@ -2,7 +2,7 @@ import logging
 from baseline.model import DependencyParserModel, register_model
 from baseline.pytorch.torchy import *
 from eight_mile.pytorch.layers import sequence_mask_mxlen, truncate_mask_over_time
-from baseline.utils import listify, write_json, revlut
+from baseline.utils import listify, write_json, revlut, mst_decode
 from eight_mile.pytorch.layers import *
 import torch.backends.cudnn as cudnn
 import torch.jit as jit
@@ -28,6 +28,22 @@ def decode_results(heads_pred: TensorDef, labels_pred: TensorDef) -> Tuple[Tenso
     return greedy_heads_pred, greedy_labels_pred
 
 
+def decode_heads(heads_pred: TensorDef, lengths: TensorDef, decoder_type: str = 'greedy') -> TensorDef:
+    """Pick a head for each token from the arc scores
+
+    :param heads_pred: ``[B, T, T]`` arc scores, with the head on the last dimension
+    :param lengths: ``[B]`` the length of each sentence, including the root
+    :param decoder_type: `greedy` takes the argmax head for each token, `mst` finds the maximum spanning tree
+    :return: ``[B, T]`` the head for each token
+    """
+    if decoder_type == 'greedy':
+        return torch.argmax(heads_pred, -1)
+    if decoder_type == 'mst':
+        heads = mst_decode(heads_pred.detach().float().cpu().numpy(), lengths.cpu().numpy())
+        return torch.from_numpy(heads).to(heads_pred.device)
+    raise Exception("Unknown decoder type: {}".format(decoder_type))
+
+
 class ArcLabelLoss(nn.Module):
     def __init__(self):
         super().__init__()
@@ -183,7 +199,7 @@ class DependencyParserModelBase(nn.Module, DependencyParserModel):
         examples, perm_idx = self.make_input(batch_dict, perm=True, numpy_to_tensor=numpy_to_tensor)
         with torch.no_grad():
             if decode:
-                arcs, rels = self.decode(examples)
+                arcs, rels = self.decode(examples, decoder_type=kwargs.get('decoder_type'))
 
             else:
                 arcs, rels = self(examples)
@@ -238,6 +254,7 @@ class BiAffineDependencyParser(DependencyParserModelBase):
         self.arc_attn = self.init_biaffine(self.arc_h.output_dim, 1, True, False)
         self.rel_attn = self.init_biaffine(self.rel_h.output_dim, len(self.labels), True, True)
         self.primary_key = self.lengths_key.split('_')[0]
+        self.decoder_type = kwargs.get('decoder_type', 'greedy')
 
     def init_embed(self, embeddings: Dict[str, TensorDef], **kwargs) -> BaseLayer:
         """This method creates the "embedding" layer of the inputs, with an optional reduction
@@ -285,13 +302,12 @@ class BiAffineDependencyParser(DependencyParserModelBase):
 
 
 
-    def forward(self, inputs: Dict[str, TensorDef]) -> TensorDef:
-        """Forward execution of the model.  Sub-classes typically shouldnt need to override
+    def encode(self, inputs: Dict[str, TensorDef]) -> Tuple[TensorDef, TensorDef, TensorDef, TensorDef]:
+        """Run everything up to (but not including) the label biaffine
 
         :param inputs: An input dictionary containing the features and the primary key length
-        :return: A tensor
+        :return: The arc scores ``[B, T, T]``, the label projections for dependents and heads, and the mask
         """
-
         lengths = inputs.get("lengths")
         Tin = inputs[self.primary_key].shape[1]
         mask = sequence_mask_mxlen(lengths, max_len=Tin).to(lengths.device)
@@ -304,5 +320,32 @@ class BiAffineDependencyParser(DependencyParserModelBase):
         rels_d = self.rel_d(pooled)
         mask = truncate_mask_over_time(mask, arcs_h)
         score_arcs = self.arc_attn(arcs_d, arcs_h, mask)
+        return score_arcs, rels_d, rels_h, mask
+
+    def forward(self, inputs: Dict[str, TensorDef]) -> TensorDef:
+        """Forward execution of the model.  Sub-classes typically shouldnt need to override
+
+        :param inputs: An input dictionary containing the features and the primary key length
+        :return: A tensor
+        """
+        score_arcs, rels_d, rels_h, mask = self.encode(inputs)
         score_rels = self.rel_attn(rels_d, rels_h, mask.unsqueeze(1)).permute(0, 2, 3, 1)
         return score_arcs, score_rels
+
+    def decode(self, example, **kwargs):
+        """Pick the heads first, then score the labels only for the selected head of each token
+
+        This avoids building the ``[B, T, T, L]`` label tensor that `forward()` produces for training, so
+        memory grows with ``T`` rather than ``T^2`` for the labels
+
+        :param example: An input dictionary containing the features and the primary key length
+        :Keyword Arguments:
+        * *decoder_type* -- (``str``) `greedy` or `mst`, defaults to the `decoder_type` the model was created with
+        :return: The heads ``[B, T]`` and the labels ``[B, T]``
+        """
+        decoder_type = kwargs.get('decoder_type') or getattr(self, 'decoder_type', 'greedy')
+        score_arcs, rels_d, rels_h, _ = self.encode(example)
+        heads = decode_heads(score_arcs, example['lengths'], decoder_type)
+        heads_h = rels_h.gather(1, heads.unsqueeze(-1).expand(-1, -1, rels_h.shape[-1]))
+        score_rels = self.rel_attn.score_pairs(rels_d, heads_h)
+        return heads, torch.argmax(score_rels, -1)
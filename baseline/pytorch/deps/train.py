@@ -10,7 +10,7 @@ from eight_mile.progress import create_progress_bar
 from baseline.utils import verbose_output, get_model_file, get_metric_cmp
 from baseline.train import EpochReportingTrainer, create_trainer, register_trainer, register_training_func
 from baseline.model import create_model_for
-from torch.utils.data import DataLoader
+from baseline.pytorch.torchy import create_data_loader, distributed_data_parallel, distributed_rank, unwrap_model
 logger = logging.getLogger('baseline')
 
 
@@ -43,13 +43,17 @@ class DependencyParserTrainerPyTorch(EpochReportingTrainer):
             logger.warning("Requested training on CPU.  This will be slow.")
             self.crit = model.create_loss()
             self.model = model
+        if bool(kwargs.get('distributed', False)):
+            self.model = distributed_data_parallel(self.model, **kwargs)
         self.nsteps = kwargs.get('nsteps', six.MAXSIZE)
 
     def _get_pytorch_model(self):
-        return self.model.module if self.gpus > 1 else self.model
+        return unwrap_model(self.model)
 
     def save(self, model_file):
-        self._get_pytorch_model().save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self._get_pytorch_model().save(model_file)
 
     def _make_input(self, batch_dict, **kwargs):
         return self._get_pytorch_model().make_input(batch_dict, **kwargs)
@@ -63,23 +67,23 @@ class DependencyParserTrainerPyTorch(EpochReportingTrainer):
         steps = len(loader)
         pg = create_progress_bar(steps)
         metrics = [LAS(), UAS(), LCM(), UCM()]
+        model = self._get_pytorch_model()
 
         with torch.no_grad():
             for batch_dict in pg(loader):
                 example = self._make_input(batch_dict)
                 labels_gold = example.pop('labels')
                 heads_gold = example.pop('heads')
-                batchsz = self._get_batchsz(batch_dict)
-                greedy_heads_pred, greedy_labels_pred = self.model.decode(example)
+                greedy_heads_pred, greedy_labels_pred = model.decode(example)
                 T = greedy_labels_pred.shape[1]
                 labels_gold_trimmed = labels_gold[:, :T]
                 heads_gold_trimmed = heads_gold[:, :T]
+                if self.punct_eval is False:
+                    labels_gold_trimmed = labels_gold_trimmed.masked_fill(labels_gold_trimmed == model.punct, Offsets.PAD)
 
-                for i in range(batchsz):
-                    for m in metrics:
-                        if self.punct_eval is False:
-                            labels_gold_trimmed[i].masked_fill_(labels_gold_trimmed[i] == self.model.punct, Offsets.PAD)
-                        m.add(greedy_heads_pred[i], heads_gold_trimmed[i], greedy_labels_pred[i], labels_gold_trimmed[i])
+                # The metrics reduce the whole batch on the device
+                for m in metrics:
+                    m.add(greedy_heads_pred, heads_gold_trimmed, greedy_labels_pred, labels_gold_trimmed)
 
         metrics = {m.name: m.score for m in metrics} 
         return metrics
@@ -91,22 +95,26 @@ class DependencyParserTrainerPyTorch(EpochReportingTrainer):
         pg = create_progress_bar(steps)
         epoch_loss = 0
         epoch_div = 0
-        for batch_dict in pg(loader):
-            self.optimizer.zero_grad()
+        self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
+        for i, batch_dict in enumerate(pg(loader)):
             example = self._make_input(batch_dict)
             heads_gold = example.pop('heads')
             labels_gold = example.pop('labels')
-            heads_pred, labels_pred = self.model(example)
-            loss = self.crit(heads_pred, heads_gold, labels_pred, labels_gold)
+            with self.optimizer.autocast(self.model):
+                heads_pred, labels_pred = self.model(example)
+                loss = self.crit(heads_pred, heads_gold, labels_pred, labels_gold)
             batchsz = self._get_batchsz(batch_dict)
             report_loss = loss.item() * batchsz
             epoch_loss += report_loss
             epoch_div += batchsz
             self.nstep_agg += report_loss
             self.nstep_div += batchsz
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
             self.optimizer.step()
+            self.optimizer.zero_grad()
 
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
                 metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
@@ -158,12 +166,13 @@ def fit(model_params, ts, vs, es, **kwargs):
 
     num_loader_workers = int(kwargs.get('num_loader_workers', 0))
     pin_memory = bool(kwargs.get('pin_memory', True))
-    if not isinstance(ts, DataLoader):
-        ts = DataLoader(ts, num_workers=num_loader_workers, batch_size=None, pin_memory=pin_memory)
-    if not isinstance(vs, DataLoader):
-        vs = DataLoader(vs, batch_size=None, pin_memory=pin_memory)
-    if es and not isinstance(es, DataLoader):
-        es = DataLoader(es, batch_size=None, pin_memory=pin_memory)
+    prefetch = int(kwargs.get('prefetch', 0))
+    prefetch_workers = int(kwargs.get('prefetch_workers', 1))
+    distributed = bool(kwargs.get('distributed', False))
+    ts = create_data_loader(ts, num_loader_workers, pin_memory, prefetch, prefetch_workers, distributed=distributed)
+    vs = create_data_loader(vs, 0, pin_memory, prefetch, prefetch_workers)
+    if es:
+        es = create_data_loader(es, 0, pin_memory, prefetch, prefetch_workers)
 
     best_metric = 0
     if do_early_stopping:
@@ -198,9 +207,10 @@ def fit(model_params, ts, vs, es, **kwargs):
     if do_early_stopping is True:
         logger.info('Best performance on %s: %.3f at epoch %d', early_stopping_metric, best_metric, last_improved)
 
-    if es is not None:
+    # When we are distributed, only the first worker has the saved model, so it runs the test on its own
+    if es is not None and distributed_rank() == 0:
         logger.info('Reloading best checkpoint')
         model = torch.load(model_file)
-        trainer = create_trainer(model, **kwargs)
+        trainer = create_trainer(model, **{**kwargs, 'distributed': False})
         test_metrics = trainer.test(es, reporting_fns, phase='Test', verbose=verbose, output=output, txts=txts)
     return test_metrics
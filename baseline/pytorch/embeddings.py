@@ -160,20 +160,23 @@ class TransformerLMEmbeddings(PyTorchEmbeddings):
         windowed_ra = kwargs.get('windowed_ra', False)
         rpr_value_on = kwargs.get('rpr_value_on', True)
         ra_type = kwargs.get('ra_type')
+        keep_attn = kwargs.get('keep_attn', True)
+        checkpoint_layers = kwargs.get('checkpoint_layers', False)
         is_mlp = kwargs.get("mlp", False)
         transformer_type = kwargs.get("transformer_type", None)
         if is_mlp:
             self.transformer = GatedMLPEncoderStack(self.d_model, pdrop=pdrop, layers=num_layers,
                                                     nctx=kwargs.get('nctx', 256),
                                                     activation=activation, ffn_pdrop=ff_pdrop,
-                                                    layer_norm_eps=layer_norm_eps)
+                                                    layer_norm_eps=layer_norm_eps, checkpoint_layers=checkpoint_layers)
         else:
 
             self.transformer = TransformerEncoderStack(num_heads, d_model=self.d_model, pdrop=pdrop, scale=True,
                                                        layers=num_layers, d_ff=d_ff, rpr_k=rpr_k, d_k=d_k,
                                                        activation=activation, ffn_pdrop=ff_pdrop,
                                                        layer_norms_after=layer_norms_after, layer_norm_eps=layer_norm_eps,
-                                                       windowed_ra=windowed_ra, rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type= transformer_type)
+                                                       windowed_ra=windowed_ra, rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type= transformer_type,
+                                                       keep_attn=keep_attn, checkpoint_layers=checkpoint_layers)
         self.mlm = kwargs.get('mlm', True)
         self.finetune = kwargs.get('finetune', True)
 
@@ -1,5 +1,5 @@
 from baseline.pytorch.torchy import *
-from eight_mile.pytorch.layers import TransformerEncoderStack, subsequent_mask, MultiHeadedAttention
+from eight_mile.pytorch.layers import TransformerEncoderStack, subsequent_mask, MultiHeadedAttention, kv_cache_length
 from baseline.model import LanguageModel, register_model
 from eight_mile.pytorch.serialize import load_tlm_npz
 import torch.autograd
@@ -218,6 +218,8 @@ class TransformerLanguageModel(AbstractGeneratorLanguageModel):
         rpr_value_on = kwargs.get('rpr_value_on', True)
         ra_type = kwargs.get('ra_type')
         transformer_type = kwargs.get('transformer_type')
+        keep_attn = kwargs.get('keep_attn', True)
+        checkpoint_layers = kwargs.get('checkpoint_layers', False)
         self.mask_pad = kwargs.get('mask_pad', False)
         return TransformerEncoderStack(num_heads, d_model=d_model, pdrop=pdrop, scale=scale,
                                        layers=layers, d_ff=d_ff, rpr_k=rpr_k, d_k=d_k,
@@ -226,7 +228,8 @@ class TransformerLanguageModel(AbstractGeneratorLanguageModel):
                                        layer_norm_eps=layer_norm_eps,
                                        layer_norms_after=layer_norms_after, windowed_ra=windowed_ra,
                                        rpr_value_on=rpr_value_on, ra_type=ra_type,
-                                       layer_drop=layer_drop, transformer_type=transformer_type)
+                                       layer_drop=layer_drop, transformer_type=transformer_type, keep_attn=keep_attn,
+                                       checkpoint_layers=checkpoint_layers)
 
     def create_layers(self, embeddings, **kwargs):
         super().create_layers(embeddings, **kwargs)
@@ -241,9 +244,21 @@ class TransformerLanguageModel(AbstractGeneratorLanguageModel):
 
         return mask * self._pad_mask(inputs)
 
-    def generate(self, bth, _, inputs):
+    def init_cache(self):
+        """Create a key/value cache to pass as the `hidden` argument for incremental decoding
+
+        When the model is called with a cache, only the positions of the input that are not in the cache yet
+        are run, and the outputs are only returned for those positions.  The updated cache is returned as the hidden
+        state, so it can be passed right back in with the input extended by one token
+        """
+        return self.generator.init_cache()
+
+    def generate(self, bth, hidden, inputs):
         mask = self.create_mask(bth, inputs)
-        return self.generator((bth, mask)), None
+        if hidden is None:
+            return self.generator((bth, mask)), None
+        T_cached = kv_cache_length(hidden)
+        return self.generator((bth[:, T_cached:], mask[:, :, T_cached:]), cache=hidden), hidden
 
 
 @register_model(task='lm', name='transformer-mlm')
@@ -255,6 +270,9 @@ class TransformerMaskedLanguageModel(TransformerLanguageModel):
 
         return self._pad_mask(inputs)
 
+    def init_cache(self):
+        raise Exception("Incremental decoding requires a causal language model")
+
 
 @register_model(task='lm', name='gmlp-mlm')
 class GatedMLPLanguageModel(AbstractGeneratorLanguageModel):
@@ -286,6 +304,7 @@ class GatedMLPLanguageModel(AbstractGeneratorLanguageModel):
         ffn_pdrop = kwargs.get('ffn_pdrop', 0.0)
         layer_norm_eps = kwargs.get('layer_norm_eps', 1e-12)
         layer_drop = kwargs.get('layer_drop', 0.0)
+        checkpoint_layers = kwargs.get('checkpoint_layers', False)
         nctx = int(kwargs.get('nctx', 256))
         self.mask_pad = kwargs.get('mask_pad', False)
         return GatedMLPEncoderStack(d_model=d_model, pdrop=pdrop,
@@ -293,7 +312,8 @@ class GatedMLPLanguageModel(AbstractGeneratorLanguageModel):
                                     activation=activation,
                                     ffn_pdrop=ffn_pdrop,
                                     layer_norm_eps=layer_norm_eps,
-                                    layer_drop=layer_drop)
+                                    layer_drop=layer_drop,
+                                    checkpoint_layers=checkpoint_layers)
 
     def create_layers(self, embeddings, **kwargs):
         super().create_layers(embeddings, **kwargs)
@@ -6,7 +6,6 @@ from eight_mile.pytorch.optz import OptimizerManager
 from baseline.utils import get_model_file, get_metric_cmp
 from baseline.train import Trainer, create_trainer, register_trainer, register_training_func
 from baseline.model import create_model_for
-from torch.utils.data import DataLoader
 logger = logging.getLogger('baseline')
 
 
@@ -32,6 +31,8 @@ class LanguageModelTrainerPyTorch(Trainer):
         else:
             logger.warning("Requested training on CPU.  This will be slow.")
             self.crit = model.create_loss()
+        if bool(kwargs.get('distributed', False)):
+            self.model = distributed_data_parallel(self.model, **kwargs)
 
         self.nsteps = kwargs.get('nsteps', 500)
         self.optimizer = OptimizerManager(self.model, **kwargs)
@@ -44,10 +45,12 @@ class LanguageModelTrainerPyTorch(Trainer):
             return tuple(self.repackage_hidden(v) for v in h)
 
     def save(self, model_file):
-        self._get_pytorch_model().save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self._get_pytorch_model().save(model_file)
 
     def _get_pytorch_model(self):
-        return self.model.module if self.gpus > 1 else self.model
+        return unwrap_model(self.model)
 
     @staticmethod
     def _get_dims(loader):
@@ -100,23 +103,28 @@ class LanguageModelTrainerPyTorch(Trainer):
         batchsz, nctx = self._get_dims(ts)
         hidden = self._get_pytorch_model().zero_state(batchsz)
 
-        for batch_dict in ts:
+        steps = len(ts)
+        self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
+        for i, batch_dict in enumerate(ts):
             if hidden is not None:
                 hidden = self.repackage_hidden(hidden)
             inputs = self._get_pytorch_model().make_input(batch_dict)
             y = inputs.pop('y')
-            self.optimizer.zero_grad()
-            output, hidden = self.model(inputs, hidden)
-            loss = self.crit(output, y)
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-            self.optimizer.step()
+            with self.optimizer.autocast(self.model):
+                output, hidden = self.model(inputs, hidden)
+                loss = self.crit(output, y)
             toks = self._num_toks(batch_dict)
             report_loss = loss.item() * toks
             epoch_loss += report_loss
             epoch_toks += toks
             self.nstep_agg += report_loss
             self.nstep_div += toks
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
                 metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
                 metrics['lr'] = self.optimizer.current_lr
@@ -147,12 +155,13 @@ def fit(model, ts, vs, es, **kwargs):
 
     num_loader_workers = int(kwargs.get('num_loader_workers', 0))
     pin_memory = bool(kwargs.get('pin_memory', True))
-    if not isinstance(ts, DataLoader):
-        ts = DataLoader(ts, num_workers=num_loader_workers, batch_size=None, pin_memory=pin_memory)
-    if not isinstance(vs, DataLoader):
-        vs = DataLoader(vs, batch_size=None, pin_memory=pin_memory)
-    if es and not isinstance(es, DataLoader):
-        es = DataLoader(es, batch_size=None, pin_memory=pin_memory)
+    prefetch = int(kwargs.get('prefetch', 0))
+    prefetch_workers = int(kwargs.get('prefetch_workers', 1))
+    distributed = bool(kwargs.get('distributed', False))
+    ts = create_data_loader(ts, num_loader_workers, pin_memory, prefetch, prefetch_workers, distributed=distributed)
+    vs = create_data_loader(vs, 0, pin_memory, prefetch, prefetch_workers)
+    if es:
+        es = create_data_loader(es, 0, pin_memory, prefetch, prefetch_workers)
     best_metric = 10000
     if do_early_stopping:
         early_stopping_metric = kwargs.get('early_stopping_metric', 'avg_loss')
@@ -189,9 +198,10 @@ def fit(model, ts, vs, es, **kwargs):
     if do_early_stopping is True:
         logger.info('Best performance on %s: %.3f at epoch %d', early_stopping_metric, best_metric, last_improved)
 
-    if es is not None:
+    # When we are distributed, only the first worker has the saved model, so it runs the test on its own
+    if es is not None and distributed_rank() == 0:
         logger.info('Reloading best checkpoint')
         model = torch.load(model_file)
-        trainer = create_trainer(model, **kwargs)
+        trainer = create_trainer(model, **{**kwargs, 'distributed': False})
         test_metrics = trainer.test(es, reporting_fns, phase='Test')
     return test_metrics
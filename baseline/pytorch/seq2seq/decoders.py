@@ -6,6 +6,7 @@ import numpy as np
 from torch.autograd import Variable
 from baseline.utils import Offsets, exporter
 from eight_mile.pytorch.layers import repeat_batch, gnmt_length_penalty, BeamSearchBase, rnn_cell, WeightTieDense, subsequent_mask, TransformerDecoderStack
+from eight_mile.pytorch.layers import kv_cache_length, reorder_kv_cache, select_kv_cache
 from baseline.model import register_arc_policy, register_decoder, create_seq2seq_arc_policy
 from baseline.pytorch.seq2seq.encoders import TransformerEncoderOutput
 from baseline.pytorch.torchy import (
@@ -98,6 +99,7 @@ class RNNDecoder(torch.nn.Module):
         rnntype = kwargs.get('rnntype', 'lstm')
         layers = kwargs.get('layers', 1)
         feed_input = kwargs.get('feed_input', True)
+        self.feed_input = feed_input
         dsz = tgt_embeddings.get_dsz()
         if feed_input:
             self.input_i = self._feed_input
@@ -191,6 +193,13 @@ class RNNDecoder(torch.nn.Module):
         # inference where we are decoding a single step at a time.
         embed_out_tbh = self.tgt_embeddings(dst_tb)
 
+        if not self.feed_input:
+            # Without input feeding the RNN inputs don't depend on the attention, so the whole sequence can go
+            # through the fused RNN kernel and the attention can be run for every timestep at once
+            outputs_tbh, h_i = self.decoder_rnn.forward_sequence(embed_out_tbh, h_i)
+            outputs_tbh = self.attn_sequence(outputs_tbh, context_bth, src_mask)
+            return self.dropout(outputs_tbh), h_i
+
         outputs = []
 
         # Iterate through the `dst` embeddings one at a time. The reason for doing this at inference
@@ -215,6 +224,9 @@ class RNNDecoder(torch.nn.Module):
     def attn(self, output_t, context, src_mask=None):
         return output_t
 
+    def attn_sequence(self, output_tbh, context, src_mask=None):
+        return output_tbh
+
     def init_attn(self, **kwargs):
         pass
 
@@ -225,6 +237,8 @@ class RNNDecoder(torch.nn.Module):
 
     class BeamSearch(BeamSearchBase):
 
+        can_shrink = True
+
         def __init__(self, parent, **kwargs):
             super().__init__(**kwargs)
             self.parent = parent
@@ -251,6 +265,15 @@ class RNNDecoder(torch.nn.Module):
             dec_out = dec_out[beams, :]
             return h_i, dec_out, context, src_mask
 
+        def shrink(self, rows, extra):
+            """Drop the state of the examples that are done, including the encoder outputs."""
+            h_i, dec_out, context, src_mask = extra
+            if isinstance(h_i, tuple):
+                h_i = tuple(hc.index_select(1, rows) for hc in h_i)
+            else:
+                h_i = h_i.index_select(1, rows)
+            return h_i, dec_out.index_select(0, rows), context.index_select(0, rows), src_mask.index_select(0, rows)
+
     def beam_search(self, encoder_outputs, **kwargs):
         alpha = kwargs.get('alpha')
         if alpha is not None:
@@ -322,6 +345,9 @@ class RNNDecoderWithAttn(RNNDecoder):
     def attn(self, output_t, context, src_mask=None):
         return self.attn_module(output_t, context, context, src_mask)
 
+    def attn_sequence(self, output_tbh, context, src_mask=None):
+        return self.attn_module.forward_sequence(output_tbh.transpose(0, 1), context, context, src_mask).transpose(0, 1).contiguous()
+
 
 @register_decoder(name='transformer')
 class TransformerDecoderWrapper(torch.nn.Module):
@@ -334,6 +360,8 @@ class TransformerDecoderWrapper(torch.nn.Module):
                  d_k=None,
                  d_ff=None,
                  transformer_type=None,
+                 keep_attn=True,
+                 checkpoint_layers=False,
                  **kwargs):
         super().__init__()
         self.tgt_embeddings = tgt_embeddings
@@ -348,7 +376,8 @@ class TransformerDecoderWrapper(torch.nn.Module):
                                                            pdrop=dropout, scale=scale, layers=layers,
                                                            rpr_k=rpr_k, d_k=d_k, activation_type=activation,
                                                            layer_drop=layer_drop, layer_norm_eps=layer_norm_eps,
-                                                           rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type=transformer_type)
+                                                           rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type=transformer_type,
+                                                           keep_attn=keep_attn, checkpoint_layers=checkpoint_layers)
 
         self.proj_to_hsz = self._identity
         self.proj_to_dsz = self._identity
@@ -369,14 +398,28 @@ class TransformerDecoderWrapper(torch.nn.Module):
     def _identity(self, x):
         return x
 
-    def forward(self, encoder_output, dst):
+    def forward(self, encoder_output, dst, cache=None):
+        """Run the decoder over the target sequence
+
+        :param encoder_output: The output of the encoder
+        :param dst: The target sequence [B, T]
+        :param cache: An optional key/value cache from `transformer_decoder.init_cache()`.  When given, only the
+            positions of `dst` that are not in the cache yet are run through the decoder stack
+        :return: The log probabilities for each position that was run
+        """
         embed_out_bth = self.tgt_embeddings(dst)
         embed_out_bth = self.proj_to_hsz(embed_out_bth)
         context_bth = encoder_output.output
         T = embed_out_bth.shape[1]
         dst_mask = subsequent_mask(T).type_as(embed_out_bth)  # [B, 1, T_q, T_q]
         src_mask = encoder_output.src_mask.unsqueeze(1).unsqueeze(1)  # [B, 1, 1, T_k]
-        output = self.transformer_decoder((embed_out_bth, context_bth, src_mask, dst_mask))
+        if cache is not None:
+            # The embeddings are still looked up for the whole path so each position gets the right positional
+            # embedding, but the decoder stack only sees the new positions
+            T_cached = kv_cache_length(cache)
+            embed_out_bth = embed_out_bth[:, T_cached:]
+            dst_mask = dst_mask[:, :, T_cached:]
+        output = self.transformer_decoder((embed_out_bth, context_bth, src_mask, dst_mask), cache=cache)
         output = self.proj_to_dsz(output)
         prob = self.output(output)
         return prob
@@ -388,27 +431,46 @@ class TransformerDecoderWrapper(torch.nn.Module):
 
     class BeamSearch(BeamSearchBase):
 
+        can_shrink = True
+
         def __init__(self, parent, **kwargs):
             super().__init__(**kwargs)
             self.parent = parent
 
         def init(self, encoder_outputs):
-            """Tile for the batch of the encoder inputs."""
+            """Tile for the batch of the encoder inputs and create a key/value cache if the decoder supports it."""
             encoder_outputs = TransformerEncoderOutput(
                 repeat_batch(encoder_outputs.output, self.K),
                 repeat_batch(encoder_outputs.src_mask, self.K)
             )
-            return encoder_outputs
+            decoder = self.parent.transformer_decoder
+            cache = decoder.init_cache() if decoder.supports_kv_cache else None
+            return encoder_outputs, cache
 
         def step(self, paths, extra):
-            """Calculate the probs for the last item based on the full path."""
+            """Calculate the probs for the last item, using the cache for everything before it when we have one."""
             B, K, T = paths.size()
             assert K == self.K
-            return self.parent(extra, paths.view(B * K, T))[:, -1], extra
+            encoder_outputs, cache = extra
+            return self.parent(encoder_outputs, paths.view(B * K, T), cache=cache)[:, -1], extra
 
         def update(self, beams, extra):
-            """There is no state for the transformer so just pass it."""
-            return extra
+            """Select the cached keys and values of the best performing beams."""
+            encoder_outputs, cache = extra
+            if cache is not None:
+                cache = reorder_kv_cache(cache, beams)
+            return encoder_outputs, cache
+
+        def shrink(self, rows, extra):
+            """Drop the encoder outputs and the cached keys and values of the examples that are done."""
+            encoder_outputs, cache = extra
+            encoder_outputs = TransformerEncoderOutput(
+                encoder_outputs.output.index_select(0, rows),
+                encoder_outputs.src_mask.index_select(0, rows)
+            )
+            if cache is not None:
+                cache = select_kv_cache(cache, rows)
+            return encoder_outputs, cache
 
     def beam_search(self, encoder_outputs, **kwargs):
         return TransformerDecoderWrapper.BeamSearch(parent=self, **kwargs)(encoder_outputs)
@@ -47,6 +47,8 @@ class TransformerEncoderWrapper(torch.nn.Module):
                  d_k=None,
                  d_ff=None,
                  transformer_type=None,
+                 keep_attn=True,
+                 checkpoint_layers=False,
                  **kwargs):
         super().__init__()
         if hsz is None:
@@ -59,7 +61,8 @@ class TransformerEncoderWrapper(torch.nn.Module):
                                                    pdrop=dropout, scale=scale, layers=layers,
                                                    rpr_k=rpr_k, d_k=d_k, activation=activation, layer_drop=layer_drop,
                                                    layer_norm_eps=layer_norm_eps,
-                                                   rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type=transformer_type)
+                                                   rpr_value_on=rpr_value_on, ra_type=ra_type, transformer_type=transformer_type,
+                                                   keep_attn=keep_attn, checkpoint_layers=checkpoint_layers)
 
     def _identity(self, x):
         return x
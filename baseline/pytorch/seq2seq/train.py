@@ -9,7 +9,7 @@ from baseline.train import Trainer, create_trainer, register_trainer, register_t
 from eight_mile.pytorch.optz import OptimizerManager
 from eight_mile.bleu import bleu
 from baseline.model import create_model_for
-from torch.utils.data import DataLoader
+from baseline.pytorch.torchy import create_data_loader, distributed_data_parallel, distributed_rank, unwrap_model
 
 logger = logging.getLogger('baseline')
 
@@ -44,6 +44,8 @@ class Seq2SeqTrainerPyTorch(Trainer):
         else:
             logger.warning("Requested training on CPU.  This will be slow.")
             self.crit = model.create_loss()
+        if bool(kwargs.get('distributed', False)):
+            self.model = distributed_data_parallel(self.model, **kwargs)
 
         self.nsteps = kwargs.get('nsteps', 500)
 
@@ -63,10 +65,12 @@ class Seq2SeqTrainerPyTorch(Trainer):
         return float(correct)/total
 
     def save(self, model_file):
-        self._get_pytorch_model().save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self._get_pytorch_model().save(model_file)
 
     def _get_pytorch_model(self):
-        return self.model.module if self.gpus > 1 else self.model
+        return unwrap_model(self.model)
 
     def calc_metrics(self, agg, norm):
         metrics = super().calc_metrics(agg, norm)
@@ -135,16 +139,16 @@ class Seq2SeqTrainerPyTorch(Trainer):
 
         start = time.perf_counter()
         self.nstep_start = start
-        for batch_dict in ts:
+        steps = len(ts)
+        self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
+        for i, batch_dict in enumerate(ts):
 
-            self.optimizer.zero_grad()
             input_ = self._input(batch_dict)
             tgt = input_['tgt']
-            pred = self.model(input_)
-            loss = self.crit(pred, tgt)
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-            self.optimizer.step()
+            with self.optimizer.autocast(self.model):
+                pred = self.model(input_)
+                loss = self.crit(pred, tgt)
             tgt_lens = batch_dict['tgt_lengths']
             tok_count = self._num_toks(tgt_lens)
             reporting_loss = loss.item() * tok_count
@@ -152,6 +156,11 @@ class Seq2SeqTrainerPyTorch(Trainer):
             epoch_toks += tok_count
             self.nstep_agg += reporting_loss
             self.nstep_div += tok_count
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
 
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
                 metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
@@ -183,13 +192,14 @@ def fit(model_params, ts, vs, es=None, **kwargs):
 
     num_loader_workers = int(kwargs.get('num_loader_workers', 0))
     pin_memory = bool(kwargs.get('pin_memory', True))
+    prefetch = int(kwargs.get('prefetch', 0))
+    prefetch_workers = int(kwargs.get('prefetch_workers', 1))
 
-    if not isinstance(ts, DataLoader):
-        ts = DataLoader(ts, num_workers=num_loader_workers, batch_size=None, pin_memory=pin_memory)
-    if not isinstance(vs, DataLoader):
-        vs = DataLoader(vs, batch_size=None, pin_memory=pin_memory)
-    if es and not isinstance(es, DataLoader):
-        es = DataLoader(es, batch_size=None, pin_memory=pin_memory)
+    distributed = bool(kwargs.get('distributed', False))
+    ts = create_data_loader(ts, num_loader_workers, pin_memory, prefetch, prefetch_workers, distributed=distributed)
+    vs = create_data_loader(vs, 0, pin_memory, prefetch, prefetch_workers)
+    if es:
+        es = create_data_loader(es, 0, pin_memory, prefetch, prefetch_workers)
 
     best_metric = 0
     if do_early_stopping:
@@ -229,8 +239,9 @@ def fit(model_params, ts, vs, es=None, **kwargs):
     if do_early_stopping is True:
         logger.info('Best performance on %s: %.3f at epoch %d', early_stopping_metric, best_metric, last_improved)
 
-    if es is not None:
+    # When we are distributed, only the first worker has the saved model, so it runs the test on its own
+    if es is not None and distributed_rank() == 0:
         model = torch.load(model_file)
-        trainer = create_trainer(model, **kwargs)
+        trainer = create_trainer(model, **{**kwargs, 'distributed': False})
         test_metrics = trainer.test(es, reporting_fns, phase='Test')
     return test_metrics
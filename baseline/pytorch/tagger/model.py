@@ -581,6 +581,7 @@ class TransformerTaggerModel(AbstractEncoderTaggerModel):
         * *d_ff* (``int``) The feed-forward layer size
         * *rpr_k* (``list`` or ``int``) The relative attention sizes.  If its a list, one scalar per layer, if its
           a scalar, apply same size to each layer
+        * *packed* (``bool``) Run the layers on only the valid tokens instead of the padded batch, defaults to `False`
         :return: An encoder
         """
         layers = int(kwargs.get('layers', 1))
@@ -590,7 +591,9 @@ class TransformerTaggerModel(AbstractEncoderTaggerModel):
         hsz = int(kwargs['hsz'])
         rpr_k = kwargs.get('rpr_k', 100)
         d_ff = kwargs.get('d_ff')
-        encoder = TransformerEncoderStackWithLengths(num_heads, hsz, pdrop, scale, layers, d_ff=d_ff, rpr_k=rpr_k, input_sz=input_dim)
+        packed = bool(kwargs.get('packed', False))
+        encoder = TransformerEncoderStackWithLengths(num_heads, hsz, pdrop, scale, layers, d_ff=d_ff, rpr_k=rpr_k, input_sz=input_dim,
+                                                     packed=packed)
         return encoder
 
 
@@ -9,7 +9,6 @@ from eight_mile.pytorch.optz import OptimizerManager
 from eight_mile.utils import span_f1, per_entity_f1, conlleval_output
 from eight_mile.confusion import ConfusionMatrix
 from baseline.model import create_model_for
-from torch.utils.data import DataLoader
 
 logger = logging.getLogger('baseline')
 
@@ -23,6 +22,16 @@ def _add_to_cm(cm, y, pred):
     cm.add_batch(yt.data.numpy(), yp.data.numpy())
 
 
+class _ComputeLoss(nn.Module):
+    """Make a tagger's `compute_loss()` its `forward()`, so that it can be wrapped in `DistributedDataParallel`"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, inputs):
+        return self.model.compute_loss(inputs)
+
+
 @register_trainer(task='tagger', name='default')
 class TaggerTrainerPyTorch(EpochReportingTrainer):
 
@@ -33,7 +42,6 @@ class TaggerTrainerPyTorch(EpochReportingTrainer):
             if checkpoint:
                 model['checkpoint'] = checkpoint
             model = create_model_for('tagger', **model)
-        self.grad_accum = int(kwargs.get('grad_accum', 1))
         self.gpus = int(kwargs.get('gpus', 1))
         # By default support IOB1/IOB2
         self.span_type = kwargs.get('span_type', 'iob')
@@ -51,11 +59,16 @@ class TaggerTrainerPyTorch(EpochReportingTrainer):
             self.model = model.cuda()
         else:
             logger.warning("Requested training on CPU.  This will be slow.")
+        self.compute_loss = self.model.compute_loss
+        if bool(kwargs.get('distributed', False)):
+            self.compute_loss = distributed_data_parallel(_ComputeLoss(self.model), **kwargs)
 
         self.nsteps = kwargs.get('nsteps', six.MAXSIZE)
 
     def save(self, model_file):
-        self.model.save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self.model.save(model_file)
 
     @staticmethod
     def _get_batchsz(batch_dict):
@@ -146,25 +159,27 @@ class TaggerTrainerPyTorch(EpochReportingTrainer):
         steps = len(ts)
         pg = create_progress_bar(steps)
         self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
 
         for i, batch_dict in enumerate(pg(ts)):
             inputs = self.model.make_input(batch_dict)
-            loss = self.model.compute_loss(inputs)
-            loss.backward()
-
-            if (i+1) % self.grad_accum == 0 or (i+1) == steps:
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+            with self.optimizer.autocast(self.model):
+                loss = self.compute_loss(inputs)
 
             bsz = self._get_batchsz(batch_dict)
-            report_loss = loss.item() * bsz
+            # The loss sums stay on the device so we dont sync every step, only when we report
+            report_loss = loss.detach().double() * bsz
             epoch_loss += report_loss
             epoch_norm += bsz
             self.nstep_agg += report_loss
             self.nstep_div += bsz
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
-                metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
+                metrics = self.calc_metrics(float(self.nstep_agg), self.nstep_div)
                 metrics['lr'] = self.optimizer.current_lr
                 self.report(
                     self.optimizer.global_step + 1, metrics, self.nstep_start,
@@ -172,7 +187,7 @@ class TaggerTrainerPyTorch(EpochReportingTrainer):
                 )
                 self.reset_nstep()
 
-        metrics = self.calc_metrics(epoch_loss, epoch_norm)
+        metrics = self.calc_metrics(float(epoch_loss), epoch_norm)
         metrics['lr'] = self.optimizer.current_lr
 
         return metrics
@@ -192,7 +207,6 @@ class JointTaggerTrainerPyTorch(EpochReportingTrainer):
             if checkpoint:
                 model['checkpoint'] = checkpoint
             model = create_model_for('tagger', **model)
-        self.grad_accum = int(kwargs.get('grad_accum', 1))
         self.gpus = int(kwargs.get('gpus', 1))
         # By default support IOB1/IOB2
         self.span_type = kwargs.get('span_type', 'iob')
@@ -211,11 +225,16 @@ class JointTaggerTrainerPyTorch(EpochReportingTrainer):
             self.model = model.cuda()
         else:
             logger.warning("Requested training on CPU.  This will be slow.")
+        self.compute_loss = self.model.compute_loss
+        if bool(kwargs.get('distributed', False)):
+            self.compute_loss = distributed_data_parallel(_ComputeLoss(self.model), **kwargs)
 
         self.nsteps = kwargs.get('nsteps', six.MAXSIZE)
 
     def save(self, model_file):
-        self.model.save(model_file)
+        # Only the first worker writes out the model when we are distributed
+        if distributed_rank() == 0:
+            self.model.save(model_file)
 
     @staticmethod
     def _get_batchsz(batch_dict):
@@ -309,25 +328,27 @@ class JointTaggerTrainerPyTorch(EpochReportingTrainer):
         steps = len(ts)
         pg = create_progress_bar(steps)
         self.optimizer.zero_grad()
+        self.optimizer.start_epoch(steps)
 
         for i, batch_dict in enumerate(pg(ts)):
             inputs = self.model.make_input(batch_dict)
-            loss = self.model.compute_loss(inputs)
-            loss.backward()
-
-            if (i+1) % self.grad_accum == 0 or (i+1) == steps:
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-                self.optimizer.step()
-                self.optimizer.zero_grad()
+            with self.optimizer.autocast(self.model):
+                loss = self.compute_loss(inputs)
 
             bsz = self._get_batchsz(batch_dict)
-            report_loss = loss.item() * bsz
+            # The loss sums stay on the device so we dont sync every step, only when we report
+            report_loss = loss.detach().double() * bsz
             epoch_loss += report_loss
             epoch_norm += bsz
             self.nstep_agg += report_loss
             self.nstep_div += bsz
+            if not self.optimizer.backward(loss) and (i + 1) != steps:
+                continue
+            self.optimizer.clip_grad_norm(self.clip)
+            self.optimizer.step()
+            self.optimizer.zero_grad()
             if (self.optimizer.global_step + 1) % self.nsteps == 0:
-                metrics = self.calc_metrics(self.nstep_agg, self.nstep_div)
+                metrics = self.calc_metrics(float(self.nstep_agg), self.nstep_div)
                 metrics['lr'] = self.optimizer.current_lr
                 self.report(
                     self.optimizer.global_step + 1, metrics, self.nstep_start,
@@ -335,7 +356,7 @@ class JointTaggerTrainerPyTorch(EpochReportingTrainer):
                 )
                 self.reset_nstep()
 
-        metrics = self.calc_metrics(epoch_loss, epoch_norm)
+        metrics = self.calc_metrics(float(epoch_loss), epoch_norm)
         metrics['lr'] = self.optimizer.current_lr
 
         return metrics
@@ -352,13 +373,14 @@ def fit(model_params, ts, vs, es, **kwargs):
 
     num_loader_workers = int(kwargs.get('num_loader_workers', 0))
     pin_memory = bool(kwargs.get('pin_memory', True))
+    prefetch = int(kwargs.get('prefetch', 0))
+    prefetch_workers = int(kwargs.get('prefetch_workers', 1))
 
-    if not isinstance(ts, DataLoader):
-        ts = DataLoader(ts, num_workers=num_loader_workers, batch_size=None, pin_memory=pin_memory)
-    if not isinstance(vs, DataLoader):
-        vs = DataLoader(vs, batch_size=None, pin_memory=pin_memory)
-    if es and not isinstance(es, DataLoader):
-        es = DataLoader(es, batch_size=None, pin_memory=pin_memory)
+    distributed = bool(kwargs.get('distributed', False))
+    ts = create_data_loader(ts, num_loader_workers, pin_memory, prefetch, prefetch_workers, distributed=distributed)
+    vs = create_data_loader(vs, 0, pin_memory, prefetch, prefetch_workers)
+    if es:
+        es = create_data_loader(es, 0, pin_memory, prefetch, prefetch_workers)
 
     best_metric = 0
     if do_early_stopping:
@@ -397,9 +419,10 @@ def fit(model_params, ts, vs, es, **kwargs):
     if do_early_stopping is True:
         logger.info('Best performance on %s: %.3f at epoch %d', early_stopping_metric, best_metric, last_improved)
 
-    if es is not None:
+    # When we are distributed, only the first worker has the saved model, so it runs the test on its own
+    if es is not None and distributed_rank() == 0:
         logger.info('Reloading best checkpoint')
         model = torch.load(model_file)
-        trainer = create_trainer(model, **kwargs)
+        trainer = create_trainer(model, **{**kwargs, 'distributed': False})
         test_metrics = trainer.test(es, reporting_fns, conll_output=conll_output, txts=txts, phase='Test')
     return test_metrics
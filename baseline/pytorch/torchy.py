@@ -1,14 +1,20 @@
 import math
 import copy
 import os
+import random
 import logging
+from typing import Optional
 import numpy as np
 import torch
 import torch.autograd
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import IterableDataset, Dataset
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import IterableDataset, Dataset, DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 from baseline.utils import lookup_sentence, get_version, Offsets
+from baseline.data import PrefetchDataFeed
 from eight_mile.pytorch.layers import *
 
 PYT_MAJOR_VERSION = get_version(torch)
@@ -17,6 +23,53 @@ BaseLayer = nn.Module
 TensorDef = torch.Tensor
 
 
+def confusion_counts(truth: torch.Tensor, guess: torch.Tensor, nc: int, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Count a batch of `truth` and `guess` pairs into a confusion matrix with a single `index_add_`
+
+    Unlike `torch.bincount`, which has to read the largest value back to the host to size its output, this adds
+    into a tensor that is sized by `nc` so it never syncs with a CUDA device
+
+    :param truth: The gold labels
+    :param guess: The predicted labels, the same shape as `truth`
+    :param nc: The number of classes
+    :param out: An optional flat ``[nc * nc]`` long tensor to add the counts into
+    :return: An ``[nc, nc]`` tensor of counts, indexed by ``[truth, guess]``, on the same device as the inputs
+    """
+    flat = truth.reshape(-1).long() * nc + guess.reshape(-1).long()
+    if out is None:
+        out = torch.zeros(nc * nc, dtype=torch.long, device=flat.device)
+    out.index_add_(0, flat, torch.ones_like(flat))
+    return out.view(nc, nc)
+
+
+class ConfusionCounts:
+    """Accumulate confusion counts as a tensor on whatever device the predictions live on
+
+    Adding a batch never syncs with the host.  The counts only come back when they are merged into a
+    `ConfusionMatrix` with `update()`, which the trainers do at the end of an epoch
+    """
+
+    def __init__(self, nc: int):
+        self.nc = nc
+        self.counts = None
+
+    def add_batch(self, truth: torch.Tensor, guess: torch.Tensor):
+        if self.counts is None:
+            self.counts = torch.zeros(self.nc * self.nc, dtype=torch.long, device=truth.device)
+        confusion_counts(truth, guess, self.nc, out=self.counts)
+
+    def update(self, cm):
+        """Move the counts to the host, add them to `cm` and reset
+
+        :param cm: A `ConfusionMatrix`
+        :return: The `ConfusionMatrix`
+        """
+        if self.counts is not None:
+            cm.add_counts(self.counts.view(self.nc, self.nc).cpu().numpy())
+            self.counts = None
+        return cm
+
+
 class IterableDatasetAdapter(IterableDataset):
     def __init__(self, example_list, shuffle=False):
         super().__init__()
@@ -34,6 +87,141 @@ class IterableDatasetAdapter(IterableDataset):
                 yield example
 
 
+def batch_to_tensors(batch, pin_memory=False):
+    """Convert the numpy arrays in a batch to tensors, the same way a `DataLoader` would
+
+    :param batch: A batch dictionary
+    :param pin_memory: Put the tensors in pinned memory so they can be copied to the GPU asynchronously
+    :return: A batch dictionary of tensors
+    """
+    tensors = {}
+    for k, v in batch.items():
+        if isinstance(v, np.ndarray) and v.dtype.kind in 'biuf':
+            v = torch.from_numpy(v)
+            if pin_memory:
+                v = v.pin_memory()
+        tensors[k] = v
+    return tensors
+
+
+def distributed_rank() -> int:
+    """The rank of this worker if we are training distributed, otherwise 0
+
+    :return: The rank
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def distributed_data_parallel(model: nn.Module, **kwargs) -> DistributedDataParallel:
+    """Wrap a model in `DistributedDataParallel` for this worker
+
+    The process group must already be set up (see `init_distributed`).  With the `nccl` backend the model is moved to
+    this worker's GPU, with `gloo` it is left where it is, which lets us train on CPU-only machines
+
+    :param model: The model to wrap
+    :Keyword Arguments:
+    * *find_unused_parameters* -- (``bool``) Set this if the model has parameters that dont take part in the loss
+    :return: The wrapped model
+    """
+    find_unused_parameters = bool(kwargs.get('find_unused_parameters', False))
+    if dist.get_backend() == 'nccl':
+        device = torch.cuda.current_device()
+        model = model.cuda(device)
+        return DistributedDataParallel(model, device_ids=[device], output_device=device,
+                                       find_unused_parameters=find_unused_parameters)
+    return DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    """Get the model out of a `DataParallel` or `DistributedDataParallel` wrapper
+
+    :param model: A model, possibly wrapped
+    :return: The underlying model
+    """
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+class EpochDistributedSampler(DistributedSampler):
+    """A `DistributedSampler` that moves on to the next epoch each time it is iterated
+
+    The `DistributedSampler` only reshuffles when `set_epoch()` is called, this takes care of that so that the
+    trainers can treat the loader like any other.  When we arent shuffling, each worker gets a contiguous block of
+    batches rather than every `num_replicas`-th one, so stateful models (like an RNN LM) still see a continuous stream
+    """
+    def __iter__(self):
+        if self.shuffle:
+            if hasattr(self.dataset, '_epoch_steps'):
+                # Let the feed draw new batches (like re-bucketing), seeded by the epoch so every worker gets the same ones
+                np_state, py_state = np.random.get_state(), random.getstate()
+                np.random.seed(self.seed + self.epoch)
+                random.seed(self.seed + self.epoch)
+                try:
+                    self.dataset._epoch_steps()
+                finally:
+                    np.random.set_state(np_state)
+                    random.setstate(py_state)
+            indices = list(super().__iter__())
+        else:
+            indices = list(range(len(self.dataset)))
+            padding = self.total_size - len(indices)
+            if padding > 0:
+                indices += (indices * math.ceil(padding / len(indices)))[:padding]
+            indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        self.set_epoch(self.epoch + 1)
+        return iter(indices)
+
+
+class DataFeedSampler(Sampler):
+    """Visit the steps of a `DataFeed` in the order the feed picks for each epoch
+
+    The feed shuffles its steps and draws new length buckets in `_epoch_steps`, a plain `DataLoader` only indexes
+    the feed so it would see the same batches every epoch.  The order is taken when the `DataLoader` starts its
+    iterator, before any worker processes are started, so the workers get the new batches too
+    """
+    def __init__(self, feed):
+        self.feed = feed
+
+    def __iter__(self):
+        return iter(self.feed._epoch_steps().tolist())
+
+    def __len__(self):
+        return len(self.feed)
+
+
+def create_data_loader(feed, num_workers=0, pin_memory=True, prefetch=0, prefetch_workers=1, distributed=False):
+    """Wrap a `DataFeed` so it can be iterated for tensors in a trainer
+
+    By default this is a `DataLoader` over the feed that visits the steps in the order the feed picks each epoch
+    (see `DataFeedSampler`).  If `prefetch` is set, the feed is wrapped in a
+    `PrefetchDataFeed` instead, which builds the next `prefetch` batches (and their tensors) on `prefetch_workers`
+    background threads, and keeps the per-epoch shuffling and bucketing of the feed
+
+    If `distributed` is set, the batches of the feed are split between the workers with an
+    `EpochDistributedSampler`, which also takes over the shuffling.  Prefetching is not used in that case
+
+    :param feed: A `DataFeed`, if it is already a `DataLoader` or `PrefetchDataFeed` it is returned as is
+    :param num_workers: The number of `DataLoader` worker processes
+    :param pin_memory: Use pinned memory for the tensors
+    :param prefetch: The number of batches to build ahead, `0` turns prefetching off
+    :param prefetch_workers: The number of threads that build batches when prefetching
+    :param distributed: Give each distributed worker its own share of the batches
+    :return: Something that can be iterated for batches of tensors
+    """
+    if isinstance(feed, (DataLoader, PrefetchDataFeed)):
+        return feed
+    if distributed:
+        sampler = EpochDistributedSampler(feed, shuffle=feed.shuffle)
+        return DataLoader(feed, num_workers=num_workers, batch_size=None, pin_memory=pin_memory, sampler=sampler)
+    if prefetch > 0:
+        pin_memory = pin_memory and torch.cuda.is_available()
+        return PrefetchDataFeed(feed, prefetch, prefetch_workers, transform=lambda batch: batch_to_tensors(batch, pin_memory))
+    return DataLoader(feed, num_workers=num_workers, batch_size=None, pin_memory=pin_memory, sampler=DataFeedSampler(feed))
+
+
 class DatasetAdapter(Dataset):
     """Wrapper for example_list, only needed if you care about typing
 
@@ -1,11 +1,15 @@
 import os
 import re
+import hashlib
 from typing import List, Dict
 import codecs
 import json
 from itertools import chain
 import logging
-from collections import Counter
+import multiprocessing as mp
+from functools import partial
+from contextlib import contextmanager
+from collections import Counter, namedtuple
 import numpy as np
 import baseline.data
 from baseline.vectorizers import Dict1DVectorizer, Token1DVectorizer, create_vectorizer, HasPredefinedVocab
@@ -106,7 +110,22 @@ def _read_from_col(col, files, col_splitter=r'\t', word_splitter=r'\s'):
     return text
 
 
-def _build_vocab_for_col(col, files, vectorizers, text=None, col_splitter=r'\t', word_splitter=r'\s'):
+def _count_col(col, vectorizers, col_splitter, word_splitter, shard):
+    """Count the words in a single column of a file, or a `_FileShard` of one"""
+    counts = {k: Counter() for k in vectorizers}
+    with _open_text(shard) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line == "":
+                continue
+            cols = re.split(col_splitter, line)
+            t = re.split(word_splitter, cols[col])
+            for k, vect in vectorizers.items():
+                counts[k].update(vect.count(t))
+    return counts, _seen_state(vectorizers)
+
+
+def _build_vocab_for_col(col, files, vectorizers, text=None, col_splitter=r'\t', word_splitter=r'\s', workers=1):
     """Build vocab from a single column in file. (separated by `\t`).
 
     Used to read a vocab from a single conll column, read a vocab from the
@@ -118,14 +137,23 @@ def _build_vocab_for_col(col, files, vectorizers, text=None, col_splitter=r'\t',
     :param text: List[str]: The text from the columns or None
     :param col_splitter: `str`: The regex that splits a line into columns.
     :param word_splitter: `str`: The regex that will split a column into words.
+    :param workers: `int`: The number of processes to count the files with.
 
     :returns: dict[str] -> dict[str] -> int: The vocabs.
     """
-    text = _read_from_col(col, files, col_splitter, word_splitter) if text is None else text
+    if text is None and workers <= 1:
+        text = _read_from_col(col, files, col_splitter, word_splitter)
     vocab = {k: Counter() for k in vectorizers}
-    for t in text:
-        for k, vect in vectorizers.items():
-            vocab[k].update(vect.count(t))
+    if text is not None:
+        for t in text:
+            for k, vect in vectorizers.items():
+                vocab[k].update(vect.count(t))
+        return vocab
+
+    count = partial(_count_col, col, vectorizers, col_splitter, word_splitter)
+    for counts, seen in _map_shards(count, _shard_files(files, workers), workers):
+        _merge_counts(vocab, counts)
+        _merge_seen_state(vectorizers, seen)
     return vocab
 
 
@@ -146,12 +174,248 @@ def _vocab_allowed(vectorizers):
         raise RuntimeError(fail_str + vect_str)
 
 
+class _FileShard(namedtuple('_FileShard', 'file_name start end')):
+    """A byte range of a file, from the start of a line up to the start of another line (or the end of the file)"""
+
+
+# A shard is never smaller than this, so small files are not split up
+_MIN_SHARD_BYTES = 1 << 20
+# The function a `_map_shards` pool worker calls, this is only ever set in the (forked) worker processes
+_WORKER_FN = None
+
+
+def _read_shard_lines(f, size):
+    while size > 0:
+        line = f.readline()
+        if not line:
+            break
+        size -= len(line)
+        # `codecs` splits on all the unicode line breaks, not just `\n`, so we do the same
+        for l in line.decode('utf-8').splitlines(True):
+            yield l
+
+
+@contextmanager
+def _open_text(file_name):
+    """Open a file name, or a `_FileShard` of one, for reading lines of UTF-8 text"""
+    if not isinstance(file_name, _FileShard):
+        with codecs.open(file_name, encoding='utf-8', mode='r') as f:
+            yield f
+        return
+    with open(file_name.file_name, 'rb') as f:
+        f.seek(file_name.start)
+        yield _read_shard_lines(f, file_name.end - file_name.start)
+
+
+def _shard_file(file_name, num_shards, blank_lines=False, start=0):
+    """Split a file into (up to) `num_shards` byte ranges that only hold whole lines
+
+    :param file_name: The file to split
+    :param num_shards: How many pieces to split it into, files smaller than `_MIN_SHARD_BYTES` per shard get fewer
+    :param blank_lines: If `True`, only split after a blank line, for files where an example spans several lines
+    :param start: The offset of the first byte to read, this is used to skip a header
+    :return: A list of `_FileShard`s, or just `[file_name]` when the file is not split so that it is read with
+        `codecs` like before (in that case the caller skips anything before `start`)
+    """
+    size = os.path.getsize(file_name)
+    num_shards = max(1, min(num_shards, (size - start) // _MIN_SHARD_BYTES))
+    if num_shards == 1:
+        return [file_name]
+    bounds = [start]
+    with open(file_name, 'rb') as f:
+        for i in range(1, num_shards):
+            offset = start + (size - start) * i // num_shards
+            if offset <= bounds[-1]:
+                continue
+            # Move to the start of the next line
+            f.seek(offset - 1)
+            f.readline()
+            if blank_lines:
+                for line in iter(f.readline, b''):
+                    if not line.strip():
+                        break
+            offset = f.tell()
+            if bounds[-1] < offset < size:
+                bounds.append(offset)
+    bounds.append(max(size, start))
+    return [_FileShard(file_name, s, e) for s, e in zip(bounds, bounds[1:])]
+
+
+def _shard_files(files, workers, blank_lines=False):
+    return [shard for file_name in files if file_name is not None for shard in _shard_file(file_name, workers, blank_lines)]
+
+
+def _init_shard_worker(fn):
+    global _WORKER_FN
+    _WORKER_FN = fn
+
+
+def _run_shard(shard):
+    return _WORKER_FN(shard)
+
+
+def _map_shards(fn, shards, workers=1):
+    """Call `fn` on each of the shards, using `workers` processes when there is more than one
+
+    The results come back in the same order as the shards, so merging them in order gives the same result as
+    reading the files one after another
+
+    :param fn: The function to call on each shard, a `partial` of one of the module-level counting functions
+    :param shards: The shards (or file names)
+    :param workers: The number of processes to use
+    :return: A list of the results
+    """
+    workers = min(workers, len(shards))
+    if workers <= 1 or 'fork' not in mp.get_all_start_methods():
+        return [fn(shard) for shard in shards]
+    # The workers are forked and get `fn` through their initializer, so it (and the reader and vectorizers it uses)
+    # is never pickled, and nothing in this process is shared between calls
+    with mp.get_context('fork').Pool(workers, initializer=_init_shard_worker, initargs=(fn,)) as pool:
+        return pool.map(_run_shard, shards, chunksize=1)
+
+
+def _vocab_workers(**kwargs):
+    """Get the number of processes to build the vocab with from the reader config, `-1` means use all the cores"""
+    workers = int(kwargs.get('vocab_workers', 1))
+    if workers < 1:
+        return os.cpu_count() or 1
+    return workers
+
+
+def _merge_counts(vocabs, counts):
+    for k, counter in counts.items():
+        vocabs[k].update(counter)
+
+
+def _seen_state(vectorizers):
+    """Get the longest lengths that each vectorizer has counted, they size the tensors when `mxlen` is -1"""
+    return {k: {a: v for a, v in vars(vect).items() if a.startswith('max_seen')} for k, vect in vectorizers.items()}
+
+
+def _merge_seen_state(vectorizers, seen):
+    for k, state in seen.items():
+        for attr, value in state.items():
+            setattr(vectorizers[k], attr, max(getattr(vectorizers[k], attr), value))
+
+
+def _bucketing_params(**kwargs):
+    """Get the length bucketing options for the `ExampleDataFeed` from the reader config, if there are any"""
+    return {k: kwargs[k] for k in ('max_tokens', 'num_buckets', 'bucket_key') if kwargs.get(k) is not None}
+
+
+def _describe(value):
+    """Get a stable, JSON-serializable description of a reader or vectorizer setting for the example cache key"""
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, set):
+        return [_describe(v) for v in sorted(value, key=str)]
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _describe(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if callable(value):
+        code = getattr(value, '__code__', None)
+        name = '{}.{}'.format(getattr(value, '__module__', ''), getattr(value, '__qualname__', type(value).__name__))
+        # Lambdas all share a name, so tell them apart by what they do
+        return name if code is None else '{}:{}'.format(name, hashlib.sha1(code.co_code).hexdigest())
+    return type(value).__name__
+
+
+def _is_setting(value):
+    """Is this a simple value (or a container of them, or a function) that we can put in the example cache key?"""
+    if isinstance(value, (str, int, float, bool, type(None))) or callable(value):
+        return True
+    if isinstance(value, (list, tuple, set)):
+        return all(_is_setting(v) for v in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, (str, int)) and _is_setting(v) for k, v in value.items())
+    return False
+
+
+def _vectorizer_specs(vectorizers):
+    """Get the class and settings of each vectorizer for the example cache key
+
+    The settings are all the simple attributes of the vectorizer except for the `max_seen` counters, which change
+    while counting.  This should be called when a reader is built, before the vectorizers are run, because `run`
+    fills in settings like an `mxlen` of `-1` from what was seen while counting
+
+    :param vectorizers: A dictionary of vectorizers
+    :return: A JSON-serializable description of each vectorizer
+    """
+    return {
+        k: [
+            type(v).__name__,
+            {a: _describe(value) for a, value in sorted(vars(v).items()) if not a.startswith('max_seen') and _is_setting(value)},
+        ]
+        for k, v in vectorizers.items()
+    }
+
+
+def _vectorizer_state(vectorizer):
+    """Get the simple attributes of a vectorizer, some of these (like `mxlen`) are only filled in on the first `run`"""
+    return {k: v for k, v in vars(vectorizer).items() if isinstance(v, (str, int, float, bool, type(None)))}
+
+
+def _example_cache_path(cache_dir, files, specs, vocabs, **config):
+    """Get the directory of the example cache for these files, vectorizers and vocabularies
+
+    The key covers the file contents, the class and settings of each vectorizer (from `_vectorizer_specs`), the
+    vocabularies and any other reader settings that change the tensors, so a change to any of them goes to a new
+    cache entry
+    """
+    sha1 = hashlib.sha1()
+    for file_name in files:
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    description = {
+        'vectorizers': specs,
+        'vocabs': {k: sorted(v.items()) for k, v in vocabs.items()},
+        'config': _describe(config),
+    }
+    sha1.update(json.dumps(description, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, sha1.hexdigest())
+
+
+def _load_cached_examples(cache_dir, files, vectorizers, specs, vocabs, build_fn, **config):
+    """Load the vectorized examples from a memory-mapped cache, or build them and write the cache
+
+    :param cache_dir: The cache directory, if this is `None` the examples are always built
+    :param files: The files the examples are read from
+    :param vectorizers: All the vectorizers that are used to build an example
+    :param specs: The `_vectorizer_specs` of the vectorizers, taken when the reader was built
+    :param vocabs: The vocabulary for each vectorizer
+    :param build_fn: A function that builds the list of examples
+    :param config: Any other settings that change the examples
+    :return: A list of example dictionaries, or a `PackedExampleList` when it came from the cache
+    """
+    if cache_dir is None:
+        return build_fn()
+    path = _example_cache_path(cache_dir, files, specs, vocabs, **config)
+    if os.path.exists(path):
+        logger.info("Loading cached examples from %s", path)
+        examples = baseline.data.PackedExampleList(path)
+        for k, state in examples.extra.get('vectorizers', {}).items():
+            vars(vectorizers[k]).update(state)
+        return examples
+    examples = build_fn()
+    if examples:
+        os.makedirs(cache_dir, exist_ok=True)
+        state = {k: _vectorizer_state(v) for k, v in vectorizers.items()}
+        baseline.data.PackedExampleList.write(examples, path, extra={'vectorizers': state})
+        logger.info("Wrote example cache to %s", path)
+    return examples
+
+
 @export
 class ParallelCorpusReader:
 
-    def __init__(self, vectorizers, trim=False, truncate=False):
+    def __init__(self, vectorizers, trim=False, truncate=False, **kwargs):
         super().__init__()
 
+        self.cache_dir = kwargs.get('cache_dir')
+        self.bucketing = _bucketing_params(**kwargs)
+        self.vocab_workers = _vocab_workers(**kwargs)
         self.src_vectorizers = {}
         self.tgt_vectorizer = None
         for k, vectorizer in vectorizers.items():
@@ -165,6 +429,7 @@ class ParallelCorpusReader:
                 self.src_vectorizers[k] = vectorizer
         self.trim = trim
         self.truncate = truncate
+        self.vectorizer_specs = _vectorizer_specs(dict(self.src_vectorizers, tgt=self.tgt_vectorizer))
 
     def build_vocabs(self, files, **kwargs):
         pass
@@ -175,7 +440,8 @@ class ParallelCorpusReader:
     def load(self, tsfile, vocab1, vocab2, batchsz, shuffle=False, sort_key=None):
         examples = self.load_examples(tsfile, vocab1, vocab2, shuffle, sort_key)
         return baseline.data.ExampleDataFeed(examples, batchsz,
-                                             shuffle=shuffle, trim=self.trim, sort_key=sort_key, truncate=self.truncate)
+                                             shuffle=shuffle, trim=self.trim, sort_key=sort_key, truncate=self.truncate,
+                                             **self.bucketing)
 
 
 @register_reader(task='seq2seq', name='tsv')
@@ -183,7 +449,7 @@ class TSVParallelCorpusReader(ParallelCorpusReader):
 
     def __init__(self, vectorizers,
                  trim=False, truncate=False, src_col_num=0, tgt_col_num=1, **kwargs):
-        super().__init__(vectorizers, trim, truncate)
+        super().__init__(vectorizers, trim, truncate, **kwargs)
         self.src_col_num = src_col_num
         self.tgt_col_num = tgt_col_num
 
@@ -201,15 +467,15 @@ class TSVParallelCorpusReader(ParallelCorpusReader):
             src_vocab = _build_vocab_for_col(None, None, self.src_vectorizers, text=text)
             tgt_vocab = _build_vocab_for_col(None, None, {'tgt': self.tgt_vectorizer}, text=text)
             return src_vocab, tgt_vocab['tgt']
-        src_vocab = _build_vocab_for_col(self.src_col_num, files, self.src_vectorizers)
-        tgt_vocab = _build_vocab_for_col(self.tgt_col_num, files, {'tgt': self.tgt_vectorizer})
+        src_vocab = _build_vocab_for_col(self.src_col_num, files, self.src_vectorizers, workers=self.vocab_workers)
+        tgt_vocab = _build_vocab_for_col(self.tgt_col_num, files, {'tgt': self.tgt_vectorizer}, workers=self.vocab_workers)
         min_f = kwargs.get('min_f', {})
         tgt_min_f = {'tgt': min_f.pop('tgt', -1)}
         src_vocab = _filter_vocab(src_vocab, min_f)
         tgt_vocab = _filter_vocab(tgt_vocab, tgt_min_f)
         return src_vocab, tgt_vocab['tgt']
 
-    def load_examples(self, tsfile, src_vocabs, tgt_vocab, do_shuffle, src_sort_key):
+    def _build_examples(self, tsfile, src_vocabs, tgt_vocab):
         ts = []
         with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
             for line in f:
@@ -225,6 +491,15 @@ class TSVParallelCorpusReader(ParallelCorpusReader):
                 tgt = list(filter(lambda x: len(x) != 0, re.split("\s+", splits[1])))
                 example['tgt'], example['tgt_lengths'] = self.tgt_vectorizer.run(tgt, tgt_vocab)
                 ts.append(example)
+        return ts
+
+    def load_examples(self, tsfile, src_vocabs, tgt_vocab, do_shuffle, src_sort_key):
+        vocabs = dict(src_vocabs, tgt=tgt_vocab)
+        ts = _load_cached_examples(self.cache_dir, [tsfile], dict(self.src_vectorizers, tgt=self.tgt_vectorizer),
+                                   self.vectorizer_specs, vocabs,
+                                   lambda: self._build_examples(tsfile, src_vocabs, tgt_vocab),
+                                   reader=type(self).__name__, src_col_num=self.src_col_num,
+                                   tgt_col_num=self.tgt_col_num)
         return baseline.data.Seq2SeqExamples(ts, do_shuffle=do_shuffle, src_sort_key=src_sort_key)
 
 
@@ -233,7 +508,7 @@ class TSVParallelCorpusReader(ParallelCorpusReader):
 class MultiFileParallelCorpusReader(ParallelCorpusReader):
 
     def __init__(self, vectorizers, trim=False, truncate=False, **kwargs):
-        super().__init__(vectorizers, trim, truncate)
+        super().__init__(vectorizers, trim, truncate, **kwargs)
         pair_suffix = kwargs['pair_suffix']
 
         self.src_suffix = pair_suffix[0]
@@ -257,15 +532,17 @@ class MultiFileParallelCorpusReader(ParallelCorpusReader):
             src_vocab = _build_vocab_for_col(None, None, self.src_vectorizers, text=text)
             tgt_vocab = _build_vocab_for_col(None, None, {'tgt': self.tgt_vectorizer}, text=text)
             return src_vocab, tgt_vocab['tgt']
-        src_vocab = _build_vocab_for_col(0, [f + self.src_suffix for f in files], self.src_vectorizers)
-        tgt_vocab = _build_vocab_for_col(0, [f + self.tgt_suffix for f in files], {'tgt': self.tgt_vectorizer})
+        src_vocab = _build_vocab_for_col(0, [f + self.src_suffix for f in files], self.src_vectorizers,
+                                         workers=self.vocab_workers)
+        tgt_vocab = _build_vocab_for_col(0, [f + self.tgt_suffix for f in files], {'tgt': self.tgt_vectorizer},
+                                         workers=self.vocab_workers)
         min_f = kwargs.get('min_f', {})
         tgt_min_f = {'tgt': min_f.pop('tgt', -1)}
         src_vocab = _filter_vocab(src_vocab, min_f)
         tgt_vocab = _filter_vocab(tgt_vocab, tgt_min_f)
         return src_vocab, tgt_vocab['tgt']
 
-    def load_examples(self, tsfile, src_vocabs, tgt_vocab, do_shuffle, src_sort_key):
+    def _build_examples(self, tsfile, src_vocabs, tgt_vocab):
         ts = []
 
         with codecs.open(tsfile + self.src_suffix, encoding='utf-8', mode='r') as fsrc:
@@ -280,6 +557,14 @@ class MultiFileParallelCorpusReader(ParallelCorpusReader):
                     tgt = re.split("\s+", tgt.strip())
                     example['tgt'], example['tgt_lengths'] = self.tgt_vectorizer.run(tgt, tgt_vocab)
                     ts.append(example)
+        return ts
+
+    def load_examples(self, tsfile, src_vocabs, tgt_vocab, do_shuffle, src_sort_key):
+        vocabs = dict(src_vocabs, tgt=tgt_vocab)
+        ts = _load_cached_examples(self.cache_dir, [tsfile + self.src_suffix, tsfile + self.tgt_suffix],
+                                   dict(self.src_vectorizers, tgt=self.tgt_vectorizer), self.vectorizer_specs, vocabs,
+                                   lambda: self._build_examples(tsfile, src_vocabs, tgt_vocab),
+                                   reader=type(self).__name__)
         return baseline.data.Seq2SeqExamples(ts, do_shuffle=do_shuffle, src_sort_key=src_sort_key)
 
 
@@ -295,14 +580,40 @@ def _try_read_labels(**kwargs):
     return label2index
 
 
+def _count_examples(reader, vectorizers, shard):
+    """Count each example that `reader` reads from a file (or a `_FileShard` of one) with the vectorizers"""
+    counts = {k: Counter() for k in vectorizers}
+    for example in reader.read_examples(shard):
+        for k, vectorizer in vectorizers.items():
+            counts[k].update(vectorizer.count(example))
+    return counts, _seen_state(vectorizers)
+
+
+def _count_multi_label_examples(reader, shard):
+    """Count each example that a `MultiLabelSeqPredictReader` reads with its label and feature vectorizers"""
+    label_counts = {k: Counter() for k in reader.label_vectorizers}
+    counts = {k: Counter() for k in reader.vectorizers}
+    for example in reader.read_examples(shard):
+        for k, vectorizer in reader.label_vectorizers.items():
+            label_counts[k].update(vectorizer.count(example))
+        for k, vectorizer in reader.vectorizers.items():
+            counts[k].update(vectorizer.count(example))
+    return label_counts, counts, _seen_state(reader.label_vectorizers), _seen_state(reader.vectorizers)
+
+
 @export
 class SeqPredictReader:
+    # Examples are separated by blank lines, so the files can only be split for counting at a blank line
+    blank_line_separated = True
 
     def __init__(self, vectorizers, trim=False, truncate=False, mxlen=-1, **kwargs):
         super().__init__()
         self.vectorizers = vectorizers
         self.trim = trim
         self.truncate = truncate
+        self.cache_dir = kwargs.get('cache_dir')
+        self.bucketing = _bucketing_params(**kwargs)
+        self.vocab_workers = _vocab_workers(**kwargs)
         label_vectorizer_spec = kwargs.get('label_vectorizer', None)
         if label_vectorizer_spec:
             cache = label_vectorizer_spec.get("data_download_cache", os.path.expanduser("~/.bl-data"))
@@ -317,6 +628,7 @@ class SeqPredictReader:
             self.label_vectorizer = create_vectorizer(**label_vectorizer_spec)
         else:
             self.label_vectorizer = Dict1DVectorizer(fields='y', mxlen=mxlen)
+        self.vectorizer_specs = _vectorizer_specs(dict(self.vectorizers, y=self.label_vectorizer))
         self.label2index = {
             Offsets.VALUES[Offsets.PAD]: Offsets.PAD,
             Offsets.VALUES[Offsets.GO]: Offsets.GO,
@@ -355,18 +667,14 @@ class SeqPredictReader:
                 pre_vocabs = _build_vocab_for_col(0, listify(vocab_file), self.vectorizers)
 
         labels = Counter()
+        all_vectorizers = dict(self.vectorizers, y=self.label_vectorizer)
 
-        for file in files:
-            if file is None:
-                continue
-
-            examples = self.read_examples(file)
-            for example in examples:
-                labels.update(self.label_vectorizer.count(example))
-                if not have_vocabs:
-                    for k, vectorizer in self.vectorizers.items():
-                        vocab_example = vectorizer.count(example)
-                        vocabs[k].update(vocab_example)
+        count = partial(_count_examples, self, {k: v for k, v in all_vectorizers.items() if k == 'y' or not have_vocabs})
+        shards = _shard_files(files, self.vocab_workers, self.blank_line_separated)
+        for counts, seen in _map_shards(count, shards, self.vocab_workers):
+            labels.update(counts.pop('y'))
+            _merge_counts(vocabs, counts)
+            _merge_seen_state(all_vectorizers, seen)
 
         if label2index:
             logger.info("Collected vocabs via counting, labels via file")
@@ -387,12 +695,23 @@ class SeqPredictReader:
 
     def load(self, filename, vocabs, batchsz, shuffle=False, sort_key=None):
         texts = self.read_examples(filename)
+        return self._load_texts(filename, texts, vocabs, batchsz, shuffle, sort_key,
+                                lambda: self.convert_to_tensors(texts, vocabs))
+
+    def cache_config(self):
+        """Get the reader settings that change the tensors `convert_to_tensors` makes, for the example cache key"""
+        return {'reader': type(self).__name__, 'named_fields': getattr(self, 'named_fields', {})}
+
+    def _load_texts(self, filename, texts, vocabs, batchsz, shuffle, sort_key, build_fn):
         if sort_key is not None and not sort_key.endswith('_lengths'):
             sort_key += '_lengths'
 
-        examples = self.convert_to_tensors(texts, vocabs)
+        vectorizers = dict(self.vectorizers, y=self.label_vectorizer)
+        examples = _load_cached_examples(self.cache_dir, [filename], vectorizers, self.vectorizer_specs,
+                                         dict(vocabs, y=self.label2index), build_fn, **self.cache_config())
         examples = baseline.data.DictExamples(examples, do_shuffle=shuffle, sort_key=sort_key)
-        return baseline.data.ExampleDataFeed(examples, batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate), texts
+        return baseline.data.ExampleDataFeed(examples, batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate,
+                                             **self.bucketing), texts
 
     def convert_to_tensors(self, texts, vocabs):
         ts = []
@@ -421,6 +740,7 @@ class MultiLabelSeqPredictReader:
         self.vectorizers = vectorizers
         self.trim = trim
         self.truncate = truncate
+        self.vocab_workers = _vocab_workers(**kwargs)
         label_vectorizer_spec_dict = kwargs.get('label_vectorizers', {'y': Dict1DVectorizer(fields='y', mxlen=mxlen)})
         self.label_vectorizers = {}
         self.label2index = {}
@@ -458,17 +778,13 @@ class MultiLabelSeqPredictReader:
             _vocab_allowed(self.vectorizers)
             pre_vocabs = _build_vocab_for_col(0, listify(vocab_file), self.vectorizers)
 
-        for file in files:
-            if file is None:
-                continue
-
-            examples = self.read_examples(file)
-            for example in examples:
-                for k, vectorizer in self.label_vectorizers.items():
-                    labels[k].update(vectorizer.count(example))
-                for k, vectorizer in self.vectorizers.items():
-                    vocab_example = vectorizer.count(example)
-                    vocabs[k].update(vocab_example)
+        shards = _shard_files(files, self.vocab_workers, blank_lines=True)
+        count = partial(_count_multi_label_examples, self)
+        for label_counts, counts, label_seen, seen in _map_shards(count, shards, self.vocab_workers):
+            _merge_counts(labels, label_counts)
+            _merge_counts(vocabs, counts)
+            _merge_seen_state(self.label_vectorizers, label_seen)
+            _merge_seen_state(self.vectorizers, seen)
 
         vocabs = _filter_vocab(vocabs, kwargs.get('min_f', {}))
         base_offset = len(Offsets.VALUES) - 1  # Dont put UNK in labels
@@ -523,7 +839,7 @@ class CONLLSeqReader(SeqPredictReader):
         tokens = []
         examples = []
 
-        with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
+        with _open_text(tsfile) as f:
             for i, line in enumerate(f):
                 states = re.split("\s", line.strip())
 
@@ -555,14 +871,24 @@ class CONLLJointSeqReader(CONLLSeqReader):
     def __init__(self, vectorizers, trim=False, truncate=False, mxlen=-1, **kwargs):
         super().__init__(vectorizers, trim, truncate, mxlen, **kwargs)
         self.label2index = {"tags": self.label2index, "class_labels": {}}
+        # The class label is the first token of each example
+        self.class_label_field = self.named_fields.get('0', '0')
 
+    def load(self, filename, vocabs, batchsz, shuffle=False, sort_key=None):
+        texts = self.read_examples(filename)
+        # Take the class labels off before the cache lookup so the texts line up with the tensors either way
+        class_labels = [example_tokens.pop(0)[self.class_label_field] for example_tokens in texts]
+        return self._load_texts(filename, texts, vocabs, batchsz, shuffle, sort_key,
+                                lambda: self.convert_to_tensors(texts, vocabs, class_labels))
 
-    def convert_to_tensors(self, texts, vocabs):
+    def cache_config(self):
+        return dict(super().cache_config(), class_label_field=self.class_label_field)
+
+    def convert_to_tensors(self, texts, vocabs, class_labels):
         ts = []
 
-        for i, example_tokens in enumerate(texts):
+        for i, (example_tokens, class_label) in enumerate(zip(texts, class_labels)):
             example = {}
-            class_label = example_tokens.pop(0)["text"]
             for k, vectorizer in self.vectorizers.items():
                 example[k], lengths = vectorizer.run(example_tokens, vocabs[k])
                 if lengths is not None:
@@ -603,7 +929,7 @@ class CONLLJointSeqReader(CONLLSeqReader):
             examples = self.read_examples(file)
             for example in examples:
                 #accessing class labels which are the first token text of the string
-                class_label = example.pop(0)[self.named_fields['0']]
+                class_label = example.pop(0)[self.class_label_field]
                 if class_label not in self.label2index["class_labels"]:
                     self.label2index["class_labels"][class_label] = class_label_idx
                     class_label_idx += 1
@@ -638,7 +964,7 @@ class CONLLParserSeqReader(MultiLabelSeqPredictReader):
         tokens = []
         examples = []
 
-        with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
+        with _open_text(tsfile) as f:
             for i, line in enumerate(f):
                 states = re.split("\s", line.strip())
 
@@ -669,6 +995,9 @@ class SRLSeqReader(SeqPredictReader):
     """Read data in the format described by https://github.com/luheng/deep_srl tested on CoNLL2012 SRL data
 
     """
+    # There is one example per line
+    blank_line_separated = False
+
     def __init__(self, vectorizers, trim=False, truncate=False, mxlen=-1, **kwargs):
         super().__init__(vectorizers, trim, truncate, mxlen, **kwargs)
         self.named_fields = kwargs.get('named_fields', {})
@@ -677,7 +1006,7 @@ class SRLSeqReader(SeqPredictReader):
 
         examples = []
 
-        with codecs.open(tsfile, encoding='utf-8', mode='r') as f:
+        with _open_text(tsfile) as f:
             for i, line in enumerate(f):
                 pred_surface, labels = line.strip().split("|||")
                 pred_surface = pred_surface.strip().split()
@@ -699,6 +1028,28 @@ def _norm_ext(ext):
     return ext if ext.startswith('.') else '.' + ext
 
 
+def _count_labeled_lines(reader, headers, shard):
+    """Count the text of each line that a `LineSeqLabelReader` reads from a file (or a `_FileShard` of one)
+
+    :return: The counts, the labels in the order they were first seen and the seen state of the vectorizers
+    """
+    counts = {k: Counter() for k in reader.vectorizers}
+    labels = {}
+    with _open_text(shard) as f:
+        if isinstance(shard, _FileShard):
+            header = headers.get(shard.file_name)
+        else:
+            header = next(f) if shard in headers else None
+        for line in f:
+            label, text = reader.label_and_sentence(line, reader.clean_fn, header)
+            if len(text) == 0:
+                continue
+            for k, vectorizer in reader.vectorizers.items():
+                counts[k].update(vectorizer.count(text))
+            labels.setdefault(label, len(labels))
+    return counts, list(labels), _seen_state(reader.vectorizers)
+
+
 @export
 class SeqLabelReader:
 
@@ -747,6 +1098,10 @@ class LineSeqLabelReader(SeqLabelReader):
         self.truncate = truncate
         self.has_header = bool(kwargs.get('has_header', False))
         self.col_keys = kwargs.get('col_keys', [])
+        self.cache_dir = kwargs.get('cache_dir')
+        self.bucketing = _bucketing_params(**kwargs)
+        self.vocab_workers = _vocab_workers(**kwargs)
+        self.vectorizer_specs = _vectorizer_specs(vectorizers)
     SPLIT_ON = '[\t\s]+'
 
     @staticmethod
@@ -814,23 +1169,27 @@ class LineSeqLabelReader(SeqLabelReader):
                 files = [files]
         vocab = {k: Counter() for k in self.vectorizers.keys()}
 
+        shards = []
+        headers = {}
         for file_name in files:
             if file_name is None:
                 continue
-            with codecs.open(file_name, encoding='utf-8', mode='r') as f:
-                header = next(f) if self.has_header else None
-                for il, line in enumerate(f):
-                    label, text = self.label_and_sentence(line, self.clean_fn, header)
-                    if len(text) == 0:
-                        continue
-
-                    for k, vectorizer in self.vectorizers.items():
-                        vocab_file = vectorizer.count(text)
-                        vocab[k].update(vocab_file)
-
-                    if label not in self.label2index:
-                        self.label2index[label] = label_idx
-                        label_idx += 1
+            start = 0
+            if self.has_header:
+                with open(file_name, 'rb') as f:
+                    header = f.readline()
+                headers[file_name] = header.decode('utf-8')
+                start = len(header)
+            shards.extend(_shard_file(file_name, self.vocab_workers, start=start))
+
+        count = partial(_count_labeled_lines, self, headers)
+        for counts, labels, seen in _map_shards(count, shards, self.vocab_workers):
+            _merge_counts(vocab, counts)
+            _merge_seen_state(self.vectorizers, seen)
+            for label in labels:
+                if label not in self.label2index:
+                    self.label2index[label] = label_idx
+                    label_idx += 1
 
         vocab = _filter_vocab(vocab, kwargs.get('min_f', {}))
 
@@ -872,15 +1231,10 @@ class LineSeqLabelReader(SeqLabelReader):
         return baseline.data.ExampleDataFeed(baseline.data.DictExamples(examples,
                                                                         do_shuffle=shuffle,
                                                                         sort_key=sort_key),
-                                             batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate), texts
+                                             batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate,
+                                             **self.bucketing), texts
 
-    def load(self, filename, vocabs, batchsz, **kwargs):
-    
-        shuffle = kwargs.get('shuffle', False)
-        sort_key = kwargs.get('sort_key', None)
-        if sort_key is not None and not sort_key.endswith('_lengths'):
-            sort_key += '_lengths'
-    
+    def _build_examples(self, filename, vocabs):
         examples = []
 
         with codecs.open(filename, encoding='utf-8', mode='r') as f:
@@ -901,10 +1255,24 @@ class LineSeqLabelReader(SeqLabelReader):
             
                 example_dict['y'] = y
                 examples.append(example_dict)
+        return examples
+
+    def load(self, filename, vocabs, batchsz, **kwargs):
+    
+        shuffle = kwargs.get('shuffle', False)
+        sort_key = kwargs.get('sort_key', None)
+        if sort_key is not None and not sort_key.endswith('_lengths'):
+            sort_key += '_lengths'
+
+        examples = _load_cached_examples(self.cache_dir, [filename], self.vectorizers, self.vectorizer_specs, vocabs,
+                                         lambda: self._build_examples(filename, vocabs),
+                                         reader=type(self).__name__, label2index=self.label2index,
+                                         clean_fn=self.clean_fn, has_header=self.has_header, col_keys=self.col_keys)
         return baseline.data.ExampleDataFeed(baseline.data.DictExamples(examples,
                                                                         do_shuffle=shuffle,
                                                                         sort_key=sort_key),
-                                             batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate)
+                                             batchsz=batchsz, shuffle=shuffle, trim=self.trim, truncate=self.truncate,
+                                             **self.bucketing)
 
 
 @export
@@ -1223,6 +1591,13 @@ class JSONLIndexPairLabelReader(IndexPairLabelReader):
         return index, text1, text2, label
 
 
+def _count_file_tokens(vectorizers, file_name):
+    """Count a whole file as a single sequence, like a `LineSeqReader` vectorizes it"""
+    tokens = LineSeqReader._file_tokens(file_name)
+    counts = {k: vectorizer.count(tokens) for k, vectorizer in vectorizers.items()}
+    return counts, _seen_state(vectorizers)
+
+
 @export
 @register_reader(task='lm', name='default')
 class LineSeqReader:
@@ -1230,6 +1605,16 @@ class LineSeqReader:
     def __init__(self, vectorizers, trim=False, **kwargs):
         self.nctx = kwargs['nctx']
         self.vectorizers = vectorizers
+        self.vocab_workers = _vocab_workers(**kwargs)
+
+    @staticmethod
+    def _file_tokens(file_name):
+        """Read a whole file as a single list of tokens, with an `<EOS>` at the end of each line"""
+        sentences = []
+        with codecs.open(file_name, encoding='utf-8', mode='r') as f:
+            for line in f:
+                sentences += line.split() + ['<EOS>']
+        return sentences
 
     def build_vocab(self, files, **kwargs):
         if _all_predefined_vocabs(self.vectorizers):
@@ -1243,16 +1628,13 @@ class LineSeqReader:
 
         vocabs = {k: Counter() for k in self.vectorizers.keys()}
 
-        for file in files:
-            if file is None:
-                continue
-
-            with codecs.open(file, encoding='utf-8', mode='r') as f:
-                sentences = []
-                for line in f:
-                    sentences += line.split() + ['<EOS>']
-                for k, vectorizer in self.vectorizers.items():
-                    vocabs[k].update(vectorizer.count(sentences))
+        # Each file is counted as a single sequence (that is what `load` vectorizes) so we can only split up the
+        # work by file
+        count = partial(_count_file_tokens, self.vectorizers)
+        files = [f for f in files if f is not None]
+        for counts, seen in _map_shards(count, files, self.vocab_workers):
+            _merge_counts(vocabs, counts)
+            _merge_seen_state(self.vectorizers, seen)
 
         vocabs = _filter_vocab(vocabs, kwargs.get('min_f', {}))
         return vocabs
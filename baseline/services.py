@@ -1,9 +1,14 @@
 import os
+import time
+import queue
 import pickle
+import asyncio
 import logging
+import threading
 from copy import deepcopy
 from typing import Optional, List
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Future
 import numpy as np
 import baseline
 from baseline.utils import (
@@ -22,6 +27,8 @@ from baseline.utils import (
     load_vocabs,
     lookup_sentence,
     normalize_backend,
+    listify,
+    mst_decode,
 )
 from baseline.model import load_model_for
 
@@ -31,6 +38,98 @@ __all__ = []
 export = exporter(__all__)
 
 
+ONNX_GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+
+def create_onnx_session(model_name, **kwargs):
+    """Create an `onnxruntime.InferenceSession`, setting up its `SessionOptions` from the `Service.load` kwargs
+
+    :param model_name: The path to the `.onnx` file
+    :Keyword Arguments:
+        * *intra_op_threads* -- (``int``) The number of threads used to parallelize a single op
+        * *inter_op_threads* -- (``int``) The number of threads used to run independent ops in parallel
+        * *graph_optimization_level* -- (``str``) One of `disable`, `basic`, `extended` or `all`
+        * *execution_mode* -- (``str``) `sequential` or `parallel`
+        * *providers* -- (``List[str]``) The execution providers to use, in order of preference
+
+    :return: An `onnxruntime.InferenceSession`
+    """
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    if kwargs.get('intra_op_threads') is not None:
+        options.intra_op_num_threads = int(kwargs['intra_op_threads'])
+    if kwargs.get('inter_op_threads') is not None:
+        options.inter_op_num_threads = int(kwargs['inter_op_threads'])
+    level = kwargs.get('graph_optimization_level')
+    if level is not None:
+        if level not in ONNX_GRAPH_OPTIMIZATION_LEVELS:
+            raise Exception(f"Unknown graph_optimization_level {level}, expected one of {list(ONNX_GRAPH_OPTIMIZATION_LEVELS)}")
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, ONNX_GRAPH_OPTIMIZATION_LEVELS[level])
+    mode = kwargs.get('execution_mode')
+    if mode is not None:
+        if mode not in {'sequential', 'parallel'}:
+            raise Exception(f"Unknown execution_mode {mode}, expected sequential or parallel")
+        options.execution_mode = getattr(ort.ExecutionMode, f'ORT_{mode.upper()}')
+    providers = kwargs.get('providers')
+    if providers is not None:
+        return ort.InferenceSession(model_name, sess_options=options, providers=listify(providers))
+    return ort.InferenceSession(model_name, sess_options=options)
+
+
+def has_dynamic_batch(model):
+    """Check if every input of an ONNX session has a symbolic batch axis
+
+    Models exported before the batch axis was made dynamic (and taggers decoded with a batch size 1 Viterbi)
+    have a fixed batch of 1
+
+    :param model: An `onnxruntime.InferenceSession`
+    :return: `True` if the whole batch can be run in one call
+    """
+    for x in model.get_inputs():
+        if x.shape and isinstance(x.shape[0], int):
+            return False
+    return True
+
+
+def run_onnx(model, examples, batchable=True):
+    """Run a vectorized batch through an ONNX session
+
+    :param model: An `onnxruntime.InferenceSession`
+    :param examples: `dict[str] -> np.ndarray` The vectorized batch
+    :param batchable: Can the session take the whole batch at once? If not, run each row by itself
+    :return: The list of outputs, each with the batch as its first axis
+    """
+    if batchable:
+        return model.run(None, examples)
+    batchsz = len(next(iter(examples.values())))
+    outputs = [model.run(None, {k: v[i:i+1] for k, v in examples.items()}) for i in range(batchsz)]
+    return [np.concatenate(output, axis=0) for output in zip(*outputs)]
+
+
+def vectorize_onnx(vectorizers, vocabs, tokens_batch, lengths_key=None):
+    """Vectorize a whole batch for an ONNX session, which takes the lengths as a single `lengths` input
+
+    :param vectorizers: The vectorizers to run
+    :param vocabs: The vocabs for each vectorizer
+    :param tokens_batch: `List[List[str]]`: The input text batch
+    :param lengths_key: The vectorizer to take the `lengths` from (if any)
+    :return: `dict[str] -> np.ndarray` The vectorized batch
+    """
+    examples = {}
+    for k, vectorizer in vectorizers.items():
+        # Exported models expect int64 inputs
+        vecs, lengths = vectorizer.run_batch(tokens_batch, vocabs[k], dtype=np.int64)
+        examples[k] = vecs
+        if lengths_key == k and lengths is not None:
+            examples['lengths'] = lengths
+    return examples
+
+
 class Service:
 
     def __init__(self, vocabs=None, vectorizers=None, model=None, preproc='client'):
@@ -90,43 +189,27 @@ class Service:
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
-        keys = self.vectorizers.keys()
-        for i, tokens in enumerate(tokens_batch):
-            if is_sequence(tokens[0]):
-                if len(tokens) != 2:
-                    raise Exception("We currently only accept dual inputs for multi-encoder")
-                keys = []
-                for k, vectorizer in self.vectorizers.items():
-                    vec0, length0 = vectorizer.run(tokens[0], self.vocabs[k])
-                    vec1, length1 = vectorizer.run(tokens[1], self.vocabs[k])
-                    # Its paired data
-                    key0 = f'{k}[0]'
-                    key1 = f'{k}[1]'
-                    keys.append(key0)
-                    keys.append(key1)
-                    examples[key0].append(vec0)
-                    examples[key1].append(vec1)
-                    if length0 is not None:
-                        lengths_key = f'{key0}_lengths'
-                        examples[lengths_key].append(length0)
-                    if length1 is not None:
-                        lengths_key = f'{key1}_lengths'
-                        examples[lengths_key].append(length1)
-
-            else:
-                for k, vectorizer in self.vectorizers.items():
-                    vec, length = vectorizer.run(tokens, self.vocabs[k])
-                    examples[k].append(vec)
-                    if length is not None:
-                        lengths_key = f'{k}_lengths'
-                        examples[lengths_key].append(length)
-
-        for k in keys:
-            examples[k] = np.stack(examples[k])
-            lengths_key = f'{k}_lengths'
-            if lengths_key in examples:
-                examples[lengths_key] = np.stack(examples[lengths_key])
+        examples = {}
+        tokens_batch = list(tokens_batch)
+        if is_sequence(tokens_batch[0][0]):
+            if any(len(tokens) != 2 for tokens in tokens_batch):
+                raise Exception("We currently only accept dual inputs for multi-encoder")
+            for k, vectorizer in self.vectorizers.items():
+                # Its paired data
+                for pair_idx in range(2):
+                    key = f'{k}[{pair_idx}]'
+                    pair_batch = [tokens[pair_idx] for tokens in tokens_batch]
+                    # Exported models expect int64 inputs
+                    vecs, lengths = vectorizer.run_batch(pair_batch, self.vocabs[k], dtype=np.int64)
+                    examples[key] = vecs
+                    if lengths is not None:
+                        examples[f'{key}_lengths'] = lengths
+        else:
+            for k, vectorizer in self.vectorizers.items():
+                vecs, lengths = vectorizer.run_batch(tokens_batch, self.vocabs[k], dtype=np.int64)
+                examples[k] = vecs
+                if lengths is not None:
+                    examples[f'{k}_lengths'] = lengths
         return examples
 
     @classmethod
@@ -301,6 +384,7 @@ class ONNXClassifierService(ClassifierService):
         super().__init__(vocabs, vectorizers, model, **kwargs)
         self.return_labels = False
         self.input_names = set([x.name for x in model.get_inputs()])
+        self.batchable = has_dynamic_batch(model)
 
     def get_labels(self):
         return self.labels
@@ -308,9 +392,8 @@ class ONNXClassifierService(ClassifierService):
     def predict(self, tokens, **kwargs):
         tokens_batch = self.batch_input(tokens)
         self.prepare_vectorizers(tokens_batch)
-        # Hide the fact we can only do one at a time
-        examples = [self.vectorize([tokens]) for tokens in tokens_batch]
-        outcomes_list = np.concatenate([self.model.run(None, example)[0] for example in examples])
+        examples = self.vectorize(tokens_batch)
+        outcomes_list = run_onnx(self.model, examples, self.batchable)[0]
         return self.format_output(outcomes_list, dense=kwargs.get('dense', False))
 
     def vectorize(self, tokens_batch):
@@ -320,22 +403,9 @@ class ONNXClassifierService(ClassifierService):
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
         if self.lengths_key is None and 'lengths' in self.input_names:
             self.lengths_key = list(self.vectorizers.keys())[0]
-
-        for i, tokens in enumerate(tokens_batch):
-            for k, vectorizer in self.vectorizers.items():
-                vec, length = vectorizer.run(tokens, self.vocabs[k])
-                examples[k].append(vec)
-                if self.lengths_key == k and length:
-                    #examples[f'{self.lengths_key}_lengths'].append(length)
-                    examples['lengths'].append(length)
-        for k in self.vectorizers.keys():
-            examples[k] = np.stack(examples[k])
-        if 'lengths' in examples:
-            examples['lengths'] = np.stack(examples['lengths'])
-        return examples
+        return vectorize_onnx(self.vectorizers, self.vocabs, tokens_batch, self.lengths_key)
 
     def format_output(self, predicted, dense=False):
         if dense:
@@ -354,7 +424,6 @@ class ONNXClassifierService(ClassifierService):
 
         :returns a Service implementation
         """
-        import onnxruntime as ort
 
         # can delegate
         if os.path.isdir(bundle):
@@ -373,7 +442,7 @@ class ONNXClassifierService(ClassifierService):
         # Currently nothing to do here
         labels = read_json(model_basename + '.labels')
 
-        model = ort.InferenceSession(model_name)
+        model = create_onnx_session(model_name, **kwargs)
         return cls(vocabs, vectorizers, model, labels)
 
 
@@ -384,14 +453,13 @@ class ONNXEmbeddingService(Service):
         super().__init__(vocabs, vectorizers, model,)
         self.lengths_key = lengths_key
         self.input_names = set([x.name for x in model.get_inputs()])
+        self.batchable = has_dynamic_batch(model)
 
     def predict(self, tokens, **kwargs):
         tokens_batch = self.batch_input(tokens)
         self.prepare_vectorizers(tokens_batch)
-        # Hide the fact we can only do one at a time
-        examples = [self.vectorize([tokens]) for tokens in tokens_batch]
-        outcomes_list = np.concatenate([self.model.run(None, example)[0] for example in examples])
-        return outcomes_list
+        examples = self.vectorize(tokens_batch)
+        return run_onnx(self.model, examples, self.batchable)[0]
 
     def vectorize(self, tokens_batch):
         """Turn the input into that batch dict for prediction.
@@ -400,22 +468,9 @@ class ONNXEmbeddingService(Service):
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
         if self.lengths_key is None and 'lengths' in self.input_names:
             self.lengths_key = list(self.vectorizers.keys())[0]
-
-        for i, tokens in enumerate(tokens_batch):
-            for k, vectorizer in self.vectorizers.items():
-                vec, length = vectorizer.run(tokens, self.vocabs[k])
-                examples[k].append(vec)
-                if self.lengths_key == k and length:
-                    #examples[f'{self.lengths_key}_lengths'].append(length)
-                    examples['lengths'].append(length)
-        for k in self.vectorizers.keys():
-            examples[k] = np.stack(examples[k])
-        if 'lengths' in examples:
-            examples['lengths'] = np.stack(examples['lengths'])
-        return examples
+        return vectorize_onnx(self.vectorizers, self.vocabs, tokens_batch, self.lengths_key)
 
     @classmethod
     def load(cls, bundle, **kwargs):
@@ -425,7 +480,6 @@ class ONNXEmbeddingService(Service):
 
         :returns a Service implementation
         """
-        import onnxruntime as ort
 
         # can delegate
         if os.path.isdir(bundle):
@@ -441,7 +495,7 @@ class ONNXEmbeddingService(Service):
         vocabs = load_vocabs(directory)
         vectorizers = load_vectorizers(directory)
 
-        model = ort.InferenceSession(model_name)
+        model = create_onnx_session(model_name, **kwargs)
         return cls(vocabs, vectorizers, model)
 
 
@@ -686,6 +740,7 @@ class ONNXTaggerService(TaggerService):
         self.lengths_key = lengths_key
         super().__init__(vocabs, vectorizers, model)
         self.input_names = set([x.name for x in model.get_inputs()])
+        self.batchable = has_dynamic_batch(model)
 
     def get_vocab(self, vocab_type='word'):
         return self.vocabs.get(vocab_type)
@@ -696,23 +751,10 @@ class ONNXTaggerService(TaggerService):
     def predict(self, tokens, **kwargs):
         tokens_batch = self.batch_input(tokens)
         self.prepare_vectorizers(tokens_batch)
-        # Process each example in the batch by itself to hide the one at a time nature
-        examples = [self.vectorize([tokens]) for tokens in tokens_batch]
-        outcomes_list = np.concatenate([self.model.run(None, example)[0] for example in examples], axis=0)
+        examples = self.vectorize(tokens_batch)
+        outcomes_list = run_onnx(self.model, examples, self.batchable)[0]
         return self.format_output(outcomes_list, tokens_batch, label_field=kwargs.get('label', 'label'), vectorized_examples=examples)
 
-    def format_output(self, *args, **kwargs):
-        """Because the ONNX service is hiding it's one at a time nature it is a List[Dict[str]] instead of a Dict[str, List]
-           So flip it so it can be processed by the normal format_output.
-        """
-        vectorized_examples = kwargs['vectorized_examples']
-        new_vec = defaultdict(list)
-        for key in vectorized_examples[0]:
-            for ve in vectorized_examples:
-                new_vec[key].append(ve[key][0])
-        kwargs['vectorized_examples'] = new_vec
-        return super().format_output(*args, **kwargs)
-
     def vectorize(self, tokens_batch):
         """Turn the input into that batch dict for prediction.
 
@@ -720,21 +762,9 @@ class ONNXTaggerService(TaggerService):
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
         if self.lengths_key is None and 'lengths' in self.input_names:
             self.lengths_key = list(self.vectorizers.keys())[0]
-
-        for i, tokens in enumerate(tokens_batch):
-            for k, vectorizer in self.vectorizers.items():
-                vec, length = vectorizer.run(tokens, self.vocabs[k])
-                examples[k].append(vec)
-                if self.lengths_key == k and length:
-                    examples['lengths'].append(length)
-        for k in self.vectorizers.keys():
-            examples[k] = np.stack(examples[k])
-        if 'lengths' in examples:
-            examples['lengths'] = np.stack(examples['lengths'])
-        return examples
+        return vectorize_onnx(self.vectorizers, self.vocabs, tokens_batch, self.lengths_key)
 
     @classmethod
     def load(cls, bundle, **kwargs):
@@ -744,7 +774,6 @@ class ONNXTaggerService(TaggerService):
 
         :returns a Service implementation
         """
-        import onnxruntime as ort
         if os.path.isdir(bundle):
             directory = bundle
         else:
@@ -759,7 +788,7 @@ class ONNXTaggerService(TaggerService):
         # Currently nothing to do here
         labels = read_json(model_basename + '.labels')
 
-        model = ort.InferenceSession(model_name)
+        model = create_onnx_session(model_name, **kwargs)
         return cls(vocabs, vectorizers, model, labels)
 
 
@@ -770,6 +799,7 @@ class ONNXJointTaggerService(JointTaggerService):
         self.lengths_key = lengths_key
         super().__init__(vocabs, vectorizers, model)
         self.input_names = set([x.name for x in model.get_inputs()])
+        self.batchable = has_dynamic_batch(model)
 
 
     def get_vocab(self, vocab_type='word'):
@@ -783,33 +813,12 @@ class ONNXJointTaggerService(JointTaggerService):
     def predict(self, tokens, **kwargs):
         tokens_batch = self.batch_input(tokens)
         self.prepare_vectorizers(tokens_batch)
-        # Process each example in the batch by itself to hide the one at a time nature
-        examples = [self.vectorize([tokens]) for tokens in tokens_batch]
-        class_outputs = []
-        tag_outputs = []
-        for example in examples:
-            class_output, tag_output = self.model.run(None, example)
-            tag_outputs.append(tag_output)
-            class_max_index = class_output.argmax()
-            class_label = self.class_label_vocab[class_max_index]
-            class_outputs.append(class_label)
-
-        outcomes_list = np.concatenate(tag_outputs, axis=0)
-        tag_labels = self.format_output(outcomes_list, tokens_batch, label_field=kwargs.get('label', 'label'), vectorized_examples=examples)
+        examples = self.vectorize(tokens_batch)
+        class_output, tag_output = run_onnx(self.model, examples, self.batchable)
+        class_outputs = [self.class_label_vocab[i] for i in class_output.reshape(len(tokens_batch), -1).argmax(-1)]
+        tag_labels = self.format_output(tag_output, tokens_batch, label_field=kwargs.get('label', 'label'), vectorized_examples=examples)
         return zip(class_outputs, tag_labels)
 
-    def format_output(self, *args, **kwargs):
-        """Because the ONNX service is hiding it's one at a time nature it is a List[Dict[str]] instead of a Dict[str, List]
-           So flip it so it can be processed by the normal format_output.
-        """
-        vectorized_examples = kwargs['vectorized_examples']
-        new_vec = defaultdict(list)
-        for key in vectorized_examples[0]:
-            for ve in vectorized_examples:
-                new_vec[key].append(ve[key][0])
-        kwargs['vectorized_examples'] = new_vec
-        return super().format_output(*args, **kwargs)
-
     def vectorize(self, tokens_batch):
         """Turn the input into that batch dict for prediction.
 
@@ -817,21 +826,9 @@ class ONNXJointTaggerService(JointTaggerService):
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
         if self.lengths_key is None and 'lengths' in self.input_names:
             self.lengths_key = list(self.vectorizers.keys())[0]
-
-        for i, tokens in enumerate(tokens_batch):
-            for k, vectorizer in self.vectorizers.items():
-                vec, length = vectorizer.run(tokens, self.vocabs[k])
-                examples[k].append(vec)
-                if self.lengths_key == k and length:
-                    examples['lengths'].append(length)
-        for k in self.vectorizers.keys():
-            examples[k] = np.stack(examples[k])
-        if 'lengths' in examples:
-            examples['lengths'] = np.stack(examples['lengths'])
-        return examples
+        return vectorize_onnx(self.vectorizers, self.vocabs, tokens_batch, self.lengths_key)
 
     @classmethod
     def load(cls, bundle, **kwargs):
@@ -841,7 +838,6 @@ class ONNXJointTaggerService(JointTaggerService):
 
         :returns a Service implementation
         """
-        import onnxruntime as ort
         if os.path.isdir(bundle):
             directory = bundle
         else:
@@ -856,7 +852,7 @@ class ONNXJointTaggerService(JointTaggerService):
         # Currently nothing to do here
         labels = read_json(model_basename + '.labels')
 
-        model = ort.InferenceSession(model_name)
+        model = create_onnx_session(model_name, **kwargs)
         return cls(vocabs, vectorizers, model, labels)
 
 
@@ -950,7 +946,8 @@ class DependencyParserService(Service):
             unfeaturized_examples[self.model.lengths_key] = examples[self.model.lengths_key]  # remote model
             examples = unfeaturized_examples
 
-        outcomes = self.model.predict(examples)
+        decode_kwargs = {'decoder_type': kwargs['decoder_type']} if kwargs.get('decoder_type') else {}
+        outcomes = self.model.predict(examples, **decode_kwargs)
         return self.format_output(outcomes, tokens_batch=tokens_batch, label_field=label_field, vectorized_examples=examples)
 
     def format_output(self, predicted, tokens_batch=None, label_field='label', arc_field='head', vectorized_examples=None, **kwargs):
@@ -976,6 +973,7 @@ class ONNXDependencyParserService(DependencyParserService):
         self.labels = labels
         self.lengths_key = lengths_key
         super().__init__(vocabs, vectorizers, model)
+        self.batchable = has_dynamic_batch(model)
 
     def get_vocab(self, vocab_type='word'):
         return self.vocabs.get(vocab_type)
@@ -986,31 +984,16 @@ class ONNXDependencyParserService(DependencyParserService):
     def predict(self, tokens, **kwargs):
         tokens_batch = self.batch_input(tokens)
         self.prepare_vectorizers(tokens_batch)
-        # Process each example in the batch by itself to hide the one at a time nature
-        examples = [self.vectorize([tokens]) for tokens in tokens_batch]
-        arcs_batch = []
-        labels_batch = []
-        for example in examples:
-            arcs_logits, labels_logits = self.model.run(None, example)
-            arcs_logits = arcs_logits.squeeze(0)
-            labels_logits = labels_logits.squeeze(0)
+        examples = self.vectorize(tokens_batch)
+        # [B, T, T] and [B, T, T, L]
+        arcs_logits, labels_logits = run_onnx(self.model, examples, self.batchable)
+        if kwargs.get('decoder_type', 'greedy') == 'mst':
+            arcs = mst_decode(arcs_logits, examples.get('lengths'))
+        else:
             arcs = np.argmax(arcs_logits, -1)
-            labels = np.argmax(labels_logits[np.arange(len(arcs)), arcs], -1)
-            arcs_batch.append(arcs)
-            labels_batch.append(labels)
-        return self.format_output((arcs_batch, labels_batch), tokens_batch, label_field=kwargs.get('label', 'label'), vectorized_examples=examples)
-
-    def format_output(self, *args, **kwargs):
-        """Because the ONNX service is hiding it's one at a time nature it is a List[Dict[str]] instead of a Dict[str, List]
-           So flip it so it can be processed by the normal format_output.
-        """
-        vectorized_examples = kwargs['vectorized_examples']
-        new_vec = defaultdict(list)
-        for key in vectorized_examples[0]:
-            for ve in vectorized_examples:
-                new_vec[key].append(ve[key][0])
-        kwargs['vectorized_examples'] = new_vec
-        return super().format_output(*args, **kwargs)
+        labels_logits = np.take_along_axis(labels_logits, arcs[:, :, np.newaxis, np.newaxis], axis=2).squeeze(2)
+        labels = np.argmax(labels_logits, -1)
+        return self.format_output((arcs, labels), tokens_batch, label_field=kwargs.get('label', 'label'), vectorized_examples=examples)
 
     def vectorize(self, tokens_batch):
         """Turn the input into that batch dict for prediction.
@@ -1019,21 +1002,9 @@ class ONNXDependencyParserService(DependencyParserService):
 
         :returns: dict[str] -> np.ndarray: The vectorized batch.
         """
-        examples = defaultdict(list)
         if self.lengths_key is None:
             self.lengths_key = list(self.vectorizers.keys())[0]
-
-        for i, tokens in enumerate(tokens_batch):
-            for k, vectorizer in self.vectorizers.items():
-                vec, length = vectorizer.run(tokens, self.vocabs[k])
-                examples[k].append(vec)
-                if self.lengths_key == k and length:
-                    examples['lengths'].append(length)
-        for k in self.vectorizers.keys():
-            examples[k] = np.stack(examples[k])
-        if 'lengths' in examples:
-            examples['lengths'] = np.stack(examples['lengths'])
-        return examples
+        return vectorize_onnx(self.vectorizers, self.vocabs, tokens_batch, self.lengths_key)
 
     @classmethod
     def load(cls, bundle, **kwargs):
@@ -1043,7 +1014,6 @@ class ONNXDependencyParserService(DependencyParserService):
 
         :returns a Service implementation
         """
-        import onnxruntime as ort
         if os.path.isdir(bundle):
             directory = bundle
         else:
@@ -1058,7 +1028,7 @@ class ONNXDependencyParserService(DependencyParserService):
         # Currently nothing to do here
         labels = read_json(model_basename + '.labels')
 
-        model = ort.InferenceSession(model_name)
+        model = create_onnx_session(model_name, **kwargs)
         return cls(vocabs, vectorizers, model, labels)
 
 
@@ -1285,3 +1255,156 @@ class EncoderDecoderService(Service):
             if K > 1:
                 results.append(n_best_result)
         return results
+
+
+@export
+class BatchingService:
+    """Put a `Service` behind a request queue, so that concurrent requests run through the model together
+
+    Callers on different threads (or asyncio tasks, using `apredict`) each make their own request.  A worker
+    thread takes the oldest request, then keeps collecting more until it has `max_batchsz` examples or `max_wait`
+    seconds have passed.  The whole batch goes through a single call to the wrapped service's `predict`, so
+    there is one `vectorize`, one `model.predict` and one `format_output`, and then the results are split back
+    out to each caller.  Only requests with the same keyword arguments are batched together.
+
+    After each batch, the `reporting_fns` are called with the batch size, the number of requests and the depth
+    of the queue, the same way the trainers report metrics.  An error from a reporting function is logged, it does
+    not stop the worker
+    """
+    def __init__(self, service, max_batchsz=32, max_wait=0.005, reporting_fns=None):
+        """Constructor
+
+        :param service: The `Service` to wrap
+        :param max_batchsz: The most examples to put in a batch, a single larger request is still run alone
+        :param max_wait: The most time (in seconds) to wait for more requests after the first one arrives
+        :param reporting_fns: Functions to call with the metrics for each batch
+        """
+        self.service = service
+        self.max_batchsz = max_batchsz
+        self.max_wait = max_wait
+        self.reporting_fns = listify(reporting_fns)
+        self.requests = queue.Queue()
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_examples = 0
+        self.max_queue_depth = 0
+        self._deferred = deque()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __getattr__(self, name):
+        # Everything else (`get_labels`, `get_vocab`, ...) comes from the wrapped service
+        if name == 'service':
+            raise AttributeError(name)
+        return getattr(self.service, name)
+
+    def submit(self, tokens, **kwargs):
+        """Queue a request without waiting for it
+
+        :param tokens: The input, in any format the wrapped service's `predict` accepts
+        :param kwargs: Keyword arguments to the wrapped service's `predict`
+        :return: A `concurrent.futures.Future` for the output
+        """
+        future = Future()
+        tokens_batch = list(self.service.batch_input(tokens))
+        with self._lock:
+            if self._closed:
+                raise Exception("This BatchingService is closed")
+            if not tokens_batch:
+                future.set_result([])
+            else:
+                self.requests.put((tokens_batch, kwargs, future))
+        return future
+
+    def predict(self, tokens, **kwargs):
+        """Make a request and wait for its output
+
+        :param tokens: The input, in any format the wrapped service's `predict` accepts
+        :param kwargs: Keyword arguments to the wrapped service's `predict`
+        :return: The output of the wrapped service's `predict` for this input
+        """
+        return self.submit(tokens, **kwargs).result()
+
+    async def apredict(self, tokens, **kwargs):
+        """Make a request from an asyncio task and wait for its output without blocking the event loop"""
+        return await asyncio.wrap_future(self.submit(tokens, **kwargs))
+
+    def close(self):
+        """Stop the worker after the requests that are already queued are done, later requests raise an exception"""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self.requests.put(None)
+        self._worker.join()
+
+    @property
+    def stats(self):
+        """The totals so far, along with the average batch size and the largest queue depth seen"""
+        return {
+            'batches': self.num_batches,
+            'requests': self.num_requests,
+            'examples': self.num_examples,
+            'avg_batch_size': self.num_examples / max(self.num_batches, 1),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def _next_request(self, timeout=None):
+        if self._deferred:
+            return self._deferred.popleft()
+        return self.requests.get(timeout=timeout)
+
+    def _collect(self, first):
+        batch = [first]
+        size = len(first[0])
+        skipped = []
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batchsz:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None or size + len(request[0]) > self.max_batchsz:
+                # Stop here so that this request goes first in the next batch
+                skipped.append(request)
+                break
+            if request[1] != first[1]:
+                skipped.append(request)
+                continue
+            batch.append(request)
+            size += len(request[0])
+        self._deferred.extendleft(reversed(skipped))
+        return batch, size
+
+    def _run(self):
+        while True:
+            first = self._next_request()
+            if first is None:
+                return
+            batch, size = self._collect(first)
+            queue_depth = self.requests.qsize() + len(self._deferred)
+            tokens_batch = [tokens for request in batch for tokens in request[0]]
+            try:
+                outputs = self.service.predict(tokens_batch, **first[1])
+                start = 0
+                for request_batch, _, future in batch:
+                    future.set_result(outputs[start:start + len(request_batch)])
+                    start += len(request_batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            self.num_examples += size
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            metrics = {'batch_size': size, 'requests': len(batch), 'queue_depth': queue_depth}
+            for reporting in self.reporting_fns:
+                try:
+                    reporting(metrics, self.num_batches, 'Serve', 'BATCH')
+                except Exception:
+                    logger.exception("Reporting the batch metrics failed")
@@ -10,18 +10,13 @@ from eight_mile.utils import listify, get_version
 from eight_mile.tf.layers import get_shape_as_list
 from eight_mile.tf.optz import *
 from baseline.utils import get_model_file, get_metric_cmp
-from baseline.tf.tfy import SET_TRAIN_FLAG, setup_tf2_checkpoints
-from baseline.tf.classify.training.utils import to_tensors
+from baseline.tf.tfy import SET_TRAIN_FLAG, setup_tf2_checkpoints, to_dataset, dataset_params
+from baseline.tf.classify.training.utils import to_batch_tensors
 from baseline.train import EpochReportingTrainer, register_trainer, register_training_func
 from baseline.utils import verbose_output
 from baseline.model import create_model_for
 import numpy as np
 
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
-
 log = logging.getLogger('baseline.timing')
 
 
@@ -229,14 +224,10 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     lengths_key = model_params.get('lengths_key')
 
     test_batchsz = kwargs.get('test_batchsz', batchsz)
-    train_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(ts, lengths_key))
-    train_dataset = train_dataset.shuffle(buffer_size=SHUF_BUF_SZ)
-    train_dataset = train_dataset.batch(batchsz, drop_remainder=False)
-    train_dataset = train_dataset.prefetch(NUM_PREFETCH)
+    data_params = dataset_params(**kwargs)
+    train_dataset = to_dataset(ts, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, shuffle=True, drop_remainder=False, **data_params)
 
-    valid_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(vs, lengths_key))
-    valid_dataset = valid_dataset.batch(batchsz, drop_remainder=False)
-    valid_dataset = valid_dataset.prefetch(NUM_PREFETCH)
+    valid_dataset = to_dataset(vs, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, drop_remainder=False, **data_params)
 
     best_metric = 0
     if do_early_stopping:
@@ -277,7 +268,5 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     if es is not None:
         print('Reloading best checkpoint')
         trainer.recover_last_checkpoint()
-        test_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(es, lengths_key))
-        test_dataset = test_dataset.batch(test_batchsz, drop_remainder=False)
-        test_dataset = test_dataset.prefetch(NUM_PREFETCH)
+        test_dataset = to_dataset(es, lambda batch: to_batch_tensors(batch, lengths_key), test_batchsz, drop_remainder=False, **data_params)
         trainer.test(test_dataset, reporting_fns, phase='Test', verbose=verbose, steps=len(es))
@@ -4,15 +4,25 @@ import time
 import logging
 import tensorflow as tf
 import numpy as np
-
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
+from baseline.tf.tfy import concat_batches
 
 log = logging.getLogger('baseline.timing')
 
 
+def to_batch_tensors(batch, lengths_key):
+    """Convert one batch of a data feed into a tuple of `features` (`dict`) and `y` values
+
+    :param batch: A batch from the data feed
+    :param lengths_key: The field to use as the `lengths`
+    :return: A `tuple` of `features` and `y` (labels)
+    """
+    features = dict((k, np.asarray(v)) for k, v in batch.items())
+    if lengths_key and lengths_key in features:
+        features['lengths'] = features.pop(lengths_key)
+    y = features.pop('y')
+    return features, y
+
+
 def to_tensors(ts, lengths_key):
     """Convert a data feed into a tuple of `features` (`dict`) and `y` values
 
@@ -21,20 +31,7 @@ def to_tensors(ts, lengths_key):
     :param ts: The data feed to convert
     :return: A `tuple` of `features` and `y` (labels)
     """
-    keys = ts[0].keys()
-    features = dict((k, []) for k in keys)
-    for sample in ts:
-        for k in features.keys():
-            # add each sample
-            for s in sample[k]:
-                features[k].append(s)
-
-    features = dict((k, np.stack(v)) for k, v in features.items())
-    if lengths_key and lengths_key in features:
-        features['lengths'] = features[lengths_key]
-        del features[lengths_key]
-    y = features.pop('y')
-    return features, y
+    return concat_batches(to_batch_tensors(batch, lengths_key) for batch in ts)
 
 
 def _report(step, metrics, start, phase, tt, reporting_fns, steps=1):
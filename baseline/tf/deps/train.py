@@ -9,17 +9,12 @@ from eight_mile.utils import listify, get_version, Offsets
 from eight_mile.metrics import LCM, UCM, LAS, UAS
 from eight_mile.tf.layers import SET_TRAIN_FLAG, get_shape_as_list, autograph_options, masked_fill
 from eight_mile.tf.optz import *
-from baseline.tf.tfy import setup_tf2_checkpoints
+from baseline.tf.tfy import setup_tf2_checkpoints, concat_batches, to_dataset, dataset_params
 from baseline.utils import get_model_file, get_metric_cmp
 from baseline.train import EpochReportingTrainer, register_trainer, register_training_func
 from baseline.model import create_model_for
 import numpy as np
 
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
-
 log = logging.getLogger('baseline.timing')
 
 TF_VERSION = get_version(tf)
@@ -35,17 +30,18 @@ def to_tensors(ts, lengths_key):
     :param ts: The data feed to convert
     :return: A `tuple` of `features` and `y` (labels)
     """
-    keys = ts[0].keys()
-    features = dict((k, []) for k in keys)
-    for sample in ts:
-        for k in features.keys():
-            # add each sample
-            for s in sample[k]:
-                features[k].append(s)
-
-    features = dict((k, np.stack(v)) for k, v in features.items())
-    features['lengths'] = features[lengths_key]
-    del features[lengths_key]
+    return concat_batches(to_batch_tensors(batch, lengths_key) for batch in ts)
+
+
+def to_batch_tensors(batch, lengths_key):
+    """Convert one batch of a data feed into a tuple of `features` (`dict`) and `y` values
+
+    :param batch: A batch from the data feed
+    :param lengths_key: The field to use as the `lengths`
+    :return: A `tuple` of `features` and `y` (heads and labels)
+    """
+    features = dict((k, np.asarray(v)) for k, v in batch.items())
+    features['lengths'] = features.pop(lengths_key)
     heads = features.pop('heads')
     labels = features.pop('labels')
     return features, (heads, labels)
@@ -195,16 +191,14 @@ class DependencyParserTrainerEagerTf(EpochReportingTrainer):
         for features, y in pg(loader):
             heads_gold, labels_gold = y
             greedy_heads_pred, greedy_labels_pred = self.model.decode(features)
-            B, T = get_shape_as_list(greedy_labels_pred)[:2]
+            T = get_shape_as_list(greedy_labels_pred)[1]
             labels_gold_trimmed = labels_gold[:, :T].numpy()
             heads_gold_trimmed = heads_gold[:, :T].numpy()
+            if self.punct_eval is False:
+                labels_gold_trimmed = np.where(labels_gold_trimmed == self.model.punct, Offsets.PAD, labels_gold_trimmed)
 
-            for i in range(B):
-                for m in metrics:
-                    if self.punct_eval is False:
-                        labels_gold_trimmed[i] = masked_fill(labels_gold_trimmed[i],
-                                                             labels_gold_trimmed[i] == self.model.punct, Offsets.PAD)
-                    m.add(greedy_heads_pred[i], heads_gold_trimmed[i], greedy_labels_pred[i], labels_gold_trimmed[i])
+            for m in metrics:
+                m.add(greedy_heads_pred, heads_gold_trimmed, greedy_labels_pred, labels_gold_trimmed)
 
         metrics = {m.name: m.score for m in metrics}
         return metrics
@@ -269,14 +263,10 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     lengths_key = model_params.get('lengths_key')
 
     test_batchsz = kwargs.get('test_batchsz', batchsz)
-    train_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(ts, lengths_key))
-    train_dataset = train_dataset.shuffle(buffer_size=SHUF_BUF_SZ)
-    train_dataset = train_dataset.batch(batchsz, drop_remainder=False)
-    train_dataset = train_dataset.prefetch(NUM_PREFETCH)
+    data_params = dataset_params(**kwargs)
+    train_dataset = to_dataset(ts, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, shuffle=True, drop_remainder=False, **data_params)
 
-    valid_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(vs, lengths_key))
-    valid_dataset = valid_dataset.batch(batchsz, drop_remainder=False)
-    valid_dataset = valid_dataset.prefetch(NUM_PREFETCH)
+    valid_dataset = to_dataset(vs, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, drop_remainder=False, **data_params)
 
     best_metric = 0
     if do_early_stopping:
@@ -317,7 +307,5 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     if es is not None:
         print('Reloading best checkpoint')
         trainer.recover_last_checkpoint()
-        test_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(es, lengths_key))
-        test_dataset = test_dataset.batch(test_batchsz, drop_remainder=False)
-        test_dataset = test_dataset.prefetch(NUM_PREFETCH)
+        test_dataset = to_dataset(es, lambda batch: to_batch_tensors(batch, lengths_key), test_batchsz, drop_remainder=False, **data_params)
         trainer.test(test_dataset, reporting_fns, phase='Test', verbose=verbose, steps=len(es))
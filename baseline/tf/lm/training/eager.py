@@ -8,8 +8,8 @@ from eight_mile.tf.optz import EagerOptimizer
 from baseline.utils import get_model_file, get_metric_cmp
 from baseline.model import create_model_for
 from baseline.train import register_training_func, Trainer
-from baseline.tf.tfy import setup_tf2_checkpoints
-from baseline.tf.lm.training.utils import to_tensors, SHUF_BUF_SZ, NUM_PREFETCH
+from baseline.tf.tfy import setup_tf2_checkpoints, to_dataset, dataset_params
+from baseline.tf.lm.training.utils import to_batch_tensors
 
 
 def loss_with_state(model, h, x, y):
@@ -255,14 +255,10 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     test_batchsz = kwargs.get('test_batchsz', batchsz)
     tgt_key = model_params.get('tgt_key')
 
-    train_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(ts))
-    train_dataset = train_dataset.shuffle(buffer_size=SHUF_BUF_SZ)
-    train_dataset = train_dataset.batch(batchsz, drop_remainder=False)
-    train_dataset = train_dataset.prefetch(NUM_PREFETCH)
+    data_params = dataset_params(**kwargs)
+    train_dataset = to_dataset(ts, lambda batch: to_batch_tensors(batch), batchsz, shuffle=True, drop_remainder=False, **data_params)
 
-    valid_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(vs))
-    valid_dataset = valid_dataset.batch(batchsz, drop_remainder=False)
-    valid_dataset = valid_dataset.prefetch(NUM_PREFETCH)
+    valid_dataset = to_dataset(vs, lambda batch: to_batch_tensors(batch), batchsz, drop_remainder=False, **data_params)
 
     trainer = LanguageModelTrainerEagerTf(model_params, **kwargs)
     last_improved = 0
@@ -294,8 +290,6 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     if es is not None:
         print('Reloading best checkpoint')
         trainer.recover_last_checkpoint()
-        test_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(es))
-        test_dataset = test_dataset.batch(test_batchsz, drop_remainder=False)
-        test_dataset = test_dataset.prefetch(NUM_PREFETCH)
+        test_dataset = to_dataset(es, lambda batch: to_batch_tensors(batch), test_batchsz, drop_remainder=False, **data_params)
         trainer.test(test_dataset, reporting_fns, phase='Test')
 
@@ -2,18 +2,12 @@ import os
 import time
 import numpy as np
 import tensorflow as tf
-from baseline.tf.tfy import TRAIN_FLAG, SET_TRAIN_FLAG
+from baseline.tf.tfy import TRAIN_FLAG, SET_TRAIN_FLAG, concat_batches
 from baseline.train import Trainer, register_trainer
 from baseline.model import create_model_for
 from collections import OrderedDict
 
 
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
-
-
 def to_tensors(ts):
     """Convert a data feed into a tuple of `features` (`dict`) and `y` values
 
@@ -25,18 +19,17 @@ def to_tensors(ts):
     :param lengths_key: This is a field passed from the model params specifying source of truth of the temporal lengths
     :return: A `tuple` of `features` and `y` (labels)
     """
-    keys = ts[0].keys()
-    # This is kind of a hack
-    keys = [k for k in keys if k != 'ids']
+    return concat_batches(to_batch_tensors(batch) for batch in ts)
 
-    features = dict((k, []) for k in keys)
 
-    for sample in ts:
-        for k in features.keys():
-            for s in sample[k]:
-                features[k].append(s)
+def to_batch_tensors(batch):
+    """Convert one batch of a data feed into a tuple of `features` (`dict`) and `y` values
 
-    features = dict((k, np.stack(v).astype(np.int32)) for k, v in features.items())
+    :param batch: A batch from the data feed
+    :return: A `tuple` of `features` and `y` (labels)
+    """
+    # This is kind of a hack
+    features = dict((k, np.asarray(v).astype(np.int32)) for k, v in batch.items() if k != 'ids')
     tgt = features.pop('y')
     return features, tgt
 
@@ -10,7 +10,8 @@ from baseline.utils import get_model_file, get_metric_cmp, convert_seq2seq_golds
 from eight_mile.bleu import bleu
 from baseline.model import create_model_for
 from baseline.train import register_training_func, Trainer
-from baseline.tf.seq2seq.training.utils import to_tensors, SHUF_BUF_SZ, NUM_PREFETCH
+from baseline.tf.tfy import to_dataset, dataset_params
+from baseline.tf.seq2seq.training.utils import to_batch_tensors
 
 
 def loss(model, features, labels):
@@ -297,14 +298,10 @@ def fit_eager_distributed(model_params, ts, vs, es=None, **kwargs):
     tgt_key = model_params.get('tgt_key')
 
     src_lengths_key = model_params.get('src_lengths_key')
-    train_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(ts, src_lengths_key, dst=True))
-    train_dataset = train_dataset.shuffle(buffer_size=SHUF_BUF_SZ)
-    train_dataset = train_dataset.batch(batchsz, drop_remainder=True)
-    train_dataset = train_dataset.prefetch(NUM_PREFETCH)
+    data_params = dataset_params(**kwargs)
+    train_dataset = to_dataset(ts, lambda batch: to_batch_tensors(batch, src_lengths_key, dst=True), batchsz, shuffle=True, drop_remainder=True, **data_params)
 
-    valid_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(vs, src_lengths_key, dst=True))
-    valid_dataset = valid_dataset.batch(batchsz, drop_remainder=True)
-    valid_dataset = valid_dataset.prefetch(NUM_PREFETCH)
+    valid_dataset = to_dataset(vs, lambda batch: to_batch_tensors(batch, src_lengths_key, dst=True), batchsz, drop_remainder=True, **data_params)
 
     trainer = Seq2SeqTrainerDistributedTf(model_params, **kwargs)
     
@@ -340,8 +337,6 @@ def fit_eager_distributed(model_params, ts, vs, es=None, **kwargs):
     if es is not None:
         print('Reloading best checkpoint')
         trainer.recover_last_checkpoint()
-        test_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(es, src_lengths_key, dst=True))
-        test_dataset = test_dataset.batch(test_batchsz, drop_remainder=False)
-        test_dataset = test_dataset.prefetch(NUM_PREFETCH)
+        test_dataset = to_dataset(es, lambda batch: to_batch_tensors(batch, src_lengths_key, dst=True), test_batchsz, drop_remainder=False, **data_params)
         trainer.test(test_dataset, steps=len(es.examples) // es.batchsz, reporting_fns=reporting_fns, phase='Test')
 
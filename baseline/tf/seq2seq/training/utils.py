@@ -11,15 +11,10 @@ from baseline.utils import (
 )
 
 from baseline.train import Trainer, register_trainer
-from baseline.tf.tfy import TRAIN_FLAG, SET_TRAIN_FLAG
+from baseline.tf.tfy import TRAIN_FLAG, SET_TRAIN_FLAG, concat_batches
 
 from baseline.model import create_model_for
 
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
-
 
 def to_tensors(ts, src_lengths_key, dst=False):
     """Convert a data feed into a tuple of `features` (`dict`) and `y` values
@@ -33,23 +28,24 @@ def to_tensors(ts, src_lengths_key, dst=False):
     :param dst: `bool` that says if we should prepare a `dst` tensor.  This is needed in distributed mode
     :return: A `tuple` of `features` and `y` (labels)
     """
-    keys = ts[0].keys()
+    return concat_batches(to_batch_tensors(batch, src_lengths_key, dst) for batch in ts)
+
+
+def to_batch_tensors(batch, src_lengths_key, dst=False):
+    """Convert one batch of a data feed into a tuple of `features` (`dict`) and `y` values
+
+    :param batch: A batch from the data feed
+    :param src_lengths_key: This is a field passed from the model params specifying source of truth of the temporal lengths
+    :param dst: `bool` that says if we should prepare a `dst` tensor.  This is needed in distributed mode
+    :return: A `tuple` of `features` and `y` (labels)
+    """
     # This is kind of a hack
-    keys = [k for k in keys if '_lengths' not in k and k != 'ids'] + [src_lengths_key, "tgt_lengths"]
-
-    features = dict((k, []) for k in keys)
-    for sample in ts:
-        for k in keys:
-            for s in sample[k]:
-                features[k].append(s)
-    features['src_len'] = features[src_lengths_key]
-    del features[src_lengths_key]
-    features['tgt_len'] = features['tgt_lengths']
-    del features['tgt_lengths']
-    features = dict((k, np.stack(v).astype(np.int32)) for k, v in features.items())
+    keys = [k for k in batch.keys() if '_lengths' not in k and k != 'ids'] + [src_lengths_key, "tgt_lengths"]
+    features = dict((k, np.asarray(batch[k]).astype(np.int32)) for k in keys)
+    features['src_len'] = features.pop(src_lengths_key)
+    features['tgt_len'] = features.pop('tgt_lengths')
     if dst:
         features['dst'] = features['tgt'][:, :-1]
     tgt = features.pop('tgt')
-
     return features, tgt
 
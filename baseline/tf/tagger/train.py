@@ -15,12 +15,7 @@ from eight_mile.confusion import ConfusionMatrix
 from baseline.model import create_model_for
 from baseline.train import register_training_func, EpochReportingTrainer, register_trainer, create_trainer
 from baseline.utils import get_model_file, get_metric_cmp
-from baseline.tf.tfy import setup_tf2_checkpoints
-# Number of batches to prefetch if using tf.datasets
-NUM_PREFETCH = 2
-# The shuffle buffer
-SHUF_BUF_SZ = 5000
-
+from baseline.tf.tfy import setup_tf2_checkpoints, concat_batches, to_dataset, dataset_params
 logger = logging.getLogger('baseline')
 
 
@@ -35,20 +30,20 @@ def to_tensors(ts, lengths_key):
     :param lengths_key: This is a field passed from the model params specifying source of truth of the temporal lengths
     :return: A `tuple` of `features` and `y` (labels)
     """
-    keys = ts[0].keys()
+    return concat_batches(to_batch_tensors(batch, lengths_key) for batch in ts)
+
+
+def to_batch_tensors(batch, lengths_key):
+    """Convert one batch of a data feed into a tuple of `features` (`dict`) and `y` values
+
+    :param batch: A batch from the data feed
+    :param lengths_key: This is a field passed from the model params specifying source of truth of the temporal lengths
+    :return: A `tuple` of `features` and `y` (labels)
+    """
     # This is kind of a hack
-    keys = [k for k in keys if '_lengths' not in k and k != 'ids'] + [lengths_key]
-
-    features = dict((k, []) for k in keys)
-    for sample in ts:
-        for k in features.keys():
-            # add each sample
-            for s in sample[k]:
-                features[k].append(s)
-
-    features['lengths'] = features[lengths_key]
-    del features[lengths_key]
-    features = dict((k, np.stack(v)) for k, v in features.items())
+    keys = [k for k in batch.keys() if '_lengths' not in k and k != 'ids'] + [lengths_key]
+    features = dict((k, np.asarray(batch[k])) for k in keys)
+    features['lengths'] = features.pop(lengths_key)
     y = features.pop('y')
     return features, y
 
@@ -602,14 +597,10 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     test_batchsz = kwargs.get('test_batchsz', batchsz)
     lengths_key = model_params.get('lengths_key')
 
-    train_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(ts, lengths_key))
-    train_dataset = train_dataset.shuffle(buffer_size=SHUF_BUF_SZ)
-    train_dataset = train_dataset.batch(batchsz, drop_remainder=False)
-    train_dataset = train_dataset.prefetch(NUM_PREFETCH)
+    data_params = dataset_params(**kwargs)
+    train_dataset = to_dataset(ts, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, shuffle=True, drop_remainder=False, **data_params)
 
-    valid_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(vs, lengths_key))
-    valid_dataset = valid_dataset.batch(batchsz, drop_remainder=False)
-    valid_dataset = valid_dataset.prefetch(NUM_PREFETCH)
+    valid_dataset = to_dataset(vs, lambda batch: to_batch_tensors(batch, lengths_key), batchsz, drop_remainder=False, **data_params)
 
     best_metric = 0
     if do_early_stopping:
@@ -651,9 +642,7 @@ def fit_eager(model_params, ts, vs, es=None, **kwargs):
     if es is not None:
         print('Reloading best checkpoint')
         trainer.recover_last_checkpoint()
-        test_dataset = tf.data.Dataset.from_tensor_slices(to_tensors(es, lengths_key))
-        test_dataset = test_dataset.batch(test_batchsz, drop_remainder=False)
-        test_dataset = test_dataset.prefetch(NUM_PREFETCH)
+        test_dataset = to_dataset(es, lambda batch: to_batch_tensors(batch, lengths_key), test_batchsz, drop_remainder=False, **data_params)
         evaluator = trainer.evaluator_class(trainer.model, span_type, verbose)
         timer = Timer()
         test_metrics = evaluator.test(test_dataset, conll_output=conll_output, txts=txts, batches=es, steps=len(es))
@@ -64,3 +64,79 @@ def setup_tf2_checkpoints(optimizer: EagerOptimizer, model: tf.keras.layers.Laye
         _checkpoint.restore(restore_file)
     return _checkpoint, checkpoint_manager
 
+
+
+# Number of batches to prefetch if using tf.datasets
+NUM_PREFETCH = 2
+# The shuffle buffer
+SHUF_BUF_SZ = 5000
+
+
+def _concat_padded(*xs):
+    """Concatenate arrays along the batch, padding any other dimension (like a bucketed `T`) with zeros to the longest"""
+    shape = np.max([x.shape[1:] for x in xs], axis=0) if xs[0].ndim > 1 else ()
+    return np.concatenate([np.pad(x, [(0, 0)] + [(0, s - d) for s, d in zip(shape, x.shape[1:])]) for x in xs])
+
+
+def concat_batches(batches):
+    """Concatenate a stream of `(features, y)` batches into one `(features, y)` over the whole data feed
+
+    Batches from a feed that trims or buckets by length can have different sequence lengths, those are padded
+    with zeros (`Offsets.PAD`) to the longest one
+
+    :param batches: An iterable of `(features, y)`, where `features` is a `dict` of arrays (`y` can be a tuple)
+    :return: The concatenated `(features, y)`
+    """
+    return tf.nest.map_structure(_concat_padded, *list(batches))
+
+
+def to_dataset(ts, transform, batchsz, shuffle=False, drop_remainder=False, stream=True,
+               shuffle_buffer=SHUF_BUF_SZ, prefetch=NUM_PREFETCH):
+    """Build a batched `tf.data.Dataset` from a data feed
+
+    When `stream` is on, the feed is read one batch at a time through a generator and split into examples, so we
+    never build a second, stacked copy of the whole corpus in memory.  Otherwise we fall back to
+    `from_tensor_slices` on the concatenated feed, which some distribution strategies (TPU) require.  Every
+    dimension but the batch may change from one batch of the feed to the next (a trimmed or length-bucketed feed),
+    so the examples are re-batched with `padded_batch`, which pads them with zeros to the longest in the batch
+
+    :param ts: The data feed
+    :param transform: A function from one batch of the feed to its `(features, y)`
+    :param batchsz: The batch size of the dataset
+    :param shuffle: Should we shuffle the examples (with a buffer of `shuffle_buffer`)?
+    :param drop_remainder: Should we drop the last, smaller batch?
+    :param stream: Should we stream the feed through a generator?
+    :param shuffle_buffer: The size of the shuffle buffer
+    :param prefetch: The number of batches to prefetch
+    :return: A `tf.data.Dataset` of `(features, y)`
+    """
+    if stream:
+        first = transform(ts[0])
+        signature = tf.nest.map_structure(lambda x: tf.TensorSpec((None,) * x.ndim, tf.as_dtype(x.dtype)), first)
+
+        def generator():
+            for batch in ts:
+                yield transform(batch)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        dataset = dataset.unbatch()
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(concat_batches(transform(batch) for batch in ts))
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer)
+    dataset = dataset.padded_batch(batchsz, drop_remainder=drop_remainder)
+    return dataset.prefetch(prefetch)
+
+
+def dataset_params(**kwargs):
+    """Get the `to_dataset` options from the training kwargs
+
+    Streaming is on by default, except under a TPU strategy where the input pipeline cant call back into Python
+
+    :return: A `dict` of `stream`, `shuffle_buffer` and `prefetch`
+    """
+    return {
+        'stream': bool(kwargs.get('stream_data', kwargs.get('strategy_type') != 'tpu')),
+        'shuffle_buffer': int(kwargs.get('shuffle_buffer', SHUF_BUF_SZ)),
+        'prefetch': int(kwargs.get('prefetch', NUM_PREFETCH)),
+    }
@@ -1,13 +1,15 @@
 import collections
 import copy
+import heapq
 import tempfile
 import unicodedata
 import re
 import json
-from typing import Tuple, List, Iterable, Set, Dict
+from typing import Tuple, List, Iterable, Set, Dict, Optional
 import numpy as np
 
 from functools import lru_cache
+from itertools import islice, chain
 from eight_mile.downloads import open_file_or_url, get_file_or_url
 from eight_mile.utils import exporter, optional_params, listify, register, Offsets, is_sequence, pads
 from baseline.utils import import_user_module
@@ -37,6 +39,33 @@ class Vectorizer:
     def run(self, tokens, vocab):
         pass
 
+    def run_batch(self, tokens_batch, vocab, dtype=np.int32) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Convert a batch of token streams into a single array
+
+        The default implementation calls `run` on each example and copies the result into an array that is
+        allocated once for the whole batch.  Vectorizers that can write their values in place override this
+
+        :param tokens_batch: An iterable of token streams, one per example
+        :param vocab: A word-to-integer index
+        :param dtype: The dtype to use for the (integer) output array
+        :return: A `[B, ...]` array and a `[B]` array of valid lengths (`None` if the vectorizer has no lengths)
+        """
+        tokens_batch = list(tokens_batch)
+        vecs = None
+        lengths = None
+        for i, tokens in enumerate(tokens_batch):
+            vec, length = self.run(tokens, vocab)
+            vec = np.asarray(vec)
+            if vecs is None:
+                vec_dtype = dtype if np.issubdtype(vec.dtype, np.integer) else vec.dtype
+                vecs = np.empty((len(tokens_batch),) + vec.shape, dtype=vec_dtype)
+                if length is not None:
+                    lengths = np.empty(len(tokens_batch), dtype=np.int64)
+            vecs[i] = vec
+            if lengths is not None:
+                lengths[i] = length
+        return vecs, lengths
+
     def count(self, tokens):
         pass
 
@@ -190,6 +219,37 @@ class Token1DVectorizer(AbstractVectorizer):
             return vec1d, None
         return vec1d, valid_length
 
+    def run_batch(self, tokens_batch, vocab, dtype=np.int32):
+        """Convert a batch of token streams into a single `[B, mxlen]` array, writing each example in place
+
+        :param tokens_batch: An iterable of token streams, one per example
+        :param vocab: A word-to-integer index
+        :param dtype: The dtype to use for the output array
+        :return: A (padded) `[B, mxlen]` array and a `[B]` array of valid lengths
+        """
+        if type(self).run is not Token1DVectorizer.run:
+            # A subclass changed how an example is vectorized so we cant write it in place
+            return super().run_batch(tokens_batch, vocab, dtype)
+        if self.mxlen < 0:
+            self.mxlen = self.max_seen
+
+        tokens_batch = list(tokens_batch)
+        vecs = pads((len(tokens_batch), self.mxlen), dtype=dtype)
+        lengths = np.empty(len(tokens_batch), dtype=np.int64)
+        for i, tokens in enumerate(tokens_batch):
+            values = np.fromiter(islice(self._next_element(tokens, vocab), self.mxlen), dtype=dtype)
+            valid_length = len(values)
+            if self.time_reverse:
+                vecs[i, self.mxlen - valid_length:] = values[::-1]
+            else:
+                vecs[i, :valid_length] = values
+            # Same as `run`, an empty stream still gets a length of 1
+            lengths[i] = max(valid_length, 1)
+
+        if self.time_reverse:
+            return vecs, None
+        return vecs, lengths
+
     def get_dims(self):
         return self.mxlen,
 
@@ -325,9 +385,41 @@ class Char2DVectorizer(AbstractCharVectorizer):
         if self.mxwlen < 0:
             self.mxwlen = self.max_seen_char
 
-        EOW = vocab.get('<EOW>', vocab.get(' ', Offsets.PAD))
-
         vec2d = pads((self.mxlen, self.mxwlen), dtype=int)
+        valid_length = self._write(vec2d, tokens, vocab)
+        return vec2d, valid_length
+
+    def run_batch(self, tokens_batch, vocab, dtype=np.int32):
+        """Convert a batch of token streams into a single `[B, mxlen, mxwlen]` array, writing each example in place
+
+        :param tokens_batch: An iterable of token streams, one per example
+        :param vocab: A character-to-integer index
+        :param dtype: The dtype to use for the output array
+        :return: A (padded) `[B, mxlen, mxwlen]` array and a `[B]` array of valid lengths
+        """
+        if type(self).run is not Char2DVectorizer.run:
+            return super().run_batch(tokens_batch, vocab, dtype)
+        if self.mxlen < 0:
+            self.mxlen = self.max_seen_tok
+        if self.mxwlen < 0:
+            self.mxwlen = self.max_seen_char
+
+        tokens_batch = list(tokens_batch)
+        vecs = pads((len(tokens_batch), self.mxlen, self.mxwlen), dtype=dtype)
+        lengths = np.empty(len(tokens_batch), dtype=np.int64)
+        for i, tokens in enumerate(tokens_batch):
+            lengths[i] = self._write(vecs[i], tokens, vocab)
+        return vecs, lengths
+
+    def _write(self, vec2d, tokens, vocab):
+        """Fill the (already padded) `[mxlen, mxwlen]` array with the characters of each token
+
+        :param vec2d: The array to write to
+        :param tokens: An iterable token stream
+        :param vocab: A character-to-integer index
+        :return: The valid length
+        """
+        EOW = vocab.get('<EOW>', vocab.get(' ', Offsets.PAD))
         i = 0
         j = 0
         over = False
@@ -351,8 +443,7 @@ class Char2DVectorizer(AbstractCharVectorizer):
             else:
                 vec2d[i, j] = atom
                 j += 1
-        valid_length = i
-        return vec2d, valid_length
+        return i
 
     def get_dims(self):
         return self.mxlen, self.mxwlen
@@ -420,6 +511,35 @@ class Char1DVectorizer(AbstractCharVectorizer):
             return vec1d, None
         return vec1d, i + 1
 
+    def run_batch(self, tokens_batch, vocab, dtype=np.int32):
+        """Convert a batch of token streams into a single `[B, mxlen]` array of characters, writing each example in place
+
+        :param tokens_batch: An iterable of token streams, one per example
+        :param vocab: A character-to-integer index
+        :param dtype: The dtype to use for the output array
+        :return: A (padded) `[B, mxlen]` array and a `[B]` array of valid lengths
+        """
+        if type(self).run is not Char1DVectorizer.run:
+            return super().run_batch(tokens_batch, vocab, dtype)
+        if self.mxlen < 0:
+            self.mxlen = self.max_seen_tok
+
+        tokens_batch = list(tokens_batch)
+        vecs = pads((len(tokens_batch), self.mxlen), dtype=dtype)
+        lengths = np.empty(len(tokens_batch), dtype=np.int64)
+        for i, tokens in enumerate(tokens_batch):
+            values = np.fromiter(islice(self._next_element(tokens, vocab), self.mxlen), dtype=dtype)
+            valid_length = len(values)
+            if self.time_reverse:
+                vecs[i, self.mxlen - valid_length:] = values[::-1]
+            else:
+                vecs[i, :valid_length] = values
+            lengths[i] = valid_length
+
+        if self.time_reverse:
+            return vecs, None
+        return vecs, lengths
+
     def get_dims(self):
         return self.mxlen,
 
@@ -1010,13 +1130,113 @@ class BasicTokenizer:
         return "".join(output)
 
 
+_TRIE_END = ''
+
+
+@export
+class WordpieceTrie:
+    """A character trie over a WordPiece vocabulary
+
+    There are two roots, one for pieces that can start a word and one for the `##` continuation pieces (stored
+    without their prefix), so a greedy longest match is a single walk down the trie instead of probing the vocab
+    with every shorter substring
+    """
+
+    def __init__(self, vocab, subword_sentinel="##"):
+        self.subword_sentinel = subword_sentinel
+        self.initial = {}
+        self.continuation = {}
+        for piece in vocab:
+            self._insert(self.initial, piece)
+            if piece.startswith(subword_sentinel) and len(piece) > len(subword_sentinel):
+                self._insert(self.continuation, piece[len(subword_sentinel):])
+
+    @staticmethod
+    def _insert(root, piece):
+        node = root
+        for char in piece:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = True
+
+    def longest_match(self, word, start):
+        """Find the end of the longest piece in the vocab that starts at `start`
+
+        :param word: The word being segmented
+        :param start: The offset of the piece, if its > 0 we look for a continuation piece
+        :return: The end offset of the longest match or `None` if nothing matches
+        """
+        node = self.initial if start == 0 else self.continuation
+        end = None
+        for i in range(start, len(word)):
+            node = node.get(word[i])
+            if node is None:
+                break
+            if _TRIE_END in node:
+                end = i + 1
+        return end
+
+    def segment(self, word):
+        """Greedy longest-match-first segmentation of a single word
+
+        :param word: A single word
+        :return: A tuple of the word pieces or `None` if the word cant be covered by the vocab
+        """
+        pieces = []
+        start = 0
+        while start < len(word):
+            end = self.longest_match(word, start)
+            if end is None:
+                return None
+            pieces.append(word[start:end] if start == 0 else self.subword_sentinel + word[start:end])
+            start = end
+        return tuple(pieces)
+
+
+_WORDPIECE_TRIE = (None, 0, None)
+
+
+def _wordpiece_trie(vocab):
+    """Get a trie for this vocab, reusing the last one if its for the same vocab (usually `BERT_VOCAB`)"""
+    global _WORDPIECE_TRIE
+    cached_vocab, size, trie = _WORDPIECE_TRIE
+    if cached_vocab is not vocab or size != len(vocab):
+        trie = WordpieceTrie(vocab)
+        _WORDPIECE_TRIE = (vocab, len(vocab), trie)
+    return trie
+
+
 class WordpieceTokenizer:
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200, cache_size=65536):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.cache_size = cache_size
+        self._build()
+
+    def _build(self):
+        self.trie = _wordpiece_trie(self.vocab)
+        self.tokenize_word = lru_cache(maxsize=self.cache_size)(self._tokenize_word)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['trie']
+        del state['tokenize_word']
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('cache_size', 65536)
+        self.__dict__.update(state)
+        self._build()
+
+    @property
+    def cache_stats(self):
+        """Get the hits, misses, current size and hit rate of the word cache"""
+        info = self.tokenize_word.cache_info()
+        lookups = info.hits + info.misses
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+                'hit_rate': info.hits / lookups if lookups else 0.0}
 
     def convert_tokens_to_ids(self, tokens):
         return convert_by_vocab(self.vocab, tokens)
@@ -1025,11 +1245,18 @@ class WordpieceTokenizer:
     def subword_sentinel(self):
         return "##"
 
+    def _tokenize_word(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+        pieces = self.trie.segment(token)
+        return (self.unk_token,) if pieces is None else pieces
+
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
 
         This uses a greedy longest-match-first algorithm to perform tokenization
-        using the given vocabulary.
+        using the given vocabulary.  The matching is done on a trie of the vocab
+        and the pieces for each word are kept in a bounded LRU cache.
 
         For example:
           input = "unaffable"
@@ -1047,35 +1274,7 @@ class WordpieceTokenizer:
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
+            output_tokens.extend(self.tokenize_word(token))
         return output_tokens
 
 
@@ -1134,7 +1333,8 @@ class WordpieceVectorizer1D(AbstractVectorizer, HasSubwordTokens):
         
         super().__init__(kwargs.get('transform_fn'), kwargs.get('emit_begin_tok', ['[CLS]']), kwargs.get('emit_end_tok', ['[SEP]']))
         self.max_seen = kwargs.get('max_seen', 512)
-        self.tokenizer = WordpieceTokenizer(self.read_vocab(kwargs.get('vocab_file')))
+        self.tokenizer = WordpieceTokenizer(self.read_vocab(kwargs.get('vocab_file')),
+                                            cache_size=kwargs.get('wordpiece_cache_size', 65536))
         self.mxlen = kwargs.get('mxlen', -1)
         self.dtype = kwargs.get('dtype', 'int')
         # TODO: maybe this be a superset that includes things like [UNK], [SEP]
@@ -1427,72 +1627,119 @@ def get_pairs(word):
 
 
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=65536):
         self.encoder = encoder
         self.decoder = {v:k for k,v in self.encoder.items()}
         self.errors = errors # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v:k for k, v in self.byte_encoder.items()}
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        # A bounded LRU, so a long running service doesnt keep every token it has ever seen
+        self.cache_size = cache_size
+        self.bpe = lru_cache(maxsize=cache_size)(self._bpe)
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = regex.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['bpe']
+        return state
+
+    def __setstate__(self, state):
+        # Older pickles have an unbounded `cache` dict instead
+        state.pop('cache', None)
+        state.setdefault('cache_size', 65536)
+        self.__dict__.update(state)
+        self.bpe = lru_cache(maxsize=self.cache_size)(self._bpe)
 
-        if not pairs:
+    @property
+    def cache_stats(self):
+        """Get the hits, misses, current size and hit rate of the BPE cache"""
+        info = self.bpe.cache_info()
+        lookups = info.hits + info.misses
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize,
+                'hit_rate': info.hits / lookups if lookups else 0.0}
+
+    def _bpe(self, token):
+        """Apply the merges to a single (byte-encoded) token
+
+        The symbols are kept in a linked list and the candidate pairs in a heap keyed by rank, so each merge only
+        looks at its neighbors instead of rescanning the whole word.  Like the reference implementation, every
+        occurrence of the best pair is merged (left to right) before any pair that those merges made is considered
+        """
+        word = list(token)
+        if len(word) < 2:
             return token
+        ranks = self.bpe_ranks
+        nxt = list(range(1, len(word))) + [-1]
+        prev = list(range(-1, len(word) - 1))
+        heap = []
+        for i in range(len(word) - 1):
+            rank = ranks.get((word[i], word[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, word[i], word[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            # Everything for this rank comes off in position order
+            merges = []
+            while heap and heap[0][0] == rank:
+                merges.append(heapq.heappop(heap))
+            made = []
+            for _, i, first, second in merges:
+                j = nxt[i]
+                # Skip pairs that an earlier merge has already used up
+                if word[i] != first or j == -1 or word[j] != second:
+                    continue
+                word[i] = first + second
+                word[j] = None
+                k = nxt[j]
+                nxt[i] = k
+                if k != -1:
+                    prev[k] = i
+                made.append(i)
+            for i in made:
+                if word[i] is None:
+                    continue
+                p, k = prev[i], nxt[i]
+                if p != -1:
+                    rank = ranks.get((word[p], word[i]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, p, word[p], word[i]))
+                if k != -1:
+                    rank = ranks.get((word[i], word[k]))
+                    if rank is not None:
+                        heapq.heappush(heap, (rank, i, word[i], word[k]))
+
+        symbols = []
+        i = 0
+        while i != -1:
+            symbols.append(word[i])
+            i = nxt[i]
+        return ' '.join(symbols)
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
+    def encode_many(self, texts, subwords=False):
+        """Encode a batch of texts, running BPE only once for each distinct pre-token in the batch
 
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
-        return word
+        :param texts: A list of strings
+        :param subwords: Give back the subword strings instead of their indices
+        :return: A list with the encoded tokens for each text
+        """
+        pieces = [regex.findall(self.pat, text) for text in texts]
+        encoded = {}
+        for piece in set(chain.from_iterable(pieces)):
+            token = ''.join(self.byte_encoder[b] for b in piece.encode('utf-8'))
+            bpe_tokens = self.bpe(token).split(' ')
+            encoded[piece] = bpe_tokens if subwords else [self.encoder[bpe_token] for bpe_token in bpe_tokens]
+        return [list(chain.from_iterable(encoded[piece] for piece in text_pieces)) for text_pieces in pieces]
 
     def encode(self, text):
-        bpe_tokens = []
-        for token in regex.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
-        return bpe_tokens
+        return self.encode_many([text])[0]
 
     def encode_subword(self, text):
-        bpe_tokens = []
-        for token in regex.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(bpe_token for bpe_token in self.bpe(token).split(' '))
-        return bpe_tokens
+        return self.encode_many([text], subwords=True)[0]
 
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
@@ -1521,6 +1768,7 @@ class GPT2Vectorizer1D(AbstractVectorizer, HasSubwordTokens):
         self.tokenizer = Encoder(
             encoder=vocab,
             bpe_merges=bpe_merges,
+            cache_size=kwargs.get('bpe_cache_size', 65536),
         )
 
         self.mxlen = kwargs.get('mxlen', -1)
@@ -1573,14 +1821,15 @@ class GPT2Vectorizer1D(AbstractVectorizer, HasSubwordTokens):
         self.max_seen = max(self.max_seen, seen)
         return counter
 
+    @staticmethod
+    def _to_text(tokens):
+        return tokens if isinstance(tokens, str) else ' '.join(tokens)
+
     def iterable(self, tokens):
         for t in self.emit_begin_tok:
             yield t
 
-        if not isinstance(tokens, str):
-            tokens = ' '.join(tokens)
-
-        bpe_tokens = self.tokenizer.encode_subword(tokens)
+        bpe_tokens = self.tokenizer.encode_many([self._to_text(tokens)], subwords=True)[0]
         for t in bpe_tokens:
             yield t
         for t in self.emit_end_tok:
@@ -1591,6 +1840,33 @@ class GPT2Vectorizer1D(AbstractVectorizer, HasSubwordTokens):
             value = vocab.get(atom, vocab.get("<unk>"))
             yield value
 
+    def run_batch(self, tokens_batch, vocab, dtype=np.int32):
+        """Convert a batch of token streams, running the BPE for the whole batch at once with `encode_many`
+
+        :param tokens_batch: An iterable of token streams, one per example
+        :param vocab: A word-to-integer index
+        :param dtype: The dtype to use for the output array
+        :return: A (padded) `[B, mxlen]` array and a `[B]` array of valid lengths
+        """
+        if type(self).iterable is not GPT2Vectorizer1D.iterable or type(self).run is not GPT2Vectorizer1D.run:
+            return super().run_batch(tokens_batch, vocab, dtype)
+        if self.mxlen < 0:
+            self.mxlen = self.max_seen
+        texts = [self._to_text(tokens) for tokens in tokens_batch]
+        unk = vocab.get("<unk>")
+        begin = [vocab.get(t, unk) for t in self.emit_begin_tok]
+        end = [vocab.get(t, unk) for t in self.emit_end_tok]
+        vecs = pads((len(texts), self.mxlen), dtype=dtype)
+        lengths = np.empty(len(texts), dtype=np.int64)
+        for i, bpe_tokens in enumerate(self.tokenizer.encode_many(texts, subwords=True)):
+            values = begin + [vocab.get(t, unk) for t in bpe_tokens] + end
+            if len(values) > self.mxlen:
+                # Same as `run`, the end tokens are kept when we truncate
+                values = values[:self.mxlen - len(self.emit_end_tok)] + [vocab.get(x) for x in self.emit_end_tok]
+            vecs[i, :len(values)] = values
+            lengths[i] = len(values)
+        return vecs, lengths
+
     def run(self, tokens, vocab):
 
         if self.mxlen < 0:
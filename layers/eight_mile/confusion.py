@@ -40,6 +40,15 @@ class ConfusionMatrix:
 
         self._cm[truth, guess] += 1
 
+    def add_counts(self, counts):
+        """Add a whole matrix of counts, indexed by `[truth, guess]`, to the confusion matrix
+
+        This is useful when the counts have been accumulated elsewhere (like on an accelerator)
+
+        :param counts: An array with the same shape as the confusion matrix
+        """
+        self._cm += np.asarray(counts, dtype=self._cm.dtype)
+
     def __str__(self):
         values = []
         width = max(8, max(len(x) for x in self.labels) + 1)
@@ -1,4 +1,6 @@
 import io
+import os
+import json
 import copy
 import logging
 import collections
@@ -63,6 +65,113 @@ def write_word2vec_file(filename, vocab, word_vectors):
             f.write(bytes("{} ".format(word), encoding="utf-8") + vec_str)
 
 
+def _embeddings_index_files(filename):
+    return "{}.idx.vocab".format(filename), "{}.idx.npy".format(filename)
+
+
+def _embeddings_source_stamp(filename):
+    """Get the size and modification time of an embeddings file, an index made from a different version is rebuilt"""
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_index_vocab(filename, vocab_file):
+    """Read the words of an embeddings index, or `None` if there isnt one for this version of `filename`
+
+    The file is read without newline translation, since a word may contain a `\r`
+    """
+    try:
+        with io.open(vocab_file, "r", encoding="utf-8", newline="") as f:
+            stamp = json.loads(f.readline())
+            words = f.read().split("\n")
+    except (OSError, ValueError):
+        return None
+    if stamp != _embeddings_source_stamp(filename):
+        return None
+    return words
+
+
+def _write_word2vec_index(filename, weights_file):
+    import mmap
+
+    words = []
+    with io.open(filename, "rb") as f:
+        with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
+            header_end = m.find(b"\n")
+            vsz, dsz = map(int, m[:header_end].split())
+            width = 4 * dsz
+            weights = np.lib.format.open_memmap(weights_file, mode="w+", dtype=np.float32, shape=(vsz, dsz))
+            current = header_end + 1
+            for i in range(vsz):
+                end = m.find(b" ", current)
+                # Only strip out normal space and \n not other spaces which are words.
+                words.append(m[current:end].decode("utf-8").strip(" \n"))
+                weights[i] = np.frombuffer(m[end + 1 : end + 1 + width], dtype=np.float32)
+                current = end + 1 + width
+            weights.flush()
+            del weights
+    return words
+
+
+def _write_text_index(filename, weights_file):
+    vsz = 0
+    dsz = None
+    has_header = False
+    with io.open(filename, "r", encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            values = line.rstrip("\n ").split(" ")
+            if i == 0 and len(values) == 2:
+                has_header = True
+                continue
+            if len(values) < 2:
+                continue
+            if dsz is None:
+                dsz = len(values) - 1
+            vsz += 1
+    words = []
+    weights = np.lib.format.open_memmap(weights_file, mode="w+", dtype=np.float32, shape=(vsz, dsz))
+    with io.open(filename, "r", encoding="utf-8") as f:
+        if has_header:
+            next(f)
+        for line in f:
+            values = line.rstrip("\n ").split(" ")
+            if len(values) < 2:
+                continue
+            weights[len(words)] = np.asarray(values[1:], dtype=np.float32)
+            words.append(values[0])
+    weights.flush()
+    del weights
+    return words
+
+
+@export
+def write_embeddings_index(filename):
+    """Convert a word2vec binary or GloVe text file to an index that can be loaded quickly
+
+    The index is two files next to the original.  `{filename}.idx.vocab` starts with a JSON line holding the size
+    and modification time of the original, followed by each word on its own line, in file order, and
+    `{filename}.idx.npy` is a contiguous `float32` matrix with a row for each word.  The matrix can be
+    memory-mapped so that loading only has to read the rows that are used.  This only needs to be redone when the
+    original file changes
+
+    :param filename: (`str`) The embeddings file
+    :return: A tuple of the vocab and weights file names
+    """
+    vocab_file, weights_file = _embeddings_index_files(filename)
+    tmp_suffix = ".{}.tmp".format(os.getpid())
+    write_fn = _write_text_index if mime_type(filename) == "text/plain" else _write_word2vec_index
+    logger.info("Writing an embeddings index for %s", filename)
+    stamp = _embeddings_source_stamp(filename)
+    words = write_fn(filename, weights_file + tmp_suffix)
+    with io.open(vocab_file + tmp_suffix, "w", encoding="utf-8", newline="") as f:
+        f.write(json.dumps(stamp) + "\n")
+        f.write("\n".join(words))
+    # Move the weights in last, since that is what we check to see if there is an index
+    os.replace(vocab_file + tmp_suffix, vocab_file)
+    os.replace(weights_file + tmp_suffix, weights_file)
+    return vocab_file, weights_file
+
+
 @export
 class EmbeddingsModel:
     def __init__(self):
@@ -168,22 +277,29 @@ class PretrainedEmbeddingsModel(WordEmbeddingsModel):
         special_tokens = [self.nullv]
         for i in range(1, len(Offsets.VALUES)):
             special_tokens.append(np.random.uniform(-uw, uw, self.dsz).astype(np.float32))
-        word_vectors = special_tokens + word_vectors
         # Add "well-known" values to the vocab
         for i, name in enumerate(Offsets.VALUES):
             self.vocab[name] = i
 
+        unknown_vectors = []
         if known_vocab is not None:
             # Remove "well-known" values
             for name in Offsets.VALUES:
                 known_vocab.pop(name, 0)
             unknown = {v: cnt for v, cnt in known_vocab.items() if cnt > 0}
             for v in unknown:
-                word_vectors.append(np.random.uniform(-uw, uw, self.dsz).astype(np.float32))
+                unknown_vectors.append(np.random.uniform(-uw, uw, self.dsz).astype(np.float32))
                 self.vocab[v] = idx
                 idx += 1
 
-        self.weights = np.array(word_vectors)
+        # The vectors from the file may be a list of rows or a single matrix, either way only copy them once
+        self.weights = np.concatenate(
+            [
+                np.stack(special_tokens),
+                np.asarray(word_vectors, dtype=np.float32).reshape(-1, self.dsz),
+                np.asarray(unknown_vectors, dtype=np.float32).reshape(-1, self.dsz),
+            ]
+        )
         if normalize is True:
             self.weights = norm_weights(self.weights)
 
@@ -192,6 +308,8 @@ class PretrainedEmbeddingsModel(WordEmbeddingsModel):
 
     def _read_vectors(self, filename, idx, known_vocab, keep_unused, **kwargs):
         use_mmap = bool(kwargs.get("use_mmap", False))
+        if bool(kwargs.get("use_index", False)):
+            return self._read_index(filename, idx, known_vocab, keep_unused)
         read_fn = self._read_word2vec_file
         is_glove_file = mime_type(filename) == "text/plain"
         if use_mmap:
@@ -204,6 +322,35 @@ class PretrainedEmbeddingsModel(WordEmbeddingsModel):
 
         return read_fn(filename, idx, known_vocab, keep_unused)
 
+    def _read_index(self, filename, idx, known_vocab, keep_unused):
+        """Read the vectors from the index made by `write_embeddings_index`, making the index first if there isnt one
+        or the embeddings file has changed since it was made
+
+        The words are checked against the vocab, and the rows to keep are then copied out of the memory-mapped
+        matrix in a single gather
+        """
+        vocab_file, weights_file = _embeddings_index_files(filename)
+        words = _read_index_vocab(filename, vocab_file) if os.path.exists(weights_file) else None
+        if words is None:
+            write_embeddings_index(filename)
+            words = _read_index_vocab(filename, vocab_file)
+            if words is None:
+                raise Exception("The embeddings file {} changed while it was being indexed".format(filename))
+        weights = np.load(weights_file, mmap_mode="r")
+        rows = []
+        for i, word in enumerate(words):
+            if word in self.vocab:
+                continue
+            if keep_unused is False and word not in known_vocab:
+                continue
+            if known_vocab and word in known_vocab:
+                known_vocab[word] = 0
+            rows.append(i)
+            self.vocab[word] = idx
+            idx += 1
+        word_vectors = weights[np.array(rows, dtype=np.int64)]
+        return word_vectors, weights.shape[1], known_vocab, idx
+
     def _read_word2vec_file(self, filename, idx, known_vocab, keep_unused):
         word_vectors = []
         with io.open(filename, "rb") as f:
@@ -351,7 +498,9 @@ class PretrainedEmbeddingsStack(EmbeddingsModel):
         embeddings = []
 
         for file in filenames:
-            embeddings.append(PretrainedEmbeddingsModel(file, copy.deepcopy(known_vocab)))
+            embeddings.append(
+                PretrainedEmbeddingsModel(file, copy.deepcopy(known_vocab), use_index=kwargs.get("use_index", False))
+            )
 
         self.dsz = sum([embedding.dsz for embedding in embeddings])
         self.weights = np.random.uniform(-uw, uw, (self.vsz, self.dsz)).astype(np.float32)
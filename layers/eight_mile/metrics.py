@@ -6,98 +6,99 @@ __all__ = []
 export = exporter(__all__)
 
 
-@export
-# Metrics UAS/LAS
-# UCM (unlabeled complete matching rate, the % of sentences with whole correct trees
-# LCM labeled complete matching rate
-class LAS:
+def _count(x) -> int:
+    """Sum on whatever device `x` lives on (numpy or a tensor), and only bring the scalar back to the host"""
+    return int(x.sum())
+
+
+class DependencyMetric:
+    """Base for the dependency parsing metrics, which accumulate `correct` and `total` counts
+
+    `add()` takes either a single sentence ``[T]`` or a whole batch ``[B, T]`` of numpy arrays or tensors, and
+    counts them with masked reductions rather than walking over the tokens
+    """
     def __init__(self):
         self.total = 0
         self.correct = 0
 
-    def add(self, heads_pred, heads_gold, labels_pred, labels_gold):
-        valid = labels_gold != Offsets.PAD
-        for h_p, h_g, l_p, l_g in zip(heads_pred[valid], heads_gold[valid], labels_pred[valid], labels_gold[valid]):
-            correct = h_p == h_g and l_p == l_g
-            self.total += 1
-            self.correct += float(correct)
+    def matches(self, heads_pred, heads_gold, labels_pred, labels_gold):
+        """Which tokens count as correct
 
-    @property
-    def name(self):
-        return 'las'
-
-    @property
-    def score(self):
-        return self.correct / self.total
+        :return: A boolean array the same shape as the inputs
+        """
+        return heads_pred == heads_gold
 
+    def count(self, matches, valid):
+        """Update the counts for a batch
 
-@export
-class UAS:
-    def __init__(self):
-        self.total = 0
-        self.correct = 0
+        :param matches: ``[B, T]`` Which tokens are correct
+        :param valid: ``[B, T]`` Which tokens are not padding
+        """
 
     def add(self, heads_pred, heads_gold, labels_pred, labels_gold):
+        if len(heads_gold.shape) == 1:
+            heads_pred, heads_gold, labels_pred, labels_gold = (
+                heads_pred[None], heads_gold[None], labels_pred[None], labels_gold[None]
+            )
         valid = labels_gold != Offsets.PAD
-        for h_p, h_g in zip(heads_pred[valid], heads_gold[valid]):
-            correct = h_p == h_g
-            self.total += 1
-            self.correct += float(correct)
-
-    @property
-    def name(self):
-        return 'uas'
+        self.count(self.matches(heads_pred, heads_gold, labels_pred, labels_gold), valid)
 
     @property
     def score(self):
         return self.correct / self.total
 
 
-@export
-class LCM:
-    def __init__(self):
-        self.total = 0
-        self.correct = 0
+class AttachmentScore(DependencyMetric):
+    """Token level accuracy over the non-padding tokens"""
+    def count(self, matches, valid):
+        self.total += _count(valid)
+        self.correct += _count(matches & valid)
 
-    def add(self, heads_pred, heads_gold, labels_pred, labels_gold):
-        valid = labels_gold != Offsets.PAD
-        correct = True
-        # For LCM, the entire tree has to match with labels
-        for h_p, h_g, l_p, l_g in zip(heads_pred[valid], heads_gold[valid], labels_pred[valid], labels_gold[valid]):
-            correct = correct and (h_p == h_g and l_p == l_g)
 
-        self.total += 1
-        self.correct += int(correct)
+class CompleteMatch(DependencyMetric):
+    """Sentence level accuracy, where every non-padding token must be correct"""
+    def count(self, matches, valid):
+        self.total += valid.shape[0]
+        self.correct += _count(~(valid & ~matches).any(-1))
+
+
+@export
+# Metrics UAS/LAS
+# UCM (unlabeled complete matching rate, the % of sentences with whole correct trees
+# LCM labeled complete matching rate
+class LAS(AttachmentScore):
+
+    def matches(self, heads_pred, heads_gold, labels_pred, labels_gold):
+        return (heads_pred == heads_gold) & (labels_pred == labels_gold)
 
     @property
     def name(self):
-        return 'ucm'
+        return 'las'
+
+
+@export
+class UAS(AttachmentScore):
 
     @property
-    def score(self):
-        return self.correct / self.total
+    def name(self):
+        return 'uas'
 
 
 @export
-class UCM:
-    def __init__(self):
-        self.total = 0
-        self.correct = 0
+class LCM(CompleteMatch):
+    # For LCM, the entire tree has to match with labels
+    def matches(self, heads_pred, heads_gold, labels_pred, labels_gold):
+        return (heads_pred == heads_gold) & (labels_pred == labels_gold)
+
+    @property
+    def name(self):
+        return 'lcm'
 
-    def add(self, heads_pred, heads_gold, labels_pred, labels_gold):
-        valid = labels_gold != Offsets.PAD
-        correct = True
-        # For UCM, the entire tree has to match
-        for h_p, h_g in zip(heads_pred[valid], heads_gold[valid]):
-            correct = correct and (h_p == h_g)
 
-        self.total += 1
-        self.correct += int(correct)
+@export
+class UCM(CompleteMatch):
+    # For UCM, the entire tree has to match
 
     @property
     def name(self):
         return 'ucm'
-
-    @property
-    def score(self):
-        return self.correct / self.total
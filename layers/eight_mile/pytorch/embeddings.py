@@ -63,6 +63,24 @@ class LookupTableEmbeddings(PyTorchEmbeddings):
         return f"finetune=False" if not self.finetune else ""
 
 
+def compose_unique_words(compose, flat_chars, unique_words=False):
+    """Run a character composition function, optionally over only the distinct words in the batch
+
+    Natural text has far fewer distinct words than `B x T` slots (and all of the padding is the same "word"),
+    so with `unique_words` we compose each distinct row of characters once and gather the results back out.
+    When training, each distinct word gets one dropout mask for the whole batch
+
+    :param compose: A function from `[N, W]` characters to `[N, D]` word vectors
+    :param flat_chars: `[N, W]` The characters of each word
+    :param unique_words: Should we only compose the distinct words?
+    :return: `[N, D]` The word vectors
+    """
+    if not unique_words:
+        return compose(flat_chars)
+    words, index = torch.unique(flat_chars, dim=0, return_inverse=True)
+    return compose(words)[index]
+
+
 class CharConvEmbeddings(PyTorchEmbeddings):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -76,6 +94,7 @@ class CharConvEmbeddings(PyTorchEmbeddings):
         self.wsz = kwargs.get("wsz", 30)
         self.projsz = kwargs.get("projsz", 0)
         self.pdrop = kwargs.get("pdrop", 0.5)
+        self.unique_words = kwargs.get("unique_words", False)
         self.filtsz, self.nfeats = calc_nfeats(self.cfiltsz, self.nfeat_factor, self.max_feat, self.wsz)
         self.conv_outsz = int(np.sum(self.nfeats))
         self.outsz = self.conv_outsz
@@ -101,12 +120,15 @@ class CharConvEmbeddings(PyTorchEmbeddings):
     def get_vsz(self):
         return self.vsz
 
-    def forward(self, xch):
+    def compose(self, flat_chars):
+        """Build a word vector from the characters of each word
 
+        :param flat_chars: `[N, W]` The characters of each word
+        :return: `[N, D]` The word vectors
+        """
         # For starters we need to perform embeddings for each character
         # (TxB) x W -> (TxB) x W x D
-        _0, _1, W = xch.shape
-        char_vecs = self.embeddings(xch.view(-1, W))
+        char_vecs = self.embeddings(flat_chars)
         # (TxB) x D x W
         # char_vecs = char_embeds.transpose(1, 2).contiguous()
 
@@ -115,7 +137,11 @@ class CharConvEmbeddings(PyTorchEmbeddings):
         gated = self.gating_seq(mots)
         if self.projsz:
             gated = self.proj(gated)
-        return gated.view(_0, _1, self.get_dsz())
+        return gated
+
+    def forward(self, xch):
+        _0, _1, W = xch.shape
+        return compose_unique_words(self.compose, xch.view(-1, W), self.unique_words).view(_0, _1, self.get_dsz())
 
 
 class CharLSTMEmbeddings(PyTorchEmbeddings):
@@ -127,13 +153,17 @@ class CharLSTMEmbeddings(PyTorchEmbeddings):
         pdrop = kwargs.get("pdrop", 0.5)
         unif = kwargs.get("unif", 0)
         weight_init = kwargs.get("weight_init", "uniform")
+        self.unique_words = kwargs.get("unique_words", False)
         self.char_comp = BiLSTMEncoderHidden(
             self.embed.output_dim, self.lstmsz, layers, pdrop, unif=unif, initializer=weight_init
         )
 
-    def forward(self, xch):
-        B, T, W = xch.shape
-        flat_chars = xch.view(-1, W)
+    def compose(self, flat_chars):
+        """Build a word vector from the characters of each word
+
+        :param flat_chars: `[N, W]` The characters of each word
+        :return: `[N, D]` The word vectors
+        """
         char_embeds = self.embed(flat_chars)
 
         # Calculate the lengths of each word
@@ -156,9 +186,11 @@ class CharLSTMEmbeddings(PyTorchEmbeddings):
         hidden = hidden.masked_fill((sorted_word_lengths == 0).unsqueeze(-1), 0)
 
         # Undo the sort so that the representations of the words are in the correct part of the sentence.
-        results = unsort_batch(hidden, perm_idx)
+        return unsort_batch(hidden, perm_idx)
 
-        return results.reshape((B, T, -1))
+    def forward(self, xch):
+        B, T, W = xch.shape
+        return compose_unique_words(self.compose, xch.view(-1, W), self.unique_words).reshape((B, T, -1))
 
     def get_dsz(self):
         return self.lstmsz
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.jit as jit
 import torch.autograd
+import torch.utils.checkpoint
 import contextlib
 import glob
 from eight_mile.utils import listify, Offsets, is_sequence, str2bool, get_alibi_slopes
@@ -686,6 +687,60 @@ def pytorch_linear(in_sz: int, out_sz: int, unif: float = 0, initializer: str =
     return l
 
 
+def _fused_rnn(stack: nn.Module, rnn_type: type) -> nn.RNNBase:
+    """Get an `nn.LSTM` or `nn.GRU` that runs a `StackedLSTMCell` or `StackedGRUCell` over a whole sequence
+
+    The RNN is built the first time and kept outside of the module tree, so the cells still own the parameters and
+    the state dict is unchanged.  Its weights are the cells' own `Parameter`s, and whenever they are replaced or
+    moved (`.to()`, `.cuda()`) they are flattened again, so cuDNN gets one contiguous buffer instead of copying the
+    weights on every call.  On the CPU, or when cuDNN can't take the weights, `flatten_parameters` does nothing and
+    the kernel reads the cell weights where they are.
+
+    `DataParallel` replicas share their module's `__dict__` (so this RNN) and get new weights on every call, so
+    they don't use this, see `_step_sequence`
+
+    :param stack: The stacked cells
+    :param rnn_type: `nn.LSTM` or `nn.GRU`
+    :return: The fused RNN, with the dropout and train mode of `stack`
+    """
+    weights = [
+        w for cell in stack.layers for w in (cell.weight_ih, cell.weight_hh, cell.bias_ih, cell.bias_hh) if w is not None
+    ]
+    rnn = stack.__dict__.get('_fused_rnn')
+    if rnn is None:
+        first = stack.layers[0]
+        rnn = rnn_type(first.input_size, first.hidden_size, num_layers=stack.num_layers, bias=first.bias)
+        # Set it straight into `__dict__` so that it isnt registered as a submodule
+        stack.__dict__['_fused_rnn'] = rnn
+        stack.__dict__['_fused_state'] = None
+    state = [(id(w), w.data_ptr()) for w in weights]
+    if state != stack.__dict__['_fused_state']:
+        for name, w in zip(rnn._flat_weights_names, weights):
+            setattr(rnn, name, w)
+        rnn.flatten_parameters()
+        stack.__dict__['_fused_state'] = [(id(w), w.data_ptr()) for w in weights]
+    rnn.dropout = stack.dropout.p
+    rnn.train(stack.training)
+    return rnn
+
+
+def _step_sequence(stack: nn.Module, input: torch.Tensor, hidden):
+    """Run a `StackedLSTMCell` or `StackedGRUCell` over a sequence one timestep at a time
+
+    This is what `forward_sequence` falls back to on a `DataParallel` replica, where the fused RNN can't be shared
+
+    :param stack: The stacked cells
+    :param input: The input to the first cell `[T, B, H]`
+    :param hidden: The initial hidden state
+    :return: The output of the last cell `[T, B, H]` and the final hidden state
+    """
+    outputs = []
+    for input_t in input:
+        output, hidden = stack(input_t, hidden)
+        outputs.append(output)
+    return torch.stack(outputs), hidden
+
+
 class StackedLSTMCell(nn.Module):
     """A stacked LSTM cells applied at a timestep
     """
@@ -722,6 +777,21 @@ class StackedLSTMCell(nn.Module):
 
         return input, (hs, cs)
 
+    def forward_sequence(self, input: torch.Tensor, hidden: Tuple[torch.Tensor, torch.Tensor]):
+        """Apply the stack to a whole sequence at once with the fused (cuDNN on the GPU) LSTM kernel
+
+        This runs an `nn.LSTM` that shares the weights of the cells (see `_fused_rnn`), so it gives the same result
+        as calling `forward` at each timestep
+
+        :param input: The input to the first LSTM `[T, B, H]`
+        :param hidden: The initial `(h, c)` where `h=(h_0, h_1,..)`, `c=(c_0, c_1,..)`
+        :return: The output of the last LSTM `[T, B, H]` and the final hidden `(h, c)`
+        """
+        if getattr(self, '_is_replica', False):
+            return _step_sequence(self, input, hidden)
+        output, (hs, cs) = _fused_rnn(self, nn.LSTM)(input, tuple(hidden))
+        return output, (hs, cs)
+
 
 class StackedGRUCell(nn.Module):
     """A stacked GRU cells applied at a timestep
@@ -757,6 +827,22 @@ class StackedGRUCell(nn.Module):
 
         return input, hs
 
+    def forward_sequence(self, input: torch.Tensor, hidden: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Apply the stack to a whole sequence at once with the fused (cuDNN on the GPU) GRU kernel
+
+        This runs an `nn.GRU` that shares the weights of the cells (see `_fused_rnn`), so it gives the same result
+        as calling `forward` at each timestep
+
+        :param input: The input to the first GRU `[T, B, H]`
+        :param hidden: The initial `h` where `h=(h_0, h_1,..)`
+        :return: The output of the last GRU `[T, B, H]` and the final hidden `h`
+        """
+        if getattr(self, '_is_replica', False):
+            return _step_sequence(self, input, hidden)
+        output, hs = _fused_rnn(self, nn.GRU)(input, hidden)
+        # `forward` also applies dropout to the output of the last layer
+        return self.dropout(output), hs
+
 
 class Dense(nn.Module):
     """Dense (Linear) layer with optional activation given
@@ -1871,6 +1957,31 @@ class VectorSequenceAttention(nn.Module):
         attended = torch.tanh(self.W_c(attended))
         return attended
 
+    def forward_sequence(self, query_bqh, keys_bth, values_bth, keys_mask=None):
+        """Attend with a whole sequence of queries at once
+
+        This gives the same result as calling `forward` for each query
+
+        :param query_bqh: The queries `[B, Q, H]`
+        :param keys_bth: The keys `[B, T, H]`
+        :param values_bth: The values `[B, T, H]`
+        :param keys_mask: The mask over the keys `[B, T]`
+        :return: The attended output for each query `[B, Q, H]`
+        """
+        a = self._attention_sequence(query_bqh, keys_bth, keys_mask)
+        return self._update_sequence(a, query_bqh, values_bth)
+
+    def _attention_sequence(self, query_bqh, keys_bth, keys_mask):
+        # Fall back to running the single query version for each query
+        return torch.stack([self._attention(q, keys_bth, keys_mask) for q in query_bqh.unbind(1)], 1)
+
+    def _update_sequence(self, a, query_bqh, values_bth):
+        # (B x Q x T) (B x T x H) = (B x Q x H)
+        c_t = a @ values_bth
+        attended = torch.cat([c_t, query_bqh], -1)
+        attended = torch.tanh(self.W_c(attended))
+        return attended
+
 
 def dot_product_attention_weights(query_t: torch.Tensor,
                                   keys_bth: torch.Tensor,
@@ -1881,6 +1992,15 @@ def dot_product_attention_weights(query_t: torch.Tensor,
     return a
 
 
+def dot_product_attention_weights_sequence(query_bqh: torch.Tensor,
+                                           keys_bth: torch.Tensor,
+                                           keys_mask: torch.Tensor) -> torch.Tensor:
+    a = query_bqh @ keys_bth.transpose(1, 2)
+    a = a.masked_fill(keys_mask.unsqueeze(1) == MASK_FALSE, -1e9)
+    a = F.softmax(a, dim=-1)
+    return a
+
+
 def dot_product_attention_weights_lengths(query_t: torch.Tensor,
                                           keys_bth: torch.Tensor,
                                           keys_lengths: torch.Tensor) -> torch.Tensor:
@@ -1895,6 +2015,9 @@ class LuongDotProductAttention(VectorSequenceAttention):
     def _attention(self, query_t, keys_bth, keys_mask):
         return dot_product_attention_weights(query_t, keys_bth, keys_mask)
 
+    def _attention_sequence(self, query_bqh, keys_bth, keys_mask):
+        return dot_product_attention_weights_sequence(query_bqh, keys_bth, keys_mask)
+
 
 class ScaledDotProductAttention(VectorSequenceAttention):
     def __init__(self, hsz):
@@ -1906,6 +2029,9 @@ class ScaledDotProductAttention(VectorSequenceAttention):
         a = F.softmax(a, dim=-1)
         return a
 
+    def _attention_sequence(self, query_bqh, keys_bth, keys_mask):
+        return dot_product_attention_weights_sequence(query_bqh / math.sqrt(self.hsz), keys_bth, keys_mask)
+
 
 class LuongGeneralAttention(VectorSequenceAttention):
     def __init__(self, hsz):
@@ -1918,6 +2044,9 @@ class LuongGeneralAttention(VectorSequenceAttention):
         a = F.softmax(a, dim=-1)
         return a
 
+    def _attention_sequence(self, query_bqh, keys_bth, keys_mask):
+        return dot_product_attention_weights_sequence(self.W_a(query_bqh), keys_bth, keys_mask)
+
 
 class BahdanauAttention(VectorSequenceAttention):
     def __init__(self, hsz):
@@ -1937,6 +2066,16 @@ class BahdanauAttention(VectorSequenceAttention):
         a = F.softmax(a, dim=-1)
         return a
 
+    def _attention_sequence(self, query_bqh, keys_bth, keys_mask):
+        # (B x Q x 1 x H) + (B x 1 x T x H) = (B x Q x T x H)
+        q = self.W_a(query_bqh).unsqueeze(2)
+        u = self.E_a(keys_bth).unsqueeze(1)
+        z = torch.tanh(q + u)
+        a = self.v(z).squeeze(-1)
+        a = a.masked_fill(keys_mask.unsqueeze(1) == MASK_FALSE, -1e9)
+        a = F.softmax(a, dim=-1)
+        return a
+
     def _update(self, a, query_t, values_bth):
         query_t = query_t.view(-1, self.hsz)
         # a = B x T
@@ -1949,6 +2088,12 @@ class BahdanauAttention(VectorSequenceAttention):
         attended = self.W_c(attended)
         return attended
 
+    def _update_sequence(self, a, query_bqh, values_bth):
+        c_t = a @ values_bth
+        attended = torch.cat([c_t, query_bqh], -1)
+        attended = self.W_c(attended)
+        return attended
+
 
 class FineTuneModel(nn.Module):
     def __init__(self, nc, embeddings, stack_model=None):
@@ -2154,6 +2299,60 @@ def script_viterbi(
     return new_path_vec[1:], path_score
 
 
+@torch.jit.script
+def script_viterbi_batch(
+    unary: torch.Tensor, trans: torch.Tensor, lengths: torch.Tensor, start_idx: int, end_idx: int, norm: bool = False
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Do Viterbi decode on a batch without leaving the device
+
+    The backpointers go into one preallocated `[T, B, N]` buffer and the lengths are handled with a `[T, B]` mask
+    built on the device, so there is no host sync on the lengths and no per-step Python overhead.
+
+    :param unary: torch.FloatTensor: [T, B, N]
+    :param trans: torch.FloatTensor: [1, N, N]
+    :param lengths: torch.LongTensor: [B]
+    :param start_idx: The index of the start symbol
+    :param end_idx: The index of the end symbol
+    :param norm: Should the initial alphas be log softmax normalized?
+
+    :return: torch.LongTensor: [T, B] the padded paths
+    :return: torch.FloatTensor: [B] the path scores
+    """
+    seq_len, batch_size, tag_size = unary.size(0), unary.size(1), unary.size(2)
+    lengths = lengths.to(unary.device)
+    # [T, B]
+    mask = torch.arange(seq_len, device=unary.device).unsqueeze(1) < lengths.unsqueeze(0)
+    step_mask = mask.unsqueeze(-1)
+    backpointers = torch.empty((seq_len, batch_size, tag_size), dtype=torch.long, device=unary.device)
+
+    # Alphas: [B, 1, N]
+    alphas = unary.new_full((batch_size, 1, tag_size), -1e4)
+    alphas[:, 0, start_idx] = 0
+    if norm:
+        alphas = F.log_softmax(alphas, dim=-1)
+
+    for i in range(seq_len):
+        viterbi, best_tag_ids = torch.max(alphas + trans, 2)
+        backpointers[i] = best_tag_ids
+        # Once we are past an example's length keep its old alphas
+        alphas = torch.where(step_mask[i].unsqueeze(1), (viterbi + unary[i]).unsqueeze(1), alphas)
+
+    # Add end tag
+    terminal_var = alphas.squeeze(1) + trans[:, end_idx, :]
+    path_score, best_tag_id = torch.max(terminal_var, 1)
+
+    best_path = torch.zeros((seq_len, batch_size), dtype=torch.long, device=unary.device)
+    if seq_len > 0:
+        best_path[seq_len - 1] = best_tag_id
+    for t in range(seq_len - 1, 0, -1):
+        # Past an example's length the tag just carries back to its real last step
+        prev_tag_id = backpointers[t].gather(1, best_tag_id.unsqueeze(1)).squeeze(1)
+        best_tag_id = torch.where(mask[t], prev_tag_id, best_tag_id)
+        best_path[t - 1] = best_tag_id
+    best_path = best_path.masked_fill(~mask, 0)
+    return best_path, path_score
+
+
 class ViterbiBatchSize1(nn.Module):
     def __init__(self, start_idx: int, end_idx: int):
         super().__init__()
@@ -2187,53 +2386,7 @@ class Viterbi(nn.Module):
         :return: torch.LongTensor: [T, B] the padded paths
         :return: torch.FloatTensor: [B] the path scores
         """
-        seq_len, batch_size, tag_size = unary.size()
-        min_length = torch.min(lengths)
-        backpointers = []
-
-        # Alphas: [B, 1, N]
-        alphas = torch.full((batch_size, 1, tag_size), -1e4, device=unary.device)
-        alphas[:, 0, self.start_idx] = 0
-        # alphas = self.norm(alphas)
-
-        for i, unary_t in enumerate(unary):
-            next_tag_var = alphas + trans
-            viterbi, best_tag_ids = torch.max(next_tag_var, 2)
-            backpointers.append(best_tag_ids)
-            new_alphas = viterbi + unary_t
-            new_alphas.unsqueeze_(1)
-            # This part generates a warning
-            if i >= min_length:
-                mask = (i < lengths).view(-1, 1, 1)
-                alphas = alphas.masked_fill(mask, 0) + new_alphas.masked_fill(mask == MASK_FALSE, 0)
-            else:
-                alphas = new_alphas
-
-        # Add end tag
-        terminal_var = alphas.squeeze(1) + trans[:, self.end_idx, :]
-        path_score, best_tag_id = torch.max(terminal_var, 1)
-        # Flip lengths
-        rev_len = seq_len - lengths - 1
-
-        best_path = [best_tag_id]
-        for i in range(len(backpointers)):
-            t = len(backpointers) - i - 1
-            backpointer_t = backpointers[t]
-            # Get new best tag candidate
-            new_best_tag_id = backpointer_t.gather(1, best_tag_id.unsqueeze(1)).squeeze(1)
-            # We are going backwards now, if flipped length was passed
-            # these you aren't in your real results yet
-            mask = i > rev_len
-            best_tag_id = best_tag_id.masked_fill(mask, 0) + new_best_tag_id.masked_fill(mask == MASK_FALSE, 0)
-            best_path.append(best_tag_id)
-        _ = best_path.pop()
-        best_path.reverse()
-        best_path = torch.stack(best_path)
-        # Mask out the extra tags (This might be pointless given thathatt anything that
-        # will use this as a dense tensor downstream will mask it itself?)
-        seq_mask = sequence_mask(lengths, seq_len).to(best_path.device).transpose(0, 1)
-        best_path = best_path.masked_fill(seq_mask == MASK_FALSE, 0)
-        return best_path, path_score
+        return script_viterbi_batch(unary, trans, lengths, self.start_idx, self.end_idx)
 
 
 @torch.jit.script
@@ -2298,52 +2451,7 @@ class ViterbiLogSoftmaxNorm(Viterbi):
         :return: torch.LongTensor: [T, B] the padded paths
         :return: torch.FloatTensor: [B] the path scores
         """
-        seq_len, batch_size, tag_size = unary.size()
-        min_length = torch.min(lengths)
-        backpointers = []
-
-        # Alphas: [B, 1, N]
-        alphas = torch.full((batch_size, 1, tag_size), -1e4, device=unary.device)
-        alphas[:, 0, self.start_idx] = 0
-        alphas = F.log_softmax(alphas, dim=-1)
-
-        for i, unary_t in enumerate(unary):
-            next_tag_var = alphas + trans
-            viterbi, best_tag_ids = torch.max(next_tag_var, 2)
-            backpointers.append(best_tag_ids)
-            new_alphas = viterbi + unary_t
-            new_alphas.unsqueeze_(1)
-            if i >= min_length:
-                mask = (i < lengths).view(-1, 1, 1)
-                alphas = alphas.masked_fill(mask, 0) + new_alphas.masked_fill(mask == MASK_FALSE, 0)
-            else:
-                alphas = new_alphas
-
-        # Add end tag
-        terminal_var = alphas.squeeze(1) + trans[:, self.end_idx, :]
-        path_score, best_tag_id = torch.max(terminal_var, 1)
-        # Flip lengths
-        rev_len = seq_len - lengths - 1
-
-        best_path = [best_tag_id]
-        for i in range(len(backpointers)):
-            t = len(backpointers) - i - 1
-            backpointer_t = backpointers[t]
-            # Get new best tag candidate
-            new_best_tag_id = backpointer_t.gather(1, best_tag_id.unsqueeze(1)).squeeze(1)
-            # We are going backwards now, if flipped length was passed
-            # these you aren't in your real results yet
-            mask = i > rev_len
-            best_tag_id = best_tag_id.masked_fill(mask, 0) + new_best_tag_id.masked_fill(mask == MASK_FALSE, 0)
-            best_path.append(best_tag_id)
-        _ = best_path.pop()
-        best_path.reverse()
-        best_path = torch.stack(best_path)
-        # Mask out the extra tags (This might be pointless given that anything that
-        # will use this as a dense tensor downstream will mask it itself?)
-        seq_mask = sequence_mask(lengths, seq_len).to(best_path.device).transpose(0, 1)
-        best_path = best_path.masked_fill(seq_mask == MASK_FALSE, 0)
-        return best_path, path_score
+        return script_viterbi_batch(unary, trans, lengths, self.start_idx, self.end_idx, True)
 
 
 def ident(x):
@@ -2418,6 +2526,41 @@ class TaggerGreedyDecoder(nn.Module):
         return str_
 
 
+@torch.jit.script
+def script_crf_forward(
+    unary: torch.Tensor, trans: torch.Tensor, lengths: torch.Tensor, start_idx: int, end_idx: int
+) -> torch.Tensor:
+    """The CRF forward algorithm on a batch, compiled so the loop over time stays on the device
+
+    :param unary: torch.FloatTensor: [T, B, N]
+    :param trans: torch.FloatTensor: [1, N, N]
+    :param lengths: torch.LongTensor: [B]
+    :param start_idx: The index of the start symbol
+    :param end_idx: The index of the end symbol
+
+    :return: torch.FloatTensor: [B]
+    """
+    seq_len, batch_size, num_tags = unary.size(0), unary.size(1), unary.size(2)
+    # [T, B, 1, 1]
+    step_mask = (torch.arange(seq_len, device=unary.device).unsqueeze(1) < lengths.to(unary.device).unsqueeze(0))
+    step_mask = step_mask.view(seq_len, batch_size, 1, 1)
+    # alphas: [B, 1, N]
+    alphas = unary.new_full((batch_size, 1, num_tags), -1e4)
+    alphas[:, 0, start_idx] = 0.0
+
+    for i in range(seq_len):
+        # Broadcast alphas along the rows of trans and trans along the batch of alphas
+        # [B, 1, N] + [1, N, N] + [B, N, 1] -> [B, N, N]
+        scores = alphas + trans + unary[i].unsqueeze(2)
+        new_alphas = vec_log_sum_exp(scores, 2).transpose(1, 2)
+        # If we are past your length keep the old alphas
+        alphas = torch.where(step_mask[i], new_alphas, alphas)
+
+    terminal_vars = alphas + trans[:, end_idx]
+    alphas = vec_log_sum_exp(terminal_vars, 2)
+    return alphas.view(batch_size)
+
+
 class CRF(nn.Module):
     def __init__(
         self,
@@ -2526,38 +2669,7 @@ class CRF(nn.Module):
 
         :return: torch.FloatTensor: [B]
         """
-        # alphas: [B, 1, N]
-        min_length = torch.min(lengths)
-        batch_size = lengths.shape[0]
-        lengths.shape[0] == unary.shape[1]
-        alphas = torch.full((batch_size, 1, self.num_tags), -1e4, device=unary.device)
-        alphas[:, 0, self.start_idx] = 0.0
-        # alphas.requires_grad = True
-
-        trans = self.transitions  # [1, N, N]
-
-        for i, unary_t in enumerate(unary):
-            # unary_t: [B, N]
-            unary_t = unary_t.unsqueeze(2)  # [B, N, 1]
-            # Broadcast alphas along the rows of trans
-            # Broadcast trans along the batch of alphas
-            # [B, 1, N] + [1, N, N] -> [B, N, N]
-            # Broadcast unary_t along the cols of result
-            # [B, N, N] + [B, N, 1] -> [B, N, N]
-            scores = alphas + trans + unary_t
-            new_alphas = vec_log_sum_exp(scores, 2).transpose(1, 2)
-            # If we haven't reached your length zero out old alpha and take new one.
-            # If we are past your length, zero out new_alpha and keep old one.
-
-            if i >= min_length:
-                mask = (i < lengths).view(-1, 1, 1)
-                alphas = alphas.masked_fill(mask, 0) + new_alphas.masked_fill(mask == MASK_FALSE, 0)
-            else:
-                alphas = new_alphas
-
-        terminal_vars = alphas + trans[:, self.end_idx]
-        alphas = vec_log_sum_exp(terminal_vars, 2)
-        return alphas.view(batch_size)
+        return script_crf_forward(unary, self.transitions, lengths, self.start_idx, self.end_idx)
 
     def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
         unary, lengths = inputs
@@ -2696,17 +2808,95 @@ def subsequent_mask(size: int):
     return torch.from_numpy(sub_mask)
 
 
+class PackedMask:
+    """The mask for a batch whose valid tokens have been packed into a single `[N, H]` tensor with no padding
+
+    A transformer encoder layer can take one of these in place of its `[B, 1, 1, T]` mask.  Everything in the layer
+    except attention works on each token on its own, so it runs on the `N` valid tokens only.  The attention unpacks
+    its projected queries, keys and values to `[B, H, T, D]`, attends with the usual mask, and packs the result again
+    """
+
+    def __init__(self, lengths: torch.Tensor, max_len: int = -1):
+        """
+        :param lengths: A `B` tensor holding the length of each sequence
+        :param max_len: The padded length `T`, defaults to the longest sequence
+        """
+        mask = sequence_mask(lengths, max_len).to(lengths.device)
+        self.batchsz, self.max_len = mask.shape
+        self.mask = mask.unsqueeze(1).unsqueeze(1)
+        # The offset of each valid token in the flattened `[B * T]` batch
+        self.index = mask.view(-1).nonzero(as_tuple=True)[0]
+
+    def pack(self, x: torch.Tensor) -> torch.Tensor:
+        """Take the valid tokens out of a padded tensor
+
+        :param x: A tensor of shape `[B, T, ...]`
+        :return: A tensor of shape `[N, ...]`
+        """
+        return x.reshape((self.batchsz * self.max_len,) + x.shape[2:]).index_select(0, self.index)
+
+    def unpack(self, x: torch.Tensor) -> torch.Tensor:
+        """Put packed tokens back into a zero padded tensor
+
+        :param x: A tensor of shape `[N, ...]`
+        :return: A tensor of shape `[B, T, ...]`
+        """
+        padded = x.new_zeros((self.batchsz * self.max_len,) + x.shape[1:]).index_copy(0, self.index, x)
+        return padded.view((self.batchsz, self.max_len) + x.shape[1:])
+
+
+HAS_FUSED_ATTENTION = hasattr(F, 'scaled_dot_product_attention')
+
+
+def fused_attention(
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        pdrop: float = 0.0,
+        scale: bool = True
+) -> torch.Tensor:
+    """Dot product attention with the fused `F.scaled_dot_product_attention` kernel
+
+    This gives the same result as `SeqScaledDotProductAttention` (or `SeqDotProductAttention` when `scale` is `False`)
+    but it doesnt keep the `[B, H, T_q, T_k]` attention weights around, so they are not available afterwards
+
+    :param query: The query `[B, H, T_q, D]`
+    :param key: The keys `[B, H, T_k, D]`
+    :param value: The values `[B, H, T_k, D_v]`
+    :param mask: A mask that broadcasts to `[B, H, T_q, T_k]`, where `MASK_FALSE` means dont attend
+    :param pdrop: The dropout on the attention weights
+    :param scale: Should the scores be scaled by `1/sqrt(D)`
+    :return: A tensor of shape `[B, H, T_q, D_v]`
+    """
+    if not scale:
+        # Undo the scaling that the kernel does
+        query = query * math.sqrt(query.size(-1))
+    if mask is not None:
+        # An additive mask keeps fully masked rows uniform (like `masked_fill`) instead of giving back NaNs
+        mask = torch.zeros(mask.shape, dtype=query.dtype, device=query.device).masked_fill(
+            mask == MASK_FALSE, torch.finfo(query.dtype).min
+        )
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=pdrop)
+
+
 class SequenceSequenceAttention(nn.Module):
-    def __init__(self, hsz: int = None, pdrop: float = 0.1, **kwargs):
+    def __init__(self, hsz: int = None, pdrop: float = 0.1, keep_attn: bool = True, **kwargs):
+        """
+        :param hsz: The hidden size
+        :param pdrop: The dropout on the attention weights
+        :param keep_attn: Should the attention weights be kept in `self.attn` after the forward pass
+        """
         super().__init__()
         self.hsz = hsz
         self.dropout = nn.Dropout(pdrop)
+        self.keep_attn = keep_attn
         self.attn = None
 
     def forward(self, qkvm: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
         query, key, value, mask = qkvm
         a = self._attention(query, key, mask)
-        self.attn = a
+        self.attn = a if self.keep_attn else None
         a = self.dropout(a)
         return self._update(a, value)
 
@@ -2730,6 +2920,12 @@ class SeqScaledDotProductAttention(SequenceSequenceAttention):
     def __init__(self, pdrop: float = 0.1, **kwargs):
         super().__init__(pdrop=pdrop, **kwargs)
 
+    def forward(self, qkvm: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+        if self.keep_attn or not HAS_FUSED_ATTENTION:
+            return super().forward(qkvm)
+        query, key, value, mask = qkvm
+        return fused_attention(query, key, value, mask, self.dropout.p if self.training else 0.0)
+
     def _attention(self, query: torch.Tensor, key: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """Scaled dot product attention, as defined in https://arxiv.org/abs/1706.03762
 
@@ -2847,6 +3043,12 @@ class SeqDotProductAttention(SequenceSequenceAttention):
     def __init__(self, pdrop: float = 0.1, **kwargs):
         super().__init__(pdrop=pdrop, **kwargs)
 
+    def forward(self, qkvm: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+        if self.keep_attn or not HAS_FUSED_ATTENTION:
+            return super().forward(qkvm)
+        query, key, value, mask = qkvm
+        return fused_attention(query, key, value, mask, self.dropout.p if self.training else 0.0, scale=False)
+
     def _attention(self, query: torch.Tensor, key: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         scores = torch.matmul(query, key.transpose(-2, -1))
         if mask is not None:
@@ -2942,10 +3144,11 @@ class SequenceSequenceRelativeAttention(nn.Module):
 
     """
 
-    def __init__(self, hsz: int = None, pdrop: float = 0.1, **kwargs):
+    def __init__(self, hsz: int = None, pdrop: float = 0.1, keep_attn: bool = True, **kwargs):
         super().__init__()
         self.hsz = hsz
         self.dropout = nn.Dropout(pdrop)
+        self.keep_attn = keep_attn
         self.attn = None
 
     def forward(
@@ -2958,7 +3161,7 @@ class SequenceSequenceRelativeAttention(nn.Module):
         """
         query, key, value, edges_key, edges_value, mask = q_k_v_ek_ev_m
         a = self._attention(query, key, edges_key, mask)
-        self.attn = a
+        self.attn = a if self.keep_attn else None
         a = self.dropout(a)
         return self._update(a, value, edges_value)
 
@@ -3159,6 +3362,7 @@ class MultiHeadedAttention(nn.Module):
 
     def __init__(
         self, num_heads: int, d_model: int, dropout: float = 0.1, scale: bool = False, d_k: Optional[int] = None, ra_type: Optional[str] = None,
+        keep_attn: bool = True,
     ):
         """Constructor for multi-headed attention
 
@@ -3168,6 +3372,8 @@ class MultiHeadedAttention(nn.Module):
         :param scale: Should we scale the dot product attention
         :param d_k: The low-order project per head.  This is normally `d_model // num_heads` unless set explicitly
         :param ra_type: If there is an attention bias term, that will be encapsulated in the attention computation
+        :param keep_attn: Should the attention weights be kept in `self.attn`.  If not, and there is no attention bias,
+            the fused `F.scaled_dot_product_attention` kernel is used, which never creates the full weight matrix
         """
         super().__init__()
         if d_k is None:
@@ -3190,43 +3396,129 @@ class MultiHeadedAttention(nn.Module):
             self.w_O = Dense(self.d_k * self.h, d_model)
         if scale:
             if ra_type == 'alibi':
-                self.attn_fn = SeqScaledDotProductAttentionALiBi(dropout, num_heads=num_heads)
+                self.attn_fn = SeqScaledDotProductAttentionALiBi(dropout, num_heads=num_heads, keep_attn=keep_attn)
             elif ra_type == 't5':
                 # TODO: pass through options
-                self.attn_fn = SeqScaledDotProductAttentionT5(dropout, num_heads=num_heads)
+                self.attn_fn = SeqScaledDotProductAttentionT5(dropout, num_heads=num_heads, keep_attn=keep_attn)
             else:
-                self.attn_fn = SeqScaledDotProductAttention(dropout)
+                self.attn_fn = SeqScaledDotProductAttention(dropout, keep_attn=keep_attn)
         else:
             if ra_type == 'alibi':
-                self.attn_fn = SeqDotProductAttentionALiBi(dropout, num_heads=num_heads)
+                self.attn_fn = SeqDotProductAttentionALiBi(dropout, num_heads=num_heads, keep_attn=keep_attn)
             elif ra_type == 't5':
                 # TODO: pass through options
-                self.attn_fn = SeqDotProductAttentionT5(dropout, num_heads=num_heads)
+                self.attn_fn = SeqDotProductAttentionT5(dropout, num_heads=num_heads, keep_attn=keep_attn)
             else:
-                self.attn_fn = SeqDotProductAttention(dropout)
+                self.attn_fn = SeqDotProductAttention(dropout, keep_attn=keep_attn)
         self.attn = None
 
-    def forward(self, qkvm: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def _qkv_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The weight and bias of `w_Q`, `w_K` and `w_V` stacked, for the single GEMM in self-attention
+
+        When no gradient is needed (inference), the stacked copy is kept and only rebuilt if one of the parameters is
+        replaced, moved or updated in place, which bumps its version.  During training the weights change every step
+        and the stacked copy has to be part of the graph, so it is built on each call
+
+        :return: The stacked weight `[2 * H * d_k + H * d_value, d_model]` and bias
+        """
+        params = (
+            self.w_Q.layer.weight, self.w_K.layer.weight, self.w_V.layer.weight,
+            self.w_Q.layer.bias, self.w_K.layer.bias, self.w_V.layer.bias,
+        )
+        if (
+            torch.jit.is_scripting() or torch.jit.is_tracing() or
+            (torch.is_grad_enabled() and any(p.requires_grad for p in params))
+        ):
+            return torch.cat(params[:3]), torch.cat(params[3:])
+        state = [(id(p), p.data_ptr(), p._version) for p in params]
+        # Set it straight into `__dict__` so it isnt a buffer, and replace rather than update it, since `DataParallel`
+        # replicas start with a copy of this dict
+        cached = self.__dict__.get('_qkv_cache')
+        if cached is None or cached[0] != state:
+            cached = (state, torch.cat(params[:3]), torch.cat(params[3:]))
+            self.__dict__['_qkv_cache'] = cached
+        return cached[1], cached[2]
+
+    def _project_qkv(
+        self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, packed: Optional[PackedMask] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Project the query, key and value.  For self-attention, this is a single GEMM over the stacked weights
+
+        If the inputs are packed, the projections are done on the packed tokens and then unpacked
+
+        :param query: The query `[B, T_q, d_model]`
+        :param key: The keys `[B, T_k, d_model]`
+        :param value: The values `[B, T_k, d_model]`
+        :param packed: The `PackedMask` if the inputs are packed `[N, d_model]` tokens
+        :return: The projected query, key and value, split into heads `[B, H, T, D]`
+        """
+        if query is key and key is value:
+            weight, bias = self._qkv_weights()
+            query, key, value = F.linear(query, weight, bias).split(
+                [self.h * self.d_k, self.h * self.d_k, self.h * self.d_value], dim=-1
+            )
+        else:
+            query = self.w_Q(query)
+            key = self.w_K(key)
+            value = self.w_V(value)
+        if packed is not None:
+            query, key, value = packed.unpack(query), packed.unpack(key), packed.unpack(value)
+        batchsz = query.size(0)
+        query = query.view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
+        key = key.view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
+        value = value.view(batchsz, -1, self.h, self.d_value).transpose(1, 2)
+        return query, key, value
+
+    def forward(
+        self,
+        qkvm: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+        cache: Optional[Dict[str, torch.Tensor]] = None,
+        static_kv: bool = False,
+    ) -> torch.Tensor:
         """Low-order projections of query, key and value into multiple heads, then attention application and dropout
 
+        When a `cache` is given, the projected keys and values are stored in it.  For self-attention during incremental
+        decoding, the keys and values of the new positions are appended to the ones from previous steps, so only the
+        newest positions need to be passed in.  If `static_kv` is set (encoder-decoder attention), the keys and values
+        are projected on the first call and reused afterwards
+
         :param query: a query for alignment. Can come from self in case of self-attn or decoder in case of E/D
         :param key: a set of keys from encoder or self
         :param value: a set of values from encoder or self
-        :param mask: masking (for destination) to prevent seeing what we shouldnt
+        :param mask: masking (for destination) to prevent seeing what we shouldnt.  This can be a `PackedMask` if the
+            inputs are packed `[N, d_model]` tokens, in which case the output is packed too
+        :param cache: An optional dictionary holding the projected `key` and `value` from previous calls
+        :param static_kv: Are the keys and values the same on every call, so they only need to be projected once
         :return: Multi-head attention output, result of attention application to sequence (B, T, d_model)
         """
         query, key, value, mask = qkvm
-        batchsz = query.size(0)
+        packed = None
+        if isinstance(mask, PackedMask):
+            if cache is not None:
+                raise Exception("Incremental decoding is not supported with packed inputs")
+            packed = mask
+            mask = packed.mask
 
         # (B, H, T, D)
-        query = self.w_Q(query).view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
-        key = self.w_K(key).view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
-        value = self.w_V(value).view(batchsz, -1, self.h, self.d_value).transpose(1, 2)
+        if cache is not None and static_kv and 'key' in cache:
+            query = self.w_Q(query).view(query.size(0), -1, self.h, self.d_k).transpose(1, 2)
+            key = cache['key']
+            value = cache['value']
+        else:
+            query, key, value = self._project_qkv(query, key, value, packed)
+            if cache is not None:
+                if not static_kv and 'key' in cache:
+                    key = torch.cat([cache['key'], key], dim=2)
+                    value = torch.cat([cache['value'], value], dim=2)
+                cache['key'] = key
+                cache['value'] = value
 
         x = self.attn_fn((query, key, value, mask))
         self.attn = self.attn_fn.attn
 
-        x = x.transpose(1, 2).contiguous().view(batchsz, -1, self.h * self.d_value)
+        x = x.transpose(1, 2).contiguous().view(query.size(0), -1, self.h * self.d_value)
+        if packed is not None:
+            x = packed.pack(x)
         if self.h > 1:
             return self.w_O(x)
         else:
@@ -3253,7 +3545,8 @@ class MultiHeadedRelativeAttention(nn.Module):
         scale: bool = False,
         d_k: Optional[int] = None,
         windowed_ra: bool = False,
-        rpr_value_on: bool = True
+        rpr_value_on: bool = True,
+        keep_attn: bool = True,
     ):
         """Constructor for multi-headed attention
 
@@ -3264,6 +3557,7 @@ class MultiHeadedRelativeAttention(nn.Module):
         :param dropout (``float``): The amount of dropout to use
         :param scale: Should we scale the dot product attention
         :param d_k: The low-order project per head.  This is normally `d_model // num_heads` unless set explicitly
+        :param keep_attn: Should the attention weights be kept in `self.attn` after the forward pass
         """
         super().__init__()
 
@@ -3294,11 +3588,11 @@ class MultiHeadedRelativeAttention(nn.Module):
             self.w_O = Dense(self.d_k * self.h, d_model)
         if scale:
             if windowed_ra:
-                self.attn_fn = SeqScaledWindowedRelativeAttention(dropout)
+                self.attn_fn = SeqScaledWindowedRelativeAttention(dropout, keep_attn=keep_attn)
             else:
-                self.attn_fn = SeqScaledDotProductRelativeAttention(dropout)
+                self.attn_fn = SeqScaledDotProductRelativeAttention(dropout, keep_attn=keep_attn)
         else:
-            self.attn_fn = SeqDotProductRelativeAttention(dropout)
+            self.attn_fn = SeqDotProductRelativeAttention(dropout, keep_attn=keep_attn)
         self.attn = None
 
     def make_rpr(self, q_len, k_len, device) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -3328,18 +3622,28 @@ class MultiHeadedRelativeAttention(nn.Module):
         :param query: a query for alignment. Can come from self in case of self-attn or decoder in case of E/D
         :param key: a set of keys from encoder or self
         :param value: a set of values from encoder or self
-        :param mask: masking (for destination) to prevent seeing what we shouldnt
+        :param mask: masking (for destination) to prevent seeing what we shouldnt.  This can be a `PackedMask` if the
+            inputs are packed `[N, d_model]` tokens, in which case the output is packed too
         :return: Multi-head attention output, result of attention application to sequence (B, T, d_model)
         """
         query, key, value, mask = qkvm
+        packed = None
+        if isinstance(mask, PackedMask):
+            packed = mask
+            mask = packed.mask
+        query = self.w_Q(query)
+        key = self.w_K(key)
+        value = self.w_V(value)
+        if packed is not None:
+            query, key, value = packed.unpack(query), packed.unpack(key), packed.unpack(value)
         batchsz = query.size(0)
         query_len = query.size(1)
         key_len = key.size(1)  # key and value have the same length, but query can have a different length
 
         # (B, H, T, D)
-        query = self.w_Q(query).view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
-        key = self.w_K(key).view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
-        value = self.w_V(value).view(batchsz, -1, self.h, self.d_value).transpose(1, 2)
+        query = query.view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
+        key = key.view(batchsz, -1, self.h, self.d_k).transpose(1, 2)
+        value = value.view(batchsz, -1, self.h, self.d_value).transpose(1, 2)
 
         if self.windowed_ra:
             rpr_key, rpr_value = self.make_windowed_rpr(query.device)
@@ -3349,6 +3653,8 @@ class MultiHeadedRelativeAttention(nn.Module):
         self.attn = self.attn_fn.attn
 
         x = x.transpose(1, 2).contiguous().view(batchsz, -1, self.h * self.d_value)
+        if packed is not None:
+            x = packed.pack(x)
         if self.h > 1:
             return self.w_O(x)
         else:
@@ -3371,6 +3677,7 @@ class TransformerEncoderBase(nn.Module):
         windowed_ra: Optional[bool] = False,
         rpr_value_on: bool = True,
         ra_type: Optional[str] = None,
+        keep_attn: bool = True,
         **kwargs,
     ):
         super().__init__()
@@ -3378,9 +3685,11 @@ class TransformerEncoderBase(nn.Module):
         self.d_ff = d_ff if d_ff is not None else 4 * d_model
         if rpr_k is not None and rpr_k != 0:
             self.self_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k,
-                                                          windowed_ra=windowed_ra, rpr_value_on=rpr_value_on)
+                                                          windowed_ra=windowed_ra, rpr_value_on=rpr_value_on,
+                                                          keep_attn=keep_attn)
         else:
-            self.self_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale=scale, d_k=d_k, ra_type=ra_type)
+            self.self_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale=scale, d_k=d_k, ra_type=ra_type,
+                                                  keep_attn=keep_attn)
         self.ffn = nn.Sequential(
             Dense(self.d_model, self.d_ff),
             get_activation(activation_type),
@@ -3391,31 +3700,44 @@ class TransformerEncoderBase(nn.Module):
         self.ln2 = nn.LayerNorm(self.d_model, eps=layer_norm_eps)
         self.dropout = nn.Dropout(pdrop)
 
+    def _self_attention(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor], cache: Optional[Dict[str, Dict[str, torch.Tensor]]]
+    ) -> torch.Tensor:
+        if cache is None:
+            return self.self_attn((x, x, x, mask))
+        return self.self_attn((x, x, x, mask), cache=cache.setdefault('self_attn', {}))
+
 
 class PreLNTransformerEncoder(TransformerEncoderBase):
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self, inputs: Tuple[torch.Tensor, torch.Tensor], cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None
+    ) -> torch.Tensor:
         """
         :param inputs: `(x, mask)`
+        :param cache: An optional key/value cache for this layer, used for incremental decoding
         :return: The output tensor
         """
         x, mask = inputs
         h = self.ln1(x)
-        x = x + self.dropout(self.self_attn((h, h, h, mask)))
+        x = x + self.dropout(self._self_attention(h, mask, cache))
         x = x + self.dropout(self.ffn(self.ln2(x)))
         return x
 
 
 class PreLNBeforeResConnTransformerEncoder(TransformerEncoderBase):
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self, inputs: Tuple[torch.Tensor, torch.Tensor], cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None
+    ) -> torch.Tensor:
         """
         :param inputs: `(x, mask)`
+        :param cache: An optional key/value cache for this layer, used for incremental decoding
         :return: The output tensor
         """
         x, mask = inputs
         x = self.ln1(x)
-        h = self.self_attn((x, x, x, mask))
+        h = self._self_attention(x, mask, cache)
         x = x + self.dropout(h)
         x = self.ln2(x)
         x = x + self.dropout(self.ffn(x))
@@ -3424,13 +3746,16 @@ class PreLNBeforeResConnTransformerEncoder(TransformerEncoderBase):
 
 class PostLNTransformerEncoder(TransformerEncoderBase):
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self, inputs: Tuple[torch.Tensor, torch.Tensor], cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None
+    ) -> torch.Tensor:
         """
         :param inputs: `(x, mask)`
+        :param cache: An optional key/value cache for this layer, used for incremental decoding
         :return: The output tensor
         """
         x, mask = inputs
-        h = self.self_attn((x, x, x, mask))
+        h = self._self_attention(x, mask, cache)
         x = x + self.dropout(h)
         x = self.ln2(x)
         x = x + self.dropout(self.ffn(x))
@@ -3535,18 +3860,20 @@ class TransformerDecoderBase(nn.Module):
         layer_norm_eps: float = 1.0e-6,
         rpr_value_on: bool = True,
         ra_type: Optional[str] = None,
-
+        keep_attn: bool = True,
     ):
         super().__init__()
         self.d_model = d_model
         self.d_ff = d_ff if d_ff is not None else 4 * d_model
         if rpr_k is not None:
-            self.self_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k, rpr_value_on=rpr_value_on)
-            self.src_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k, rpr_value_on=rpr_value_on)
+            self.self_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k, rpr_value_on=rpr_value_on,
+                                                          keep_attn=keep_attn)
+            self.src_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k, rpr_value_on=rpr_value_on,
+                                                         keep_attn=keep_attn)
 
         else:
-            self.self_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale, d_k=d_k, ra_type=ra_type)
-            self.src_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale, d_k=d_k, ra_type=ra_type)
+            self.self_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale, d_k=d_k, ra_type=ra_type, keep_attn=keep_attn)
+            self.src_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale, d_k=d_k, ra_type=ra_type, keep_attn=keep_attn)
 
         self.ffn = nn.Sequential(
             Dense(self.d_model, self.d_ff),
@@ -3560,16 +3887,39 @@ class TransformerDecoderBase(nn.Module):
         self.ln3 = nn.LayerNorm(self.d_model, eps=layer_norm_eps)
         self.dropout = nn.Dropout(pdrop)
 
+    def _self_attention(
+        self, x: torch.Tensor, mask: Optional[torch.Tensor], cache: Optional[Dict[str, Dict[str, torch.Tensor]]]
+    ) -> torch.Tensor:
+        if cache is None:
+            return self.self_attn((x, x, x, mask))
+        return self.self_attn((x, x, x, mask), cache=cache.setdefault('self_attn', {}))
+
+    def _src_attention(
+        self,
+        x: torch.Tensor,
+        memory: torch.Tensor,
+        mask: Optional[torch.Tensor],
+        cache: Optional[Dict[str, Dict[str, torch.Tensor]]],
+    ) -> torch.Tensor:
+        if cache is None:
+            return self.src_attn((x, memory, memory, mask))
+        # The memory doesn't change between decoding steps so its projections are only computed once
+        return self.src_attn((x, memory, memory, mask), cache=cache.setdefault('src_attn', {}), static_kv=True)
+
 
 class PreLNTransformerDecoder(TransformerDecoderBase):
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self,
+        inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+        cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+    ) -> torch.Tensor:
 
         x, memory, src_mask, tgt_mask = inputs
         h = self.ln1(x)
-        x = x + self.dropout(self.self_attn((h, h, h, tgt_mask)))
+        x = x + self.dropout(self._self_attention(h, tgt_mask, cache))
 
         h = self.ln2(x)
-        x = x + self.dropout(self.src_attn((h, memory, memory, src_mask)))
+        x = x + self.dropout(self._src_attention(h, memory, src_mask, cache))
 
         h = self.ln3(x)
         x = x + self.dropout(self.ffn(h))
@@ -3578,29 +3928,37 @@ class PreLNTransformerDecoder(TransformerDecoderBase):
 
 class PreLNBeforeResConnTransformerDecoder(TransformerDecoderBase):
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self,
+        inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+        cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+    ) -> torch.Tensor:
 
         x, memory, src_mask, tgt_mask = inputs
         x = self.ln1(x)
-        x = x + self.dropout(self.self_attn((x, x, x, tgt_mask)))
+        x = x + self.dropout(self._self_attention(x, tgt_mask, cache))
 
         x = self.ln2(x)
-        x = x + self.dropout(self.src_attn((x, memory, memory, src_mask)))
+        x = x + self.dropout(self._src_attention(x, memory, src_mask, cache))
 
         x = self.ln3(x)
         x = x + self.dropout(self.ffn(x))
         return x
 
 
-class PostLNTransformerDecoder(nn.Module):
+class PostLNTransformerDecoder(TransformerDecoderBase):
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def forward(
+        self,
+        inputs: Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor],
+        cache: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+    ) -> torch.Tensor:
 
         x, memory, src_mask, tgt_mask = inputs
-        x = x + self.dropout(self.self_attn((x, x, x, tgt_mask)))
+        x = x + self.dropout(self._self_attention(x, tgt_mask, cache))
 
         x = self.ln2(x)
-        x = x + self.dropout(self.src_attn((x, memory, memory, src_mask)))
+        x = x + self.dropout(self._src_attention(x, memory, src_mask, cache))
 
         x = self.ln3(x)
         x = x + self.dropout(self.ffn(x))
@@ -3608,6 +3966,23 @@ class PostLNTransformerDecoder(nn.Module):
         return x
 
 
+def checkpoint_layer(layer: nn.Module, inputs, enabled: bool = True) -> torch.Tensor:
+    """Run a layer without storing its intermediate activations, they are recomputed during the backward pass
+
+    This trades an extra forward pass of the layer for the memory of everything it would have saved for backward.
+    Checkpointing is skipped in eval mode or when there is no gradient to compute
+
+    :param layer: The layer to run
+    :param inputs: The inputs to the layer
+    :param enabled: Should the layer be checkpointed
+    :return: The output of the layer
+    """
+    if not enabled or not layer.training or not torch.is_grad_enabled():
+        return layer(inputs)
+    # The non-reentrant version gets the gradients right even if `inputs` dont require grad (or arent all tensors)
+    return torch.utils.checkpoint.checkpoint(layer, inputs, use_reentrant=False)
+
+
 class TransformerEncoderStack(nn.Module):
     def __init__(
         self,
@@ -3628,10 +4003,13 @@ class TransformerEncoderStack(nn.Module):
         layer_drop: float = 0.0,
         ra_type: Optional[str] = None,
         transformer_type: Optional[str] = False,
+        keep_attn: bool = True,
+        checkpoint_layers: bool = False,
         **kwargs,
     ):
         super().__init__()
         self.encoders = nn.ModuleList()
+        self.checkpoint_layers = checkpoint_layers
         if layer_norms_after or transformer_type == "post-layer-norm":
             logger.info("Using post-layer-norm transformer (encoder)")
             TransformerEncoder = PostLNTransformerEncoder
@@ -3658,16 +4036,41 @@ class TransformerEncoderStack(nn.Module):
                 TransformerEncoder(
                     num_heads, d_model, pdrop, scale, activation, d_ff, d_k,
                     rpr_k=rpr_k[i], ffn_pdrop=ffn_pdrop,
-                    layer_norm_eps=layer_norm_eps, windowed_ra=windowed_ra, rpr_value_on=rpr_value_on, ra_type=ra_type
+                    layer_norm_eps=layer_norm_eps, windowed_ra=windowed_ra, rpr_value_on=rpr_value_on, ra_type=ra_type,
+                    keep_attn=keep_attn
                 )
             )
+        # Relative attention depends on the absolute position of the query so we cant decode incrementally
+        self.supports_kv_cache = ra_type is None and all(
+            isinstance(layer.self_attn, MultiHeadedAttention) for layer in self.encoders
+        )
 
-    def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
+    def init_cache(self) -> List[Dict[str, Dict[str, torch.Tensor]]]:
+        """Create an empty key/value cache, one per layer, to pass to `forward` for incremental decoding"""
+        if not self.supports_kv_cache:
+            raise Exception("Incremental decoding is not supported with relative attention")
+        return [{} for _ in self.encoders]
+
+    def forward(
+        self,
+        inputs: Tuple[torch.Tensor, torch.Tensor],
+        cache: Optional[List[Dict[str, Dict[str, torch.Tensor]]]] = None,
+    ) -> torch.Tensor:
+        """
+        :param inputs: `(x, mask)`
+        :param cache: An optional key/value cache from `init_cache`.  When given, `x` only needs to hold the positions
+            that are not in the cache yet and the `mask` should only cover those rows.  The cache is updated in place
+        :return: The output tensor
+        """
         x, mask = inputs
-        for layer in self.encoders:
+        layer_caches = cache if cache is not None else [None] * len(self.encoders)
+        for layer, layer_cache in zip(self.encoders, layer_caches):
             pdrop = np.random.random()
             if not self.training or (pdrop >= self.layer_drop):
-                x = layer((x, mask))
+                if layer_cache is None:
+                    x = checkpoint_layer(layer, (x, mask), self.checkpoint_layers)
+                else:
+                    x = layer((x, mask), cache=layer_cache)
         return self.ln(x)
 
 
@@ -3685,6 +4088,7 @@ class GatedMLPEncoderStack(nn.Module):
             ffn_pdrop: Optional[float] = 0.0,
             layer_norm_eps: float = 1.0e-6,
             layer_drop: float = 0.0,
+            checkpoint_layers: bool = False,
             **kwargs,
     ):
         super().__init__()
@@ -3692,6 +4096,7 @@ class GatedMLPEncoderStack(nn.Module):
         self.ln = nn.LayerNorm(d_model, eps=layer_norm_eps)
         self.output_dim = d_model
         self.layer_drop = layer_drop
+        self.checkpoint_layers = checkpoint_layers
         for i in range(layers):
             self.encoders.append(
                 GatedMLPEncoder(
@@ -3706,7 +4111,7 @@ class GatedMLPEncoderStack(nn.Module):
         for layer in self.encoders:
             pdrop = np.random.random()
             if not self.training or (pdrop >= self.layer_drop):
-                x = layer((x, mask))
+                x = checkpoint_layer(layer, (x, mask), self.checkpoint_layers)
         return self.ln(x)
 
 
@@ -3731,17 +4136,28 @@ class TransformerEncoderStackWithLengths(TransformerEncoderStack):
         layer_drop: float = 0.0,
         ra_type: Optional[str] = None,
         transformer_type: Optional[str] = None,
+        packed: bool = False,
         **kwargs,
     ):
+        """
+        :param packed: Run everything except the attention on only the valid tokens, packed into an `[N, d_model]`
+            tensor, instead of the padded `[B, T, d_model]`.  This saves the work on the padding when the lengths in a
+            batch vary a lot.  The padding in the output is zeros.
+        """
         super().__init__(num_heads, d_model, pdrop, scale, layers, activation, d_ff, d_k, rpr_k,
                          ffn_pdrop, layer_norms_after, layer_norm_eps, windowed_ra, rpr_value_on, layer_drop, ra_type, transformer_type, **kwargs)
         self.proj = WithDropout(pytorch_linear(input_sz, d_model), pdrop)
+        self.packed = packed
 
     def forward(self, inputs: Tuple[torch.Tensor, torch.Tensor]) -> torch.Tensor:
 
         x, lengths = inputs
-        x = self.proj(x)
         max_seqlen = x.shape[1]
+        if self.packed:
+            packed = PackedMask(lengths.to(x.device), max_seqlen)
+            x = self.proj(packed.pack(x))
+            return packed.unpack(super().forward((x, packed)))
+        x = self.proj(x)
         mask = sequence_mask(lengths, max_seqlen).to(x.device)
         return super().forward((x, mask.unsqueeze(1).unsqueeze(1)))
 
@@ -3800,12 +4216,15 @@ class TransformerDecoderStack(nn.Module):
         rpr_value_on: bool = True,
         ra_type: Optional[str] = None,
         transformer_type: Optional[str] = None,
+        keep_attn: bool = True,
+        checkpoint_layers: bool = False,
         **kwargs,
 
     ):
         super().__init__()
         self.decoders = nn.ModuleList()
         self.layer_drop = layer_drop
+        self.checkpoint_layers = checkpoint_layers
         if layer_norms_after or transformer_type == "post-layer-norm":
             logger.info("Using post-layer-norm transformer (decoder)")
             TransformerDecoder = PostLNTransformerDecoder
@@ -3829,18 +4248,87 @@ class TransformerDecoderStack(nn.Module):
                 TransformerDecoder(num_heads, d_model, pdrop, scale, activation_type, d_ff,
                                    d_k=d_k, rpr_k=rpr_k[i], ffn_pdrop=ffn_pdrop,
                                    layer_norm_eps=layer_norm_eps,
-                                   rpr_value_on=rpr_value_on, ra_type=ra_type)
+                                   rpr_value_on=rpr_value_on, ra_type=ra_type, keep_attn=keep_attn)
             )
+        self.supports_kv_cache = ra_type is None and all(
+            isinstance(layer.self_attn, MultiHeadedAttention) for layer in self.decoders
+        )
 
-    def forward(self, inputs):
+    def init_cache(self) -> List[Dict[str, Dict[str, torch.Tensor]]]:
+        """Create an empty key/value cache, one per layer, to pass to `forward` for incremental decoding"""
+        if not self.supports_kv_cache:
+            raise Exception("Incremental decoding is not supported with relative attention")
+        return [{} for _ in self.decoders]
+
+    def forward(self, inputs, cache: Optional[List[Dict[str, Dict[str, torch.Tensor]]]] = None):
+        """
+        :param inputs: `(x, memory, src_mask, tgt_mask)`
+        :param cache: An optional key/value cache from `init_cache`.  When given, `x` only needs to hold the positions
+            that are not in the cache yet and the `tgt_mask` should only cover those rows.  The cache is updated in place
+        :return: The output tensor
+        """
         x, memory, src_mask, tgt_mask = inputs
-        for layer in self.decoders:
+        layer_caches = cache if cache is not None else [None] * len(self.decoders)
+        for layer, layer_cache in zip(self.decoders, layer_caches):
             pdrop = np.random.random()
             if not self.training or (pdrop >= self.layer_drop):
-                x = layer((x, memory, src_mask, tgt_mask))
+                if layer_cache is None:
+                    x = checkpoint_layer(layer, (x, memory, src_mask, tgt_mask), self.checkpoint_layers)
+                else:
+                    x = layer((x, memory, src_mask, tgt_mask), cache=layer_cache)
         return self.ln(x)
 
 
+def kv_cache_length(cache: List[Dict[str, Dict[str, torch.Tensor]]]) -> int:
+    """Get the number of timesteps that are already stored in a transformer key/value cache
+
+    :param cache: The per-layer cache created by `init_cache` on a transformer stack
+    :returns: `int`: The number of cached timesteps, zero for a fresh cache
+    """
+    if not cache or 'self_attn' not in cache[0]:
+        return 0
+    return cache[0]['self_attn']['key'].shape[2]
+
+
+def reorder_kv_cache(
+    cache: List[Dict[str, Dict[str, torch.Tensor]]], beams: torch.Tensor
+) -> List[Dict[str, Dict[str, torch.Tensor]]]:
+    """Select the cached self-attention keys and values of the hypotheses that survived a beam search step
+
+    The encoder-decoder attention cache is left alone, a beam only ever moves within its own batch element
+    so the tiled memory for it is already correct
+
+    :param cache: The per-layer cache created by `init_cache` on a transformer stack
+    :param beams: `torch.LongTensor`: [B * K] The flat index of the beam each new hypothesis came from
+    :returns: The cache, which is updated in place
+    """
+    for layer_cache in cache:
+        self_attn_cache = layer_cache.get('self_attn')
+        if self_attn_cache is None:
+            continue
+        for name, value in self_attn_cache.items():
+            self_attn_cache[name] = value.index_select(0, beams)
+    return cache
+
+
+def select_kv_cache(
+    cache: List[Dict[str, Dict[str, torch.Tensor]]], rows: torch.Tensor
+) -> List[Dict[str, Dict[str, torch.Tensor]]]:
+    """Keep only some rows of everything in a transformer key/value cache, including the encoder-decoder attention
+
+    This is used to drop the examples that are done from a batch
+
+    :param cache: The per-layer cache created by `init_cache` on a transformer stack
+    :param rows: `torch.LongTensor`: The index of the rows to keep
+    :returns: The cache, which is updated in place
+    """
+    for layer_cache in cache:
+        for attn_cache in layer_cache.values():
+            for name, value in attn_cache.items():
+                attn_cache[name] = value.index_select(0, rows)
+    return cache
+
+
 def update_lengths(lengths, eoses, idx):
     """Update the length of a generated tensor based on the first EOS found.
 
@@ -3927,9 +4415,19 @@ def repeat_batch(t, K, dim=0):
 
 
 class BeamSearchBase:
+    """The engine for batched beam search, subclasses provide the decoding steps with `init`, `step` and `update`.
+
+    Examples whose beams are all finished are retired from the search. If the subclass sets `can_shrink`
+    and implements `shrink` their rows are also removed from the decoding state so the rest of the search
+    only pays for the examples that are still running.
+    """
+
+    can_shrink = False
+
     def __init__(self, beam=1, length_penalty=None, **kwargs):
         self.length_penalty = length_penalty if length_penalty else no_length_penalty
         self.K = beam
+        self.early_stopping = bool(kwargs.get('early_stopping', False))
 
     def init(self, encoder_outputs):
         pass
@@ -3940,6 +4438,16 @@ class BeamSearchBase:
     def update(self, beams, extra):
         pass
 
+    def shrink(self, rows, extra):
+        """Keep only the decoding state of the rows that are still being searched.
+
+        :param rows: `torch.LongTensor`: [B' * K] The flat index of the rows to keep, the K beams of an
+            example are always kept or dropped together
+        :param extra: The decoding state
+        :returns: The decoding state for only these rows
+        """
+        raise NotImplementedError
+
     def __call__(self, encoder_outputs, **kwargs):
         """Perform batched Beam Search.
 
@@ -3957,6 +4465,9 @@ class BeamSearchBase:
         :param update: `Callable(beams: torch.LongTensor, extra) -> extra:
             A callable that is called to edit the decoding state based on the selected
             best beams.
+        :param shrink: `Callable(rows: torch.LongTensor, extra) -> extra:
+            A callable that is called to drop the decoding state of finished examples,
+            only used when `can_shrink` is set.
         :param length_penalty: `Callable(lengths: torch.LongTensor) -> torch.floatTensor
             A callable that generates a penalty based on the lengths. Lengths is
             [B, K] and the returned penalty should be [B, K, 1] (or [B, K, V] to
@@ -3965,6 +4476,9 @@ class BeamSearchBase:
         :Keyword Arguments:
         * *beam* -- `int`: The number of beams to use.
         * *mxlen* -- `int`: The max number of steps to run the search for.
+        * *early_stopping* -- `bool`: Stop an example once none of its unfinished beams can
+          score better than its worst finished beam. The finished beams are the same as a full
+          search but the unfinished ones are ended where they are, their EOS is not scored.
 
         :returns:
             tuple(preds: torch.LongTensor, lengths: torch.LongTensor, scores: torch.FloatTensor)
@@ -3973,28 +4487,41 @@ class BeamSearchBase:
             scores: The score of each path [B, K]
         """
         mxlen = kwargs.get("mxlen", 100)
+        early_stopping = kwargs.get("early_stopping", self.early_stopping)
         bsz = encoder_outputs.output.shape[0]
         device = encoder_outputs.output.device
+        K = self.K
         with torch.no_grad():
             extra = self.init(encoder_outputs)
-            paths = torch.full((bsz, self.K, 1), Offsets.GO, dtype=torch.long, device=device)
+            # The paths of the examples still being searched, tokens are written into it in place. Once
+            # an example is done its paths, lengths and scores are copied into the `final_*` tensors.
+            paths = torch.full((bsz, K, mxlen + 1), Offsets.GO, dtype=torch.long, device=device)
+            final_paths = torch.full((bsz, K, mxlen + 1), Offsets.EOS, dtype=torch.long, device=device)
+            final_lengths = torch.zeros((bsz, K), dtype=torch.long, device=device)
+            final_scores = torch.zeros((bsz, K), dtype=torch.float, device=device)
+            # The index of each active row in the original batch.
+            active = torch.arange(bsz, dtype=torch.long, device=device)
+            # Active examples that were already copied out, this is only needed when we can't shrink.
+            retired = torch.zeros(bsz, dtype=torch.bool, device=device)
             # This tracks the log prob of each beam. This is distinct from score which
             # is based on the log prob and penalties.
-            log_probs = torch.zeros((bsz, self.K), dtype=torch.float, device=device)
+            log_probs = torch.zeros((bsz, K), dtype=torch.float, device=device)
             # Tracks the lengths of the beams, unfinished beams have lengths of zero.
-            lengths = torch.zeros((bsz, self.K), dtype=torch.long, device=device)
+            lengths = torch.zeros((bsz, K), dtype=torch.long, device=device)
+            # Best Beam index is relative within the batch (only [0, K)).
+            # This makes the index global (e.g. best beams for the second
+            # batch example is in [K, 2*K)).
+            offsets = torch.arange(bsz, dtype=torch.long, device=device).unsqueeze(-1) * K
+            eos_mask = None
 
             for i in range(mxlen - 1):
-                probs, extra = self.step(paths, extra)
+                active_bsz = active.shape[0]
+                probs, extra = self.step(paths[:, :, :i + 1], extra)
                 V = probs.shape[-1]
-                probs = probs.view((bsz, self.K, V))  # [B, K, V]
+                probs = probs.view((active_bsz, K, V))  # [B, K, V]
                 if i > 0:
                     # This mask is for all beams that are done.
                     done_mask = (lengths != 0).unsqueeze(-1)  # [B, K, 1]
-                    # Can creating this mask be moved out of the loop? It never changes but we don't have V
-                    # This mask selects the EOS token
-                    eos_mask = torch.zeros((1, 1, V), dtype=done_mask.dtype, device=device)
-                    eos_mask[:, :, Offsets.EOS] = 1
                     # This mask selects the EOS token of only the beams that are done.
                     mask = done_mask & eos_mask
                     # Put all probability mass on the EOS token for finished beams.
@@ -4007,6 +4534,9 @@ class BeamSearchBase:
                     # Calculate the score of the beam based on the current length.
                     path_scores = probs / self.length_penalty(lengths.masked_fill(lengths == 0, i + 1))
                 else:
+                    # This mask selects the EOS token
+                    eos_mask = torch.zeros((1, 1, V), dtype=torch.bool, device=device)
+                    eos_mask[:, :, Offsets.EOS] = 1
                     # On the first step we only look at probabilities for the first beam.
                     # If we don't then the probs will be the same for each beam
                     # This means the same token will be selected for each beam
@@ -4014,57 +4544,85 @@ class BeamSearchBase:
                     # Using only the first beam ensures K different starting points.
                     path_scores = probs[:, 0, :]
 
-                flat_scores = path_scores.view(bsz, -1)  # [B, K * V]
-                best_scores, best_idx = flat_scores.topk(self.K, 1)
+                flat_scores = path_scores.view(active_bsz, -1)  # [B, K * V]
+                best_scores, best_idx = flat_scores.topk(K, 1)
                 # Get the log_probs of the best scoring beams
-                log_probs = probs.view(bsz, -1).gather(1, best_idx).view(bsz, self.K)
+                log_probs = probs.view(active_bsz, -1).gather(1, best_idx).view(active_bsz, K)
 
                 best_beams = best_idx // V  # Get which beam it came from
                 best_idx = best_idx % V  # Get the index of the word regardless of which beam it is.
 
-                # Best Beam index is relative within the batch (only [0, K)).
-                # This makes the index global (e.g. best beams for the second
-                # batch example is in [K, 2*K)).
-                offsets = torch.arange(bsz, dtype=torch.long, device=device) * self.K
-                offset_beams = best_beams + offsets.unsqueeze(-1)
-                flat_beams = offset_beams.view(bsz * self.K)
-                # Select the paths to extend based on the best beams
-                flat_paths = paths.view(bsz * self.K, -1)
-                new_paths = flat_paths[flat_beams, :].view(bsz, self.K, -1)
-                # Add the selected outputs to the paths
-                paths = torch.cat([new_paths, best_idx.unsqueeze(-1)], dim=2)
+                flat_beams = (best_beams + offsets).view(active_bsz * K)
+                # Select the paths to extend based on the best beams and add the selected outputs
+                flat_paths = paths.view(active_bsz * K, -1)
+                flat_paths[:, :i + 1] = flat_paths[flat_beams, :i + 1]
+                flat_paths[:, i + 1] = best_idx.view(-1)
 
                 # Select the lengths to keep tracking based on the valid beams left.
-                lengths = lengths.view(-1)[flat_beams].view((bsz, self.K))
+                lengths = lengths.view(-1)[flat_beams].view((active_bsz, K))
 
                 extra = self.update(flat_beams, extra)
 
                 # Updated lengths based on if we hit EOS
-                last = paths[:, :, -1]
-                eoses = last == Offsets.EOS
+                eoses = best_idx == Offsets.EOS
                 lengths = update_lengths(lengths, eoses, i + 1)
-                if (lengths != 0).all():
-                    break
+                unfinished = lengths == 0
+                scores = best_scores
+                if early_stopping:
+                    # Log probs only go down so the best an unfinished beam could do is keep its log prob
+                    # and get the biggest penalty of any length it can still reach.
+                    remaining = torch.arange(i + 2, mxlen + 1, device=device).unsqueeze(0)
+                    bound = log_probs / self.length_penalty(remaining).max()
+                    best_unfinished = bound.masked_fill(~unfinished, -np.inf).max(1)[0]
+                    worst_finished = best_scores.masked_fill(unfinished, np.inf).min(1)[0]
+                    stopped = (~unfinished).any(1) & (best_unfinished < worst_finished)
+                    # End the unfinished beams of the stopped examples with an EOS
+                    closed = stopped.unsqueeze(-1) & unfinished
+                    lengths = lengths.masked_fill(closed, i + 2)
+                    scores = torch.where(closed, log_probs / self.length_penalty(lengths).squeeze(-1), best_scores)
+                done = (lengths != 0).all(1) & ~retired
+                if done.any():
+                    rows = done.nonzero().squeeze(1)
+                    idx = active[rows]
+                    final_paths[idx, :, :i + 2] = paths[rows, :, :i + 2]
+                    final_lengths[idx] = lengths[rows]
+                    final_scores[idx] = scores[rows]
+                    retired = retired | done
+                    if retired.all():
+                        break
+                    if self.can_shrink:
+                        keep = (~retired).nonzero().squeeze(1)
+                        extra = self.shrink((keep.unsqueeze(-1) * K + torch.arange(K, device=device)).view(-1), extra)
+                        active = active[keep]
+                        paths = paths[keep]
+                        log_probs = log_probs[keep]
+                        lengths = lengths[keep]
+                        retired = retired[keep]
+                        offsets = torch.arange(keep.shape[0], dtype=torch.long, device=device).unsqueeze(-1) * K
             else:
                 # This runs if the loop didn't break meaning one beam hit the max len
                 # Add an EOS to anything that hasn't hit the end. This makes the scores real.
-                probs, extra = self.step(paths, extra)
+                active_bsz = active.shape[0]
+                probs, extra = self.step(paths[:, :, :mxlen], extra)
 
                 V = probs.size(-1)
-                probs = probs.view((bsz, self.K, V))
+                probs = probs.view((active_bsz, K, V))
                 probs = probs[:, :, Offsets.EOS]  # Select the score of EOS
                 # If any of the beams are done mask out the score of this EOS (they already had an EOS)
                 probs = probs.masked_fill((lengths != 0), 0)
                 log_probs = log_probs + probs
-                end_tokens = torch.full((bsz, self.K, 1), Offsets.EOS, device=device, dtype=paths.dtype)
-                paths = torch.cat([paths, end_tokens], dim=2)
-                lengths = update_lengths(lengths, torch.ones_like(lengths) == 1, mxlen)
                 lengths = update_lengths(lengths, torch.ones_like(lengths) == 1, mxlen)
-                best_scores = log_probs / self.length_penalty(lengths).squeeze(-1)
+                scores = log_probs / self.length_penalty(lengths).squeeze(-1)
+                rows = (~retired).nonzero().squeeze(1)
+                idx = active[rows]
+                # The EOS that ends these is already in `final_paths`
+                final_paths[idx, :, :mxlen] = paths[rows, :, :mxlen]
+                final_lengths[idx] = lengths[rows]
+                final_scores[idx] = scores[rows]
 
         # Slice off the Offsets.GO token
-        paths = paths[:, :, 1:]
-        return paths, lengths, best_scores
+        paths = final_paths[:, :, 1:final_lengths.max().item() + 1]
+        return paths, final_lengths, final_scores
 
 
 def checkpoint_for(model_base, epoch, tick_type='epoch'):
@@ -4120,17 +4678,25 @@ def save_checkpoint(model: torch.nn.Module, model_base: str, count: int, tick_ty
         rm_old_checkpoints(model_base, count)
 
 
-def init_distributed(local_rank):
+def init_distributed(local_rank, backend='nccl'):
+    """Set up the process group for this worker, and pick its device
+
+    :param local_rank: The rank of this worker on this node, or -1 to read it from the `RANK` environment variable
+    :param backend: The `torch.distributed` backend.  With `gloo` and no GPUs, the device is the CPU
+    :return: The device and the local rank
+    """
     if local_rank == -1:
         # https://github.com/kubeflow/pytorch-operator/issues/128
         # https://github.com/pytorch/examples/blob/master/imagenet/main.py
         logger.info("Setting local rank to RANK env variable")
         local_rank = int(os.environ['RANK'])
     logger.warning("Local rank (%d)", local_rank)
+    if backend == 'gloo' and not torch.cuda.is_available():
+        device = torch.device("cpu")
     # In an env like k8s with kubeflow each worker will only see a single gpu
     # with an id of 0. If the gpu count is 1 then we are probably in an env like
     # that so we should just use the first (and only) gpu avaiable
-    if torch.cuda.device_count() == 1:
+    elif torch.cuda.device_count() == 1:
         torch.cuda.set_device(0)
         device = torch.device("cuda", 0)
     # This program assumes multiprocess/multi-device on a single node. Each
@@ -4143,7 +4709,7 @@ def init_distributed(local_rank):
     else:
         torch.cuda.set_device(local_rank)
         device = torch.device("cuda", local_rank)
-    torch.distributed.init_process_group(backend='nccl', init_method='env://')
+    torch.distributed.init_process_group(backend=backend, init_method='env://')
     return device, local_rank
 
 
@@ -4278,7 +4844,8 @@ class TransformerDiscriminator(nn.Module):
         self.transformer = TransformerEncoderStack(
             num_heads, d_model=d_model, pdrop=dropout, scale=True,
             layers=layers, activation=activation, d_ff=d_ff, rpr_k=rpr_k, d_k=d_k,
-            layer_norms_after=layer_norms_after, layer_norm_eps=layer_norm_eps
+            layer_norms_after=layer_norms_after, layer_norm_eps=layer_norm_eps,
+            checkpoint_layers=kwargs.get('checkpoint_layers', False)
         )
         self.proj_to_output = pytorch_linear(d_model, 1)
         self.apply(self.init_layer_weights)
@@ -4457,6 +5024,29 @@ class BilinearAttention(nn.Module):
         s = s.masked_fill((mask.bool() == MASK_FALSE).unsqueeze(1), -1e9)
         return s
 
+    def score_pairs(self, x, y):
+        r"""Score only aligned pairs, ``x[b, i]`` against ``y[b, i]``, rather than every ``x`` against every ``y``
+
+        This is useful once the partner for each ``x`` is already known (e.g. the selected head for each dependent),
+        since it avoids materializing the ``[B, n_out, T, T]`` tensor
+
+        Args:
+            x: ``[B, T, H]``.
+            y: ``[B, T, H]``, the partner of each position in ``x``.
+        Returns:
+            ~torch.Tensor:
+                A scoring tensor of shape ``[batch_size, seq_len, n_out]``.
+        """
+        if self.bias_x is True:
+            ones = torch.ones(x.shape[:-1] + (1,), device=x.device, dtype=x.dtype)
+            x = torch.cat([x, ones], -1)
+        if self.bias_y is True:
+            ones = torch.ones(y.shape[:-1] + (1,), device=y.device, dtype=y.dtype)
+            y = torch.cat([y, ones], -1)
+        # [B, T, n_out, H] contracted against y
+        u = torch.einsum('bti,oij->btoj', x, self.weight)
+        return torch.einsum('btoj,btj->bto', u, y)
+
 
 class TripletLoss(nn.Module):
     """Provide a Triplet Loss using the reversed batch for negatives"""
@@ -4817,7 +5407,9 @@ class PairedModel(DualEncoderModel):
                                                    ffn_pdrop=ffn_pdrop,
                                                    d_k=d_k, rpr_k=rpr_k, windowed_ra=windowed_ra, rpr_value_on=rpr_value_on,
                                                    layer_norms_after=layer_norms_after, layer_norm_eps=layer_norm_eps,
-                                                   ra_type=ra_type, transformer_type=transformer_type)
+                                                   ra_type=ra_type, transformer_type=transformer_type,
+                                                   keep_attn=kwargs.get('keep_attn', True),
+                                                   checkpoint_layers=kwargs.get('checkpoint_layers', False))
 
         self.embeddings = EmbeddingsStack({'x': embeddings}, 0.0, False, embeddings_reduction)
         self.freeze = freeze_encoders
@@ -4919,7 +5511,9 @@ class TransformerBoWPairedModel(DualEncoderModel):
                                                    pdrop=dropout, layers=num_layers, activation='gelu', d_ff=d_ff,
                                                    ffn_pdrop=ffn_pdrop,
                                                    d_k=d_k, rpr_k=rpr_k, windowed_ra=windowed_ra, rpr_value_on=rpr_value_on,
-                                                   layer_norms_after=layer_norms_after, ra_type=ra_type, transformer_type=transformer_type)
+                                                   layer_norms_after=layer_norms_after, ra_type=ra_type, transformer_type=transformer_type,
+                                                   keep_attn=kwargs.get('keep_attn', True),
+                                                   checkpoint_layers=kwargs.get('checkpoint_layers', False))
 
         self.embeddings = EmbeddingsStack({'x': embeddings})
         self.freeze = freeze_encoders
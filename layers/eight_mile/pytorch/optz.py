@@ -1,5 +1,6 @@
 import math
 import logging
+import contextlib
 import torch
 import torch.autograd
 from eight_mile.optz import create_lr_scheduler, register_lr_scheduler
@@ -139,7 +140,39 @@ class AdamW(torch.optim.Optimizer):
         return loss
 
 
+def _grad_scaler(enabled: bool):
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def _autocast(enabled: bool):
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type='cuda', enabled=enabled)
+    return torch.cuda.amp.autocast(enabled=enabled)
+
+
 class OptimizerManager:
+    """Own the optimizer and the learning rate schedule, and optionally mixed precision and gradient accumulation
+
+    The trainers drive it like this:
+
+    ```
+    optimizer.start_epoch(steps)
+    for batch in batches:
+        with optimizer.autocast(model):
+            loss = ...
+        if optimizer.backward(loss):
+            optimizer.clip_grad_norm(clip)
+            optimizer.step()
+            optimizer.zero_grad()
+    ```
+
+    :Keyword Arguments:
+    * *fp16* -- (``bool``) Run the forward pass under `autocast` and scale the loss with a `GradScaler`.  This
+        only takes effect on CUDA, defaults to `False`
+    * *grad_accum* -- (``int``) How many batches to accumulate gradients over before stepping, defaults to 1
+    """
     def __init__(self, model_or_params, global_step=0, weight_decay=0.0, **kwargs):
         DONT_DECAY = ['ln.weight', 'bias']
         if isinstance(model_or_params, torch.nn.Module):
@@ -163,6 +196,14 @@ class OptimizerManager:
             self.lr_function = create_lr_scheduler(**kwargs)
         self._init_optimizer(parameters, **kwargs)
         self.current_lr = 0
+        self.grad_accum = int(kwargs.get("grad_accum", 1))
+        self.fp16 = bool(kwargs.get("fp16", False))
+        if self.fp16 and not torch.cuda.is_available():
+            logger.warning("fp16 was requested but CUDA is not available, training in fp32")
+            self.fp16 = False
+        self.scaler = _grad_scaler(self.fp16)
+        self.accum_steps = 0
+        self.remaining_steps = None
 
     @property
     def global_step(self):
@@ -217,12 +258,74 @@ class OptimizerManager:
     def _identity(self, _):
         return self.current_lr
 
+    def start_epoch(self, steps):
+        """Tell the manager how many batches are coming, so the last accumulation of the epoch knows its real size
+
+        :param steps: The number of batches in the epoch
+        """
+        self.accum_steps = 0
+        self.remaining_steps = steps
+
+    def _group_size(self):
+        """The number of batches in the current accumulation, which is less than `grad_accum` at the end of an epoch
+        """
+        if self.remaining_steps is None:
+            return self.grad_accum
+        return min(self.grad_accum, self.accum_steps + max(self.remaining_steps, 1))
+
+    def autocast(self, model=None):
+        """A context manager for the forward pass and loss, which runs in mixed precision if `fp16` is on
+
+        If the `model` is a `DistributedDataParallel` and this batch doesnt finish the accumulation, it runs under
+        `model.no_sync()`, so the gradients are only all-reduced once, on the last batch before the `step()`
+
+        :param model: The (possibly wrapped) model that runs the forward pass
+        :return: The context manager
+        """
+        if not hasattr(model, 'no_sync') or self.accum_steps + 1 >= self._group_size():
+            return _autocast(self.fp16)
+        stack = contextlib.ExitStack()
+        stack.enter_context(model.no_sync())
+        stack.enter_context(_autocast(self.fp16))
+        return stack
+
+    def backward(self, loss):
+        """Backprop the loss, scaled for mixed precision and averaged over the batches of this accumulation
+
+        This is `grad_accum` batches, except at the end of an epoch (see `start_epoch`) where it is whatever is left
+
+        :param loss: The loss for this batch
+        :return: `True` if enough batches have been accumulated that its time to `step()`
+        """
+        group_size = self._group_size()
+        if group_size > 1:
+            loss = loss / group_size
+        self.scaler.scale(loss).backward()
+        self.accum_steps += 1
+        if self.remaining_steps is not None:
+            self.remaining_steps -= 1
+        return self.accum_steps >= group_size
+
+    def clip_grad_norm(self, max_norm):
+        """Unscale the gradients (if we are in mixed precision) and clip them
+
+        :param max_norm: The max norm of the gradients
+        :return: The total norm of the gradients
+        """
+        self.scaler.unscale_(self.optimizer)
+        parameters = [p for param_group in self.optimizer.param_groups for p in param_group['params']]
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+
     def step(self):
         """Runs at every step and updates the learning rate
 
+        In mixed precision, the step is skipped if the gradients overflowed and the loss scale is updated
+
         :return:
         """
-        self.optimizer.step()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.accum_steps = 0
         self.current_lr = self.update_lr()
         self.global_step += 1
 
@@ -1858,3 +1858,75 @@ def find_cycles(sequence):
         if index[i] == -1:
             _dfs(i)
     return all_cycles
+
+
+def _chu_liu_edmonds(scores: np.ndarray) -> np.ndarray:
+    """Find the maximum spanning arborescence rooted at position 0 for a single sentence
+
+    The greedy heads are taken first, then each cycle (found with `find_cycles`) is contracted into a single node
+    and the contracted graph is solved recursively, and expanded back out, breaking the cycle where the best
+    outside head enters it.
+
+    :param scores: ``[T, T]`` scores where ``scores[d, h]`` is the score of ``h`` being the head of ``d``.  The
+        diagonal and the root row must already be set to ``-inf``
+    :return: ``[T]`` The head of each position, with the root pointing at itself
+    """
+    heads = scores.argmax(-1)
+    heads[0] = 0
+    cycles = find_cycles(heads)
+    if not cycles:
+        return heads
+    cycle = np.array(sorted(cycles[0]))
+    in_cycle = np.zeros(len(scores), dtype=bool)
+    in_cycle[cycle] = True
+    # The root never has a head, so it is never in a cycle and stays at index 0 of the contracted graph
+    rest = np.where(~in_cycle)[0]
+    cycle_scores = scores[cycle, heads[cycle]]
+    # Outside dependents attach to their best head inside the cycle
+    out_scores = scores[np.ix_(rest, cycle)]
+    out_best = cycle[out_scores.argmax(-1)]
+    # An outside head enters the cycle at the node that loses the least by giving up its cycle head
+    in_scores = scores[np.ix_(cycle, rest)] - cycle_scores[:, np.newaxis]
+    in_best = cycle[in_scores.argmax(0)]
+
+    C = len(rest)
+    contracted = np.full((C + 1, C + 1), -np.inf)
+    contracted[:C, :C] = scores[np.ix_(rest, rest)]
+    contracted[:C, C] = out_scores.max(-1)
+    contracted[C, :C] = in_scores.max(0)
+    contracted_heads = _chu_liu_edmonds(contracted)
+
+    rest_heads = contracted_heads[:C]
+    heads[rest] = np.where(rest_heads == C, out_best, rest[np.minimum(rest_heads, C - 1)])
+    cycle_head = contracted_heads[C]
+    heads[in_best[cycle_head]] = rest[cycle_head]
+    return heads
+
+
+@export
+def mst_decode(scores: np.ndarray, lengths: Optional[np.ndarray] = None) -> np.ndarray:
+    """Decode a batch of dependency arc scores to well-formed trees using Chu-Liu-Edmonds
+
+    Unlike taking the argmax head for each token, this guarantees that the result has no cycles and that every
+    token is reachable from the root.  Each sentence is solved with vectorized numpy operations on its own
+    ``[T, T]`` sub-matrix, so padding never factors into the search
+
+    :param scores: ``[B, T, T]`` arc scores where ``scores[b, d, h]`` scores ``h`` as the head of ``d``, and
+        position 0 is the root
+    :param lengths: ``[B]`` The number of valid positions (including the root) for each sentence, defaults to ``T``
+    :return: ``[B, T]`` The predicted heads, with the root and any padding set to 0
+    """
+    scores = np.asarray(scores)
+    B, T, _ = scores.shape
+    if lengths is None:
+        lengths = np.full(B, T)
+    heads = np.zeros((B, T), dtype=np.int64)
+    for b, length in enumerate(lengths):
+        length = int(length)
+        if length < 2:
+            continue
+        sentence = scores[b, :length, :length].astype(np.float64)
+        np.fill_diagonal(sentence, -np.inf)
+        sentence[0] = -np.inf
+        heads[b, :length] = _chu_liu_edmonds(sentence)
+    return heads
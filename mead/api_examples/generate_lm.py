@@ -30,25 +30,28 @@ def decode_sentence(model, vectorizer, query, word2index, index2word, device, en
     vec, length = vectorizer.run(query, word2index)
     bpe = [index2word[v] for v in vec if v != Offsets.PAD]
     logger.info('[BPE] ' + ' '.join(bpe))
-    toks = torch.from_numpy(vec).to(device=device)
+    toks = torch.from_numpy(vec).to(device=device).unsqueeze(0)
 
     with torch.no_grad():
 
         words = []
+        # The keys and values of each position are cached, so every step only runs the newest token.
+        # Without a cache (relative attention), the whole prefix is run every step
+        cache = model.init_cache() if model.generator.supports_kv_cache else None
         for i in range(100):
-            predictions, _ = model({'x': toks.unsqueeze(0)}, None)
-            predictions = predictions.squeeze(0)
+            predictions, cache = model({'x': toks[:, :length + i]}, cache)
+            predictions = predictions[0, -1]
 
             if not sample:
-                output = torch.argmax(predictions[length + i - 1], -1).item()
+                output = torch.argmax(predictions, -1).item()
                 word = index2word[output]
             else:
-                sample_dist = torch.softmax(predictions[length + i - 1] / sample_temperature, -1)
+                sample_dist = torch.softmax(predictions / sample_temperature, -1)
                 output = torch.multinomial(sample_dist, num_samples=1)
                 output = output.squeeze(0).item()
                 word = index2word[output]
             words.append(word)
-            toks[length + i] = output
+            toks[0, length + i] = output
             if word == end_token:
                 break
 
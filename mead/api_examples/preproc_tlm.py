@@ -3,7 +3,7 @@ import gzip
 import sys
 import argparse
 import baseline
-from baseline.vectorizers import BPEVectorizer1D, WordpieceVectorizer1D
+from baseline.vectorizers import BPEVectorizer1D, WordpieceVectorizer1D, GPT2Vectorizer1D
 from mead.api_examples.preproc_utils import *
 from eight_mile.utils import (
     write_yaml,
@@ -49,6 +49,8 @@ def get_subword_vec1d(type):
         return BPEVectorizer1D
     elif type == 'wordpiece':
         return WordpieceVectorizer1D
+    elif type == 'gpt2':
+        return GPT2Vectorizer1D
     else:
         from baseline.vectorizers import SentencePieceVectorizer1D
         return SentencePieceVectorizer1D
@@ -101,10 +103,49 @@ class TextFile:
         self.file.close()
 
 
+def tokenized_lines(rf, tokenizer, get_line, tok_on_eol):
+    """Tokenize each line of a file, skipping the empty ones and ending each with `tok_on_eol`"""
+    for line in rf:
+        to_bpe = tokenizer(get_line(line))
+        if not to_bpe:
+            continue
+        yield to_bpe + [tok_on_eol]
+
+
+def vectorize_batches(vectorizer, lines, batchsz):
+    """Vectorize `batchsz` lines at a time with a single `run_batch`
+
+    Subword vectorizers that can encode a whole batch at once (like GPT2, which runs the BPE once for each distinct
+    pre-token with `encode_many`) do so, the rest fall back to running each line
+
+    :param vectorizer: A subword vectorizer
+    :param lines: An iterable of token lists
+    :param batchsz: The number of lines to vectorize at once
+    :return: A generator of the vectorized values and their length for each line
+    """
+    batch = []
+    for to_bpe in lines:
+        batch.append(to_bpe)
+        if len(batch) == batchsz:
+            yield from _vectorize_batch(vectorizer, batch)
+            batch = []
+    if batch:
+        yield from _vectorize_batch(vectorizer, batch)
+
+
+def _vectorize_batch(vectorizer, batch):
+    vectorizer.mxlen = max(max(len(to_bpe) for to_bpe in batch) * 2, 4096)
+    vecs, lengths = vectorizer.run_batch(batch, vectorizer.vocab, dtype=np.int64)
+    for vec, available in zip(vecs, lengths):
+        if available > vectorizer.mxlen:
+            logger.warning("Truncating from %d to %d", available, vectorizer.mxlen)
+        yield vec, int(available)
+
+
 def run(input_files=[], input_pattern='*.txt', codes=None, vocab=None, nctx=256, fmt='json', fields=['x_str', 'y_str'],
         output=None, prefix=None, suffix=None, max_file_size=100, tok_on_eol="<EOS>", cased=True,
         mask_type="mlm", module=None, pad_y=True, extra_tokens=['[CLS]', '[MASK]'], world_size=1, world_offset=0,
-        input_field='text', tokenizer_type=None, subword_type='bpe', **kwargs):
+        input_field='text', tokenizer_type=None, subword_type='bpe', batchsz=100, **kwargs):
 
     def parse_json_line(x): return json.loads(x)[input_field]
 
@@ -167,15 +208,7 @@ def run(input_files=[], input_pattern='*.txt', codes=None, vocab=None, nctx=256,
 
         with InputFile(text) as rf:
             print(f"Reading from {text}...")
-            for line in rf:
-                to_bpe = tokenizer(get_line(line))
-                if not to_bpe:
-                    continue
-                to_bpe += [tok_on_eol]
-                vectorizer.mxlen = max(len(to_bpe) * 2, 4096)
-                output, available = vectorizer.run(to_bpe, vectorizer.vocab)
-                if available > vectorizer.mxlen:
-                    print(f"Warning, truncation from {vectorizer.mxlen} to {available}")
+            for output, available in vectorize_batches(vectorizer, tokenized_lines(rf, tokenizer, get_line, tok_on_eol), batchsz):
                 while available > 0:
                     if len(lookup_indices) == nctx:
                         record = create_record(lookup_indices, indices2word, prefix, suffix, masking=masking)
@@ -215,7 +248,7 @@ def parse_args(argv):
     parser.add_argument('--codes', help='BPE codes')
     parser.add_argument('--vocab', help='BPE vocab')
     parser.add_argument("--nctx", type=int, default=256, help="Max input length")
-    parser.add_argument("--subword_type", type=str, choices=["bpe", "wordpiece", "sentencepiece"], default="bpe")
+    parser.add_argument("--subword_type", type=str, choices=["bpe", "wordpiece", "sentencepiece", "gpt2"], default="bpe")
     parser.add_argument("--fmt", type=str, default='json', choices=['json', 'tsv', 'tfrecord'])
     parser.add_argument("--fields", type=str, nargs="+", default=["x_str", "y_str"])
     parser.add_argument("--output", type=str, help="Output base name, e.g. /path/to/output/record")
@@ -223,6 +256,7 @@ def parse_args(argv):
     parser.add_argument("--suffix", type=str, help="Suffix every line with this token")
     parser.add_argument('--world_size', type=int, default=1, help="Can be used as decimation factor, or to support multiproc")
     parser.add_argument('--world_offset', type=int, default=0, help="Offset for decimation or processor")
+    parser.add_argument("--batchsz", type=int, default=100, help="Number of lines to vectorize at once")
     parser.add_argument("--max_file_size", type=int, default=100, help="Shard size, defaults to 100MB")
     parser.add_argument("--stride", type=int, help="Tokens to stride before next read, defaults to `nctx`")
     parser.add_argument("--tok_on_eol", type=str, default="<EOS>")
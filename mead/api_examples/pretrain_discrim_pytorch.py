@@ -130,6 +130,8 @@ def train():
                         type=int, default=[8], nargs='+')
 
     parser.add_argument("--num_train_workers", type=int, default=4, help="Number train workers")
+    parser.add_argument("--checkpoint_layers", type=str2bool, default=False,
+                        help="Recompute the activations of each layer in the backward pass to save memory")
     parser.add_argument("--nctx", type=int, default=256, help="Max context length (for both encoder and decoder)")
     parser.add_argument("--embed_type", type=str, default='default',
                         choices=["default", "positional", "learned-positional"],
@@ -248,12 +250,14 @@ def train():
     gen_model = TransformerMaskedLanguageModel.create(gen_embeddings, hsz=args.gen_d_model, d_ff=args.gen_d_ff,
                                                       tie_weights=True, dropout=args.gen_dropout,
                                                       num_heads=args.gen_num_heads, layers=args.gen_num_layers,
-                                                      rpr_k=gen_rpr_k, d_k=args.gen_d_k, src_keys=['x'], tgt_key='x')
+                                                      rpr_k=gen_rpr_k, d_k=args.gen_d_k, src_keys=['x'], tgt_key='x',
+                                                      checkpoint_layers=args.checkpoint_layers)
     discrim_model = TransformerDiscriminator(discrim_embeddings, d_model=args.discrim_d_model, d_ff=args.discrim_d_ff,
                                              dropout=args.discrim_dropout, num_heads=args.discrim_num_heads,
                                              layers=args.discrim_num_layers,
                                              activation='gelu', layer_norm_eps=1.0e-12,
-                                             rpr_k=discrim_rpr_k, d_k=args.discrim_d_k)
+                                             rpr_k=discrim_rpr_k, d_k=args.discrim_d_k,
+                                             checkpoint_layers=args.checkpoint_layers)
     gen_model.to(args.device)
     gen_loss_fn = gen_model.create_loss()
 
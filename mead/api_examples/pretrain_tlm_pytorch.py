@@ -49,7 +49,7 @@ def run(basedir=None, train_file=None, valid_file=None, dataset_key='tlm', embed
         restart_tt=None, warmup_steps=10000, saves_per_epoch=10, mlm=True, preprocessed=True, rpr_k=[8],
         rpr_value_on=False, windowed_ra=False, device="cuda", distributed=False, local_rank=-1,
         extra_tokens=["[CLS]", "[MASK]"], do_early_stopping=False, model_type='transformer-mlm', modules=[],
-        ra_type=None, transformer_type=None, **kwargs):
+        ra_type=None, transformer_type=None, checkpoint_layers=False, **kwargs):
     if basedir is None:
         basedir = 'lm-{}-bpe-{}'.format(dataset_key, os.getpid())
     logging.basicConfig(level=logging.INFO if local_rank in [-1, 0] else logging.WARN)
@@ -137,6 +137,7 @@ def run(basedir=None, train_file=None, valid_file=None, dataset_key='tlm', embed
         model_type=model_type,
         ra_type=ra_type,
         transformer_type=transformer_type,
+        checkpoint_layers=checkpoint_layers,
         src_keys=['x'], tgt_key='x')
     model.to(device)
 
@@ -331,6 +332,8 @@ def parse_args(argv):
     parser.add_argument("--dropout", type=float, default=0.1, help="Dropout")
     parser.add_argument("--ffn_pdrop", type=float, default=0.0, help="Dropout in the dense stack")
     parser.add_argument("--layer_drop", type=float, default=0.0, help="LayerDrop to apply")
+    parser.add_argument("--checkpoint_layers", type=str2bool, default=False,
+                        help="Recompute the activations of each layer in the backward pass to save memory")
     parser.add_argument("--lr_scheduler", type=str, default='cosine', help="The type of learning rate decay scheduler")
     parser.add_argument("--lr_decay_steps", type=int, help="decay steps of lr scheduler")
     parser.add_argument("--lr_decay_rate", type=float, help="decay rate of lr scheduler")
@@ -46,6 +46,7 @@ def main():
     parser.add_argument('--name', help='Name of the model, used second in the path', default=None)
     parser.add_argument('--beam', help='beam_width', default=30, type=int)
     parser.add_argument('--nbest_input', help='Is the input to this model N-best', default=False, type=str2bool)
+    parser.add_argument('--dynamic_batch', help='Should the exported (ONNX) model have a dynamic batch axis?', default=True, type=str2bool)
     parser.add_argument('--is_remote', help='if True, separate items for remote server and client. If False bundle everything together (default True)', default=None)
     parser.add_argument('--backend', help='The deep learning backend to use')
     parser.add_argument('--reporting', help='reporting hooks', nargs='+')
@@ -106,7 +107,8 @@ def main():
     feature_exporter_field_map = create_feature_exporter_field_map(config_params['features'])
     exporter = create_exporter(task, exporter_type, return_labels=return_labels,
                                feature_exporter_field_map=feature_exporter_field_map,
-                               nbest_input=args.nbest_input)
+                               nbest_input=args.nbest_input,
+                               dynamic_batch=args.dynamic_batch)
     exporter.run(args.model, output_dir, project, name, model_version,
                  remote=is_remote, use_version=args.use_version, zip_results=args.zip, use_all_features=args.use_all_features)
 
@@ -12,6 +12,7 @@ from eight_mile.pytorch.layers import (
 )
 from baseline.utils import (
     exporter,
+    str2bool,
     Offsets,
     write_json,
     load_vectorizers,
@@ -89,6 +90,7 @@ class PytorchONNXExporter(Exporter):
         self.default_size = int(kwargs.get('default_size', 100))
         self.onnx_opset = int(kwargs.get('onnx_opset', 12))
         self.nbest_inputs = bool(kwargs.get('nbest_input', False))
+        self.dynamic_batch = str2bool(kwargs.get('dynamic_batch', True))
 
     def apply_model_patches(self, model):
         return model
@@ -134,6 +136,11 @@ class PytorchONNXExporter(Exporter):
                     dynamics[name] = {1: 'nbest', 2: 'sequence'}
                 else:
                     dynamics[name] = {1: 'sequence'}
+
+        if self.dynamic_batch:
+            # The services check for a symbolic batch axis to decide if they can run a whole batch in one call
+            for name in list(inputs) + list(outputs):
+                dynamics.setdefault(name, {})[0] = 'batch'
         logger.info(dynamics)
         return dynamics
 
@@ -271,11 +278,15 @@ class TaggerPytorchONNXExporter(PytorchONNXExporter):
             if isinstance(model.decoder, CRF):
                 model.decoder.viterbi = ViterbiBatchSize1(model.decoder.viterbi.start_idx,
                                                           model.decoder.viterbi.end_idx)
-            elif isinstance(model.decoder, TaggerGreedyDecoder):
+                self.dynamic_batch = False
+            elif isinstance(model.decoder, TaggerGreedyDecoder) and model.decoder.constraint_mask is not None:
                 model.decoder.viterbi = ViterbiLogSoftmaxNormBatchSize1(
                     model.decoder.viterbi.start_idx,
                     model.decoder.viterbi.end_idx
                 )
+                self.dynamic_batch = False
+            if not self.dynamic_batch:
+                logger.info("Exporting with a fixed batch size of 1 for the Viterbi decoder")
         return model
 
 
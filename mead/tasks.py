@@ -236,6 +236,18 @@ class Task:
         self._configure_reporting(config_params.get('reporting', {}), config_file=config_file, **kwargs)
         self.reader = self._create_task_specific_reader(vecs_set)
 
+    @property
+    def primary_worker(self) -> bool:
+        """Is this the worker that writes files and reports?
+
+        This is always true unless we are training distributed, where only the first worker (`RANK` 0) does
+
+        :return: `True` if this worker should write files and report
+        """
+        if not self.config_params['train'].get('distributed', False):
+            return True
+        return int(os.getenv('RANK', 0)) == 0
+
     def _load_user_modules(self):
         # User modules can be downloaded from hub or HTTP automatically if they are defined in form
         # http://path/to/module_name.py
@@ -304,7 +316,8 @@ class Task:
         :return: Nothing
         """
         self._reorganize_params()
-        baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
+        if self.primary_worker:
+            baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
         self._load_dataset()
 
         model_params = self.config_params['model']
@@ -314,7 +327,7 @@ class Task:
         train_params = self.config_params['train']
         train_params['checkpoint'] = checkpoint
         baseline.train.fit(model_params, self.train_data, self.valid_data, self.test_data, **train_params)
-        if str2bool(self.config_params.get('zip_checkpoint', True)):
+        if self.primary_worker and str2bool(self.config_params.get('zip_checkpoint', True)):
             baseline.zip_files(self.get_basedir())
         self._close_reporting_hooks()
 
@@ -331,9 +344,13 @@ class Task:
 
         reporting_hooks, reporting = merge_reporting_with_settings(reporting, self.mead_settings_config)
 
-        self.reporting = create_reporting(reporting_hooks,
-                                          reporting,
-                                          {'config_file': config_file, 'task': self.__class__.task_name(), 'base_dir': self.get_basedir()})
+        if self.primary_worker:
+            self.reporting = create_reporting(reporting_hooks,
+                                              reporting,
+                                              {'config_file': config_file, 'task': self.__class__.task_name(), 'base_dir': self.get_basedir()})
+        else:
+            # Only the first worker reports when we are distributed
+            self.reporting = []
 
         self.config_params['train']['reporting'] = [x.step for x in self.reporting]
         logging.basicConfig(level=logging.DEBUG)
@@ -528,7 +545,8 @@ class ClassifierTask(Task):
                                                      min_f=Task._get_min_f(self.config_params),
                                                      **self.dataset)
         self.embeddings, self.feat2index = self._create_embeddings(embeddings_set, vocab, self.config_params['features'])
-        baseline.save_vocabs(self.get_basedir(), self.feat2index)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2index)
 
     def _get_features(self):
         return self.embeddings
@@ -610,7 +628,8 @@ class TaggerTask(Task):
 
         vocabs = self.reader.build_vocab(vocab_sources, min_f=Task._get_min_f(self.config_params), **self.dataset)
         self.embeddings, self.feat2index = self._create_embeddings(embeddings_set, vocabs, self.config_params['features'])
-        baseline.save_vocabs(self.get_basedir(), self.feat2index)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2index)
 
     def _reorganize_params(self):
         train_params = self.config_params['train']
@@ -677,7 +696,8 @@ class TaggerTask(Task):
 
     def train(self, checkpoint=None):
         self._load_dataset()
-        baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
+        if self.primary_worker:
+            baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
         self._reorganize_params()
         conll_output = self.config_params.get("conll_output", None)
         model_params = self.config_params['model']
@@ -695,7 +715,8 @@ class TaggerTask(Task):
                 os.makedirs(dir_name, exist_ok=True)
 
         baseline.train.fit(model_params, self.train_data, self.valid_data, self.test_data, **train_params)
-        baseline.zip_files(self.get_basedir())
+        if self.primary_worker:
+            baseline.zip_files(self.get_basedir())
         self._close_reporting_hooks()
 
 
@@ -738,7 +759,8 @@ class DependencyParserTask(Task):
                                          vocab_file
                                          =self.dataset.get('vocab_file'))
         self.embeddings, self.feat2index = self._create_embeddings(embeddings_set, vocabs, self.config_params['features'])
-        baseline.save_vocabs(self.get_basedir(), self.feat2index)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2index)
 
     def _reorganize_params(self):
         train_params = self.config_params['train']
@@ -795,7 +817,8 @@ class DependencyParserTask(Task):
 
     def train(self, checkpoint=None):
         self._load_dataset()
-        baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
+        if self.primary_worker:
+            baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
         self._reorganize_params()
         conll_output = self.config_params.get("conll_output", None)
         model_params = self.config_params['model']
@@ -813,7 +836,8 @@ class DependencyParserTask(Task):
                 os.makedirs(dir_name, exist_ok=True)
 
         baseline.train.fit(model_params, self.train_data, self.valid_data, self.test_data, **train_params)
-        baseline.zip_files(self.get_basedir())
+        if self.primary_worker:
+            baseline.zip_files(self.get_basedir())
         self._close_reporting_hooks()
 
 
@@ -868,9 +892,11 @@ class EncoderDecoderTask(Task):
 
         self.src_embeddings, self.feat2src = self._create_embeddings(embeddings_set, vocab1, features_src)
         # For now, dont allow multiple vocabs of output
-        baseline.save_vocabs(self.get_basedir(), self.feat2src)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2src)
         self.tgt_embeddings, self.feat2tgt = self._create_embeddings(embeddings_set, {'tgt': vocab2}, [features_tgt])
-        baseline.save_vocabs(self.get_basedir(), self.feat2tgt)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2tgt)
         self.tgt_embeddings = self.tgt_embeddings['tgt']
         self.feat2tgt = self.feat2tgt['tgt']
 
@@ -985,7 +1011,8 @@ class LanguageModelingTask(Task):
                                          min_f=Task._get_min_f(self.config_params),
                                          **self.dataset)
         self.embeddings, self.feat2index = self._create_embeddings(embeddings_set, vocabs, self.config_params['features'])
-        baseline.save_vocabs(self.get_basedir(), self.feat2index)
+        if self.primary_worker:
+            baseline.save_vocabs(self.get_basedir(), self.feat2index)
 
     def _load_dataset(self):
         read = self.config_params['reader'] if 'reader' in self.config_params else self.config_params['loader']
@@ -1042,7 +1069,8 @@ class LanguageModelingTask(Task):
         self._load_dataset()
         # Dont do this here!  We need to move train_data elsewhere
         calc_lr_params(self.config_params['train'], self.train_data.steps)
-        baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
+        if self.primary_worker:
+            baseline.save_vectorizers(self.get_basedir(), self.vectorizers)
 
         model_params = self.config_params['model']
         model_params['task'] = self.task_name()
@@ -1050,7 +1078,8 @@ class LanguageModelingTask(Task):
         train_params = self.config_params['train']
         train_params['checkpoint'] = checkpoint
         baseline.train.fit(model_params, self.train_data, self.valid_data, self.test_data, **train_params)
-        baseline.zip_files(self.get_basedir())
+        if self.primary_worker:
+            baseline.zip_files(self.get_basedir())
         self._close_reporting_hooks()
 
     @staticmethod
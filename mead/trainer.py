@@ -75,6 +75,44 @@ def update_datasets(datasets_config, config_params, train, valid, test):
     datasets_config.append(updated_record)
 
 
+def init_distributed_training(args, config_params):
+    """Set this process up as a distributed (PyTorch DDP) worker, and point the `train` block at it
+
+    With the `nccl` backend each worker gets its own GPU.  With `gloo` on a machine without GPUs, the workers
+    train on the CPU
+
+    :param args: The parsed `mead-train` arguments
+    :param config_params: The mead config, the `train` (and `model`) sections are updated for this worker
+    """
+    import torch
+    from eight_mile.pytorch.layers import init_distributed
+    if normalize_backend(config_params.get('backend', 'pytorch')) != 'pytorch':
+        raise Exception('Distributed training with mead-train is only supported for PyTorch')
+    backend = args.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo')
+    local_rank = args.local_rank if args.local_rank != -1 else int(os.getenv('LOCAL_RANK', -1))
+    device, _ = init_distributed(local_rank, backend)
+    config_params['train']['distributed'] = True
+    if device.type == 'cpu':
+        config_params['train']['gpus'] = 0
+        config_params['model']['nogpu'] = True
+    else:
+        config_params['train']['gpus'] = 1
+    if torch.distributed.get_rank() > 0:
+        for name in ('mead', 'baseline'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def _distributed_worker(local_rank, args, overrides):
+    """The entry point for each of the workers that `mead-train` spawns with `--nproc_per_node`"""
+    os.environ['RANK'] = str(local_rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = str(args.nproc_per_node)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    args.local_rank = local_rank
+    run(args, overrides)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Train a text classifier')
     parser.add_argument('--config', help='JSON/YML Configuration for an experiment: local file or remote URL', type=convert_path, default="$MEAD_CONFIG")
@@ -95,7 +133,27 @@ def main():
     parser.add_argument('--reporting', help='reporting hooks', nargs='+')
     parser.add_argument('--backend', help='The deep learning backend to use')
     parser.add_argument('--checkpoint', help='Restart training from this checkpoint')
+    parser.add_argument('--distributed', help='Train with PyTorch DistributedDataParallel, one worker per process',
+                        type=str2bool, default=False)
+    parser.add_argument('--nproc_per_node', help='Spawn this many distributed workers.  Leave at 1 when another launcher '
+                                                 '(like torchrun) starts the workers', type=int, default=1)
+    parser.add_argument('--dist_backend', help='The torch.distributed backend, defaults to nccl on GPUs and gloo otherwise')
+    parser.add_argument('--local_rank', help='The local rank of this worker, if a launcher passes it', type=int, default=-1)
+    parser.add_argument('--master_port', help='The port for the spawned workers to rendezvous on', type=int, default=29500)
     args, overrides = parser.parse_known_args()
+    if args.distributed and args.nproc_per_node > 1:
+        import torch.multiprocessing as mp
+        mp.spawn(_distributed_worker, args=(args, overrides), nprocs=args.nproc_per_node)
+        return
+    run(args, overrides)
+
+
+def run(args, overrides):
+    """Run training for the parsed `mead-train` arguments
+
+    :param args: The parsed arguments
+    :param overrides: Any remaining arguments, which override values in the config (and reporting hooks)
+    """
     config_params = read_config_stream(args.config)
     config_params = parse_and_merge_overrides(config_params, overrides, pre='x')
     if args.basedir is not None:
@@ -135,6 +193,8 @@ def main():
         config_params['train']['fit_func'] = args.fit_func
     if args.backend:
         config_params['backend'] = normalize_backend(args.backend)
+    if args.distributed:
+        init_distributed_training(args, config_params)
 
     config_params['modules'] = list(chain(config_params.get('modules', []), args.modules))
 
@@ -0,0 +1,444 @@
+"""Microbenchmarks for the code around the models: vectorizers, readers, batching and the services.
+
+Everything runs on synthetic data that is generated on the fly, including the subword models, so nothing
+needs to be downloaded.  The timings are written to the same `speed` table that `run` uses, with the
+component as the `model`, the operation as the `phase` and `synthetic` as the `dataset`, so `report` and
+`regress` work on them too.
+"""
+import os
+import time
+import json
+import random
+import shutil
+import logging
+import tempfile
+import importlib
+from collections import Counter, namedtuple
+import baseline
+from baseline.utils import suppress_output
+from baseline.reader import create_reader
+from baseline.vectorizers import (
+    Token1DVectorizer,
+    Char2DVectorizer,
+    Dict1DVectorizer,
+    BPEVectorizer1D,
+    WordpieceVectorizer1D,
+    GPT2Vectorizer1D,
+    HasPredefinedVocab,
+    bytes_to_unicode,
+)
+from eight_mile.utils import Offsets
+from eight_mile.progress import create_progress_bar
+from speed_test.run import (
+    Version,
+    create_db,
+    save_data,
+    version_str_to_tuple,
+    get_framework_version,
+    get_cpu_info,
+    get_python_version,
+)
+
+logger = logging.getLogger('baseline')
+
+Benchmark = namedtuple('Benchmark', 'model phase framework fn number')
+BENCH_TASKS = ['vectorizer', 'reader', 'examples', 'service']
+BENCHMARKS = {}
+
+
+def register_benchmark(task):
+    """Register a function that yields the `Benchmark`s for part of the library.
+
+    The function is called with the `SyntheticCorpus` and the list of batch sizes.
+    """
+    def wrapper(fn):
+        BENCHMARKS.setdefault(task, []).append(fn)
+        return fn
+    return wrapper
+
+
+class SyntheticCorpus:
+    """Random sentences over a random vocab with a Zipfian distribution, along with the files the readers and
+    subword vectorizers need to use it.
+    """
+    def __init__(self, sentences=1000, vocab_size=2000, min_len=5, max_len=40, seed=1234):
+        rng = random.Random(seed)
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        words = set()
+        while len(words) < vocab_size:
+            words.add(''.join(rng.choice(letters) for _ in range(rng.randint(2, 10))))
+        self.words = sorted(words)
+        rng.shuffle(self.words)
+        weights = [1.0 / (i + 1) for i in range(len(self.words))]
+        self.sentences = [rng.choices(self.words, weights, k=rng.randint(min_len, max_len)) for _ in range(sentences)]
+        self.labels = ['neg', 'neu', 'pos']
+        self.tags = ['O', 'B-X', 'I-X', 'B-Y', 'I-Y']
+        self.rels = ['nsubj', 'obj', 'amod', 'det', 'punct']
+        self.y = [rng.choice(self.labels) for _ in self.sentences]
+        self.sentence_tags = [[rng.choice(self.tags) for _ in s] for s in self.sentences]
+        self.heads = [[0] + [rng.randint(1, i) for i in range(1, len(s))] for s in self.sentences]
+        self.sentence_rels = [['root'] + [rng.choice(self.rels) for _ in s[1:]] for s in self.sentences]
+        self.counts = Counter(w for s in self.sentences for w in s)
+        self.path = tempfile.mkdtemp(prefix='baseline-bench-')
+        self.files = self._write_files()
+
+    @property
+    def params(self):
+        return {
+            'sentences': len(self.sentences),
+            'vocab_size': len(self.words),
+            'tokens': sum(len(s) for s in self.sentences)
+        }
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, name, lines):
+        file_name = os.path.join(self.path, name)
+        with open(file_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return file_name
+
+    def _write_files(self):
+        files = {}
+        files['classify'] = self._write(
+            'classify.txt', ['{}\t{}'.format(y, ' '.join(s)) for y, s in zip(self.y, self.sentences)]
+        )
+        files['tagger'] = self._write('tagger.conll', [
+            '\n'.join('{} {}'.format(w, t) for w, t in zip(s, tags)) + '\n'
+            for s, tags in zip(self.sentences, self.sentence_tags)
+        ])
+        files['deps'] = self._write('deps.conll', [
+            '\n'.join(
+                '\t'.join([str(i + 1), w, '_', '_', '_', '_', str(h), r, '_', '_'])
+                for i, (w, h, r) in enumerate(zip(s, heads, rels))
+            ) + '\n'
+            for s, heads, rels in zip(self.sentences, self.heads, self.sentence_rels)
+        ])
+        files['lm'] = self._write('lm.txt', [' '.join(s) for s in self.sentences])
+        files['seq2seq'] = self._write('seq2seq.tsv', ['{}\t{}'.format(' '.join(s), ' '.join(s[::-1])) for s in self.sentences])
+        files.update(self._write_subword_files())
+        return files
+
+    def _merges(self, split):
+        """Merge the symbols of each of the common words together from left to right"""
+        merges = []
+        seen = set()
+        for word, _ in self.counts.most_common(len(self.counts) // 2):
+            symbols = split(word)
+            current = symbols[0]
+            for symbol in symbols[1:]:
+                if (current, symbol) not in seen:
+                    seen.add((current, symbol))
+                    merges.append((current, symbol))
+                current += symbol
+        return merges
+
+    def _write_subword_files(self):
+        files = {}
+        letters = sorted({c for w in self.words for c in w})
+        common = [w for w, _ in self.counts.most_common(len(self.counts) // 4)]
+        suffixes = sorted({w[-3:] for w in self.words} | {w[-2:] for w in self.words})
+        wordpiece = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + letters + ['##' + c for c in letters]
+        wordpiece += common + ['##' + s for s in suffixes]
+        files['wordpiece_vocab'] = self._write('wordpiece-vocab.txt', wordpiece)
+
+        # GPT2 works on the byte encoded text, where a leading space is `Ġ`
+        byte_encoder = bytes_to_unicode()
+        space = byte_encoder[ord(' ')]
+        merges = self._merges(lambda word: [space] + list(word))
+        # The vectorizer sets the global `Offsets` from these, so they go at the usual indices
+        vocab = ['<pad>', '<s>', '</s>', '<unk>', '<|endoftext|>'] + sorted(set(byte_encoder.values()))
+        vocab += [a + b for a, b in merges]
+        vocab = {t: i for i, t in enumerate(dict.fromkeys(vocab))}
+        files['gpt2_vocab'] = self._write('gpt2-vocab.json', [json.dumps(vocab)])
+        files['gpt2_merges'] = self._write('gpt2-merges.txt', ['#version: 0.2'] + ['{} {}'.format(a, b) for a, b in merges])
+
+        # fastBPE marks the end of a word with `</w>` in the codes and the continued subwords with `@@`
+        merges = self._merges(lambda word: list(word[:-1]) + [word[-1] + '</w>'])
+        files['bpe_codes'] = self._write('bpe-codes.txt', [
+            '{} {} {}'.format(a, b, len(merges) - i) for i, (a, b) in enumerate(merges)
+        ])
+        subwords = Counter()
+        for word, count in self.counts.items():
+            subwords[word] += count
+        for c in letters:
+            subwords[c + '@@'] += 1
+            subwords[c] += 1
+        files['bpe_vocab'] = self._write('bpe-vocab.txt', ['{} {}'.format(w, c) for w, c in subwords.most_common()])
+        return files
+
+
+def time_fn(fn, number=1, trials=5):
+    """Time `fn`, giving back the average time of a call for each trial.
+
+    `fn` is called once before we start the clock, so things like caches are warm.
+    """
+    fn()
+    times = []
+    for _ in range(trials):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def _batches(data, batchsz):
+    return [data[i:i + batchsz] for i in range(0, len(data), batchsz)]
+
+
+def _cycle(items):
+    """Give back a function that returns the next item each time it is called"""
+    state = {'i': 0}
+
+    def next_item():
+        item = items[state['i'] % len(items)]
+        state['i'] += 1
+        return item
+    return next_item
+
+
+def _vocab(counts):
+    vocab = {k: i for i, k in enumerate(Offsets.VALUES)}
+    for word in counts:
+        vocab.setdefault(word, len(vocab))
+    return vocab
+
+
+def _missing_module(modules):
+    """Get the first of these modules that can't be imported, or `None` if they all can"""
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            return module
+    return None
+
+
+def _vectorizers(corpus):
+    """Yield the name of each vectorizer, a function to build it, and the optional modules it needs"""
+    yield 'Token1DVectorizer', lambda: Token1DVectorizer(mxlen=-1), []
+    yield 'Char2DVectorizer', lambda: Char2DVectorizer(mxlen=-1, mxwlen=-1), []
+    yield 'BPEVectorizer1D', lambda: BPEVectorizer1D(
+        model_file=corpus.files['bpe_codes'], vocab_file=corpus.files['bpe_vocab'], mxlen=-1
+    ), ['fastBPE']
+    yield 'WordpieceVectorizer1D', lambda: WordpieceVectorizer1D(vocab_file=corpus.files['wordpiece_vocab'], mxlen=-1), []
+    # `baseline.vectorizers` only imports `regex` if it can, without it GPT2 fails with a `NameError`
+    yield 'GPT2Vectorizer1D', lambda: GPT2Vectorizer1D(
+        model_file=corpus.files['gpt2_merges'], vocab_file=corpus.files['gpt2_vocab'], mxlen=-1
+    ), ['regex']
+
+
+@register_benchmark('vectorizer')
+def vectorizer_benchmarks(corpus, batch_sizes):
+    """Time `count`, `run` and `run_batch` for a pass over the whole corpus"""
+    for name, create, requires in _vectorizers(corpus):
+        missing = _missing_module(requires)
+        if missing is not None:
+            logger.warning("Skipping %s: %s can't be imported", name, missing)
+            continue
+        try:
+            vectorizer = create()
+        except ImportError as e:
+            logger.warning("Skipping %s: %s", name, e)
+            continue
+        counts = Counter()
+        for sentence in corpus.sentences:
+            counts.update(vectorizer.count(sentence))
+        vocab = vectorizer.vocab if isinstance(vectorizer, HasPredefinedVocab) else _vocab(counts)
+
+        def count(vectorizer=vectorizer):
+            for sentence in corpus.sentences:
+                vectorizer.count(sentence)
+
+        def run(vectorizer=vectorizer, vocab=vocab):
+            for sentence in corpus.sentences:
+                vectorizer.run(sentence, vocab)
+
+        yield Benchmark(name, 'count', 'numpy', count, 1)
+        yield Benchmark(name, 'run', 'numpy', run, 1)
+        for batchsz in batch_sizes:
+            def run_batch(vectorizer=vectorizer, vocab=vocab, batches=_batches(corpus.sentences, batchsz)):
+                for batch in batches:
+                    vectorizer.run_batch(batch, vocab)
+            yield Benchmark(name, 'run_batch-{}'.format(batchsz), 'numpy', run_batch, 1)
+
+
+def _readers(corpus):
+    yield 'TSVSeqLabelReader', 'classify', {'word': Token1DVectorizer(mxlen=-1)}, {}, {}
+    yield 'CONLLSeqReader', 'tagger', {'word': Dict1DVectorizer(fields='text', mxlen=-1)}, {
+        'named_fields': {'0': 'text', '-1': 'y'}
+    }, {}
+    yield 'CONLLParserSeqReader', 'deps', {'word': Dict1DVectorizer(fields='text', mxlen=-1, emit_begin_tok='<GO>')}, {
+        'named_fields': {'1': 'text', '6': 'heads', '7': 'labels'},
+        'label_vectorizers': {
+            'heads': {'type': 'int-identity-dict1d', 'fields': 'heads', 'emit_begin_tok': 0},
+            'labels': {'type': 'dict1d', 'fields': 'labels', 'emit_begin_tok': '<PAD>'},
+        },
+    }, {}
+    yield 'LineSeqReader', 'lm', {'word': Token1DVectorizer(mxlen=-1)}, {'nctx': 35}, {'tgt_key': 'word'}
+    yield 'TSVParallelCorpusReader', 'seq2seq', {
+        'word': Token1DVectorizer(mxlen=-1), 'tgt': Token1DVectorizer(mxlen=-1)
+    }, {'type': 'tsv'}, {}
+
+
+@register_benchmark('reader')
+def reader_benchmarks(corpus, batch_sizes):
+    """Time `build_vocab` and `load` for the default reader of each task"""
+    for name, task, vectorizers, kwargs, load_kwargs in _readers(corpus):
+        reader = create_reader(task, vectorizers, False, **kwargs)
+        file_name = corpus.files[task]
+        if task == 'seq2seq':
+            def build_vocab(reader=reader, file_name=file_name):
+                return reader.build_vocabs([file_name])
+            src_vocabs, tgt_vocab = build_vocab()
+
+            def load(reader=reader, file_name=file_name, src_vocabs=src_vocabs, tgt_vocab=tgt_vocab):
+                reader.load(file_name, src_vocabs, tgt_vocab, batch_sizes[-1])
+        else:
+            def build_vocab(reader=reader, file_name=file_name):
+                return reader.build_vocab([file_name])
+            vocabs = build_vocab()
+            vocabs = vocabs[0] if task == 'classify' else vocabs
+
+            def load(reader=reader, file_name=file_name, vocabs=vocabs, load_kwargs=load_kwargs):
+                reader.load(file_name, vocabs, batch_sizes[-1], **load_kwargs)
+        yield Benchmark(name, 'build_vocab', 'numpy', build_vocab, 1)
+        yield Benchmark(name, 'load', 'numpy', load, 1)
+
+
+@register_benchmark('examples')
+def examples_benchmarks(corpus, batch_sizes):
+    """Time a pass of `DictExamples.batch` over the classifier data, with and without trimming"""
+    reader = create_reader('classify', {'word': Token1DVectorizer(mxlen=-1)}, False)
+    vocabs, _ = reader.build_vocab([corpus.files['classify']])
+    examples = reader.load(corpus.files['classify'], vocabs, batch_sizes[-1]).examples
+    for batchsz in batch_sizes:
+        steps = len(examples) // batchsz
+        for trim in (False, True):
+            def batch(batchsz=batchsz, steps=steps, trim=trim):
+                for i in range(steps):
+                    examples.batch(i, batchsz, trim=trim)
+            phase = 'batch-{}{}'.format(batchsz, '-trim' if trim else '')
+            yield Benchmark('DictExamples', phase, 'numpy', batch, 1)
+
+
+def _pytorch_services(corpus, dsz=100, hsz=100):
+    """Build each of the services around a small randomly initialized PyTorch model on the CPU"""
+    from eight_mile.embeddings import RandomInitVecModel
+    import baseline.pytorch.classify
+    import baseline.pytorch.tagger
+    import baseline.pytorch.deps
+    import baseline.pytorch.seq2seq
+    from baseline.pytorch.embeddings import LookupTableEmbeddingsModel
+    from baseline.model import create_model, create_tagger_model, create_model_for, create_seq2seq_model
+    from baseline.services import ClassifierService, TaggerService, DependencyParserService, EncoderDecoderService
+
+    wv = RandomInitVecModel(dsz, corpus.counts)
+    vocabs = {'word': wv.get_vocab()}
+
+    def embeddings(name='word'):
+        return {name: LookupTableEmbeddingsModel.create(wv, name)}
+
+    def labels(names):
+        return {k: i for i, k in enumerate(Offsets.VALUES[:Offsets.OFFSET] + names)}
+
+    with suppress_output():
+        model = create_model(embeddings(), corpus.labels, filtsz=[3, 4, 5], cmotsz=hsz, nogpu=True)
+        yield 'ClassifierService', ClassifierService(vocabs, {'word': Token1DVectorizer(mxlen=-1)}, model.eval())
+        model = create_tagger_model(
+            embeddings(), labels(corpus.tags), hsz=hsz, nogpu=True, lengths_key='word_lengths'
+        )
+        yield 'TaggerService', TaggerService(vocabs, {'word': Dict1DVectorizer(fields='text', mxlen=-1)}, model.eval())
+        model = create_model_for(
+            'deps', features=embeddings(), labels={'heads': {}, 'labels': labels(['root'] + corpus.rels)},
+            hsz=hsz, nogpu=True, lengths_key='word_lengths'
+        )
+        vectorizers = {'word': Dict1DVectorizer(fields='text', mxlen=-1, emit_begin_tok='<GO>')}
+        yield 'DependencyParserService', DependencyParserService(vocabs, vectorizers, model.eval())
+        model = create_seq2seq_model(
+            embeddings(), LookupTableEmbeddingsModel.create(wv, 'tgt'), hsz=hsz, gpu=False, src_lengths_key='word_lengths'
+        )
+        vectorizers = {'word': Token1DVectorizer(mxlen=-1), 'tgt': Token1DVectorizer(mxlen=-1)}
+        yield 'EncoderDecoderService', EncoderDecoderService(dict(vocabs, tgt=vocabs['word']), vectorizers, model.eval())
+
+
+@register_benchmark('service')
+def service_benchmarks(corpus, batch_sizes, calls=20):
+    """Time a call to `predict` for each batch size.  Each call gets the next batch of the corpus."""
+    try:
+        services = list(_pytorch_services(corpus))
+    except ImportError as e:
+        logger.warning("Skipping the services, they need PyTorch: %s", e)
+        return
+    for name, service in services:
+        for batchsz in batch_sizes:
+            next_batch = _cycle(_batches(corpus.sentences, batchsz))
+
+            def predict(service=service, next_batch=next_batch):
+                service.predict(next_batch())
+            yield Benchmark(name, 'predict-{}'.format(batchsz), 'pytorch', predict, calls)
+
+
+def get_system_info(framework):
+    """The benchmarks only use the CPU, so the GPU and CUDA information is left empty."""
+    si = {}
+    si['framework_version'] = get_framework_version(framework)
+    si['cuda'], si['cudnn'] = Version(0, 0, 0), Version(0, 0, 0)
+    si['gpu_name'], si['gpu_mem'] = 'none', 0
+    si['cpu_name'], si['cpu_mem'], si['cpu_cores'] = get_cpu_info()
+    si['python'] = get_python_version()
+    si['baseline'] = version_str_to_tuple(baseline.__version__)
+    return si
+
+
+def run_benchmarks(conn, tasks=BENCH_TASKS, batch_sizes=(1, 8, 32), trials=5, **kwargs):
+    """Run the benchmarks for `tasks` and save them to the speed database.
+
+    :param conn: A connection to the speed database
+    :param tasks: Which groups of benchmarks to run
+    :param batch_sizes: The batch sizes to use for `run_batch`, `DictExamples.batch` and `Service.predict`
+    :param trials: The number of timings to collect for each benchmark
+    :param kwargs: Passed to the `SyntheticCorpus`
+    :return: The number of benchmarks that were run
+    """
+    batch_sizes = sorted(batch_sizes)
+    corpus = SyntheticCorpus(**kwargs)
+    system_info = {}
+    count = 0
+    try:
+        for task in tasks:
+            benchmarks = [b for fn in BENCHMARKS[task] for b in fn(corpus, batch_sizes)]
+            pg = create_progress_bar(len(benchmarks))
+            for bench in benchmarks:
+                if bench.framework not in system_info:
+                    system_info[bench.framework] = get_system_info(bench.framework)
+                times = time_fn(bench.fn, bench.number, trials)
+                config = {
+                    'task': task,
+                    'backend': bench.framework,
+                    'dataset': 'synthetic',
+                    'model': {'model_type': bench.model},
+                    'bench': dict(corpus.params, number=bench.number),
+                }
+                speeds = [{'time': t, 'phase': bench.phase} for t in times]
+                save_data(conn, speeds, config, system_info[bench.framework])
+                count += 1
+                pg.update()
+            pg.done()
+    finally:
+        corpus.close()
+    return count
+
+
+def bench(args):
+    conn = create_db(args.db)
+    run_benchmarks(
+        conn,
+        tasks=args.tasks,
+        batch_sizes=args.batchsz,
+        trials=args.trials,
+        sentences=args.sentences,
+        vocab_size=args.vocab_size,
+    )
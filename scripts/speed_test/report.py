@@ -350,6 +350,81 @@ def get_env(conn, task, dataset, framework, model, phase):
     return _env
 
 
+regression_query = '''
+SELECT
+    task, dataset, model, framework, phase, config, gpu_name, cpu_name,
+    baseline_major, baseline_minor, baseline_patch,
+    AVG(time) as mean,
+    SUM(time * time) as sq,
+    COUNT(time) as runs
+FROM speed GROUP BY
+    task, dataset, model, framework, phase, config, gpu_name, cpu_name,
+    baseline_major, baseline_minor, baseline_patch
+HAVING runs >= 2
+ORDER BY
+    task, dataset, model, framework, phase, config, gpu_name, cpu_name,
+    baseline_major, baseline_minor, baseline_patch;
+'''
+
+
+def get_regressions(conn, threshold=0.1):
+    """Compare the two most recent baseline versions of each setup and find the ones that got slower.
+
+    A setup is the same task, dataset, model, framework, phase and config on the same hardware.  It is a
+    regression when the mean time grew by more than `threshold` (as a fraction of the old mean) and by more
+    than the noise, which is the sum of the standard deviations of the two versions.
+
+    :param conn: A connection to the speed database
+    :param threshold: How much slower the new version has to be before it is flagged
+    :return: A list of `dict`s, one for each regression
+    """
+    versions = defaultdict(list)
+    for row in conn.execute(regression_query).fetchall():
+        key = row[:8]
+        mean, sq, runs = row[11:]
+        std = np.sqrt(max(sq - runs * mean * mean, 0) / (runs - 1))
+        versions[key].append((Version(*row[8:11]), mean, std))
+    regressions = []
+    for key, results in versions.items():
+        if len(results) < 2:
+            continue
+        (old, old_mean, old_std), (new, new_mean, new_std) = results[-2:]
+        diff = new_mean - old_mean
+        if diff > threshold * old_mean and diff > old_std + new_std:
+            regressions.append({
+                'task': key[0], 'dataset': key[1], 'model': key[2], 'framework': key[3], 'phase': key[4],
+                'old': str(old), 'new': str(new), 'old_mean': old_mean, 'new_mean': new_mean,
+                'change': diff / old_mean,
+            })
+    return regressions
+
+
+def regress(args):
+    if not os.path.exists(args.db):
+        print("Unable to find database `{}`".format(args.db))
+        return
+    conn = sqlite3.connect(args.db)
+    regressions = get_regressions(conn, args.threshold)
+    if not regressions:
+        print("No regressions found")
+        return
+    keys = ['task', 'dataset', 'model', 'framework', 'phase', 'old', 'new', 'old_mean', 'new_mean', 'change']
+    print(" ".join(" {:<10} ".format(k) for k in keys))
+    print(" ".join(" " + "-" * 10 + " " for _ in keys))
+    for r in regressions:
+        row = []
+        for k in keys:
+            if k == 'change':
+                row.append(" {:>+9.1%} ".format(r[k]))
+            elif isinstance(r[k], float):
+                row.append(" {:=10.5f} ".format(r[k]))
+            else:
+                row.append(" {:<10} ".format(r[k]))
+        print(" ".join(row))
+    # Exit with an error so this can gate a CI job
+    raise SystemExit(1)
+
+
 def create_table(out, task, table):
     dir_name = "images_{}".format(out)
     tmp = tempfile.mkdtemp()
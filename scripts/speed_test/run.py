@@ -187,6 +187,8 @@ def get_framework_version(framework):
     elif framework == "pytorch":
         import torch
         version = torch.__version__
+    elif framework == "numpy":
+        version = np.__version__
     return version_str_to_tuple(version)
 
 
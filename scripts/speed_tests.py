@@ -1,7 +1,8 @@
 import argparse
 from mead.utils import convert_path
 from speed_test.run import run, add
-from speed_test.report import report, query, explore
+from speed_test.report import report, query, explore, regress
+from speed_test.bench import bench, BENCH_TASKS
 
 
 def print_help(p):
@@ -51,6 +52,20 @@ def main():
     report_parser.add_argument('--db', default='speed.db')
     report_parser.add_argument('--out', default='speed_test')
 
+    bench_parser = subparsers.add_parser('bench', description='Run the microbenchmarks on synthetic data.')
+    bench_parser.set_defaults(func=bench)
+    bench_parser.add_argument('--tasks', default=BENCH_TASKS, nargs='+', choices=BENCH_TASKS)
+    bench_parser.add_argument('--batchsz', default=[1, 8, 32], nargs='+', type=int)
+    bench_parser.add_argument('--sentences', default=1000, type=int)
+    bench_parser.add_argument('--vocab_size', default=2000, type=int)
+    bench_parser.add_argument('--db', default='speed.db')
+    bench_parser.add_argument('--trials', default=5, type=int)
+
+    regress_parser = subparsers.add_parser('regress', description='Find the setups that got slower in the latest version.')
+    regress_parser.set_defaults(func=regress)
+    regress_parser.add_argument('--db', default='speed.db')
+    regress_parser.add_argument('--threshold', default=0.1, type=float)
+
     add_parser = subparsers.add_parser('add', description='Add a run to the database')
     add_parser.set_defaults(func=add)
     add_parser.add_argument('--config', required=True)
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import threading
+import pytest
+from baseline.services import Service, BatchingService
+
+
+class EchoService(Service):
+    """A service that returns the number of tokens in each example and records the size of each batch"""
+
+    def __init__(self, delay=0.0):
+        super().__init__()
+        self.delay = delay
+        self.batch_sizes = []
+
+    def predict(self, tokens, upper=False, **kwargs):
+        tokens_batch = self.batch_input(tokens)
+        self.batch_sizes.append(len(tokens_batch))
+        time.sleep(self.delay)
+        if any(t[0] == 'boom' for t in tokens_batch):
+            raise ValueError('boom')
+        return [(len(t), upper) for t in tokens_batch]
+
+
+def _predict_concurrently(service, inputs, **kwargs):
+    results = [None] * len(inputs)
+
+    def call(i):
+        results[i] = service.predict(inputs[i], **kwargs)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_results_go_back_to_each_caller():
+    echo = EchoService(delay=0.01)
+    service = BatchingService(echo, max_batchsz=8, max_wait=0.05)
+    inputs = [['a'] * (i + 1) for i in range(20)]
+    results = _predict_concurrently(service, inputs)
+    assert results == [[(i + 1, False)] for i in range(20)]
+    assert max(echo.batch_sizes) > 1
+    assert max(echo.batch_sizes) <= 8
+    assert service.stats['examples'] == 20
+    service.close()
+
+
+def test_multi_example_request():
+    service = BatchingService(EchoService(), max_batchsz=4)
+    assert service.predict([['a'], ['a', 'b'], ['a', 'b', 'c']]) == [(1, False), (2, False), (3, False)]
+    service.close()
+
+
+def test_different_kwargs_not_batched():
+    echo = EchoService(delay=0.01)
+    service = BatchingService(echo, max_batchsz=16, max_wait=0.05)
+    futures = [service.submit(['a'], upper=i % 2 == 0) for i in range(10)]
+    results = [future.result() for future in futures]
+    assert results == [[(1, i % 2 == 0)] for i in range(10)]
+    service.close()
+
+
+def test_errors_go_to_callers():
+    service = BatchingService(EchoService(), max_batchsz=4, max_wait=0.0)
+    with pytest.raises(ValueError):
+        service.predict(['boom'])
+    assert service.predict(['ok']) == [(1, False)]
+    service.close()
+
+
+def test_reporting_and_asyncio():
+    reports = []
+    service = BatchingService(EchoService(delay=0.01), max_batchsz=8, max_wait=0.05,
+                              reporting_fns=[lambda metrics, tick, phase, tick_type: reports.append(metrics)])
+
+    async def run():
+        return await asyncio.gather(*[service.apredict(['a'] * (i + 1)) for i in range(6)])
+
+    results = asyncio.run(run())
+    assert [r[0][0] for r in results] == list(range(1, 7))
+    service.close()
+    assert sum(report['batch_size'] for report in reports) == 6
+    assert all('queue_depth' in report for report in reports)
+
+
+def test_reporting_errors_do_not_stop_the_worker():
+    def report(metrics, tick, phase, tick_type):
+        raise ValueError('bad reporter')
+
+    service = BatchingService(EchoService(), max_batchsz=4, max_wait=0.0, reporting_fns=[report])
+    assert service.predict(['a']) == [(1, False)]
+    assert service.submit(['a', 'b']).result(timeout=5) == [(2, False)]
+    service.close()
+
+
+def test_bad_outputs_go_to_callers():
+    class ShortService(EchoService):
+        def predict(self, tokens, **kwargs):
+            return None
+
+    service = BatchingService(ShortService(), max_batchsz=4, max_wait=0.0)
+    with pytest.raises(TypeError):
+        service.submit(['a']).result(timeout=5)
+    service.close()
+
+
+def test_submit_after_close():
+    service = BatchingService(EchoService(), max_batchsz=4)
+    service.close()
+    with pytest.raises(Exception):
+        service.submit(['a'])
+    service.close()
@@ -107,3 +107,85 @@ def test_beam_lengths():
     paths = paths.squeeze()
     assert np.allclose(paths[0].numpy(), np.array(BEST_2_1ST))
     assert np.allclose(paths[1].numpy(), np.array(BEST_2_2ND))
+
+
+class MockShrinkingBeamSearch(BeamSearchBase):
+    """Each example has its own table of log probs indexed by the step and the last token and ends around its own length."""
+
+    can_shrink = True
+
+    def __init__(self, table, **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+        self.active_sizes = []
+
+    def init(self, encoder_outputs):
+        return repeat_batch(torch.arange(encoder_outputs.output.shape[0]), self.K)
+
+    def step(self, paths, examples):
+        self.active_sizes.append(paths.shape[0])
+        t = paths.shape[2] - 1
+        last = paths[:, :, -1].reshape(-1)
+        return self.table[examples, t, last], examples
+
+    def update(self, beams, examples):
+        return examples
+
+    def shrink(self, rows, examples):
+        return examples[rows]
+
+
+def _shrinking_table(ends, mxlen=12, vsz=6, only_at_end=False):
+    torch.manual_seed(1)
+    table = torch.randn(len(ends), mxlen, vsz, vsz)
+    for b, end in enumerate(ends):
+        table[b, end:, :, Offsets.EOS] += 10
+        if only_at_end:
+            table[b, :end, :, Offsets.EOS] -= 100
+    return torch.log_softmax(table, dim=-1)
+
+
+def _search(table, can_shrink=True, **kwargs):
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    encoder.output = torch.zeros(table.shape[0], 1)
+    search = MockShrinkingBeamSearch(table, beam=3, **kwargs)
+    search.can_shrink = can_shrink
+    return search, search(encoder, mxlen=table.shape[1])
+
+
+def test_beam_shrinking_matches_full_batch():
+    table = _shrinking_table([2, 9, 4, 6])
+    search, (paths, lengths, scores) = _search(table)
+    _, (gold_paths, gold_lengths, gold_scores) = _search(table, can_shrink=False)
+    np.testing.assert_equal(paths.numpy(), gold_paths.numpy())
+    np.testing.assert_equal(lengths.numpy(), gold_lengths.numpy())
+    np.testing.assert_allclose(scores.numpy(), gold_scores.numpy())
+    assert paths.shape[2] == lengths.max()
+    assert search.active_sizes[0] == 4
+    assert search.active_sizes[-1] < search.active_sizes[0]
+    assert search.active_sizes == sorted(search.active_sizes, reverse=True)
+
+
+def test_beam_shrinking_hits_mxlen():
+    table = _shrinking_table([2, 20], only_at_end=True)
+    _, (paths, lengths, scores) = _search(table)
+    _, (gold_paths, gold_lengths, gold_scores) = _search(table, can_shrink=False)
+    np.testing.assert_equal(paths.numpy(), gold_paths.numpy())
+    np.testing.assert_equal(lengths.numpy(), gold_lengths.numpy())
+    np.testing.assert_allclose(scores.numpy(), gold_scores.numpy())
+    assert (lengths[1] == table.shape[1]).all()
+    assert (paths[1, :, -1] == Offsets.EOS).all()
+
+
+def test_beam_early_stopping_keeps_the_best_path():
+    table = _shrinking_table([2, 9, 4, 6])
+    search, (paths, lengths, scores) = _search(table, early_stopping=True)
+    gold_search, (gold_paths, gold_lengths, gold_scores) = _search(table)
+    assert len(search.active_sizes) <= len(gold_search.active_sizes)
+    np.testing.assert_equal(lengths[:, 0].numpy(), gold_lengths[:, 0].numpy())
+    np.testing.assert_allclose(scores[:, 0].numpy(), gold_scores[:, 0].numpy())
+    for b in range(paths.shape[0]):
+        length = lengths[b, 0].item()
+        np.testing.assert_equal(paths[b, 0, :length].numpy(), gold_paths[b, 0, :length].numpy())
+        for k in range(paths.shape[1]):
+            assert paths[b, k, lengths[b, k] - 1] == Offsets.EOS
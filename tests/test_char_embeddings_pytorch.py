@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+from eight_mile.utils import Offsets
+from eight_mile.pytorch.embeddings import CharConvEmbeddings, CharLSTMEmbeddings, compose_unique_words
+
+B = 6
+T = 9
+W = 7
+VSZ = 12
+
+
+@pytest.fixture
+def chars():
+    # Draw the words from a small set so there are repeats, and pad the end of each sentence
+    words = torch.randint(1, VSZ, size=(5, W))
+    words[:, 4:] = Offsets.PAD
+    xch = words[torch.randint(0, 5, size=(B, T))]
+    for b in range(B):
+        xch[b, torch.randint(1, T, size=(1,)).item():] = Offsets.PAD
+    return xch
+
+
+@pytest.mark.parametrize("embed", [CharConvEmbeddings, CharLSTMEmbeddings])
+def test_unique_words_match(chars, embed):
+    torch.manual_seed(0)
+    model = embed(vsz=VSZ, dsz=8, wsz=10, lstmsz=10, pdrop=0.0).eval()
+    gold = model(chars)
+    model.unique_words = True
+    with torch.no_grad():
+        unique = model(chars)
+    assert unique.shape == gold.shape
+    torch.testing.assert_close(unique, gold.detach())
+
+
+def test_unique_words_only_composes_distinct_rows(chars):
+    seen = []
+
+    def compose(flat_chars):
+        seen.append(flat_chars.shape[0])
+        return flat_chars.float()
+
+    flat = chars.view(-1, W)
+    out = compose_unique_words(compose, flat, True)
+    assert seen == [len(torch.unique(flat, dim=0))]
+    assert seen[0] <= 6
+    torch.testing.assert_close(out, flat.float())
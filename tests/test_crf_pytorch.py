@@ -14,6 +14,7 @@ from eight_mile.pytorch.layers import (
     ViterbiLogSoftmaxNorm,
     transition_mask,
     script_viterbi,
+    script_viterbi_batch,
     ViterbiBatchSize1,
     vec_log_sum_exp,
 )
@@ -425,6 +426,29 @@ def test_viterbi_batch_stable(generate_examples_and_batch):
     np.testing.assert_allclose(one_x_one_p.detach().numpy(), batched_p.detach().numpy())
 
 
+def test_viterbi_batch_matches_batch_size_1(generate_batch):
+    unary, _, lengths = generate_batch
+    h = unary.size(2)
+    trans = torch.rand(h, h)
+    paths, scores = script_viterbi_batch(unary, trans.unsqueeze(0), lengths, Offsets.GO, Offsets.EOS)
+    for b, l in enumerate(lengths):
+        ps, ss = script_viterbi(unary[:l, b], trans, Offsets.GO, Offsets.EOS)
+        np.testing.assert_equal(paths[:l, b].numpy(), ps.numpy())
+        np.testing.assert_equal(paths[l:, b].numpy(), 0)
+        np.testing.assert_allclose(scores[b].item(), ss.item(), rtol=1e-6)
+
+
+def test_crf_scripts(generate_batch):
+    unary, _, lengths = generate_batch
+    crf = CRF(unary.size(2), batch_first=False)
+    crf.transitions_p.data.normal_()
+    scripted = torch.jit.script(crf.viterbi)
+    p1, s1 = crf.viterbi(unary, crf.transitions, lengths)
+    p2, s2 = scripted(unary, crf.transitions, lengths)
+    np.testing.assert_equal(p1.numpy(), p2.numpy())
+    np.testing.assert_allclose(s1.detach().numpy(), s2.detach().numpy())
+
+
 def test_viterbi_degenerates_to_argmax(generate_batch):
     scores, _, l = generate_batch
     h = scores.size(2)
@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+from baseline.data import DictExamples, Seq2SeqExamples, ExampleDataFeed, PrefetchDataFeed, bucket_batches
+
+
+def _examples(lengths, mxlen=20):
+    examples = []
+    for i, length in enumerate(lengths):
+        x = np.zeros(mxlen, dtype=np.int64)
+        x[:length] = np.arange(1, length + 1)
+        examples.append({'x': x, 'x_lengths': length, 'y': i})
+    return examples
+
+
+def test_bucket_batches_covers_every_example():
+    lengths = np.random.randint(1, 50, size=500)
+    batches = bucket_batches(lengths, max_tokens=256, num_buckets=5)
+    seen = np.sort(np.concatenate([indices for indices, _ in batches]))
+    np.testing.assert_equal(seen, np.arange(len(lengths)))
+    for indices, max_len in batches:
+        assert lengths[indices].max() <= max_len
+        assert len(indices) * max_len <= 256
+
+
+def test_bucket_batches_truncate_drops_partial():
+    lengths = [5] * 10
+    batches = bucket_batches(lengths, max_tokens=20, num_buckets=1, truncate=True)
+    assert len(batches) == 2
+    assert all(len(indices) == 4 for indices, _ in batches)
+
+
+def test_bucket_batches_long_example_gets_own_batch():
+    batches = bucket_batches([100], max_tokens=10)
+    assert len(batches) == 1
+    assert len(batches[0][0]) == 1
+
+
+def test_feed_trims_to_bucket():
+    lengths = np.random.randint(1, 20, size=100)
+    feed = ExampleDataFeed(DictExamples(_examples(lengths), do_shuffle=False), 10, shuffle=True, max_tokens=60, num_buckets=4)
+    seen = []
+    for batch in feed:
+        assert batch['x'].shape[1] >= batch['x_lengths'].max()
+        assert batch['x'].size <= 60
+        assert np.all(batch['x'][:, batch['x_lengths'].max():] == 0)
+        seen.extend(batch['y'].tolist())
+    assert sorted(seen) == list(range(100))
+    assert len(feed) == len(list(feed))
+
+
+def test_feed_reshuffles_each_epoch():
+    lengths = np.random.randint(1, 20, size=200)
+    feed = ExampleDataFeed(DictExamples(_examples(lengths), do_shuffle=False), 10, shuffle=True, max_tokens=60)
+    first = [batch['y'].tolist() for batch in feed]
+    second = [batch['y'].tolist() for batch in feed]
+    assert first != second
+
+
+def test_feed_needs_length_key():
+    examples = [{'x': np.zeros(3), 'y': 0}]
+    with pytest.raises(Exception):
+        ExampleDataFeed(DictExamples(examples, do_shuffle=False), 10, max_tokens=60)
+
+
+def test_seq2seq_feed_trims_target_to_batch():
+    examples = _examples(np.random.randint(1, 20, size=50))
+    for ex in examples:
+        ex['tgt_lengths'] = np.random.randint(1, 10)
+        ex['tgt'] = np.zeros(20, dtype=np.int64)
+        ex['tgt'][:ex['tgt_lengths']] = 1
+    feed = ExampleDataFeed(Seq2SeqExamples(examples, do_shuffle=False), 10, shuffle=False, max_tokens=80)
+    for batch in feed:
+        assert batch['tgt'].shape[1] == batch['tgt_lengths'].max()
+        assert batch['x'].size <= 80
+
+
+def test_prefetch_matches_feed_order():
+    lengths = np.random.randint(1, 20, size=100)
+    feed = ExampleDataFeed(DictExamples(_examples(lengths), do_shuffle=False), 8, shuffle=False)
+    gold = [batch['y'].tolist() for batch in feed]
+    prefetched = PrefetchDataFeed(feed, prefetch=3, num_workers=2)
+    assert len(prefetched) == len(feed)
+    assert [batch['y'].tolist() for batch in prefetched] == gold
+
+
+def test_prefetch_bucketed_reshuffles():
+    lengths = np.random.randint(1, 20, size=200)
+    feed = ExampleDataFeed(DictExamples(_examples(lengths), do_shuffle=False), 10, shuffle=True, max_tokens=60)
+    prefetched = PrefetchDataFeed(feed, prefetch=2, num_workers=2)
+    first = [batch['y'].tolist() for batch in prefetched]
+    second = [batch['y'].tolist() for batch in prefetched]
+    assert first != second
+    assert sorted(sum(first, [])) == list(range(200))
+
+
+def test_prefetch_transform_and_early_stop():
+    feed = ExampleDataFeed(DictExamples(_examples([3] * 50), do_shuffle=False), 5)
+    prefetched = PrefetchDataFeed(feed, prefetch=4, transform=lambda batch: {'n': len(batch['y'])})
+    for i, batch in enumerate(prefetched):
+        assert batch == {'n': 5}
+        if i == 2:
+            break
+
+
+def test_create_data_loader_prefetch_tensors():
+    torch = pytest.importorskip('torch')
+    from baseline.pytorch.torchy import create_data_loader
+    feed = ExampleDataFeed(DictExamples(_examples([3] * 20), do_shuffle=False), 5)
+    loader = create_data_loader(feed, prefetch=2)
+    assert isinstance(loader, PrefetchDataFeed)
+    assert create_data_loader(loader) is loader
+    for batch in loader:
+        assert isinstance(batch['x'], torch.Tensor)
+        assert batch['x'].shape == (5, 20)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_create_data_loader_rebuckets_each_epoch(num_workers):
+    pytest.importorskip('torch')
+    from baseline.pytorch.torchy import create_data_loader
+    lengths = np.random.randint(1, 20, size=200)
+    feed = ExampleDataFeed(DictExamples(_examples(lengths), do_shuffle=False), 10, shuffle=True, max_tokens=60)
+    loader = create_data_loader(feed, num_workers=num_workers, pin_memory=False)
+    first = [batch['y'].tolist() for batch in loader]
+    second = [batch['y'].tolist() for batch in loader]
+    assert first != second
+    assert sorted(sum(first, [])) == sorted(sum(second, [])) == list(range(200))
@@ -73,3 +73,188 @@ def test_rnn_attn_decode_shapes():
     assert output.shape[0] == batchsz
     assert output.shape[1] == temporal_output
     assert output.shape[2] == wv.get_vsz()
+
+
+def test_transformer_cached_decode_matches_full():
+    from baseline.pytorch.embeddings import LearnedPositionalLookupTableEmbeddingsModel
+    from baseline.pytorch.seq2seq.decoders import TransformerDecoderWrapper
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    batchsz = 2
+    temporal = 7
+    temporal_output = 5
+    hsz = 16
+    wv = RandomInitVecModel(
+        hsz, {k: 1 for k in list(string.ascii_letters)}
+    )
+    encoder.output = torch.randn(batchsz, temporal, hsz)
+    encoder.src_mask = torch.ones(batchsz, temporal, dtype=torch.long)
+    tgt_embed = LearnedPositionalLookupTableEmbeddingsModel.create(wv, 'output')
+    decoder = TransformerDecoderWrapper(tgt_embed, dropout=0.0, layers=2, hsz=hsz, num_heads=2)
+    decoder.eval()
+    dst = torch.randint(len(Offsets.VALUES), wv.get_vsz(), (batchsz, temporal_output))
+    with torch.no_grad():
+        gold = decoder(encoder, dst)
+        cache = decoder.transformer_decoder.init_cache()
+        for i in range(temporal_output):
+            step = decoder(encoder, dst[:, :i + 1], cache=cache)
+            assert step.shape[1] == 1
+            np.testing.assert_allclose(step[:, -1].numpy(), gold[:, i].numpy(), atol=1e-5)
+
+
+def test_transformer_beam_search_cache_matches_no_cache():
+    from baseline.pytorch.embeddings import LearnedPositionalLookupTableEmbeddingsModel
+    from baseline.pytorch.seq2seq.decoders import TransformerDecoderWrapper
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    batchsz = 3
+    temporal = 6
+    hsz = 16
+    wv = RandomInitVecModel(
+        hsz, {k: 1 for k in list(string.ascii_letters)}
+    )
+    encoder.output = torch.randn(batchsz, temporal, hsz)
+    encoder.src_mask = torch.ones(batchsz, temporal, dtype=torch.long)
+    tgt_embed = LearnedPositionalLookupTableEmbeddingsModel.create(wv, 'output')
+    decoder = TransformerDecoderWrapper(tgt_embed, dropout=0.0, layers=2, hsz=hsz, num_heads=2)
+    decoder.eval()
+    paths, lengths, scores = decoder.beam_search(encoder, beam=3, mxlen=8)
+    decoder.transformer_decoder.supports_kv_cache = False
+    gold_paths, gold_lengths, gold_scores = decoder.beam_search(encoder, beam=3, mxlen=8)
+    np.testing.assert_equal(paths.numpy(), gold_paths.numpy())
+    np.testing.assert_equal(lengths.numpy(), gold_lengths.numpy())
+    np.testing.assert_allclose(scores.numpy(), gold_scores.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("decoder_type", ["rnn", "transformer"])
+def test_beam_search_shrinking_matches_full_batch(decoder_type):
+    from baseline.pytorch.embeddings import LookupTableEmbeddingsModel, LearnedPositionalLookupTableEmbeddingsModel
+    from baseline.pytorch.seq2seq.decoders import RNNDecoderWithAttn, TransformerDecoderWrapper
+    torch.manual_seed(0)
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    batchsz = 6
+    temporal = 7
+    hsz = 16
+    layers = 2
+    wv = RandomInitVecModel(
+        hsz, {k: 1 for k in list(string.ascii_letters)}
+    )
+    # Make the examples end at different times
+    encoder.output = torch.randn(batchsz, temporal, hsz) * torch.linspace(0.1, 4, batchsz).view(-1, 1, 1)
+    encoder.src_mask = torch.ones(batchsz, temporal, dtype=torch.long)
+    encoder.hidden = (torch.randn(layers, batchsz, hsz), torch.randn(layers, batchsz, hsz))
+    if decoder_type == "rnn":
+        tgt_embed = LookupTableEmbeddingsModel.create(wv, 'output')
+        decoder = RNNDecoderWithAttn(tgt_embed, hsz=hsz, layers=layers, dropout=0.0, tie_weights=False)
+    else:
+        tgt_embed = LearnedPositionalLookupTableEmbeddingsModel.create(wv, 'output')
+        decoder = TransformerDecoderWrapper(tgt_embed, dropout=0.0, layers=layers, hsz=hsz, num_heads=2, tie_weights=False)
+    decoder.eval()
+    with torch.no_grad():
+        decoder.preds.bias[Offsets.EOS] += 1.0
+    paths, lengths, scores = decoder.beam_search(encoder, beam=3)
+    decoder.BeamSearch.can_shrink = False
+    try:
+        gold_paths, gold_lengths, gold_scores = decoder.beam_search(encoder, beam=3)
+    finally:
+        decoder.BeamSearch.can_shrink = True
+    assert len(set(lengths.max(1)[0].tolist())) > 1
+    np.testing.assert_equal(paths.numpy(), gold_paths.numpy())
+    np.testing.assert_equal(lengths.numpy(), gold_lengths.numpy())
+    np.testing.assert_allclose(scores.numpy(), gold_scores.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("rnntype", ["lstm", "gru"])
+@pytest.mark.parametrize("attn_type", [None, "dot", "general", "sdp", "bahdanau"])
+def test_rnn_decode_without_feed_input_matches_per_step(rnntype, attn_type):
+    from baseline.pytorch.embeddings import LookupTableEmbeddingsModel
+    from baseline.pytorch.seq2seq.decoders import RNNDecoder, RNNDecoderWithAttn
+    torch.manual_seed(0)
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    batchsz = 3
+    temporal = 7
+    temporal_output = 5
+    hsz = 12
+    layers = 2
+    wv = RandomInitVecModel(
+        hsz, {k: 1 for k in list(string.ascii_letters)}
+    )
+    encoder.output = torch.randn(batchsz, temporal, hsz)
+    encoder.src_mask = torch.ones(batchsz, temporal, dtype=torch.long)
+    encoder.src_mask[0, 4:] = 0
+    hidden = torch.randn(layers, batchsz, hsz)
+    encoder.hidden = (hidden, torch.randn(layers, batchsz, hsz)) if rnntype == "lstm" else hidden
+    tgt_embed = LookupTableEmbeddingsModel.create(wv, 'output')
+    kwargs = dict(hsz=hsz, layers=layers, rnntype=rnntype, dropout=0.0, feed_input=False, tie_weights=False)
+    if attn_type is None:
+        decoder = RNNDecoder(tgt_embed, **kwargs)
+    else:
+        decoder = RNNDecoderWithAttn(tgt_embed, attn_type=attn_type, **kwargs)
+    dst = torch.randint(len(Offsets.VALUES), wv.get_vsz(), (batchsz, temporal_output))
+
+    output = decoder(encoder, dst)
+    output.sum().backward()
+    grads = [p.grad.clone() for p in decoder.parameters()]
+    decoder.zero_grad()
+    # Take the per-step loop, the inputs are still the plain embeddings
+    decoder.feed_input = True
+    gold = decoder(encoder, dst)
+    gold.sum().backward()
+    np.testing.assert_allclose(output.detach().numpy(), gold.detach().numpy(), atol=1e-5)
+    for grad, p in zip(grads, decoder.parameters()):
+        np.testing.assert_allclose(grad.numpy(), p.grad.numpy(), atol=1e-5)
+
+
+@pytest.mark.parametrize("rnntype", ["lstm", "gru"])
+def test_forward_sequence_shares_the_cell_weights(rnntype):
+    from eight_mile.pytorch.layers import StackedLSTMCell, StackedGRUCell
+    torch.manual_seed(0)
+    Stacked = StackedLSTMCell if rnntype == "lstm" else StackedGRUCell
+    stack = Stacked(2, 6, 8, 0.0)
+    keys = list(stack.state_dict().keys())
+
+    def hidden(dtype=torch.float32):
+        h = torch.randn(2, 3, 8, dtype=dtype)
+        return (h, torch.randn(2, 3, 8, dtype=dtype)) if rnntype == "lstm" else h
+
+    def per_step(x, h):
+        outputs = []
+        for x_t in x:
+            output, h = stack(x_t, h)
+            outputs.append(output)
+        return torch.stack(outputs)
+
+    x = torch.randn(4, 3, 6)
+    h = hidden()
+    stack.forward_sequence(x, h)
+    assert list(stack.state_dict().keys()) == keys
+    assert len(list(stack.parameters())) == len(keys)
+    # The fused RNN should see updates to (and replacements of) the cell weights
+    with torch.no_grad():
+        stack.layers[0].weight_ih.mul_(2)
+    stack.double()
+    x, h = x.double(), hidden(torch.float64)
+    output, _ = stack.forward_sequence(x, h)
+    np.testing.assert_allclose(output.detach().numpy(), per_step(x, h).detach().numpy(), atol=1e-6)
+
+
+@pytest.mark.parametrize("rnntype", ["lstm", "gru"])
+def test_forward_sequence_steps_on_data_parallel_replicas(rnntype):
+    from eight_mile.pytorch.layers import StackedLSTMCell, StackedGRUCell
+    torch.manual_seed(0)
+    Stacked = StackedLSTMCell if rnntype == "lstm" else StackedGRUCell
+    stack = Stacked(2, 6, 8, 0.0)
+    x = torch.randn(4, 3, 6)
+    h = torch.randn(2, 3, 8)
+    h = (h, torch.randn(2, 3, 8)) if rnntype == "lstm" else h
+    gold, gold_hidden = stack.forward_sequence(x, h)
+    fused = stack.__dict__['_fused_rnn']
+    # A replica shares the `__dict__` of its module, it shouldn't touch the fused RNN that came with it
+    replica = stack._replicate_for_data_parallel()
+    replica.__dict__['_fused_rnn'] = None
+    output, hidden = replica.forward_sequence(x, h)
+    assert replica.__dict__['_fused_rnn'] is None
+    assert stack.__dict__['_fused_rnn'] is fused
+    np.testing.assert_allclose(output.detach().numpy(), gold.detach().numpy(), atol=1e-6)
+    if rnntype == "gru":
+        hidden, gold_hidden = [hidden], [gold_hidden]
+    for a, b in zip(hidden, gold_hidden):
+        np.testing.assert_allclose(a.detach().numpy(), b.detach().numpy(), atol=1e-6)
@@ -0,0 +1,118 @@
+import itertools
+import numpy as np
+import pytest
+from eight_mile.utils import mst_decode
+torch = pytest.importorskip('torch')
+from eight_mile.pytorch.layers import BilinearAttention
+from eight_mile.pytorch.embeddings import LookupTableEmbeddings
+from baseline.pytorch.deps.model import BiAffineDependencyParser, decode_results
+
+
+def _is_tree(heads):
+    for i in range(1, len(heads)):
+        seen = set()
+        j = i
+        while j != 0:
+            if j in seen:
+                return False
+            seen.add(j)
+            j = heads[j]
+    return True
+
+
+def _tree_score(scores, heads):
+    return sum(scores[i, heads[i]] for i in range(1, len(heads)))
+
+
+def _brute_force_mst(scores):
+    T = len(scores)
+    best, best_heads = -np.inf, None
+    for heads in itertools.product(range(T), repeat=T - 1):
+        heads = (0,) + heads
+        if any(heads[i] == i for i in range(1, T)) or not _is_tree(heads):
+            continue
+        score = _tree_score(scores, heads)
+        if score > best:
+            best, best_heads = score, heads
+    return best
+
+
+def test_mst_matches_brute_force():
+    rng = np.random.RandomState(11)
+    for _ in range(100):
+        T = rng.randint(2, 7)
+        scores = rng.randn(T, T)
+        heads = mst_decode(scores[np.newaxis])[0]
+        assert _is_tree(heads)
+        np.testing.assert_allclose(_tree_score(scores, heads), _brute_force_mst(scores))
+
+
+def test_mst_keeps_greedy_tree_and_ignores_padding():
+    T = 6
+    gold = np.array([0, 2, 0, 2, 3, 3])
+    scores = np.random.RandomState(2).rand(2, T, T)
+    scores[0, np.arange(T), gold] += 10
+    # The second sentence is only 4 long, the rest is padding with huge scores
+    scores[1, :, 5] = 100
+    heads = mst_decode(scores, np.array([T, 4]))
+    np.testing.assert_equal(heads[0], gold)
+    assert _is_tree(heads[1, :4])
+    assert (heads[1, :4] < 4).all()
+    np.testing.assert_equal(heads[1, 4:], 0)
+
+
+def test_score_pairs_matches_full_scores():
+    B, T, H, L = 3, 5, 4, 7
+    attn = BilinearAttention(H, L, True, True)
+    torch.nn.init.normal_(attn.weight)
+    x = torch.randn(B, T, H)
+    y = torch.randn(B, T, H)
+    full = attn(x, y, torch.ones(B, 1, T)).permute(0, 2, 3, 1)
+    heads = torch.randint(0, T, (B, T))
+    selected = y.gather(1, heads.unsqueeze(-1).expand(-1, -1, H))
+    pairs = attn.score_pairs(x, selected)
+    expected = full[torch.arange(B).unsqueeze(-1), torch.arange(T), heads]
+    np.testing.assert_allclose(pairs.detach().numpy(), expected.detach().numpy(), rtol=1e-5, atol=1e-5)
+
+
+def _parser(**kwargs):
+    embeddings = {'word': LookupTableEmbeddings(vsz=20, dsz=8)}
+    labels = {'labels': {'<PAD>': 0, 'root': 1, 'nsubj': 2, 'obj': 3, 'punct': 4}}
+    model = BiAffineDependencyParser.create(embeddings, labels, lengths_key='word_lengths', hsz=8, layers=1,
+                                            hsz_arcs=6, hsz_rels=5, **kwargs)
+    torch.nn.init.normal_(model.rel_attn.weight)
+    torch.nn.init.normal_(model.arc_attn.weight)
+    return model.eval()
+
+
+def _example():
+    lengths = torch.tensor([6, 4, 3])
+    words = torch.randint(1, 20, (3, 6))
+    words[1, 4:] = 0
+    words[2, 3:] = 0
+    return {'word': words, 'lengths': lengths}
+
+
+def test_decode_matches_full_label_tensor():
+    torch.manual_seed(5)
+    model = _parser()
+    example = _example()
+    with torch.no_grad():
+        heads, labels = model.decode(example)
+        gold_heads, gold_labels = decode_results(*model(example))
+    np.testing.assert_equal(heads.numpy(), gold_heads.numpy())
+    np.testing.assert_equal(labels.numpy(), gold_labels.numpy())
+
+
+def test_decode_mst_gives_trees():
+    torch.manual_seed(5)
+    model = _parser(decoder_type='mst')
+    example = _example()
+    with torch.no_grad():
+        heads, labels = model.decode(example)
+        greedy_heads, _ = model.decode(example, decoder_type='greedy')
+    assert heads.shape == labels.shape == greedy_heads.shape
+    for h, length in zip(heads.numpy(), example['lengths'].numpy()):
+        assert _is_tree(h[:length])
+    with pytest.raises(Exception):
+        model.decode(example, decoder_type='beam')
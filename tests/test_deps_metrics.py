@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from eight_mile.utils import Offsets
+from eight_mile.metrics import LAS, UAS, LCM, UCM
+
+
+def _reference(heads_pred, heads_gold, labels_pred, labels_gold):
+    las = uas = tokens = lcm = ucm = 0
+    for h_p, h_g, l_p, l_g in zip(heads_pred, heads_gold, labels_pred, labels_gold):
+        valid = l_g != Offsets.PAD
+        heads_ok = h_p[valid] == h_g[valid]
+        both_ok = heads_ok & (l_p[valid] == l_g[valid])
+        tokens += valid.sum()
+        uas += heads_ok.sum()
+        las += both_ok.sum()
+        ucm += heads_ok.all()
+        lcm += both_ok.all()
+    B = len(heads_gold)
+    return {'las': las / tokens, 'uas': uas / tokens, 'lcm': lcm / B, 'ucm': ucm / B}
+
+
+def _batch(B=16, T=9, seed=0):
+    rng = np.random.RandomState(seed)
+    heads_gold = rng.randint(0, T, (B, T))
+    labels_gold = rng.randint(1, 4, (B, T))
+    lengths = rng.randint(1, T + 1, B)
+    labels_gold[np.arange(T)[np.newaxis] >= lengths[:, np.newaxis]] = Offsets.PAD
+    heads_pred = np.where(rng.rand(B, T) < 0.9, heads_gold, rng.randint(0, T, (B, T)))
+    labels_pred = np.where(rng.rand(B, T) < 0.9, labels_gold, rng.randint(1, 4, (B, T)))
+    return heads_pred, heads_gold, labels_pred, labels_gold
+
+
+def _scores(batch, per_sentence=False):
+    metrics = [LAS(), UAS(), LCM(), UCM()]
+    for m in metrics:
+        if per_sentence:
+            for sentence in zip(*batch):
+                m.add(*sentence)
+        else:
+            m.add(*batch)
+    return {m.name: m.score for m in metrics}
+
+
+def test_batched_metrics_match_reference():
+    batch = _batch()
+    expected = _reference(*batch)
+    for per_sentence in (False, True):
+        scores = _scores(batch, per_sentence)
+        assert set(scores) == set(expected)
+        for name, score in expected.items():
+            np.testing.assert_allclose(scores[name], score)
+
+
+def test_batched_metrics_on_tensors():
+    torch = pytest.importorskip('torch')
+    batch = _batch(seed=3)
+    expected = _scores(batch)
+    scores = _scores([torch.from_numpy(x) for x in batch])
+    assert scores == expected
@@ -120,6 +120,36 @@ def test_mmap_w2v():
     np.testing.assert_allclose(wv_file.weights, wv_mmap.weights)
 
 
+@pytest.mark.parametrize("source", [GLOVE_FILE, W2V_FILE])
+def test_index_matches_file(source, tmp_path):
+    import shutil
+
+    filename = str(tmp_path / os.path.basename(source))
+    shutil.copy(source, filename)
+    wv_file = PretrainedEmbeddingsModel(filename, keep_unused=True)
+    wv_index = PretrainedEmbeddingsModel(filename, keep_unused=True, use_index=True)
+    assert wv_file.vocab == wv_index.vocab
+    np.testing.assert_allclose(wv_file.weights[Offsets.OFFSET :], wv_index.weights[Offsets.OFFSET :])
+    assert wv_index.weights.dtype == np.float32
+
+
+@pytest.mark.parametrize("source", [GLOVE_FILE, W2V_FILE])
+def test_index_known_vocab(source, tmp_path):
+    import shutil
+
+    filename = str(tmp_path / os.path.basename(source))
+    shutil.copy(source, filename)
+    words = [w for w in PretrainedEmbeddingsModel(filename, keep_unused=True).vocab if w not in Offsets.VALUES]
+    known_vocab = {w: 1 for w in random.sample(words, 10)}
+    known_vocab["AAAAAAAAAAAA"] = 1
+    wv_file = PretrainedEmbeddingsModel(filename, known_vocab=dict(known_vocab))
+    write_embeddings_index(filename)
+    wv_index = PretrainedEmbeddingsModel(filename, known_vocab=dict(known_vocab), use_index=True)
+    assert wv_file.vocab == wv_index.vocab
+    found = [wv_file.vocab[w] for w in known_vocab if w != "AAAAAAAAAAAA"]
+    np.testing.assert_allclose(wv_file.weights[found], wv_index.weights[found])
+
+
 def test_normalize_e2e():
     wv = random_model()(normalize=True, keep_unused=True)
     norms = np.sqrt(np.sum(np.square(wv.weights), 1))
@@ -210,3 +240,33 @@ def test_rand_counts():
     gold = {"C", "D"}
     for g in gold:
         assert g in wv.vocab
+
+
+def _write_word2vec(filename, words, dsz=3):
+    vectors = np.random.uniform(-1, 1, (len(words), dsz)).astype(np.float32)
+    with open(filename, "wb") as f:
+        f.write("{} {}\n".format(len(words), dsz).encode("utf-8"))
+        for word, vec in zip(words, vectors):
+            f.write(word.encode("utf-8") + b" " + vec.tobytes() + b"\n")
+    return vectors
+
+
+def test_index_keeps_carriage_returns(tmp_path):
+    filename = str(tmp_path / "cr.bin")
+    words = ["a\rb", "c", "d\r", "e"]
+    _write_word2vec(filename, words)
+    wv_file = PretrainedEmbeddingsModel(filename, keep_unused=True)
+    wv_index = PretrainedEmbeddingsModel(filename, keep_unused=True, use_index=True)
+    assert wv_index.vocab == wv_file.vocab
+    assert all(w in wv_index.vocab for w in words)
+    np.testing.assert_allclose(wv_file.weights, wv_index.weights)
+
+
+def test_index_is_rebuilt_when_the_file_changes(tmp_path):
+    filename = str(tmp_path / "vectors.bin")
+    _write_word2vec(filename, ["a", "b", "c"])
+    write_embeddings_index(filename)
+    vectors = _write_word2vec(filename, ["x", "y", "z", "w"])
+    wv_index = PretrainedEmbeddingsModel(filename, keep_unused=True, use_index=True)
+    assert [w for w in wv_index.vocab if w not in Offsets.VALUES] == ["x", "y", "z", "w"]
+    np.testing.assert_allclose(wv_index.weights[Offsets.OFFSET :], vectors)
@@ -0,0 +1,121 @@
+import pytest
+import numpy as np
+from types import SimpleNamespace
+from mock import patch
+from baseline.vectorizers import Token1DVectorizer, Dict1DVectorizer
+from baseline.services import (
+    ONNXClassifierService,
+    ONNXTaggerService,
+    ONNXDependencyParserService,
+    create_onnx_session,
+    has_dynamic_batch,
+)
+
+VOCAB = {'<PAD>': 0, '<UNK>': 1, 'the': 2, 'dog': 3, 'barked': 4, 'a': 5, 'cat': 6}
+LABELS = ['<PAD>', 'x', 'y', 'z']
+BATCH = [['the', 'dog', 'barked'], ['a', 'cat'], ['the', 'cat', 'dog', 'barked'], ['dog']]
+
+
+class FakeSession:
+    """Stands in for an `onnxruntime.InferenceSession`, `fn` maps the batch dict to the list of outputs"""
+
+    def __init__(self, fn, batch_dim='batch', input_names=('word', 'lengths')):
+        self.fn = fn
+        self.inputs = [SimpleNamespace(name=name, shape=[batch_dim, 'sequence']) for name in input_names]
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        return self.inputs
+
+    def run(self, output_names, feed):
+        self.batch_sizes.append(len(feed['word']))
+        return self.fn(feed)
+
+
+def _classify(feed):
+    scores = np.stack([np.bincount(row % len(LABELS), minlength=len(LABELS)) for row in feed['word']])
+    return [scores.astype(np.float32)]
+
+
+def _tag(feed):
+    return [feed['word'] % len(LABELS)]
+
+
+def _parse(feed):
+    words = feed['word']
+    B, T = words.shape
+    # Everything attaches to the previous token, the label is the word id
+    arcs = np.zeros((B, T, T), dtype=np.float32)
+    arcs[:, np.arange(1, T), np.arange(T - 1)] = 1
+    labels = np.zeros((B, T, T, len(LABELS)), dtype=np.float32)
+    for b in range(B):
+        for t in range(T):
+            labels[b, t, :, words[b, t] % len(LABELS)] = 1
+    return [arcs, labels]
+
+
+def _label(word):
+    label = LABELS[VOCAB[word] % len(LABELS)]
+    return 'O' if label == '<PAD>' else label
+
+
+def _service(cls, fn, batch_dim, **kwargs):
+    session = FakeSession(fn, batch_dim)
+    # The classifier takes plain tokens and a list of labels, the others take dicts and a label to index dict
+    if cls is ONNXClassifierService:
+        vectorizers = {'word': Token1DVectorizer(mxlen=-1)}
+        labels = LABELS
+    else:
+        vectorizers = {'word': Dict1DVectorizer(mxlen=-1, fields='text', **kwargs)}
+        labels = {label: i for i, label in enumerate(LABELS)}
+    return cls({'word': VOCAB}, vectorizers, session, labels), session
+
+
+@pytest.mark.parametrize("cls, fn", [(ONNXClassifierService, _classify), (ONNXTaggerService, _tag)])
+def test_onnx_service_runs_once_per_batch(cls, fn):
+    batched, batched_session = _service(cls, fn, 'batch')
+    single, single_session = _service(cls, fn, 1)
+    assert batched.batchable and not single.batchable
+    assert batched.predict(BATCH) == single.predict(BATCH)
+    assert batched_session.batch_sizes == [len(BATCH)]
+    assert single_session.batch_sizes == [1] * len(BATCH)
+
+
+def test_onnx_tagger_output():
+    tagger, _ = _service(ONNXTaggerService, _tag, 'batch')
+    outputs = tagger.predict(BATCH)
+    for tokens, output in zip(BATCH, outputs):
+        assert [t['text'] for t in output] == tokens
+        assert [t['label'] for t in output] == [_label(w) for w in tokens]
+
+
+def test_onnx_parser_output():
+    # The root is prepended by the vectorizer
+    parser, session = _service(ONNXDependencyParserService, _parse, 'batch', emit_begin_tok=['<GO>'])
+    single, _ = _service(ONNXDependencyParserService, _parse, 1, emit_begin_tok=['<GO>'])
+    outputs = parser.predict(BATCH)
+    assert session.batch_sizes == [len(BATCH)]
+    assert outputs == single.predict(BATCH)
+    for tokens, output in zip(BATCH, outputs):
+        assert [t['text'] for t in output] == tokens
+        assert [t['head'] for t in output] == list(range(len(tokens)))
+        assert [t['label'] for t in output] == [LABELS[VOCAB[w] % len(LABELS)] for w in tokens]
+
+
+def test_has_dynamic_batch():
+    assert has_dynamic_batch(FakeSession(_tag, 'batch'))
+    assert not has_dynamic_batch(FakeSession(_tag, 1))
+
+
+def test_create_onnx_session_options():
+    ort = pytest.importorskip('onnxruntime')
+    with patch.object(ort, 'InferenceSession') as session:
+        create_onnx_session('model.onnx', intra_op_threads=2, inter_op_threads=3,
+                            graph_optimization_level='basic', execution_mode='parallel')
+        options = session.call_args[1]['sess_options']
+        assert options.intra_op_num_threads == 2
+        assert options.inter_op_num_threads == 3
+        assert options.graph_optimization_level == ort.GraphOptimizationLevel.ORT_ENABLE_BASIC
+        assert options.execution_mode == ort.ExecutionMode.ORT_PARALLEL
+    with pytest.raises(Exception):
+        create_onnx_session('model.onnx', graph_optimization_level='fastest')
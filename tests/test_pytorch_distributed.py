@@ -0,0 +1,217 @@
+import os
+import random
+import pytest
+import numpy as np
+torch = pytest.importorskip('torch')
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from baseline.data import DataFeed
+from baseline.pytorch.torchy import EpochDistributedSampler, create_data_loader, distributed_rank
+from baseline.pytorch.classify.train import ClassifyTrainerPyTorch
+from baseline.pytorch.deps.train import DependencyParserTrainerPyTorch
+
+LABELS = ['a', 'b', 'c']
+
+
+class _Feed(DataFeed):
+
+    def __init__(self, steps=7, shuffle=False):
+        super().__init__()
+        self.steps = steps
+        self.shuffle = shuffle
+        rng = np.random.RandomState(1)
+        self.batches = [{'x': rng.randn(4, 4).astype(np.float32), 'y': rng.randint(0, len(LABELS), 4), 'i': i}
+                        for i in range(steps)]
+
+    def _batch(self, i):
+        return self.batches[i]
+
+
+class _Classifier(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.gpu = False
+        self.labels = LABELS
+        self.proj = torch.nn.Linear(4, len(LABELS))
+
+    def create_loss(self):
+        return torch.nn.CrossEntropyLoss()
+
+    def make_input(self, batch_dict):
+        return {'x': batch_dict['x'], 'y': batch_dict['y']}
+
+    def forward(self, example):
+        return self.proj(example['x'])
+
+    def save(self, outname):
+        torch.save(self.state_dict(), outname)
+
+
+class _DepsFeed(DataFeed):
+
+    def __init__(self, steps=5):
+        super().__init__()
+        self.steps = steps
+        self.shuffle = False
+        rng = np.random.RandomState(1)
+        self.batches = [{'x': rng.randn(4, 6, 4).astype(np.float32), 'heads': rng.randint(1, 6, (4, 6)),
+                         'labels': rng.randint(1, len(LABELS), (4, 6)), 'i': i}
+                        for i in range(steps)]
+
+    def _batch(self, i):
+        return self.batches[i]
+
+
+class _Parser(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.gpu = False
+        self.labels = LABELS
+        self.punct = 1
+        self.arcs = torch.nn.Linear(4, 4)
+        self.proj = torch.nn.Linear(4, len(LABELS))
+
+    def create_loss(self):
+        def loss(heads_pred, heads_gold, labels_pred, labels_gold):
+            ce = torch.nn.functional.cross_entropy
+            return ce(heads_pred.reshape(-1, heads_pred.shape[-1]), heads_gold.reshape(-1)) + \
+                ce(labels_pred.reshape(-1, len(LABELS)), labels_gold.reshape(-1))
+        return loss
+
+    def make_input(self, batch_dict):
+        return {k: torch.as_tensor(batch_dict[k]) for k in ('x', 'heads', 'labels')}
+
+    def forward(self, example):
+        x = example['x']
+        return torch.bmm(self.arcs(x), x.transpose(1, 2)), self.proj(x)
+
+    def decode(self, example):
+        heads_pred, labels_pred = self(example)
+        return heads_pred.argmax(-1), labels_pred.argmax(-1)
+
+    def save(self, outname):
+        torch.save(self.state_dict(), outname)
+
+
+def test_sampler_gives_contiguous_shards_without_shuffle():
+    feed = _Feed(steps=7)
+    shards = [list(EpochDistributedSampler(feed, num_replicas=2, rank=r, shuffle=False)) for r in range(2)]
+    assert shards[0] == [0, 1, 2, 3]
+    # The last worker is padded so everyone takes the same number of steps
+    assert shards[1] == [4, 5, 6, 0]
+
+
+def test_sampler_reshuffles_every_epoch():
+    feed = _Feed(steps=50)
+    sampler = EpochDistributedSampler(feed, num_replicas=2, rank=0, shuffle=True)
+    first = list(sampler)
+    second = list(sampler)
+    assert len(first) == len(second) == 25
+    assert first != second
+
+
+def _train_worker(rank, world_size, port, outdir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    trainer = ClassifyTrainerPyTorch(_Classifier(), optim='sgd', lr=0.1, gpus=0, distributed=True)
+    loader = create_data_loader(_Feed(), distributed=True)
+    seen = [int(batch['i']) for batch in loader]
+    trainer._train(loader)
+    trainer.save(os.path.join(outdir, 'model-{}'.format(rank)))
+    params = torch.cat([p.detach().reshape(-1) for p in trainer._get_pytorch_model().parameters()])
+    np.save(os.path.join(outdir, 'params-{}.npy'.format(rank)), params.numpy())
+    np.save(os.path.join(outdir, 'seen-{}.npy'.format(rank)), np.array(seen))
+    assert distributed_rank() == rank
+    dist.destroy_process_group()
+
+
+def test_ddp_classify_trainer_on_cpu(tmpdir):
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+    outdir = str(tmpdir)
+    mp.spawn(_train_worker, args=(2, random.randint(20000, 40000), outdir), nprocs=2)
+    # DDP keeps the weights the same on every worker, even though they started from different seeds
+    np.testing.assert_allclose(np.load(os.path.join(outdir, 'params-0.npy')),
+                               np.load(os.path.join(outdir, 'params-1.npy')))
+    seen = [set(np.load(os.path.join(outdir, 'seen-{}.npy'.format(r)))) for r in range(2)]
+    assert seen[0] | seen[1] == set(range(7))
+    # Only the first worker saves
+    assert os.path.exists(os.path.join(outdir, 'model-0'))
+    assert not os.path.exists(os.path.join(outdir, 'model-1'))
+
+
+def _deps_worker(rank, world_size, port, outdir):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    trainer = DependencyParserTrainerPyTorch(_Parser(), optim='sgd', lr=0.1, gpus=0, distributed=True)
+    trainer._train(create_data_loader(_DepsFeed(), distributed=True))
+    # Validation runs on every worker, through the wrapped model
+    metrics = trainer._test(create_data_loader(_DepsFeed(), distributed=True))
+    np.save(os.path.join(outdir, 'metrics-{}.npy'.format(rank)), np.array([metrics[k] for k in ('las', 'uas', 'lcm', 'ucm')]))
+    dist.destroy_process_group()
+
+
+def test_ddp_deps_trainer_on_cpu(tmpdir):
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+    outdir = str(tmpdir)
+    mp.spawn(_deps_worker, args=(2, random.randint(20000, 40000), outdir), nprocs=2)
+    for r in range(2):
+        assert np.all(np.isfinite(np.load(os.path.join(outdir, 'metrics-{}.npy'.format(r)))))
+
+
+def _grad_accum_worker(rank, world_size, port, outdir):
+    from eight_mile.pytorch.optz import OptimizerManager
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    model = torch.nn.parallel.DistributedDataParallel(torch.nn.Linear(4, 1))
+    optimizer = OptimizerManager(model, optim='sgd', lr=0.1, grad_accum=2)
+    optimizer.start_epoch(2)
+    grads = []
+    for step in range(2):
+        x = torch.full((2, 4), float(rank + step + 1))
+        with optimizer.autocast(model):
+            loss = model(x).sum()
+        optimizer.backward(loss)
+        grads.append(model.module.weight.grad.detach().clone().numpy())
+    np.save(os.path.join(outdir, 'grads-{}.npy'.format(rank)), np.stack(grads))
+    dist.destroy_process_group()
+
+
+def test_ddp_grad_accum_only_syncs_the_last_batch(tmpdir):
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+    outdir = str(tmpdir)
+    mp.spawn(_grad_accum_worker, args=(2, random.randint(20000, 40000), outdir), nprocs=2)
+    grads = [np.load(os.path.join(outdir, 'grads-{}.npy'.format(r))) for r in range(2)]
+    # The first batch runs under `no_sync`, so each worker only has its own gradient
+    np.testing.assert_allclose(grads[0][0], np.full((1, 4), 1.0))
+    np.testing.assert_allclose(grads[1][0], np.full((1, 4), 2.0))
+    # The last one all-reduces the whole accumulation, the mean of 1 + 2 and 2 + 3
+    np.testing.assert_allclose(grads[0][1], np.full((1, 4), 4.0))
+    np.testing.assert_allclose(grads[1][1], np.full((1, 4), 4.0))
+
+def test_sampler_rebuckets_the_same_on_every_worker():
+    from baseline.data import DictExamples, ExampleDataFeed
+    rng = np.random.RandomState(2)
+    examples = [{'x': np.ones(20, dtype=np.int64), 'x_lengths': int(l), 'y': i} for i, l in enumerate(rng.randint(1, 20, size=100))]
+
+    def make_feed():
+        return ExampleDataFeed(DictExamples(examples, do_shuffle=False), 10, shuffle=True, max_tokens=60)
+
+    feeds = [make_feed() for _ in range(2)]
+    samplers = [EpochDistributedSampler(feed, num_replicas=2, rank=r, shuffle=True) for r, feed in enumerate(feeds)]
+    for _ in range(2):
+        shards = [list(sampler) for sampler in samplers]
+        assert [b[0].tolist() for b in feeds[0].bucketed] == [b[0].tolist() for b in feeds[1].bucketed]
+        assert len(shards[0]) == len(shards[1])
+        seen = sorted(i for r, shard in enumerate(shards) for s in shard for i in feeds[r].bucketed[s][0].tolist())
+        assert set(seen) == set(range(100))
@@ -0,0 +1,110 @@
+import pytest
+import numpy as np
+torch = pytest.importorskip('torch')
+from eight_mile.confusion import ConfusionMatrix
+from baseline.pytorch.classify.train import ClassifyTrainerPyTorch
+
+LABELS = ['a', 'b', 'c']
+
+
+class _Classifier(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.gpu = False
+        self.labels = LABELS
+        self.proj = torch.nn.Linear(4, len(LABELS))
+
+    def create_loss(self):
+        return torch.nn.CrossEntropyLoss()
+
+    def make_input(self, batch_dict):
+        return {'x': torch.from_numpy(batch_dict['x']), 'y': torch.from_numpy(batch_dict['y'])}
+
+    def forward(self, example):
+        return self.proj(example['x'])
+
+
+def _batches(n=5, B=8):
+    rng = np.random.RandomState(1)
+    return [{'x': rng.randn(B, 4).astype(np.float32), 'y': rng.randint(0, len(LABELS), B)} for _ in range(n)]
+
+
+def test_classify_train_metrics_synced_at_epoch_end():
+    torch.manual_seed(0)
+    trainer = ClassifyTrainerPyTorch(_Classifier(), optim='sgd', lr=0.0, gpus=0, nsteps=2)
+    batches = _batches()
+    reported = []
+    trainer.report = lambda step, metrics, *args: reported.append(metrics)
+    metrics = trainer._train(batches)
+
+    # With a zero learning rate the model is fixed, so we can check the accumulated results directly
+    cm = ConfusionMatrix(LABELS)
+    losses = []
+    with torch.no_grad():
+        for batch in batches:
+            example = trainer.model.make_input(batch)
+            pred = trainer.model(example)
+            losses.append(trainer.crit(pred, example['y']).item())
+            cm.add_batch(batch['y'], pred.argmax(1).numpy())
+    np.testing.assert_allclose(metrics['avg_loss'], np.mean(losses), rtol=1e-6)
+    assert metrics['acc'] == cm.get_acc()
+    assert reported
+    assert all(isinstance(m['avg_loss'], float) for m in reported)
+
+
+def test_optimizer_manager_grad_accum_averages_batches():
+    from eight_mile.pytorch.optz import OptimizerManager
+    torch.manual_seed(0)
+    xs = [torch.randn(8, 4) for _ in range(2)]
+    accum = torch.nn.Linear(4, 1)
+    full = torch.nn.Linear(4, 1)
+    full.load_state_dict(accum.state_dict())
+
+    optimizer = OptimizerManager(accum, optim='sgd', lr=0.1, mom=0.0, grad_accum=2)
+    assert not optimizer.backward(accum(xs[0]).pow(2).mean())
+    assert optimizer.backward(accum(xs[1]).pow(2).mean())
+    optimizer.clip_grad_norm(100.0)
+    optimizer.step()
+
+    reference = OptimizerManager(full, optim='sgd', lr=0.1, mom=0.0)
+    reference.backward(full(torch.cat(xs)).pow(2).mean())
+    reference.step()
+    assert optimizer.global_step == reference.global_step == 1
+    for p, q in zip(accum.parameters(), full.parameters()):
+        np.testing.assert_allclose(p.detach().numpy(), q.detach().numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_optimizer_manager_grad_accum_averages_partial_group():
+    from eight_mile.pytorch.optz import OptimizerManager
+    torch.manual_seed(0)
+    xs = [torch.randn(8, 4) for _ in range(3)]
+    accum = torch.nn.Linear(4, 1)
+    full = torch.nn.Linear(4, 1)
+    full.load_state_dict(accum.state_dict())
+
+    optimizer = OptimizerManager(accum, optim='sgd', lr=0.1, mom=0.0, grad_accum=2)
+    reference = OptimizerManager(full, optim='sgd', lr=0.1, mom=0.0)
+    optimizer.start_epoch(len(xs))
+    for batch in (xs[:2], xs[2:]):
+        for x in batch:
+            with optimizer.autocast(accum):
+                loss = accum(x).pow(2).mean()
+            stepped = optimizer.backward(loss)
+        # The last group only has one batch, so it gets the full weight of that batch
+        assert stepped
+        optimizer.step()
+        optimizer.zero_grad()
+        reference.backward(full(torch.cat(batch)).pow(2).mean())
+        reference.step()
+        reference.zero_grad()
+    assert optimizer.global_step == reference.global_step == 2
+    for p, q in zip(accum.parameters(), full.parameters()):
+        np.testing.assert_allclose(p.detach().numpy(), q.detach().numpy(), rtol=1e-5, atol=1e-6)
+
+def test_classify_train_grad_accum_steps():
+    trainer = ClassifyTrainerPyTorch(_Classifier(), optim='sgd', lr=0.01, gpus=0, grad_accum=2)
+    metrics = trainer._train(_batches(n=5))
+    # The last partial accumulation still gets a step
+    assert trainer.optimizer.global_step == 3
+    assert np.isfinite(metrics['avg_loss'])
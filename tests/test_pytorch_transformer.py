@@ -118,3 +118,168 @@ def attn_values_sub_mask(attn, qkv):
         for h in range(H):
             for t in range(T):
                 np.testing.assert_allclose(res[b, h, t, :], np.mean(gold[:, :, : t + 1, :], axis=2)[b, h, :], atol=1e-5)
+
+
+def test_encoder_stack_cache_matches_full():
+    from eight_mile.pytorch.layers import TransformerEncoderStack
+    B, T, H = 2, 6, 16
+    stack = TransformerEncoderStack(2, H, 0.0, layers=2)
+    stack.eval()
+    x = torch.rand(B, T, H)
+    mask = subsequent_mask(T)
+    gold = stack((x, mask))
+    cache = stack.init_cache()
+    prompt = 3
+    out = stack((x[:, :prompt], mask[:, :, :prompt, :prompt]), cache=cache)
+    np.testing.assert_allclose(out.numpy(), gold[:, :prompt].numpy(), atol=1e-5)
+    for t in range(prompt, T):
+        out = stack((x[:, t:t + 1], mask[:, :, t:t + 1, :t + 1]), cache=cache)
+        np.testing.assert_allclose(out[:, 0].numpy(), gold[:, t].numpy(), atol=1e-5)
+
+
+def test_encoder_stack_relative_attention_no_cache():
+    from eight_mile.pytorch.layers import TransformerEncoderStack
+    stack = TransformerEncoderStack(2, 16, 0.0, layers=2, rpr_k=4)
+    assert not stack.supports_kv_cache
+    with pytest.raises(Exception):
+        stack.init_cache()
+
+
+@pytest.mark.parametrize("attn_type", [SeqScaledDotProductAttention, SeqDotProductAttention])
+def test_fused_attn_values(attn_type, qkv):
+    attn = attn_type(0.0, keep_attn=False)
+    attn_values(attn, qkv)
+    attn_values_seq_mask(attn, qkv)
+    attn_values_sub_mask(attn, qkv)
+    assert attn.attn is None
+
+
+@pytest.mark.parametrize("attn_type", [SeqScaledDotProductAttention, SeqDotProductAttention])
+def test_fused_attn_matches_unfused(attn_type, qkv):
+    q, k, v = qkv
+    B, _, T, _ = q.shape
+    lens = torch.from_numpy(np.random.randint(1, T, size=B))
+    mask = sequence_mask(lens, T).unsqueeze(1).unsqueeze(1)
+    gold = attn_type(0.0)((q, k, v, mask))
+    res = attn_type(0.0, keep_attn=False)((q, k, v, mask))
+    np.testing.assert_allclose(res.numpy(), gold.numpy(), atol=1e-5)
+
+
+def test_mha_fused_qkv_matches_separate_projections():
+    from eight_mile.pytorch.layers import MultiHeadedAttention
+    B, T, H = 3, 7, 16
+    mha = MultiHeadedAttention(4, H, 0.0, scale=True)
+    mha.eval()
+    x = torch.rand(B, T, H)
+    # Passing copies means the query, key and value are not the same tensor, so they are projected one at a time
+    gold = mha((x, x.clone(), x.clone(), None))
+    np.testing.assert_allclose(mha((x, x, x, None)).numpy(), gold.numpy(), atol=1e-5)
+
+
+def test_mha_stacked_qkv_weights_are_cached_until_updated():
+    from eight_mile.pytorch.layers import MultiHeadedAttention
+    B, T, H = 3, 7, 16
+    mha = MultiHeadedAttention(4, H, 0.0, scale=True)
+    mha.eval()
+    x = torch.rand(B, T, H)
+    mha((x, x, x, None))
+    weight, bias = mha._qkv_weights()
+    assert mha._qkv_weights()[0] is weight
+    # An in-place update (like an optimizer step) bumps the version, so the stacked weights are rebuilt
+    mha.w_K.layer.weight.add_(1.0)
+    gold = mha((x, x.clone(), x.clone(), None))
+    np.testing.assert_allclose(mha((x, x, x, None)).numpy(), gold.numpy(), atol=1e-5)
+    assert mha._qkv_weights()[0] is not weight
+
+
+def test_mha_stacked_qkv_weights_get_gradients():
+    from eight_mile.pytorch.layers import MultiHeadedAttention
+    B, T, H = 3, 7, 16
+    mha = MultiHeadedAttention(4, H, 0.0, scale=True)
+    x = torch.rand(B, T, H)
+    for _ in range(2):
+        with torch.enable_grad():
+            mha((x, x, x, None)).sum().backward()
+        assert mha.w_Q.layer.weight.grad is not None and mha.w_V.layer.bias.grad is not None
+        mha.zero_grad()
+    assert '_qkv_cache' not in mha.__dict__
+
+def test_encoder_stack_without_attn_maps():
+    from eight_mile.pytorch.layers import TransformerEncoderStack
+    B, T, H = 2, 6, 16
+    torch.manual_seed(0)
+    gold_stack = TransformerEncoderStack(2, H, 0.0, layers=2)
+    stack = TransformerEncoderStack(2, H, 0.0, layers=2, keep_attn=False)
+    stack.load_state_dict(gold_stack.state_dict())
+    gold_stack.eval()
+    stack.eval()
+    x = torch.rand(B, T, H)
+    mask = sequence_mask(torch.tensor([6, 4]), T).unsqueeze(1).unsqueeze(1)
+    gold = gold_stack((x, mask))
+    np.testing.assert_allclose(stack((x, mask)).numpy(), gold.numpy(), atol=1e-5)
+    assert all(layer.self_attn.attn is not None for layer in gold_stack.encoders)
+    assert all(layer.self_attn.attn is None for layer in stack.encoders)
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"rpr_k": 3}, {"layer_norms_after": True}])
+def test_packed_encoder_stack_matches_padded(kwargs):
+    from eight_mile.pytorch.layers import TransformerEncoderStackWithLengths
+    B, T, H = 3, 7, 16
+    torch.manual_seed(0)
+    gold_stack = TransformerEncoderStackWithLengths(2, H, 0.0, layers=2, input_sz=8, **kwargs)
+    stack = TransformerEncoderStackWithLengths(2, H, 0.0, layers=2, input_sz=8, packed=True, **kwargs)
+    stack.load_state_dict(gold_stack.state_dict())
+    gold_stack.eval()
+    stack.eval()
+    x = torch.rand(B, T, 8)
+    lengths = torch.tensor([7, 2, 5])
+    mask = sequence_mask(lengths, T)
+    gold = gold_stack((x, lengths))
+    res = stack((x, lengths))
+    np.testing.assert_allclose(res[mask].numpy(), gold[mask].numpy(), atol=1e-5)
+    assert res[~mask].abs().sum() == 0
+
+
+def test_packed_mask_round_trip():
+    from eight_mile.pytorch.layers import PackedMask
+    packed = PackedMask(torch.tensor([3, 1, 2]), 4)
+    x = torch.arange(12).view(3, 4, 1)
+    tokens = packed.pack(x)
+    assert tokens.view(-1).tolist() == [0, 1, 2, 4, 8, 9]
+    assert packed.unpack(tokens).view(3, 4).tolist() == [[0, 1, 2, 0], [4, 0, 0, 0], [8, 9, 0, 0]]
+
+
+def _grads(stack, inputs, seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    stack.zero_grad()
+    with torch.enable_grad():
+        stack(inputs).sum().backward()
+    return {name: p.grad.clone() for name, p in stack.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize("stack_type", ["encoder", "decoder", "gmlp"])
+def test_checkpoint_layers_matches_gradients(stack_type):
+    from eight_mile.pytorch.layers import TransformerEncoderStack, TransformerDecoderStack, GatedMLPEncoderStack
+    B, T, H = 2, 6, 16
+    x = torch.rand(B, T, H)
+    mask = subsequent_mask(T)
+
+    def make_stack(**kwargs):
+        torch.manual_seed(0)
+        if stack_type == "encoder":
+            return TransformerEncoderStack(2, H, 0.1, layers=3, layer_drop=0.3, **kwargs), (x, mask)
+        if stack_type == "decoder":
+            return TransformerDecoderStack(2, H, 0.1, layers=3, layer_drop=0.3, **kwargs), (x, torch.rand(B, 4, H), None, mask)
+        return GatedMLPEncoderStack(H, 0.1, layers=3, nctx=T, layer_drop=0.3, **kwargs), (x, None)
+
+    gold_stack, inputs = make_stack()
+    stack, _ = make_stack(checkpoint_layers=True)
+    stack.load_state_dict(gold_stack.state_dict())
+    for seed in range(3):
+        # The same seed picks the same dropped layers and dropout masks, the recompute has to reuse them
+        gold = _grads(gold_stack, inputs, seed)
+        grads = _grads(stack, inputs, seed)
+        assert gold.keys() == grads.keys()
+        for name in gold:
+            np.testing.assert_allclose(grads[name].numpy(), gold[name].numpy(), atol=1e-5)
@@ -4,6 +4,7 @@ from copy import deepcopy
 from collections import Counter
 import pytest
 import numpy as np
+import baseline.data
 from mock import MagicMock, patch, call
 from baseline.reader import (
     _filter_vocab,
@@ -11,9 +12,14 @@ from baseline.reader import (
     _read_from_col,
     _build_vocab_for_col,
     _check_lens,
+    _shard_file,
+    _open_text,
     TSVSeqLabelReader,
     TSVParallelCorpusReader,
     MultiFileParallelCorpusReader,
+    CONLLSeqReader,
+    CONLLJointSeqReader,
+    LineSeqReader,
 )
 
 
@@ -199,3 +205,303 @@ def test_check_for_neg_one():
         vects[i] = vect
     fails = _check_lens(vects)
     assert fails == gold
+
+
+def _batches(feed):
+    return [{k: v.copy() for k, v in batch.items()} for batch in feed]
+
+
+def _assert_same_batches(gold, batches):
+    assert len(gold) == len(batches)
+    for gold_batch, batch in zip(gold, batches):
+        assert gold_batch.keys() == batch.keys()
+        for k in gold_batch:
+            assert gold_batch[k].dtype == batch[k].dtype
+            np.testing.assert_equal(gold_batch[k], batch[k])
+
+
+def _classify_vectorizers():
+    from baseline.vectorizers import Token1DVectorizer, Char2DVectorizer
+    return {'word': Token1DVectorizer(mxlen=-1), 'char': Char2DVectorizer(mxlen=-1, mxwlen=6)}
+
+
+def test_classify_example_cache_matches(tmp_path):
+    file_name = os.path.join(TEST_LOC, 'tsv_unstruct_file.tsv')
+    reader = TSVSeqLabelReader(_classify_vectorizers(), trim=True, cache_dir=str(tmp_path))
+    vocabs, _ = reader.build_vocab([file_name])
+    gold = _batches(reader.load(file_name, vocabs, 2, sort_key='word'))
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    # A fresh reader whose vectorizers have not been run yet should get its `mxlen` back from the cache
+    reader = TSVSeqLabelReader(_classify_vectorizers(), trim=True, cache_dir=str(tmp_path))
+    reader.build_vocab([file_name])
+    feed = reader.load(file_name, vocabs, 2, sort_key='word')
+    assert isinstance(feed.examples.example_list, baseline.data.PackedExampleList)
+    _assert_same_batches(gold, _batches(feed))
+    assert reader.vectorizers['word'].mxlen == reader.vectorizers['word'].max_seen
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+def test_classify_example_cache_key_changes(tmp_path):
+    file_name = os.path.join(TEST_LOC, 'tsv_unstruct_file.tsv')
+    reader = TSVSeqLabelReader(_classify_vectorizers(), cache_dir=str(tmp_path))
+    vocabs, _ = reader.build_vocab([file_name])
+    reader.load(file_name, vocabs, 2)
+    vocabs['word'] = {k: v + 1 for k, v in vocabs['word'].items()}
+    reader.load(file_name, vocabs, 2)
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def _write_joint_conll(file_name):
+    with open(file_name, 'w') as f:
+        f.write('pos X\nthe O\ncat B-ANI\n\nneg X\na O\ndog B-ANI\nbarked O\n\npos X\nhi O\n')
+    return file_name
+
+
+def test_joint_tagger_cache_strips_class_labels(tmp_path):
+    from baseline.vectorizers import Dict1DVectorizer
+    file_name = _write_joint_conll(str(tmp_path / 'train.conll'))
+    cache_dir = str(tmp_path / 'cache')
+
+    def make_reader():
+        return CONLLJointSeqReader({'word': Dict1DVectorizer(fields='text', mxlen=-1)},
+                                   named_fields={'0': 'text', '-1': 'y'}, cache_dir=cache_dir)
+
+    reader = make_reader()
+    vocabs = reader.build_vocab([file_name])
+    feed, texts = reader.load(file_name, vocabs, 2)
+    gold = _batches(feed)
+    reader = make_reader()
+    reader.build_vocab([file_name])
+    feed, cached_texts = reader.load(file_name, vocabs, 2)
+    assert isinstance(feed.examples.example_list, baseline.data.PackedExampleList)
+    _assert_same_batches(gold, _batches(feed))
+    assert len(os.listdir(cache_dir)) == 1
+    for example_texts in (texts, cached_texts):
+        assert [[t['text'] for t in example] for example in example_texts] == [['the', 'cat'], ['a', 'dog', 'barked'], ['hi']]
+    assert sorted(y for batch in gold for y in batch['class_label'].tolist()) == [0, 0, 1]
+
+
+def test_tagger_cache_key_covers_reader_settings(tmp_path):
+    from baseline.vectorizers import Dict1DVectorizer
+    file_name = _write_joint_conll(str(tmp_path / 'train.conll'))
+    cache_dir = str(tmp_path / 'cache')
+
+    def load(named_fields, mxlen=-1):
+        reader = CONLLSeqReader({'word': Dict1DVectorizer(fields='text', mxlen=-1)}, mxlen=mxlen,
+                                named_fields=named_fields, cache_dir=cache_dir)
+        vocabs = reader.build_vocab([file_name])
+        return reader.load(file_name, vocabs, 2)
+
+    load({'0': 'text', '-1': 'y'})
+    load({'0': 'text', '-1': 'y'})
+    assert len(os.listdir(cache_dir)) == 1
+    load({'0': 'text', '1': 'y'})
+    assert len(os.listdir(cache_dir)) == 2
+    load({'0': 'text', '-1': 'y'}, mxlen=2)
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def test_cache_key_covers_every_vectorizer_setting(tmp_path):
+    from baseline.vectorizers import Dict1DVectorizer
+    file_name = _write_joint_conll(str(tmp_path / 'train.conll'))
+    cache_dir = str(tmp_path / 'cache')
+
+    class CappedVectorizer(Dict1DVectorizer):
+        """A vectorizer with a setting of its own, like the ones in addons"""
+        def __init__(self, cap, **kwargs):
+            super().__init__(**kwargs)
+            self.cap = cap
+
+        def run(self, tokens, vocab):
+            vec, length = super().run(tokens, vocab)
+            vec[self.cap:] = 0
+            return vec, min(length, self.cap)
+
+    def load(cap):
+        reader = CONLLSeqReader({'word': CappedVectorizer(cap, fields='text', mxlen=-1)},
+                                named_fields={'0': 'text', '-1': 'y'}, cache_dir=cache_dir)
+        vocabs = reader.build_vocab([file_name])
+        return _batches(reader.load(file_name, vocabs, 2)[0])
+
+    load(1)
+    assert len(os.listdir(cache_dir)) == 1
+    gold = load(100)
+    assert len(os.listdir(cache_dir)) == 2
+    _assert_same_batches(gold, load(100))
+
+
+def test_parallel_example_cache_matches(tmp_path):
+    from baseline.vectorizers import Token1DVectorizer
+    file_name = os.path.join(TEST_LOC, 'tsv_parallel.tsv')
+
+    def make_reader():
+        vectorizers = {'src': Token1DVectorizer(mxlen=5), 'tgt': Token1DVectorizer(mxlen=5)}
+        return TSVParallelCorpusReader(vectorizers, trim=True, cache_dir=str(tmp_path))
+
+    reader = make_reader()
+    src_vocab = {'src': {w: i + 4 for i, w in enumerate('abcdef')}}
+    tgt_vocab = {w: i + 4 for i, w in enumerate('abcdef')}
+    tgt_vocab.update({'<GO>': 2, '<EOS>': 3})
+    gold = _batches(reader.load(file_name, src_vocab, tgt_vocab, 2, sort_key='src_lengths'))
+    feed = make_reader().load(file_name, src_vocab, tgt_vocab, 2, sort_key='src_lengths')
+    assert isinstance(feed.examples.example_list, baseline.data.PackedExampleList)
+    _assert_same_batches(gold, _batches(feed))
+
+
+def test_classify_cached_examples_bucketed(tmp_path):
+    file_name = os.path.join(TEST_LOC, 'tsv_unstruct_file.tsv')
+    def make_reader():
+        return TSVSeqLabelReader(_classify_vectorizers(), cache_dir=str(tmp_path), max_tokens=8, bucket_key='word_lengths')
+
+    reader = make_reader()
+    vocabs, _ = reader.build_vocab([file_name])
+    reader.load(file_name, vocabs, 2)
+    reader = make_reader()
+    reader.build_vocab([file_name])
+    feed = reader.load(file_name, vocabs, 2, shuffle=True)
+    assert isinstance(feed.examples.example_list, baseline.data.PackedExampleList)
+    ys = []
+    for batch in feed:
+        assert batch['word'].shape[1] >= batch['word_lengths'].max()
+        assert batch['char'].shape[:2] == batch['word'].shape
+        ys.extend(batch['y'].tolist())
+    assert sorted(ys) == [0, 1, 2]
+
+
+def _write_random_lines(file_name, num_lines, fmt, blank_every=None):
+    random.seed(1234)
+    words = ['w{}'.format(i) for i in range(50)] + ['ünï']
+    with open(file_name, 'w', encoding='utf-8') as f:
+        for i in range(num_lines):
+            sent = random.sample(words, random.randint(1, 10))
+            f.write(fmt(i, sent))
+            if blank_every is not None and i % blank_every == blank_every - 1:
+                f.write('\n')
+    return file_name
+
+
+def test_shard_file_splits_on_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 64)
+    file_name = _write_random_lines(str(tmp_path / 'lines.txt'), 100, lambda i, s: ' '.join(s) + '\n', blank_every=7)
+    with open(file_name, encoding='utf-8') as f:
+        gold = f.readlines()
+    for blank_lines in (False, True):
+        shards = _shard_file(file_name, 4, blank_lines=blank_lines)
+        assert len(shards) > 1
+        assert shards[0].start == 0 and shards[-1].end == os.path.getsize(file_name)
+        lines = []
+        for shard, next_shard in zip(shards, shards[1:] + [None]):
+            with _open_text(shard) as f:
+                shard_lines = list(f)
+            if blank_lines and next_shard is not None:
+                assert shard_lines[-1] == '\n'
+            lines.extend(shard_lines)
+        assert lines == gold
+
+
+def _token_vectorizers():
+    from baseline.vectorizers import Token1DVectorizer, Char2DVectorizer
+    return {'word': Token1DVectorizer(mxlen=-1), 'char': Char2DVectorizer(mxlen=-1, mxwlen=-1)}
+
+
+def _assert_same_vocabs(make_reader, build, make_vectorizers=_token_vectorizers):
+    results = []
+    for workers in (1, 3):
+        vectorizers = make_vectorizers()
+        reader = make_reader(vectorizers, workers)
+        vocabs = build(reader)
+        results.append((vocabs, vectorizers['word'].max_seen, vectorizers['char'].max_seen_char, getattr(reader, 'label2index', None)))
+    assert results[0] == results[1]
+    # The labels should be added in the order they are first seen, just like reading the files one by one
+    assert list(results[0][3] or []) == list(results[1][3] or [])
+
+
+def test_classify_parallel_vocab_matches(tmp_path, monkeypatch):
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 128)
+    files = [
+        _write_random_lines(str(tmp_path / 'train{}.tsv'.format(i)), 200, lambda j, s: '{}\t{}\n'.format(s[0], ' '.join(s)))
+        for i in range(2)
+    ]
+    _assert_same_vocabs(lambda v, w: TSVSeqLabelReader(v, vocab_workers=w), lambda r: r.build_vocab(files))
+
+
+def test_tagger_parallel_vocab_matches(tmp_path, monkeypatch):
+    from baseline.vectorizers import Dict1DVectorizer, Dict2DVectorizer
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 128)
+    file_name = str(tmp_path / 'train.conll')
+    with open(file_name, 'w', encoding='utf-8') as f:
+        random.seed(1234)
+        for i in range(100):
+            for _ in range(random.randint(1, 8)):
+                f.write('w{} T{}\n'.format(random.randint(0, 50), random.randint(0, 5)))
+            f.write('\n')
+    _assert_same_vocabs(
+        lambda v, w: CONLLSeqReader(v, named_fields={'0': 'text', '-1': 'y'}, vocab_workers=w),
+        lambda r: r.build_vocab([file_name]),
+        lambda: {'word': Dict1DVectorizer(fields='text', mxlen=-1), 'char': Dict2DVectorizer(fields='text', mxlen=-1, mxwlen=-1)}
+    )
+
+
+def test_seq2seq_parallel_vocab_matches(tmp_path, monkeypatch):
+    from baseline.vectorizers import Token1DVectorizer
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 128)
+    file_name = _write_random_lines(str(tmp_path / 'train.tsv'), 200, lambda i, s: '{}\t{}\n'.format(' '.join(s), ' '.join(reversed(s))))
+
+    def make_reader(vectorizers, workers):
+        vectorizers['tgt'] = Token1DVectorizer(mxlen=-1)
+        return TSVParallelCorpusReader(vectorizers, vocab_workers=workers)
+
+    _assert_same_vocabs(make_reader, lambda r: (r.build_vocabs([file_name]), r.tgt_vectorizer.max_seen))
+
+
+def test_lm_parallel_vocab_matches(tmp_path):
+    files = [_write_random_lines(str(tmp_path / 'train{}.txt'.format(i)), 50 * (i + 1), lambda j, s: ' '.join(s) + '\n') for i in range(3)]
+    _assert_same_vocabs(lambda v, w: LineSeqReader(v, nctx=5, vocab_workers=w), lambda r: r.build_vocab(files))
+
+
+def test_single_worker_vocab_reads_whole_files(tmp_path, monkeypatch):
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 128)
+    file_name = _write_random_lines(str(tmp_path / 'train.tsv'), 200, lambda j, s: '{}\t{}\n'.format(s[0], ' '.join(s)))
+    with open(file_name, encoding='utf-8') as f:
+        lines = f.readlines()
+    header_file = str(tmp_path / 'header.tsv')
+    with open(header_file, 'w', encoding='utf-8') as f:
+        f.write('label\ttext\n')
+        f.writelines(lines)
+    gold = TSVSeqLabelReader(_token_vectorizers()).build_vocab([file_name])
+    assert _shard_file(file_name, 1) == [file_name]
+
+    def fail(*args):
+        raise AssertionError("One worker should not read through shards")
+
+    monkeypatch.setattr('baseline.reader._read_shard_lines', fail)
+    reader = TSVSeqLabelReader(_token_vectorizers(), has_header=True, col_keys=['label', 'text'], vocab_workers=1)
+    assert reader.build_vocab([header_file]) == gold
+    assert 'label' not in reader.label2index
+
+
+def test_map_shards_is_reentrant(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr('baseline.reader._MIN_SHARD_BYTES', 128)
+    files = [
+        _write_random_lines(str(tmp_path / 'train{}.tsv'.format(i)), 200, lambda j, s: '{}\t{}\n'.format(s[0], ' '.join(s)))
+        for i in range(4)
+    ]
+    gold = [_build_vocab_for_col(1, [f], {'word': _token_vectorizers()['word']}) for f in files]
+    with ThreadPoolExecutor(4) as ex:
+        results = list(ex.map(lambda f: _build_vocab_for_col(1, [f], {'word': _token_vectorizers()['word']}, workers=3), files))
+    assert results == gold
+
+
+def test_lm_vocab_with_ngram_vectorizer(tmp_path):
+    from baseline.vectorizers import TextNGramVectorizer
+    file_name = _write_random_lines(str(tmp_path / 'train.txt'), 30, lambda j, s: ' '.join(s) + '\n')
+    tokens = []
+    with open(file_name, encoding='utf-8') as f:
+        for line in f:
+            tokens += line.split() + ['<EOS>']
+    gold = TextNGramVectorizer(filtsz=2, mxlen=-1).count(tokens)
+    reader = LineSeqReader({'x': TextNGramVectorizer(filtsz=2, mxlen=-1)}, nctx=5)
+    vocabs = reader.build_vocab([file_name])
+    assert vocabs['x'] == gold
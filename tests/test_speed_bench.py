@@ -0,0 +1,70 @@
+import os
+import sys
+import sqlite3
+import pytest
+pytest.importorskip('xpctl')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'scripts'))
+from speed_test.run import create_db, save_data, Version
+from speed_test.report import get_regressions
+from speed_test.bench import run_benchmarks, get_system_info
+
+
+@pytest.fixture
+def conn():
+    conn = create_db(':memory:')
+    yield conn
+    conn.close()
+
+
+def _add(conn, times, baseline_version, model='Token1DVectorizer', phase='run'):
+    si = get_system_info('numpy')
+    si['baseline'] = baseline_version
+    config = {'task': 'vectorizer', 'backend': 'numpy', 'dataset': 'synthetic', 'model': {'model_type': model}}
+    save_data(conn, [{'time': t, 'phase': phase} for t in times], config, si)
+
+
+def test_regression_is_flagged(conn):
+    _add(conn, [1.0, 1.1, 0.9], Version(2, 0, 0))
+    _add(conn, [1.5, 1.6, 1.4], Version(2, 0, 1))
+    regressions = get_regressions(conn)
+    assert len(regressions) == 1
+    assert regressions[0]['old'] == '2.0.0' and regressions[0]['new'] == '2.0.1'
+    assert regressions[0]['change'] == pytest.approx(0.5)
+
+
+def test_noise_and_speedups_are_not_flagged(conn):
+    _add(conn, [1.0, 1.1, 0.9], Version(2, 0, 0))
+    _add(conn, [1.15, 1.5, 0.8], Version(2, 0, 1))
+    _add(conn, [1.0, 1.1, 0.9], Version(2, 0, 0), phase='count')
+    _add(conn, [0.5, 0.6, 0.4], Version(2, 0, 1), phase='count')
+    assert get_regressions(conn) == []
+
+
+def test_only_the_latest_versions_are_compared(conn):
+    _add(conn, [1.0, 1.0], Version(1, 0, 0))
+    _add(conn, [2.0, 2.0], Version(1, 1, 0))
+    _add(conn, [2.0, 2.0], Version(1, 10, 0))
+    assert get_regressions(conn) == []
+
+
+def test_benchmarks_write_the_speed_table(conn):
+    assert run_benchmarks(conn, tasks=['vectorizer', 'examples'], batch_sizes=[4], trials=2, sentences=20, vocab_size=50) > 0
+    rows = conn.execute("SELECT DISTINCT task, model, phase, dataset FROM speed").fetchall()
+    assert ('vectorizer', 'Token1DVectorizer', 'run_batch-4', 'synthetic') in rows
+    assert ('examples', 'DictExamples', 'batch-4-trim', 'synthetic') in rows
+    assert conn.execute("SELECT COUNT(*) FROM speed WHERE model = 'Char2DVectorizer' AND phase = 'count'").fetchone()[0] == 2
+
+
+def test_gpt2_benchmarks(conn):
+    pytest.importorskip('regex')
+    run_benchmarks(conn, tasks=['vectorizer'], batch_sizes=[4], trials=1, sentences=20, vocab_size=50)
+    assert conn.execute("SELECT COUNT(*) FROM speed WHERE model = 'GPT2Vectorizer1D'").fetchone()[0] > 0
+
+
+def test_benchmarks_skip_missing_dependencies(conn, monkeypatch):
+    import speed_test.bench
+    monkeypatch.setattr(speed_test.bench, '_missing_module', lambda modules: modules[0] if modules else None)
+    assert run_benchmarks(conn, tasks=['vectorizer'], batch_sizes=[4], trials=1, sentences=20, vocab_size=50) > 0
+    models = {row[0] for row in conn.execute("SELECT DISTINCT model FROM speed").fetchall()}
+    assert 'Token1DVectorizer' in models
+    assert 'GPT2Vectorizer1D' not in models and 'BPEVectorizer1D' not in models
@@ -0,0 +1,84 @@
+import pytest
+import numpy as np
+
+tf = pytest.importorskip("tensorflow")
+from baseline.tf.tfy import to_dataset, concat_batches
+from baseline.tf.classify.training.utils import to_batch_tensors, to_tensors
+
+
+class ListFeed:
+    """A minimal data feed over a list of batches"""
+
+    def __init__(self, batches):
+        self.batches = batches
+
+    def __getitem__(self, i):
+        return self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+@pytest.fixture
+def feed():
+    batches = []
+    for i in range(5):
+        B = 3 if i < 4 else 2
+        batches.append({
+            'word': np.random.randint(1, 100, size=(B, 7)),
+            'word_lengths': np.random.randint(1, 8, size=(B,)),
+            'y': np.random.randint(0, 4, size=(B,)),
+        })
+    return ListFeed(batches)
+
+
+def _collect(dataset):
+    return concat_batches((dict((k, v.numpy()) for k, v in x.items()), y.numpy()) for x, y in dataset)
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_to_dataset_matches_to_tensors(feed, stream):
+    transform = lambda batch: to_batch_tensors(batch, 'word_lengths')
+    features, y = _collect(to_dataset(feed, transform, 4, stream=stream))
+    gold_features, gold_y = to_tensors(feed, 'word_lengths')
+    assert set(features) == {'word', 'lengths'}
+    np.testing.assert_equal(features['word'], gold_features['word'])
+    np.testing.assert_equal(features['lengths'], gold_features['lengths'])
+    np.testing.assert_equal(y, gold_y)
+    assert len(y) == 14
+
+
+def test_to_dataset_batches(feed):
+    transform = lambda batch: to_batch_tensors(batch, 'word_lengths')
+    sizes = [len(y) for _, y in to_dataset(feed, transform, 4, shuffle=True, drop_remainder=True)]
+    assert sizes == [4, 4, 4]
+
+
+@pytest.fixture
+def bucketed_feed():
+    """A feed like a trimmed or length-bucketed one, where each batch has its own `T`"""
+    batches = []
+    for i, T in enumerate([7, 3, 5, 2]):
+        lengths = np.random.randint(1, T + 1, size=(3,))
+        word = np.random.randint(1, 100, size=(3, T))
+        word[np.arange(T)[np.newaxis, :] >= lengths[:, np.newaxis]] = 0
+        batches.append({'word': word, 'word_lengths': lengths, 'y': np.random.randint(0, 4, size=(3,))})
+    return ListFeed(batches)
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_to_dataset_pads_changing_lengths(bucketed_feed, stream):
+    transform = lambda batch: to_batch_tensors(batch, 'word_lengths')
+    batches = [(dict((k, v.numpy()) for k, v in x.items()), y.numpy()) for x, y in to_dataset(bucketed_feed, transform, 4, stream=stream)]
+    assert [len(y) for _, y in batches] == [4, 4, 4]
+    features, y = concat_batches(batches)
+    assert features['word'].shape == (12, 7)
+    for i, batch in enumerate(bucketed_feed):
+        T = batch['word'].shape[1]
+        np.testing.assert_equal(features['word'][3 * i:3 * i + 3, :T], batch['word'])
+        np.testing.assert_equal(features['word'][3 * i:3 * i + 3, T:], 0)
+        np.testing.assert_equal(features['lengths'][3 * i:3 * i + 3], batch['word_lengths'])
+        np.testing.assert_equal(y[3 * i:3 * i + 3], batch['y'])
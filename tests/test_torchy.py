@@ -55,3 +55,33 @@ def test_token_sequence_loss(logits, labels, lengths):
     crit = SequenceCriterion(LossFn=loss, avg='token')
     res = crit(logits, labels)
     np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-6)
+
+
+def test_confusion_counts_match_confusion_matrix():
+    from eight_mile.confusion import ConfusionMatrix
+    from baseline.pytorch.torchy import ConfusionCounts
+    labels = [str(i) for i in range(C)]
+    gold = ConfusionMatrix(labels)
+    cm = ConfusionMatrix(labels)
+    counts = ConfusionCounts(C)
+    for _ in range(3):
+        truth = torch.randint(0, C, (B,))
+        guess = torch.randint(0, C, (B,))
+        gold.add_batch(truth.numpy(), guess.numpy())
+        counts.add_batch(truth, guess)
+    counts.update(cm)
+    np.testing.assert_equal(cm._cm, gold._cm)
+    assert counts.counts is None
+
+
+def test_confusion_counts_adds_into_out():
+    from baseline.pytorch.torchy import confusion_counts
+    truth = torch.randint(0, C, (B,))
+    guess = torch.randint(0, C, (B,))
+    out = torch.zeros(C * C, dtype=torch.long)
+    confusion_counts(truth, guess, C, out=out)
+    res = confusion_counts(truth, guess, C, out=out)
+    gold = np.zeros((C, C), dtype=np.int64)
+    np.add.at(gold, (truth.numpy(), guess.numpy()), 2)
+    np.testing.assert_equal(res.numpy(), gold)
+    assert res.data_ptr() == out.data_ptr()
@@ -14,6 +14,8 @@ from baseline.vectorizers import (
     DictTextNGramVectorizer,
     BPEVectorizer1D,
     WordpieceVectorizer1D,
+    WordpieceTokenizer,
+    load_bert_vocab,
 )
 
 TEST_DATA = os.path.join(os.path.realpath(os.path.dirname(__file__)), "test_data")
@@ -287,3 +289,213 @@ def test_wp_label_indices_generator():
     indices = wp.valid_label_indices((t for t in wp_toks))
     assert len(indices) == num_tokens
     assert indices == gold_indices
+
+
+def _random_batch(batchsz=8, max_tokens=12):
+    return [[random_string().lower() for _ in range(random.randint(0, max_tokens))] for _ in range(batchsz)]
+
+
+def _stacked_run(vect, batch, vocab):
+    vecs, lengths = zip(*[vect.run(tokens, vocab) for tokens in batch])
+    return np.stack(vecs), lengths
+
+
+@pytest.mark.parametrize("rev", [False, True])
+def test_token_1d_run_batch_matches_run(vocab, rev):
+    batch = _random_batch()
+    vect = Token1DVectorizer(mxlen=10, rev=rev)
+    gold, gold_lengths = _stacked_run(vect, batch, vocab)
+    vecs, lengths = vect.run_batch(batch, vocab)
+    assert vecs.dtype == np.int32
+    np.testing.assert_equal(vecs, gold)
+    if rev:
+        assert lengths is None
+    else:
+        np.testing.assert_equal(lengths, gold_lengths)
+
+
+def test_char_2d_run_batch_matches_run(vocab):
+    batch = _random_batch()
+    vect = Char2DVectorizer(mxlen=10, mxwlen=4)
+    gold, gold_lengths = _stacked_run(vect, batch, vocab)
+    vecs, lengths = vect.run_batch(batch, vocab)
+    assert vecs.shape == (len(batch), 10, 4)
+    np.testing.assert_equal(vecs, gold)
+    np.testing.assert_equal(lengths, gold_lengths)
+
+
+def test_char_1d_run_batch_matches_run(vocab):
+    batch = _random_batch(max_tokens=5)
+    for tokens in batch:
+        tokens.append('a')
+    vect = Char1DVectorizer(mxlen=20)
+    gold, gold_lengths = _stacked_run(vect, batch, vocab)
+    vecs, lengths = vect.run_batch(batch, vocab)
+    np.testing.assert_equal(vecs, gold)
+    np.testing.assert_equal(lengths, gold_lengths)
+
+
+def test_run_batch_uses_subclass_run(vocab):
+    vocab = dict(vocab)
+    batch = [['a', 'b', 'c', 'd'], ['b', 'c', 'd']]
+    vect = TextNGramVectorizer(filtsz=3, mxlen=5)
+    for tokens in batch:
+        for atom in vect.iterable(vect.get_padding() + tokens + vect.get_padding()):
+            vocab.setdefault(atom, len(vocab))
+    gold, gold_lengths = _stacked_run(vect, batch, vocab)
+    vecs, lengths = vect.run_batch(batch, vocab)
+    np.testing.assert_equal(vecs, gold)
+    np.testing.assert_equal(lengths, gold_lengths)
+
+
+def _reference_bpe(bpe_ranks, token):
+    """The original GPT2 merge loop, rescanning the pairs after every merge"""
+    word = tuple(token)
+    while len(word) > 1:
+        pairs = set(zip(word, word[1:]))
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float('inf')))
+        if bigram not in bpe_ranks:
+            break
+        new_word = []
+        i = 0
+        while i < len(word):
+            if i < len(word) - 1 and (word[i], word[i + 1]) == bigram:
+                new_word.append(word[i] + word[i + 1])
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+    return ' '.join(word)
+
+
+def _random_merges(alphabet, n):
+    symbols = list(alphabet)
+    merges = []
+    while len(merges) < n:
+        pair = (random.choice(symbols), random.choice(symbols))
+        if pair not in merges:
+            merges.append(pair)
+            symbols.append(''.join(pair))
+    return merges
+
+
+def test_gpt2_bpe_matches_reference():
+    pytest.importorskip('regex')
+    from baseline.vectorizers import Encoder
+    for _ in range(50):
+        merges = _random_merges('abc', random.randint(1, 20))
+        if random.random() < 0.5:
+            random.shuffle(merges)
+        encoder = Encoder({}, merges)
+        for _ in range(20):
+            token = ''.join(random.choice('abc') for _ in range(random.randint(1, 12)))
+            assert encoder.bpe(token) == _reference_bpe(encoder.bpe_ranks, token)
+
+
+def test_gpt2_bpe_cache_is_bounded():
+    pytest.importorskip('regex')
+    import pickle
+    from baseline.vectorizers import Encoder
+    encoder = Encoder({}, _random_merges('abc', 10), cache_size=4)
+    for _ in range(3):
+        for token in ['ab', 'bc', 'abc', 'cab', 'bca', 'ccc']:
+            encoder.bpe(token)
+    stats = encoder.cache_stats
+    assert stats['size'] == 4
+    assert stats['hits'] + stats['misses'] == 18
+    encoder.bpe('ccc')
+    assert encoder.cache_stats['hits'] == stats['hits'] + 1
+    restored = pickle.loads(pickle.dumps(encoder))
+    assert restored.bpe('cab') == encoder.bpe('cab')
+    assert restored.cache_stats['size'] == 1
+
+
+def _gpt2_vectorizer(tmp_path, **kwargs):
+    import json
+    from baseline.vectorizers import GPT2Vectorizer1D, bytes_to_unicode
+    symbols = list(bytes_to_unicode().values())
+    merges = [('Ġ', 'a'), ('Ġa', 'b'), ('b', 'c'), ('a', 'bc')]
+    vocab = {t: i for i, t in enumerate(['<pad>', '<s>', '</s>', '<unk>', '<|endoftext|>'] + symbols + [''.join(m) for m in merges])}
+    vocab_file = tmp_path / 'vocab.json'
+    model_file = tmp_path / 'merges.txt'
+    vocab_file.write_text(json.dumps(vocab))
+    model_file.write_text('#version: 0.2\n' + '\n'.join(' '.join(m) for m in merges) + '\n')
+    return GPT2Vectorizer1D(vocab_file=str(vocab_file), model_file=str(model_file), **kwargs)
+
+
+@pytest.mark.parametrize("mxlen", [6, 20])
+def test_gpt2_run_batch_matches_run(tmp_path, mxlen):
+    pytest.importorskip('regex')
+    saved = dict(Offsets.INDICES)
+    try:
+        vect = _gpt2_vectorizer(tmp_path, mxlen=mxlen, emit_begin_tok=['<s>'], emit_end_tok=['</s>'])
+        batch = [['abc', 'ab', 'c'], ['bca', 'abab'], ['a'], 'abc abc abc cab']
+        vecs, lengths = vect.run_batch(batch, vect.vocab, dtype=np.int64)
+        gold, gold_lengths = _stacked_run(vect, batch, vect.vocab)
+        np.testing.assert_equal(vecs, gold)
+        np.testing.assert_equal(lengths, gold_lengths)
+    finally:
+        Offsets.INDICES.clear()
+        Offsets.INDICES.update(saved)
+
+
+def test_preproc_tlm_batches_match_line_by_line(tmp_path):
+    pytest.importorskip('regex')
+    from mead.api_examples.preproc_tlm import vectorize_batches
+    saved = dict(Offsets.INDICES)
+    try:
+        vect = _gpt2_vectorizer(tmp_path)
+        lines = [['abc', 'ab', 'c', '<EOS>'], ['bca', 'abab', '<EOS>'], ['a', '<EOS>'], ['cab'] * 5 + ['<EOS>']]
+        batched = [(vec[:available].tolist(), available) for vec, available in vectorize_batches(vect, lines, 3)]
+        assert len(batched) == len(lines)
+        for to_bpe, (values, available) in zip(lines, batched):
+            vect.mxlen = 4096
+            gold, gold_length = vect.run(to_bpe, vect.vocab)
+            assert available == gold_length
+            assert values == gold[:gold_length].tolist()
+    finally:
+        Offsets.INDICES.clear()
+        Offsets.INDICES.update(saved)
+
+
+def _reference_wordpiece(vocab, word, unk="[UNK]"):
+    """The original greedy longest match, probing the vocab with every shorter substring"""
+    start = 0
+    pieces = []
+    while start < len(word):
+        end = len(word)
+        piece = None
+        while start < end:
+            substr = word[start:end] if start == 0 else "##" + word[start:end]
+            if substr in vocab:
+                piece = substr
+                break
+            end -= 1
+        if piece is None:
+            return [unk]
+        pieces.append(piece)
+        start = end
+    return pieces
+
+
+def test_wordpiece_trie_matches_reference():
+    vocab = load_bert_vocab(os.path.join(TEST_DATA, "bert-base-uncased-vocab.txt"))
+    tokenizer = WordpieceTokenizer(vocab)
+    words = [random_string(min_=1, max_=15).lower() for _ in range(500)]
+    words += ["unaffable", "##ing", "#", "naïve", "☃"]
+    for word in words:
+        assert tokenizer.tokenize(word) == _reference_wordpiece(vocab, word)
+
+
+def test_wordpiece_cache_and_pickle():
+    import pickle
+    vocab = {"[UNK]": 0, "un": 1, "##aff": 2, "##able": 3, "a": 4, "##b": 5}
+    tokenizer = WordpieceTokenizer(vocab, cache_size=2)
+    assert tokenizer.tokenize("unaffable ab unaffable") == ["un", "##aff", "##able", "a", "##b", "un", "##aff", "##able"]
+    assert tokenizer.tokenize("abc") == ["[UNK]"]
+    stats = tokenizer.cache_stats
+    assert stats['hits'] == 1 and stats['misses'] == 3 and stats['size'] == 2
+    restored = pickle.loads(pickle.dumps(tokenizer))
+    assert restored.tokenize("unaffable") == ["un", "##aff", "##able"]
+    assert restored.cache_stats['size'] == 1